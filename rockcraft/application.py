@@ -16,13 +16,23 @@
 
 """Main Rockcraft Application."""
 
-from typing import Any
+import collections
+import os
+import subprocess
+import sys
+from concurrent import futures
+from pathlib import Path
+from typing import Any, cast
 
+import craft_cli
 from craft_application import Application, AppMetadata, util
+from craft_application.models import BuildInfo
+from craft_cli import emit
 from overrides import override  # type: ignore[reportUnknownVariableType]
 
-from rockcraft import models
+from rockcraft import errors, models, utils
 from rockcraft.models import project
+from rockcraft.services import RockcraftPackageService
 
 APP_METADATA = AppMetadata(
     name="rockcraft",
@@ -31,10 +41,92 @@ APP_METADATA = AppMetadata(
     source_ignore_patterns=["*.rock"],
 )
 
+# Set for the rockcraft processes that build single platforms in parallel.
+PLATFORM_WORKER_ENV = "ROCKCRAFT_PLATFORM_WORKER"
+
+# The options that only the process running the parallel builds handles, which
+# are not passed on to the workers, and whether they take a value.
+_COORDINATOR_OPTIONS = {
+    "--platform": True,
+    "--parallel-platforms": True,
+    "--oci-index": False,
+}
+
+# The number of lines at the end of a failed worker's log shown in the error.
+_LOG_TAIL_LINES = 10
+
 
 class Rockcraft(Application):
     """Rockcraft application definition."""
 
+    _dispatcher: craft_cli.Dispatcher | None = None
+
+    @override
+    def _get_dispatcher(self) -> craft_cli.Dispatcher:
+        # Keep the dispatcher, to get the command's arguments in run_managed().
+        self._dispatcher = super()._get_dispatcher()
+        return self._dispatcher
+
+    @override
+    def run_managed(self, platform: str | None, build_for: str | None) -> None:
+        """Run the application in managed instances, one per platform.
+
+        With ``pack --parallel-platforms``, several platforms are built at the
+        same time, each by a rockcraft process of its own in its own instance.
+        With ``pack --export docker-daemon``, the rocks of all the built
+        platforms are then loaded into the host's Docker daemon, and with
+        ``pack --oci-index``, packed into a single one.
+
+        ``SOURCE_DATE_EPOCH`` is passed on to the instances, for reproducible
+        builds.
+        """
+        parsed_args = self._dispatcher.parsed_args() if self._dispatcher else None
+        is_worker = bool(os.getenv(PLATFORM_WORKER_ENV))
+        build_plan = self._get_build_plan(platform, build_for)
+
+        source_date_epoch = utils.get_source_date_epoch()
+        if source_date_epoch is not None:
+            self.services.provider.environment[utils.SOURCE_DATE_EPOCH_ENV] = str(
+                source_date_epoch
+            )
+
+        jobs = getattr(parsed_args, "parallel_platforms", 1)
+        if jobs > 1 and len(build_plan) > 1 and not is_worker:
+            commands = {
+                info.platform: _get_worker_command(sys.argv, info.platform)
+                for info in build_plan
+            }
+            log_path = self.log_path or self._work_dir / f"{self.app.name}.log"
+            _run_in_parallel(commands, jobs, log_path=log_path)
+        else:
+            super().run_managed(platform, build_for)
+
+        if is_worker:
+            return
+        package_service = cast(RockcraftPackageService, self.services.package)
+        platforms = [info.platform for info in build_plan]
+        if getattr(parsed_args, "export", None) == "docker-daemon":
+            # The managed instances can't reach the daemon, so they only
+            # packed the rocks as Docker archives.
+            loaded = package_service.load_into_docker(platforms, self._work_dir)
+            emit.progress(f"Loaded {', '.join(loaded)} into Docker", permanent=True)
+        if getattr(parsed_args, "oci_index", False):
+            rock = package_service.pack_index(platforms, self._work_dir)
+            emit.progress(f"Packed {rock.name}", permanent=True)
+
+    def _get_build_plan(
+        self, platform: str | None, build_for: str | None
+    ) -> list[BuildInfo]:
+        """Get the builds that run_managed() runs on this host."""
+        host_arch = util.get_host_architecture()
+        return [
+            info
+            for info in self.get_project().get_build_plan()
+            if info.build_on == host_arch
+            and platform in (None, info.platform)
+            and build_for in (None, info.build_for)
+        ]
+
     @override
     def _extra_yaml_transform(self, yaml_data: dict[str, Any]) -> dict[str, Any]:
         return models.transform_yaml(self._work_dir, yaml_data)
@@ -44,10 +136,96 @@ class Rockcraft(Application):
         if build_for is None:
             build_for = util.get_host_architecture()
 
-        self.services.set_kwargs("image", work_dir=self._work_dir, build_for=build_for)
+        self.services.set_kwargs(
+            "image",
+            work_dir=self._work_dir,
+            cache_dir=self.cache_dir,
+            build_for=build_for,
+        )
         self.services.set_kwargs(
             "package",
             platform=platform,
             build_for=build_for,
         )
         super()._configure_services(platform, build_for)
+
+
+def _get_worker_command(argv: list[str], platform: str) -> list[str]:
+    """Get the command line of the rockcraft process building ``platform``.
+
+    It is the command line of this process, without the options that only
+    this process handles.
+
+    :param argv: The command line of this process, like ``sys.argv``.
+    """
+    args: list[str] = []
+    remaining = iter(argv[1:])
+    for arg in remaining:
+        option, has_value, _ = arg.partition("=")
+        if option not in _COORDINATOR_OPTIONS:
+            args.append(arg)
+        elif _COORDINATOR_OPTIONS[option] and not has_value:
+            # The value is the next argument, like in "--platform amd64".
+            next(remaining, None)
+    return [sys.executable, "-m", "rockcraft", *args, f"--platform={platform}"]
+
+
+def _run_in_parallel(
+    commands: dict[str, list[str]], jobs: int, *, log_path: Path
+) -> None:
+    """Build each platform in a rockcraft process of its own.
+
+    The output of each process goes to a log file of its own, next to
+    ``log_path``, as they would fight for the terminal otherwise.
+
+    :param commands: The command line of the process building each platform.
+    :param jobs: The maximum number of platforms to build at the same time.
+    :param log_path: The log file of this process.
+    """
+    emit.progress(f"Building {len(commands)} platforms, {jobs} at a time")
+    env = {**os.environ, PLATFORM_WORKER_ENV: "1"}
+
+    def run_worker(platform: str) -> tuple[int, Path]:
+        worker_log_path = log_path.with_name(
+            f"{log_path.stem}-{platform}{log_path.suffix}"
+        )
+        emit.debug(f"Building platform {platform}, logging to {worker_log_path}")
+        with worker_log_path.open("w", encoding="utf-8") as log_file:
+            result = subprocess.run(
+                commands[platform],
+                env=env,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                check=False,
+            )
+        return result.returncode, worker_log_path
+
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        builds = {
+            executor.submit(run_worker, platform): platform for platform in commands
+        }
+        failed: list[str] = []
+        details: list[str] = []
+        for build in futures.as_completed(builds):
+            platform = builds[build]
+            returncode, worker_log_path = build.result()
+            if returncode == 0:
+                emit.progress(f"Built platform {platform}", permanent=True)
+            else:
+                failed.append(platform)
+                tail = _read_tail(worker_log_path, _LOG_TAIL_LINES)
+                details.append(
+                    f"{platform} (full log: {worker_log_path}):\n{tail}".rstrip()
+                )
+
+    if failed:
+        raise errors.RockcraftError(
+            f"Failed to build platforms: {', '.join(sorted(failed))}",
+            details="\n\n".join(sorted(details)),
+        )
+
+
+def _read_tail(path: Path, lines: int) -> str:
+    """Read the last ``lines`` lines of a text file."""
+    with path.open(encoding="utf-8", errors="replace") as file:
+        return "".join(collections.deque(file, maxlen=lines))
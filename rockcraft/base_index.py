@@ -0,0 +1,283 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Index of the files in a base image, built without unpacking it."""
+
+import base64
+import dataclasses
+import hashlib
+import json
+import os
+import posixpath
+import stat
+import tarfile
+from pathlib import Path
+from typing import Literal
+
+from rockcraft import compression, oci_layout
+
+EntryType = Literal["file", "dir", "symlink", "other"]
+
+# The files whose contents are kept in the index, as rockcraft reads them.
+INLINE_FILES = ("etc/passwd", "etc/group", "etc/shadow")
+
+# Bump when the format of saved indexes changes.
+_INDEX_VERSION = 1
+
+_WHITEOUT_PREFIX = ".wh."
+_OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+
+@dataclasses.dataclass(frozen=True)
+class Entry:
+    """A file in the base image.
+
+    :param type: The type of file.
+    :param mode: The permission bits of the file.
+    :param uid: The id of the owner.
+    :param gid: The id of the group.
+    :param size: The size of regular files, or 0.
+    :param sha256: The hex digest of the contents of regular files.
+    :param linkname: The target of symlinks.
+    """
+
+    type: EntryType
+    mode: int
+    uid: int
+    gid: int
+    size: int = 0
+    sha256: str = ""
+    linkname: str = ""
+
+
+class BaseIndex:
+    """The paths in a base image, with their metadata.
+
+    This provides what rockcraft needs to know about the base (whether paths
+    exist, their types, symlink targets, ownership, permissions and content
+    hashes, and the contents of ``INLINE_FILES``) without unpacking it. Paths
+    are relative to the root of the image, e.g. ``etc/passwd``.
+
+    :param entries: The files in the image, by path.
+    :param contents: The contents of the ``INLINE_FILES`` in the image.
+    """
+
+    def __init__(
+        self, entries: dict[str, Entry], contents: dict[str, bytes] | None = None
+    ) -> None:
+        self.entries = entries
+        self.contents = contents or {}
+
+    @classmethod
+    def from_image(cls, layout: oci_layout.ImageLayout, tag: str) -> "BaseIndex":
+        """Index an image by streaming through its layers once.
+
+        :param layout: The layout containing the image.
+        :param tag: The tag of the image.
+        """
+        index = cls({})
+        manifest, _ = layout.read_image(tag)
+        for layer in manifest["layers"]:
+            path = layout.blob_path(layer["digest"])
+            with compression.open_layer(path, layer["mediaType"]) as stream:
+                with tarfile.open(fileobj=stream, mode="r|") as tar_file:
+                    index.add_layer(tar_file)
+        return index
+
+    @classmethod
+    def load(cls, path: Path) -> "BaseIndex | None":
+        """Load an index saved by ``save()``, if it exists and is compatible."""
+        try:
+            data = json.loads(path.read_bytes())
+        except FileNotFoundError:
+            return None
+        if data.get("version") != _INDEX_VERSION:
+            return None
+
+        entries = {name: Entry(*fields) for name, *fields in data["entries"]}
+        contents = {
+            name: base64.b64decode(content)
+            for name, content in data["contents"].items()
+        }
+        return cls(entries, contents)
+
+    def save(self, path: Path) -> None:
+        """Save the index to ``path``, atomically."""
+        data = {
+            "version": _INDEX_VERSION,
+            "entries": [
+                [name, *dataclasses.astuple(entry)]
+                for name, entry in sorted(self.entries.items())
+            ],
+            "contents": {
+                name: base64.b64encode(content).decode("ascii")
+                for name, content in self.contents.items()
+            },
+        }
+        temp_path = path.with_name(f".{path.name}.tmp-{os.getpid()}")
+        temp_path.write_text(json.dumps(data, separators=(",", ":")))
+        temp_path.replace(path)
+
+    def get(self, path: str | Path) -> Entry | None:
+        """Get the entry for ``path``, without following symlinks."""
+        return self.entries.get(_normalize(str(path)))
+
+    def is_file(self, path: str | Path) -> bool:
+        """Whether ``path`` is a regular file."""
+        entry = self.get(path)
+        return entry is not None and entry.type == "file"
+
+    def read_bytes(self, path: str | Path) -> bytes | None:
+        """Get the contents of one of the ``INLINE_FILES``, if it exists."""
+        return self.contents.get(_normalize(str(path)))
+
+    def readlink(self, path: str | Path) -> Path | None:
+        """Get the target of ``path`` if it's a symlink, or None otherwise."""
+        entry = self.get(path)
+        if entry is None or entry.type != "symlink":
+            return None
+        return Path(entry.linkname)
+
+    def listdir(self, path: str | Path) -> list[str]:
+        """Get the names of the entries in the directory ``path``."""
+        directory = _normalize(str(path))
+        return sorted(
+            posixpath.basename(name)
+            for name in self.entries
+            if posixpath.dirname(name) == directory and name
+        )
+
+    def file_matches(self, path: str | Path, other: Path) -> bool:
+        """Whether ``path`` is a regular file identical to the file ``other``.
+
+        Files are identical if they have the same contents, owner, group and
+        permission bits. Symlinks are never identical to files.
+
+        :param path: The path in the base image.
+        :param other: A path in the local filesystem.
+        """
+        entry = self.get(path)
+        if entry is None or entry.type != "file" or not other.is_file():
+            return False
+
+        other_stat = other.lstat()
+        if stat.S_ISLNK(other_stat.st_mode):
+            return False
+        if (entry.uid, entry.gid, entry.mode, entry.size) != (
+            other_stat.st_uid,
+            other_stat.st_gid,
+            stat.S_IMODE(other_stat.st_mode),
+            other_stat.st_size,
+        ):
+            return False
+
+        digest = hashlib.sha256()
+        with other.open("rb") as other_file:
+            for chunk in iter(lambda: other_file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest() == entry.sha256
+
+    def add_layer(self, tar_file: tarfile.TarFile) -> None:
+        """Apply the changes of a layer tarball, an OCI changeset, to the index."""
+        added: set[str] = set()
+        for member in tar_file:
+            name = _normalize(member.name)
+            dirname, basename = posixpath.split(name)
+
+            # Whiteouts only hide files from the lower layers.
+            if basename == _OPAQUE_WHITEOUT:
+                self._remove_tree(dirname, keep=added, include_root=False)
+                continue
+            if basename.startswith(_WHITEOUT_PREFIX):
+                hidden = posixpath.join(dirname, basename[len(_WHITEOUT_PREFIX) :])
+                self._remove_tree(hidden, keep=added, include_root=True)
+                continue
+
+            if self.get(name) is not None and not member.isdir():
+                # A file replaces whatever was there, e.g. a whole directory.
+                self._remove_tree(name, keep=added, include_root=True)
+            self._add_parents(name)
+            self.entries[name] = self._get_entry(tar_file, member)
+            added.add(name)
+
+    def _add_parents(self, name: str) -> None:
+        """Add the parent directories of ``name`` missing from the layers.
+
+        They are created when unpacking, owned by root and with default
+        permissions.
+        """
+        parent = posixpath.dirname(name)
+        while parent and parent not in self.entries:
+            self.entries[parent] = Entry("dir", 0o755, 0, 0)
+            parent = posixpath.dirname(parent)
+
+    def _get_entry(self, tar_file: tarfile.TarFile, member: tarfile.TarInfo) -> Entry:
+        name = _normalize(member.name)
+        mode = member.mode & 0o7777
+        if member.isdir():
+            return Entry("dir", mode, member.uid, member.gid)
+        if member.issym():
+            return Entry(
+                "symlink", mode, member.uid, member.gid, linkname=member.linkname
+            )
+        if member.islnk():
+            # Hardlinks share their contents with a file in the same layer.
+            target = self.get(member.linkname)
+            if target is not None:
+                self._copy_contents(_normalize(member.linkname), name)
+                return target
+        if not member.isreg():
+            return Entry("other", mode, member.uid, member.gid)
+
+        digest = hashlib.sha256()
+        content = bytearray()
+        file_obj = tar_file.extractfile(member)
+        if file_obj is not None:
+            for chunk in iter(lambda: file_obj.read(1024 * 1024), b""):
+                digest.update(chunk)
+                if name in INLINE_FILES:
+                    content += chunk
+        if name in INLINE_FILES:
+            self.contents[name] = bytes(content)
+        else:
+            self.contents.pop(name, None)
+
+        return Entry(
+            "file",
+            mode,
+            member.uid,
+            member.gid,
+            size=member.size,
+            sha256=digest.hexdigest(),
+        )
+
+    def _copy_contents(self, source: str, destination: str) -> None:
+        if destination in INLINE_FILES and source in self.contents:
+            self.contents[destination] = self.contents[source]
+
+    def _remove_tree(self, path: str, *, keep: set[str], include_root: bool) -> None:
+        """Remove ``path`` (if ``include_root``) and everything below it."""
+        prefix = f"{path}/" if path else ""
+        for name in list(self.entries):
+            below = name.startswith(prefix) and name != path
+            if (below or (include_root and name == path)) and name not in keep:
+                del self.entries[name]
+                self.contents.pop(name, None)
+
+
+def _normalize(name: str) -> str:
+    """Normalize a path in a tarball, or the image, to its ``a/b/c`` form."""
+    return posixpath.normpath(f"/{name}").lstrip("/")
@@ -16,13 +16,21 @@
 
 """Command-line application entry point."""
 
+import argparse
 import logging
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, cast
 
-from rockcraft import plugins
+from craft_application.commands import ExtensibleCommand, lifecycle
+
+from rockcraft import compression, errors, plugins
 
 from . import commands
-from .services import RockcraftServiceFactory
+from .services import (
+    RockcraftImageService,
+    RockcraftPackageService,
+    RockcraftServiceFactory,
+)
+from .services.package import EXPORT_FORMATS
 
 if TYPE_CHECKING:
     from .application import Rockcraft
@@ -60,6 +68,7 @@ def _create_app() -> "Rockcraft":
         "Other",
         [
             commands.InitCommand,
+            commands.PushCommand,
         ],
     )
     app.add_command_group(
@@ -71,4 +80,97 @@ def _create_app() -> "Rockcraft":
         ],
     )
 
+    lifecycle.LifecycleStepCommand.register_parser_filler(_fill_lifecycle_parser)
+    lifecycle.LifecycleStepCommand.register_prologue(_lifecycle_prologue)
+    lifecycle.PackCommand.register_parser_filler(_fill_pack_parser)
+    lifecycle.PackCommand.register_prologue(_pack_prologue)
+
     return app
+
+
+def _fill_lifecycle_parser(
+    cmd: ExtensibleCommand,  # pylint: disable=unused-argument
+    parser: argparse.ArgumentParser,
+) -> None:
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use the cached or mirrored base image, without network access",
+    )
+
+
+def _lifecycle_prologue(
+    cmd: ExtensibleCommand,
+    parsed_args: argparse.Namespace,
+    **kwargs: Any,  # pylint: disable=unused-argument
+) -> None:
+    # pylint: disable=protected-access
+    image_service = cast(RockcraftImageService, cmd._services.image)
+    image_service.offline = parsed_args.offline
+
+
+def _fill_pack_parser(
+    cmd: ExtensibleCommand,  # pylint: disable=unused-argument
+    parser: argparse.ArgumentParser,
+) -> None:
+    parser.add_argument(
+        "--compression",
+        choices=compression.LAYER_COMPRESSIONS,
+        default=None,
+        help="Compression algorithm for the rock's layers, overriding the project's",
+    )
+    parser.add_argument(
+        "--export",
+        choices=EXPORT_FORMATS,
+        default=None,
+        help=(
+            "Also make the rock a Docker archive (docker-archive), "
+            "or load it into the Docker daemon (docker-daemon)"
+        ),
+    )
+    parser.add_argument(
+        "--squash",
+        action="store_true",
+        help="Merge all the rock's layers, base ones included, into a single layer",
+    )
+    parser.add_argument(
+        "--parallel-platforms",
+        type=_positive_int,
+        default=1,
+        metavar="N",
+        help="Build up to N platforms at the same time, in separate instances",
+    )
+    parser.add_argument(
+        "--oci-index",
+        action="store_true",
+        help="Also pack the rocks of all the platforms into one, with an OCI index",
+    )
+
+
+def _positive_int(value: str) -> int:
+    """Parse a number of at least 1, like the number of parallel builds."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a positive integer")
+    return number
+
+
+def _pack_prologue(
+    cmd: ExtensibleCommand,
+    parsed_args: argparse.Namespace,
+    **kwargs: Any,  # pylint: disable=unused-argument
+) -> None:
+    if parsed_args.oci_index and parsed_args.destructive_mode:
+        raise errors.RockcraftError(
+            "Cannot pack an OCI index in destructive mode.",
+            resolution="Pack without --destructive-mode, to build each platform.",
+        )
+    # pylint: disable=protected-access
+    package_service = cast(RockcraftPackageService, cmd._services.package)
+    if parsed_args.compression:
+        package_service.compression = parsed_args.compression
+    package_service.export = parsed_args.export
+    package_service.squash = parsed_args.squash
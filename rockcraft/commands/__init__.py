@@ -22,10 +22,12 @@ from .extensions import (
     ListExtensionsCommand,
 )
 from .init import InitCommand
+from .push import PushCommand
 
 __all__ = [
     "InitCommand",
     "ExpandExtensionsCommand",
     "ExtensionsCommand",
     "ListExtensionsCommand",
+    "PushCommand",
 ]
@@ -0,0 +1,133 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pushing of rocks to image registries."""
+import os
+import textwrap
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from craft_application.commands import AppCommand
+from craft_cli import emit
+from overrides import overrides  # type: ignore[reportUnknownVariableType]
+from platformdirs import user_cache_path
+
+from rockcraft import errors, oci_layout, registry
+
+if TYPE_CHECKING:
+    import argparse
+
+# Environment variables with the credentials for the destination registry.
+USERNAME_ENV = "ROCKCRAFT_REGISTRY_USERNAME"
+PASSWORD_ENV = "ROCKCRAFT_REGISTRY_PASSWORD"  # noqa: S105
+
+# The names of Docker Hub in image references, and the host of its registry.
+DOCKER_HUB_HOSTS = ("docker.io", "index.docker.io")
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+
+
+def parse_destination(destination: str) -> tuple[str, str, str | None]:
+    """Split an image reference like ``ghcr.io/org/name:tag``.
+
+    A leading ``docker://``, as used by skopeo, is ignored. Like with the
+    Docker CLI, ``docker.io`` stands for the registry of Docker Hub, where
+    single-name repositories are in ``library``.
+
+    :returns: The registry host, the repository and the tag, if any.
+    """
+    reference = destination.removeprefix("docker://")
+    reference, _, digest = reference.partition("@")
+    if digest:
+        raise errors.RockcraftError(
+            f"Invalid destination {destination!r}",
+            details="Rocks are pushed by tag: their digest is set by their content.",
+            resolution="Push to a tag, like in 'ghcr.io/<repository>:<tag>'.",
+        )
+    host, _, name = reference.partition("/")
+    if not name or not ("." in host or ":" in host or host == "localhost"):
+        raise errors.RockcraftError(
+            f"Invalid destination {destination!r}",
+            resolution="Include the registry, like in 'ghcr.io/<repository>:<tag>'.",
+        )
+    repository, _, tag = name.partition(":")
+    if host in DOCKER_HUB_HOSTS:
+        host = DOCKER_HUB_REGISTRY
+        if "/" not in repository:
+            repository = f"library/{repository}"
+    return host, repository, tag or None
+
+
+class PushCommand(AppCommand):
+    """Push a rock to an image registry."""
+
+    name = "push"
+    help_msg = "Push a rock to an image registry"
+    overview = textwrap.dedent(
+        """
+        Push the image in a rock to a repository of an image registry, given as
+        <registry>/<repository>[:<tag>]. The tag defaults to the rock's version.
+
+        Blobs that the repository already has are skipped, and the ones that
+        another repository in the registry is known to have (like the layers of
+        a base image pulled from it, or of rocks pushed before) are mounted from
+        it. Only the remaining blobs are uploaded, several at a time, and the
+        manifest last of all.
+
+        The credentials for the registry, if needed, are taken from the
+        ROCKCRAFT_REGISTRY_USERNAME and ROCKCRAFT_REGISTRY_PASSWORD environment
+        variables.
+        """
+    )
+
+    @overrides
+    def fill_parser(self, parser: "argparse.ArgumentParser") -> None:
+        """Add the command's arguments."""
+        parser.add_argument("rock", type=Path, help="The rock file to push")
+        parser.add_argument(
+            "destination", help="The image to push to, like ghcr.io/org/name:tag"
+        )
+
+    @overrides
+    def run(self, parsed_args: "argparse.Namespace") -> None:
+        """Run the command."""
+        host, repository, tag = parse_destination(parsed_args.destination)
+        if not parsed_args.rock.is_file():
+            raise errors.RockcraftError(f"Rock {str(parsed_args.rock)!r} not found")
+        archive = oci_layout.ArchiveReader(parsed_args.rock)
+        descriptor = archive.get_descriptor()
+        if tag is None:
+            tag = descriptor.get("annotations", {}).get(oci_layout.ANNOTATION_REF_NAME)
+            if not tag:
+                raise errors.RockcraftError(
+                    f"{parsed_args.rock} has no tag",
+                    resolution="Set the tag in the destination.",
+                )
+
+        credentials = None
+        if os.getenv(USERNAME_ENV) and os.getenv(PASSWORD_ENV):
+            credentials = (os.environ[USERNAME_ENV], os.environ[PASSWORD_ENV])
+        client = registry.Registry.from_host(host, credentials=credentials)
+        blob_store = oci_layout.BlobStore(
+            user_cache_path(self._app.name, ensure_exists=True) / "oci"
+        )
+
+        digest = registry.push_image(
+            registry.RemoteImage(client, repository, tag),
+            archive,
+            descriptor,
+            blob_store=blob_store,
+        )
+        emit.message(f"Pushed {parsed_args.rock} to {host}/{repository}:{tag}@{digest}")
@@ -0,0 +1,669 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compression of layer tarballs into OCI layer blobs, and back."""
+
+import collections
+import contextlib
+import gzip
+import hashlib
+import io
+import os
+import struct
+import subprocess
+import tempfile
+import threading
+import zlib
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, Literal, Protocol, cast
+
+from craft_cli import emit
+
+from rockcraft import errors
+from rockcraft.utils import get_snap_command_path, get_source_date_epoch
+
+if TYPE_CHECKING:
+    from _typeshed import ReadableBuffer
+
+MEDIA_TYPE_LAYER = "application/vnd.oci.image.layer.v1.tar"
+MEDIA_TYPE_LAYER_GZIP = "application/vnd.oci.image.layer.v1.tar+gzip"
+MEDIA_TYPE_LAYER_ZSTD = "application/vnd.oci.image.layer.v1.tar+zstd"
+
+LayerCompression = Literal["gzip", "zstd", "none"]
+"""The supported layer compression algorithms."""
+
+LAYER_COMPRESSIONS: tuple[LayerCompression, ...] = ("gzip", "zstd", "none")
+
+# gzip is understood by every container runtime, so it stays the default.
+DEFAULT_LAYER_COMPRESSION: LayerCompression = "gzip"
+
+# Same default level used by umoci (and Go's compress/gzip).
+GZIP_COMPRESSION_LEVEL = 6
+
+# The default level of the zstd tool, which already compresses better and
+# faster than gzip -6.
+ZSTD_COMPRESSION_LEVEL = 3
+
+# Environment variable to override the number of compression threads.
+COMPRESSION_THREADS_ENV = "ROCKCRAFT_COMPRESSION_THREADS"
+
+# Size of the chunks compressed independently by the parallel gzip writer.
+PARALLEL_GZIP_BLOCK_SIZE = 512 * 1024
+
+# Files smaller than this are compressed along with the data around them,
+# instead of as fragments of their own (see ``FragmentCache``).
+FRAGMENT_MIN_SIZE = 1024 * 1024
+
+# The size over which the least recently used fragments are evicted from a
+# ``FragmentCache``.
+FRAGMENT_CACHE_MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+# The maximum distance of a deflate back-reference.
+_DEFLATE_WINDOW_SIZE = 32 * 1024
+
+# The header of a gzip member without file name nor modification time, as
+# written by zlib: magic, "deflate" method, no flags, mtime 0, no extra flags
+# and "Unix" as the OS.
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03"
+
+
+class Sink(Protocol):
+    """The destination of a compressed layer, usually a blob writer.
+
+    Sinks that also have a ``write_file(path)`` method are given the cached
+    fragments spliced into layers (see ``ParallelGzipLayerWriter``) as files,
+    instead of their data.
+    """
+
+    def write(self, data: bytes, /) -> int:
+        """Write ``data`` to the destination."""
+
+
+class FragmentCache:
+    """A cache of the compressed tar members of large files, to splice into layers.
+
+    A fragment is the deflated data of a tar member (its header, the file's
+    content and the padding), compressed without referring to the data before
+    it. Fragments are stored by the sha256 of their uncompressed data, along
+    with the digest that each file produced the last time, keyed by the file's
+    identity, so that unchanged files need not be hashed beforehand.
+
+    :param path: The root directory of the cache.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def fragment_path(self, variant: str, digest: str) -> Path:
+        """Get the path of a fragment.
+
+        :param variant: How the fragment is compressed.
+        :param digest: The sha256 hex digest of the fragment's uncompressed data.
+        """
+        return self.path / "fragments" / variant / digest
+
+    def open_fragment(self, variant: str) -> IO[bytes]:
+        """Open a temporary file to write a new fragment into."""
+        fragments_dir = self.path / "fragments" / variant
+        fragments_dir.mkdir(parents=True, exist_ok=True)
+        return tempfile.NamedTemporaryFile(  # pylint: disable=consider-using-with
+            prefix=".tmp-fragment.", dir=fragments_dir, delete=False
+        )
+
+    def store_fragment(self, file: IO[bytes], variant: str, digest: str) -> None:
+        """Store a fragment written into a file from ``open_fragment()``."""
+        file.close()
+        os.replace(file.name, self.fragment_path(variant, digest))
+
+    def mark_used(self, fragment: Path) -> None:
+        """Record that a fragment was used, so that pruning keeps it longer."""
+        fragment.touch()
+
+    def prune(self, max_size: int = FRAGMENT_CACHE_MAX_SIZE) -> list[Path]:
+        """Remove the least recently used fragments, down to ``max_size`` bytes.
+
+        :returns: The paths of the removed fragments.
+        """
+        fragments: list[tuple[float, int, Path]] = []
+        for fragment in (self.path / "fragments").glob("*/*"):
+            if fragment.name.startswith(".tmp-"):
+                continue
+            try:
+                stat = fragment.stat()
+            except FileNotFoundError:
+                continue
+            fragments.append((stat.st_mtime, stat.st_size, fragment))
+
+        total_size = sum(size for _, size, _ in fragments)
+        removed: list[Path] = []
+        for _, size, fragment in sorted(fragments):
+            if total_size <= max_size:
+                break
+            fragment.unlink(missing_ok=True)
+            total_size -= size
+            removed.append(fragment)
+        return removed
+
+    def discard_fragment(self, file: IO[bytes]) -> None:
+        """Discard a fragment written into a file from ``open_fragment()``."""
+        file.close()
+        Path(file.name).unlink(missing_ok=True)
+
+    def get_member_digest(self, identity: str) -> str | None:
+        """Get the digest of the tar member last created from a file, if known.
+
+        :param identity: The identity of the file, like its header and stat.
+        """
+        try:
+            return self._member_record(identity).read_text()
+        except FileNotFoundError:
+            return None
+
+    def set_member_digest(self, identity: str, digest: str) -> None:
+        """Record the digest of the tar member created from a file."""
+        record = self._member_record(identity)
+        record.parent.mkdir(parents=True, exist_ok=True)
+        temp_record = record.with_name(f".tmp-{record.name}.{os.getpid()}")
+        temp_record.write_text(digest)
+        os.replace(temp_record, record)
+
+    def forget_member_digest(self, identity: str) -> None:
+        """Forget the digest of the tar member created from a file."""
+        self._member_record(identity).unlink(missing_ok=True)
+
+    def _member_record(self, identity: str) -> Path:
+        key = hashlib.sha256(identity.encode("utf-8", "surrogateescape")).hexdigest()
+        return self.path / "members" / key
+
+
+class LayerWriter(io.BufferedIOBase):
+    """Base class for writable streams that turn a layer tarball into a blob.
+
+    Data written to this stream is the uncompressed layer: its sha256 is the
+    layer's ``diff_id``, while the compressed output is fed to ``sink``. The
+    layer is thus hashed, compressed and stored in a single pass. Once all the
+    data is written, ``finish()`` must be called to flush the compressed stream.
+
+    :param sink: The destination of the compressed stream.
+    """
+
+    media_type: str
+
+    def __init__(self, sink: Sink) -> None:
+        super().__init__()
+        self._sink = sink
+        self._diff_hash = hashlib.sha256()
+        self._position = 0
+
+    def writable(self) -> bool:
+        """Layer writers are write-only streams."""
+        return True
+
+    def write(self, data: "ReadableBuffer") -> int:
+        """Write uncompressed layer data."""
+        self._diff_hash.update(data)
+        self._compress(data)
+        size = memoryview(data).nbytes
+        self._position += size
+        return size
+
+    def tell(self) -> int:
+        """Get the amount of uncompressed data written so far."""
+        return self._position
+
+    @property
+    def diff_id(self) -> str:
+        """The digest of the uncompressed data, in ``sha256:<hex>`` form."""
+        return f"sha256:{self._diff_hash.hexdigest()}"
+
+    def finish(self) -> None:
+        """Flush the compressor, leaving the blob ready to be committed."""
+
+    def _compress(self, data: "ReadableBuffer") -> None:
+        """Compress ``data`` and write the result to the sink."""
+        raise NotImplementedError
+
+
+class UncompressedLayerWriter(LayerWriter):
+    """Store a layer as it is, for consumers that would only decompress it."""
+
+    media_type = MEDIA_TYPE_LAYER
+
+    def _compress(self, data: "ReadableBuffer") -> None:
+        self._sink.write(bytes(data))
+
+
+class GzipLayerWriter(LayerWriter):
+    """Compress a layer with gzip, in the calling thread."""
+
+    media_type = MEDIA_TYPE_LAYER_GZIP
+
+    def __init__(self, sink: Sink) -> None:
+        super().__init__(sink)
+        # wbits=31 produces a gzip stream (with header and trailer)
+        self._compressor = zlib.compressobj(GZIP_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def _compress(self, data: "ReadableBuffer") -> None:
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self._sink.write(compressed)
+
+    def finish(self) -> None:
+        """Flush the compressor, leaving the blob ready to be committed."""
+        self._sink.write(self._compressor.flush())
+
+
+class ParallelGzipLayerWriter(LayerWriter):
+    """Compress a layer with gzip, using multiple threads.
+
+    Like pigz, the input is split in blocks that are deflated concurrently
+    (zlib releases the GIL while compressing), each one primed with the last
+    32 KiB of the previous block so that the compression ratio is barely
+    affected. Blocks end on a byte boundary thanks to a sync flush, so their
+    concatenation is a single valid deflate stream, wrapped in one gzip member.
+
+    Parts of the layer can also be compressed as fragments, whose first block
+    is not primed with the data before it: their compressed form is the same
+    wherever they are in a layer, so it is kept in a ``FragmentCache`` and
+    spliced into the following layers with the same data, instead of
+    compressing it again. See ``begin_fragment()``.
+
+    :param sink: The destination of the compressed stream.
+    :param threads: The number of compression threads.
+    :param block_size: The size of each independently compressed block.
+    """
+
+    media_type = MEDIA_TYPE_LAYER_GZIP
+
+    def __init__(
+        self, sink: Sink, *, threads: int, block_size: int = PARALLEL_GZIP_BLOCK_SIZE
+    ) -> None:
+        super().__init__(sink)
+        self._threads = threads
+        self._block_size = block_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="rockcraft-gzip"
+        )
+        # Each block is also copied to the file of the fragment it belongs to.
+        self._pending: collections.deque[
+            tuple[Future[bytes], IO[bytes] | None]
+        ] = collections.deque()
+        self._buffer = bytearray()
+        self._dictionary = b""
+        self._crc = 0
+        self._size = 0
+        self._fragment_cache: FragmentCache | None = None
+        self._fragment_hash = hashlib.sha256()
+        self._fragment_file: IO[bytes] | None = None
+        self._spliced_fragment: Path | None = None
+        # How to read the data of a fragment to splice again, if it does not match.
+        self._reread: Callable[[], Iterable[bytes]] | None = None
+        self._sink.write(_GZIP_HEADER)
+
+    @property
+    def fragment_variant(self) -> str:
+        """How this writer compresses fragments, which must match to splice them."""
+        return f"gzip-{GZIP_COMPRESSION_LEVEL}-{self._block_size}"
+
+    def begin_fragment(
+        self,
+        cache: FragmentCache,
+        digest: str | None = None,
+        reread: Callable[[], Iterable[bytes]] | None = None,
+    ) -> None:
+        """Start compressing the data written next as a fragment.
+
+        If ``digest`` is known, ``cache`` has its fragment and the data can be
+        read again with ``reread``, the data is only hashed, and the cached
+        fragment is written in its place when calling ``end_fragment()``.
+        Otherwise the data is compressed as usual, and also stored in the cache.
+
+        :param cache: The cache to get the fragment from, or to store it into.
+        :param digest: The sha256 hex digest that the fragment's data should
+            have, if known.
+        :param reread: A function reading the fragment's data again, in chunks,
+            to compress it after all if it does not match the digest.
+        """
+        if self._fragment_cache is not None:
+            raise errors.RockcraftError("Layer fragments cannot be nested")
+        self._end_block()
+        self._fragment_cache = cache
+        self._fragment_hash = hashlib.sha256()
+        if digest is not None and reread is not None:
+            cached = cache.fragment_path(self.fragment_variant, digest)
+            if cached.is_file():
+                self._spliced_fragment = cached
+                self._reread = reread
+                return
+        self._fragment_file = cache.open_fragment(self.fragment_variant)
+
+    def end_fragment(self) -> str:
+        """End the fragment started with ``begin_fragment()``.
+
+        If the data of a fragment to splice does not match the digest given to
+        ``begin_fragment()``, like for a file changed without changing its
+        metadata, it is read again, compressed and cached as a new fragment
+        instead.
+
+        :returns: The sha256 hex digest of the fragment's data.
+        """
+        cache = self._fragment_cache
+        if cache is None:
+            raise errors.RockcraftError("No layer fragment to end")
+        self._end_block()
+        self._write_pending(0)
+        digest = self._fragment_hash.hexdigest()
+
+        if self._spliced_fragment is not None and self._reread is not None:
+            if self._spliced_fragment.name == digest:
+                self._splice(self._spliced_fragment)
+                cache.mark_used(self._spliced_fragment)
+            else:
+                emit.debug(
+                    f"Fragment {self._spliced_fragment.name} changed, compressing it"
+                )
+                self._compress_again(cache, self._reread, digest)
+        if self._fragment_file is not None:
+            cache.store_fragment(self._fragment_file, self.fragment_variant, digest)
+
+        self._fragment_cache = None
+        self._fragment_file = None
+        self._spliced_fragment = None
+        self._reread = None
+        return digest
+
+    def _compress_again(
+        self,
+        cache: FragmentCache,
+        reread: Callable[[], Iterable[bytes]],
+        digest: str,
+    ) -> None:
+        """Compress the data that was only hashed, reading it again, as a new fragment.
+
+        :param digest: The sha256 hex digest of the data when it was hashed,
+            which it must still have.
+        """
+        self._spliced_fragment = None
+        self._fragment_file = cache.open_fragment(self.fragment_variant)
+        data_hash = hashlib.sha256()
+        for chunk in reread():
+            data_hash.update(chunk)
+            self._buffer += chunk
+            while len(self._buffer) >= self._block_size:
+                self._submit_buffered_block()
+        if data_hash.hexdigest() != digest:
+            raise errors.RockcraftError("Layer data changed while compressing it")
+        self._end_block()
+        self._write_pending(0)
+
+    def _compress(self, data: "ReadableBuffer") -> None:
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += memoryview(data).nbytes
+        if self._fragment_cache is not None:
+            self._fragment_hash.update(data)
+            if self._spliced_fragment is not None:
+                return
+
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit_buffered_block()
+
+    def _submit_buffered_block(self) -> None:
+        block = bytes(self._buffer[: self._block_size])
+        del self._buffer[: self._block_size]
+        self._submit(block, last=False)
+
+    def _submit(self, block: bytes, *, last: bool) -> None:
+        self._pending.append(
+            (
+                self._executor.submit(
+                    _deflate_block, block, self._dictionary, last=last
+                ),
+                self._fragment_file,
+            )
+        )
+        self._dictionary = block[-_DEFLATE_WINDOW_SIZE:]
+
+        # Bound the memory used by blocks waiting to be compressed or written.
+        self._write_pending(2 * self._threads)
+
+    def _end_block(self) -> None:
+        """Compress the buffered data, so that what follows starts a new block."""
+        if self._buffer:
+            self._submit(bytes(self._buffer), last=False)
+            self._buffer.clear()
+        self._dictionary = b""
+
+    def _write_pending(self, limit: int) -> None:
+        """Write compressed blocks until no more than ``limit`` are pending."""
+        while len(self._pending) > limit:
+            future, fragment_file = self._pending.popleft()
+            compressed = future.result()
+            self._sink.write(compressed)
+            if fragment_file is not None:
+                fragment_file.write(compressed)
+
+    def _splice(self, fragment: Path) -> None:
+        write_file = getattr(self._sink, "write_file", None)
+        if write_file is not None:
+            write_file(fragment)
+            return
+        with fragment.open("rb") as file:
+            while chunk := file.read(io.DEFAULT_BUFFER_SIZE * 8):
+                self._sink.write(chunk)
+
+    def finish(self) -> None:
+        """Compress the remaining data and write the gzip trailer."""
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        self._write_pending(0)
+        self._sink.write(struct.pack("<II", self._crc, self._size & 0xFFFFFFFF))
+        self._executor.shutdown()
+
+    def close(self) -> None:
+        """Stop the compression threads, discarding any pending work."""
+        self._executor.shutdown(cancel_futures=True)
+        if self._fragment_cache is not None and self._fragment_file is not None:
+            self._fragment_cache.discard_fragment(self._fragment_file)
+        self._fragment_cache = None
+        self._fragment_file = None
+        self._spliced_fragment = None
+        self._reread = None
+        super().close()
+
+
+class ZstdLayerWriter(LayerWriter):
+    """Compress a layer with zstd, through the ``zstd`` tool.
+
+    The uncompressed data is piped into a ``zstd`` process (which can use
+    multiple threads on its own) while a helper thread copies the compressed
+    output into the sink.
+
+    :param sink: The destination of the compressed stream.
+    :param threads: The number of compression threads used by ``zstd``.
+    :param level: The zstd compression level.
+    """
+
+    media_type = MEDIA_TYPE_LAYER_ZSTD
+
+    def __init__(
+        self, sink: Sink, *, threads: int = 1, level: int = ZSTD_COMPRESSION_LEVEL
+    ) -> None:
+        super().__init__(sink)
+        self._process = subprocess.Popen(  # pylint: disable=consider-using-with
+            [
+                get_snap_command_path("zstd"),
+                "--quiet",
+                "--no-progress",
+                "--stdout",
+                f"-{level}",
+                f"--threads={threads}",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self._stdin = cast(IO[bytes], self._process.stdin)
+        self._stdout = cast(IO[bytes], self._process.stdout)
+        self._error: BaseException | None = None
+        self._reader = threading.Thread(
+            target=self._copy_output, name="rockcraft-zstd", daemon=True
+        )
+        self._reader.start()
+
+    def _copy_output(self) -> None:
+        # pylint: disable=broad-exception-caught
+        try:
+            while chunk := self._stdout.read(io.DEFAULT_BUFFER_SIZE * 8):
+                self._sink.write(chunk)
+        except BaseException as err:  # noqa: BLE001
+            # Make zstd fail on its next write so that the writer notices.
+            self._error = err
+            self._stdout.close()
+
+    def _compress(self, data: "ReadableBuffer") -> None:
+        try:
+            self._stdin.write(data)
+        except BrokenPipeError as err:
+            self._raise_error(err)
+
+    def finish(self) -> None:
+        """Wait for zstd to compress the remaining data."""
+        try:
+            self._stdin.close()
+        except BrokenPipeError as err:
+            self._raise_error(err)
+        self._reader.join()
+        returncode = self._process.wait()
+        if self._error is not None or returncode != 0:
+            self._raise_error(None)
+
+    def _raise_error(self, cause: BaseException | None) -> None:
+        self._reader.join()
+        if self._error is not None:
+            raise self._error
+        raise errors.RockcraftError(
+            f"Failed to compress layer with zstd (exit code {self._process.wait()})"
+        ) from cause
+
+    def close(self) -> None:
+        """Stop the zstd process, discarding any pending output."""
+        if self._process.poll() is None:
+            self._process.kill()
+        self._reader.join()
+        self._process.wait()
+        self._stdin.close()
+        self._stdout.close()
+        super().close()
+
+
+def _deflate_block(block: bytes, dictionary: bytes, *, last: bool) -> bytes:
+    """Deflate ``block`` as a fragment of a larger raw deflate stream."""
+    if dictionary:
+        compressor = zlib.compressobj(
+            GZIP_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary
+        )
+    else:
+        compressor = zlib.compressobj(
+            GZIP_COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS
+        )
+    compressed = compressor.compress(block)
+    return compressed + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def get_compression_threads() -> int:
+    """Get the number of threads to use when compressing layers.
+
+    Defaults to the number of CPUs available to the process, and can be
+    overridden with the ``ROCKCRAFT_COMPRESSION_THREADS`` environment variable.
+    """
+    value = os.getenv(COMPRESSION_THREADS_ENV)
+    if value is None:
+        return len(os.sched_getaffinity(0))
+
+    try:
+        threads = int(value)
+    except ValueError:
+        threads = 0
+    if threads < 1:
+        raise errors.RockcraftError(
+            f"Invalid value for {COMPRESSION_THREADS_ENV}: {value!r}",
+            resolution="Set it to a positive number of threads.",
+        )
+    return threads
+
+
+def get_layer_writer(
+    sink: Sink,
+    *,
+    compression: LayerCompression = DEFAULT_LAYER_COMPRESSION,
+    threads: int | None = None,
+    fragmented: bool = False,
+) -> LayerWriter:
+    """Get the writer to compress a layer into ``sink``.
+
+    :param sink: The destination of the compressed stream.
+    :param compression: The compression algorithm of the layer.
+    :param threads: The number of compression threads; if not set, it is
+        obtained through ``get_compression_threads()``.
+    :param fragmented: Whether to prefer a writer that can compress parts of
+        the layer as cached fragments, if the compression allows it.
+    """
+    if threads is None:
+        threads = get_compression_threads()
+
+    if compression == "none":
+        return UncompressedLayerWriter(sink)
+    if compression == "zstd":
+        return ZstdLayerWriter(sink, threads=threads)
+    if compression != "gzip":
+        raise errors.RockcraftError(f"Unsupported layer compression {compression!r}")
+    # The parallel writer's output does not depend on the number of threads,
+    # so reproducible builds always use it.
+    if threads > 1 or fragmented or get_source_date_epoch() is not None:
+        return ParallelGzipLayerWriter(sink, threads=threads)
+    return GzipLayerWriter(sink)
+
+
+@contextlib.contextmanager
+def open_layer(path: Path, media_type: str) -> Iterator[IO[bytes]]:
+    """Open a layer blob for reading its uncompressed tarball.
+
+    :param path: The path to the layer blob.
+    :param media_type: The media type of the layer, which tells its compression.
+    """
+    if media_type.endswith("+zstd"):
+        with subprocess.Popen(
+            [get_snap_command_path("zstd"), "--decompress", "--stdout", str(path)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        ) as process:
+            yield cast(IO[bytes], process.stdout)
+            # Let the tool finish, in case the reader stopped before the end.
+            _, stderr = process.communicate()
+        if process.returncode != 0:
+            raise errors.RockcraftError(
+                f"Failed to decompress layer {path.name}",
+                details=stderr.decode(errors="replace").strip(),
+            )
+    elif media_type.endswith(("+gzip", ".gzip")):
+        # Docker's own layer media type ends with "tar.gzip".
+        with gzip.open(path, "rb") as stream:
+            yield cast(IO[bytes], stream)
+    else:
+        with path.open("rb") as stream:
+            yield stream
@@ -0,0 +1,140 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Minimal client for loading images into the Docker daemon."""
+
+import http.client
+import json
+import os
+import socket
+from collections.abc import Callable
+from http import HTTPStatus
+from pathlib import Path
+from typing import IO
+
+from rockcraft import errors, oci_layout
+
+DEFAULT_SOCKET = Path("/var/run/docker.sock")
+
+
+class DockerDaemon:
+    """The Docker daemon, accessed through the Docker Engine API.
+
+    :param socket_path: The path to the unix socket of the daemon.
+    """
+
+    def __init__(self, socket_path: Path) -> None:
+        self.socket_path = socket_path
+
+    @classmethod
+    def from_environment(cls) -> "DockerDaemon":
+        """Get the daemon that ``DOCKER_HOST`` points to, or the default one."""
+        host = os.getenv("DOCKER_HOST")
+        if not host:
+            return cls(DEFAULT_SOCKET)
+        if not host.startswith("unix://"):
+            raise errors.DockerError(
+                f"Unsupported DOCKER_HOST {host!r}",
+                resolution="Point DOCKER_HOST to the daemon's unix socket.",
+            )
+        return cls(Path(host[len("unix://") :]))
+
+    def load(self, archive: oci_layout.Archive) -> list[str]:
+        """Load the images in a Docker archive, streaming it to the daemon.
+
+        :returns: The names of the loaded images.
+        """
+        return self._load(archive.size, archive.write_to)
+
+    def load_file(self, path: Path) -> list[str]:
+        """Load the images in a Docker archive file, like ``docker load``.
+
+        :returns: The names of the loaded images.
+        """
+        with path.open("rb") as archive_file:
+            size = os.fstat(archive_file.fileno()).st_size
+
+            def write(request: IO[bytes]) -> None:
+                request.flush()
+                oci_layout.copy_file_data(archive_file.fileno(), request.fileno(), size)
+
+            return self._load(size, write)
+
+    def _load(self, size: int, write: Callable[[IO[bytes]], None]) -> list[str]:
+        connection = _UnixHTTPConnection(self.socket_path)
+        try:
+            connection.putrequest("POST", "/images/load")
+            connection.putheader("Content-Type", "application/x-tar")
+            connection.putheader("Content-Length", str(size))
+            connection.endheaders()
+            with connection.sock.makefile("wb") as request:
+                write(request)
+            response = connection.getresponse()
+            body = response.read().decode(errors="replace")
+        except OSError as err:
+            raise errors.DockerError(
+                f"Failed to load image into the Docker daemon at {self.socket_path}",
+                details=str(err),
+            ) from err
+        finally:
+            connection.close()
+
+        if response.status != HTTPStatus.OK:
+            raise errors.DockerError(
+                "The Docker daemon failed to load the image",
+                details=f"The daemon replied: {response.status} {body.strip()}",
+            )
+        return _parse_load_messages(body)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection over a unix socket."""
+
+    def __init__(self, socket_path: Path) -> None:
+        super().__init__("localhost")
+        self._socket_path = socket_path
+
+    def connect(self) -> None:
+        """Connect to the unix socket, in blocking mode for sendfile()."""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(str(self._socket_path))
+
+
+def _parse_load_messages(body: str) -> list[str]:
+    """Get the names of the loaded images from the daemon's JSON messages."""
+    loaded: list[str] = []
+    decoder = json.JSONDecoder()
+    position = 0
+    while position < len(body):
+        if body[position].isspace():
+            position += 1
+            continue
+        try:
+            message, position = decoder.raw_decode(body, position)
+        except json.JSONDecodeError as err:
+            raise errors.DockerError(
+                "Unexpected reply from the Docker daemon", details=body
+            ) from err
+        if "error" in message:
+            raise errors.DockerError(
+                "The Docker daemon failed to load the image",
+                details=str(message["error"]),
+            )
+        stream = str(message.get("stream", "")).strip()
+        for prefix in ("Loaded image: ", "Loaded image ID: "):
+            if stream.startswith(prefix):
+                loaded.append(stream[len(prefix) :])
+    return loaded
@@ -49,3 +49,11 @@ class LayerArchivingError(RockcraftError):
 
 class ExtensionError(RockcraftError):
     """Error related to extension handling."""
+
+
+class RegistryError(RockcraftError):
+    """Error when communicating with an image registry."""
+
+
+class DockerError(RockcraftError):
+    """Error when communicating with the Docker daemon."""
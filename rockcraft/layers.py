@@ -15,10 +15,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Handling of files and directories for rocks image layers."""
+import collections
+import copy
+import dataclasses
+import errno
+import fnmatch
+import functools
+import hashlib
+import io
 import os
+import posixpath
 import tarfile
 from collections import defaultdict
+from collections.abc import Callable, Collection, Iterator, Mapping, Sequence
+from contextlib import AbstractContextManager
 from pathlib import Path
+from stat import S_ISREG
+from typing import IO, cast
 
 from craft_cli import emit
 from craft_parts.executor.collisions import paths_collide
@@ -26,67 +39,677 @@ from craft_parts.overlays import overlays
 from craft_parts.permissions import Permissions
 
 from rockcraft import errors
+from rockcraft.base_index import BaseIndex
+from rockcraft.compression import (
+    FRAGMENT_MIN_SIZE,
+    FragmentCache,
+    ParallelGzipLayerWriter,
+)
+from rockcraft.utils import get_source_date_epoch
+
+# Bumped when layer tarballs change for the same files, to invalidate the
+# fingerprints of the layers created before.
+_LAYER_FORMAT_VERSION = 2
+
+
+@dataclasses.dataclass(frozen=True)
+class LayerFragments:
+    """How to splice the large files of a layer from the layers created before.
+
+    :param cache: The cache of compressed tar members.
+    :param hash_contents: Whether to hash large files before archiving them,
+        to look up their fragments, instead of trusting that files with the
+        same metadata as before have the same content.
+    """
+
+    cache: FragmentCache
+    hash_contents: bool = False
 
 
 def archive_layer(
     new_layer_dir: Path,
-    temp_tar_file: Path,
-    base_layer_dir: Path | None = None,
+    output: Path | io.BufferedIOBase,
+    base_layer: Path | BaseIndex | None = None,
+    *,
+    paths: Collection[str] | None = None,
+    fragments: LayerFragments | None = None,
 ) -> None:
     """Prepare new OCI layer by archiving its content into tar file.
 
     :param new_layer_dir: path to the content to be archived into a layer.
-    :param temp_tar_file: path to the temporary tar file holding the archived content.
-    :param base_layer_dir: optional path to the filesystem containing the extracted
-        base below this new layer. Used to preserve lower-level directory symlinks,
-        like the ones from Debian/Ubuntu's usrmerge.
+    :param output: path to the tar file to hold the archived content, or a
+        writable binary stream to which the uncompressed tarball is streamed.
+    :param base_layer: optional base below this new layer: the path to the
+        filesystem containing it extracted, or an index of it. Used to preserve
+        lower-level directory symlinks, like the ones from Debian/Ubuntu's usrmerge.
+    :param paths: optional paths, relative to ``new_layer_dir``, to archive
+        instead of all its content. Their parent directories are archived too.
+    :param fragments: optional cache of compressed tar members, used if
+        ``output`` supports them: large files that were archived before are
+        then spliced from the cache instead of being compressed again.
+
+    If ``SOURCE_DATE_EPOCH`` is set, the tarball is made reproducible: see
+    ``_reproducible_filter()``. The ``fragments`` are not used then, as they
+    change where the compressed blocks end, and so the bytes of the layer.
     """
-    candidates = _gather_layer_paths(new_layer_dir, base_layer_dir)
-    layer_paths = _merge_layer_paths(candidates)
-
-    with tarfile.open(temp_tar_file, mode="w") as tar_file:
+    layer_paths = _get_layer_paths(new_layer_dir, base_layer, paths)
+
+    source_date_epoch = get_source_date_epoch()
+    tar_filter = (
+        None if source_date_epoch is None else _reproducible_filter(source_date_epoch)
+    )
+
+    fragment_writer = None
+    if isinstance(output, Path):
+        tar_file = tarfile.open(output, mode="w")
+    elif (
+        fragments is not None
+        and source_date_epoch is None
+        and isinstance(output, ParallelGzipLayerWriter)
+    ):
+        # Unbuffered, so that each member is written between the fragment calls.
+        fragment_writer = output
+        tar_file = tarfile.open(fileobj=output, mode="w")
+    else:
+        # Stream mode: the stream is only ever written to, never seeked.
+        tar_file = tarfile.open(fileobj=output, mode="w|")
+
+    with tar_file:
         # Iterate on sorted keys, so that the directories are always listed before
         # any files that they contain (otherwise tools like Docker might choke on
         # the layer tarball).
         for arcname in sorted(layer_paths):
             filepath = layer_paths[arcname]
             emit.debug(f"Adding to layer: {filepath} as '{arcname}'")
-            tar_file.add(filepath, arcname=arcname, recursive=False)
+            if _is_sparse_file(filepath):
+                _add_sparse_file(tar_file, filepath, arcname, tar_filter)
+            elif (
+                fragment_writer is not None
+                and fragments is not None
+                and _is_large_file(filepath)
+            ):
+                info = tar_file.gettarinfo(filepath, arcname)
+                if tar_filter is not None:
+                    info = tar_filter(info)
+                _add_fragment(tar_file, fragment_writer, fragments, filepath, info)
+            else:
+                tar_file.add(
+                    filepath, arcname=arcname, recursive=False, filter=tar_filter
+                )
+
+
+def _is_sparse_file(path: Path) -> bool:
+    """Whether ``path`` is a regular file that takes less space than its size."""
+    stat = path.lstat()
+    return S_ISREG(stat.st_mode) and stat.st_blocks * 512 < stat.st_size
+
+
+def _add_sparse_file(
+    tar_file: tarfile.TarFile,
+    filepath: Path,
+    arcname: str,
+    tar_filter: Callable[[tarfile.TarInfo], tarfile.TarInfo] | None,
+) -> None:
+    """Add a file with holes to ``tar_file`` as a PAX 1.0 sparse member.
+
+    Only the data regions of the file, found with ``SEEK_DATA``, are read and
+    stored, after a map of their offsets. GNU tar, Python's tarfile and Go's
+    archive/tar (thus container runtimes) restore the holes when extracting.
+    """
+    info = tar_file.gettarinfo(filepath, arcname)
+    if tar_filter is not None:
+        info = tar_filter(info)
+    if not info.isreg():
+        # A hardlink to a file already in the layer, with no data.
+        tar_file.addfile(info)
+        return
+
+    with filepath.open("rb") as file:
+        regions = _get_data_regions(file.fileno(), info.size)
+        data_size = sum(length for _, length in regions)
+        if data_size == info.size or tar_file.format != tarfile.PAX_FORMAT:
+            tar_file.addfile(info, file)
+            return
+
+        sparse_map = _make_sparse_member(info, regions)
+        tar_file.addfile(
+            info,
+            _SparseReader(
+                functools.partial(os.pread, file.fileno()), sparse_map, regions
+            ),
+        )
+
+
+def _make_sparse_member(info: tarfile.TarInfo, regions: list[tuple[int, int]]) -> bytes:
+    """Turn ``info`` into a PAX 1.0 sparse member, storing only ``regions``.
+
+    :param info: The member of a regular file, with the full size of the file.
+    :param regions: The offset and size of each data region, to which an empty
+        region is appended if the file ends with a hole.
+    :returns: The encoded map of the regions, which precedes their data.
+    """
+    data_size = sum(length for _, length in regions)
+
+    # The map lists the number of regions, then the offset and size of
+    # each one; a trailing hole is marked by an empty region at the end.
+    if not regions or sum(regions[-1]) < info.size:
+        regions.append((info.size, 0))
+    numbers = [len(regions), *(n for region in regions for n in region)]
+    sparse_map = "".join(f"{number}\n" for number in numbers).encode()
+    sparse_map += tarfile.NUL * (-len(sparse_map) % tarfile.BLOCKSIZE)
+
+    info.pax_headers = {
+        **info.pax_headers,
+        "GNU.sparse.major": "1",
+        "GNU.sparse.minor": "0",
+        "GNU.sparse.name": info.name,
+        "GNU.sparse.realsize": str(info.size),
+    }
+    # Like GNU tar, but without its process id to stay reproducible.
+    info.name = posixpath.join(
+        posixpath.dirname(info.name),
+        "GNUSparseFile.0",
+        posixpath.basename(info.name),
+    )
+    info.size = len(sparse_map) + data_size
+    return sparse_map
+
+
+def _get_data_regions(fd: int, size: int) -> list[tuple[int, int]]:
+    """Get the offset and size of the regions of a file that are not holes."""
+    regions: list[tuple[int, int]] = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # Nothing but a hole until the end of the file.
+                break
+            if err.errno == errno.EINVAL:
+                # The filesystem cannot tell holes apart.
+                return [(0, size)]
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if start >= end:
+            break
+        regions.append((start, end - start))
+        offset = end
+    return regions
+
+
+class _SparseReader:
+    """Read the data of a sparse tar member: its map, then the file's data regions.
+
+    :param read_at: Reads up to a size of the sparse file at an offset, like
+        ``os.pread()`` on its descriptor.
+    :param sparse_map: The encoded map of the data regions.
+    :param regions: The offset and size of each data region.
+    """
+
+    def __init__(
+        self,
+        read_at: Callable[[int, int], bytes],
+        sparse_map: bytes,
+        regions: Sequence[tuple[int, int]],
+    ) -> None:
+        self._read_at = read_at
+        self._pending = sparse_map
+        self._regions = collections.deque(regions)
+
+    def read(self, size: int = -1, /) -> bytes:
+        """Read ``size`` bytes, or less only at the end of the data."""
+        if size < 0:
+            size = len(self._pending) + sum(length for _, length in self._regions)
+        data = bytearray(self._pending[:size])
+        self._pending = self._pending[size:]
+        while len(data) < size and self._regions:
+            offset, length = self._regions.popleft()
+            chunk = self._read_at(min(length, size - len(data)), offset)
+            if not chunk and length:
+                raise errors.LayerArchivingError("File changed while archiving it")
+            data += chunk
+            if len(chunk) < length:
+                self._regions.appendleft((offset + len(chunk), length - len(chunk)))
+        return bytes(data)
+
+
+def _is_large_file(path: Path) -> bool:
+    """Whether ``path`` is a regular file big enough to archive as a fragment."""
+    stat = path.lstat()
+    return S_ISREG(stat.st_mode) and stat.st_size >= FRAGMENT_MIN_SIZE
+
+
+def _add_fragment(
+    tar_file: tarfile.TarFile,
+    writer: ParallelGzipLayerWriter,
+    fragments: LayerFragments,
+    filepath: Path,
+    info: tarfile.TarInfo,
+) -> None:
+    """Add a large file to ``tar_file``, as ``info``, in a fragment of its own.
+
+    The fragment's digest is either computed by hashing the file, or looked
+    up by the file's identity: its tar header and the metadata that changes
+    when the file is modified.
+    """
+    if not info.isreg():
+        # A hardlink to a file already in the layer, with no data.
+        tar_file.addfile(info)
+        return
+
+    header = info.tobuf(tar_file.format, tar_file.encoding, tar_file.errors)
+    stat = filepath.stat()
+    identity = ":".join(
+        map(
+            str,
+            [
+                writer.fragment_variant,
+                hashlib.sha256(header).hexdigest(),
+                stat.st_dev,
+                stat.st_ino,
+                stat.st_size,
+                stat.st_mtime_ns,
+                stat.st_ctime_ns,
+            ],
+        )
+    )
+    cache = fragments.cache
+    known_digest = (
+        _hash_member(header, filepath, info.size)
+        if fragments.hash_contents
+        else cache.get_member_digest(identity)
+    )
+
+    with filepath.open("rb") as file:
+        writer.begin_fragment(
+            cache, known_digest, lambda: _read_member(header, filepath, info.size)
+        )
+        try:
+            tar_file.addfile(info, file)
+            digest = writer.end_fragment()
+        except BaseException:
+            cache.forget_member_digest(identity)
+            raise
+    cache.set_member_digest(identity, digest)
+
+
+def _hash_member(header: bytes, filepath: Path, size: int) -> str:
+    """Get the sha256 hex digest of the tar member for a file, without creating it."""
+    digest = hashlib.sha256()
+    for chunk in _read_member(header, filepath, size):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_member(header: bytes, filepath: Path, size: int) -> Iterator[bytes]:
+    """Read the tar member for a file, as written by ``tarfile``, in chunks."""
+    yield header
+    with filepath.open("rb") as file:
+        remaining = size
+        while remaining and (chunk := file.read(min(remaining, 1024 * 1024))):
+            remaining -= len(chunk)
+            yield chunk
+    yield tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+
+def _get_layer_paths(
+    new_layer_dir: Path,
+    base_layer: Path | BaseIndex | None,
+    paths: Collection[str] | None,
+) -> dict[str, Path]:
+    """Map names in a layer file to the paths in ``new_layer_dir`` to archive as them.
+
+    See ``archive_layer()`` for the parameters.
+    """
+    candidates = _gather_layer_paths(new_layer_dir, base_layer)
+    if paths is not None:
+        candidates = _select_layer_paths(candidates, new_layer_dir, paths)
+    return _merge_layer_paths(candidates)
+
+
+def _reproducible_filter(
+    source_date_epoch: int,
+) -> Callable[[tarfile.TarInfo], tarfile.TarInfo]:
+    """Get a tarfile filter that drops what differs between builds of the same content.
+
+    Modification times are truncated to whole seconds, so that no sub-second
+    PAX records are written, and clamped to ``source_date_epoch``. Owners are
+    only recorded by id, since their names depend on the build host.
+    """
+
+    def _filter(info: tarfile.TarInfo) -> tarfile.TarInfo:
+        info.mtime = min(int(info.mtime), source_date_epoch)
+        info.uname = ""
+        info.gname = ""
+        return info
+
+    return _filter
+
+
+def squash_layers(
+    layer_openers: Sequence[Callable[[], AbstractContextManager[IO[bytes]]]],
+    output: io.BufferedIOBase,
+) -> None:
+    """Merge the tarballs of an image's layers into the tarball of a single layer.
+
+    The layers are streamed once each, from the top-most one down, and only the
+    entries that show in the image's filesystem are copied: the ones that no
+    upper layer replaces, nor hides with its whiteouts and opaque directories.
+    The whiteouts themselves are dropped, since no layer is left below.
+
+    :param layer_openers: Callables opening the uncompressed tarball of each
+        layer, in the order of the image manifest (the base layer first).
+    :param output: A writable binary stream to which the uncompressed tarball
+        of the merged layer is streamed.
+    """
+    merger = _LayerMerger()
+    with tarfile.open(fileobj=output, mode="w|", format=tarfile.PAX_FORMAT) as tar_out:
+        for open_layer in reversed(layer_openers):
+            with open_layer() as stream:
+                with tarfile.open(fileobj=stream, mode="r|") as tar_in:
+                    broken_links = merger.add_layer(tar_in, tar_out)
+            if broken_links:
+                # Only the hardlinks' targets are needed from the second pass.
+                with open_layer() as stream:
+                    with tarfile.open(fileobj=stream, mode="r|") as tar_in:
+                        _copy_link_targets(tar_in, tar_out, broken_links)
+
+
+class _LayerMerger:
+    """Keep track of the paths that the upper layers set, when merging layers."""
+
+    def __init__(self) -> None:
+        self._seen: set[str] = set()
+        self._hidden: set[str] = set()
+        self._opaque: set[str] = set()
+
+    def add_layer(
+        self, tar_in: tarfile.TarFile, tar_out: tarfile.TarFile
+    ) -> dict[str, list[tarfile.TarInfo]]:
+        """Copy the entries of a layer below the previous ones that still show.
+
+        :returns: The hardlinks that were not copied because their target was
+            not either, by the name of the target.
+        """
+        # Whiteouts and replaced paths only hide files from the lower layers.
+        hidden: set[str] = set()
+        opaque: set[str] = set()
+        copied: set[str] = set()
+        links: dict[str, str] = {}
+        broken_links: dict[str, list[tarfile.TarInfo]] = defaultdict(list)
+        for member in tar_in:
+            name = _normalize_member_name(member.name)
+            path = Path(name)
+            if path == overlays.oci_opaque_dir(path.parent):
+                opaque.add(posixpath.dirname(name))
+                continue
+            if overlays.is_oci_whiteout_file(path):
+                hidden.add(str(overlays.oci_whited_out_file(path)))
+                continue
+            if name in self._seen or self._is_hidden(name):
+                continue
+            self._seen.add(name)
+
+            if not member.isdir():
+                # Anything but a directory replaces the whole lower tree.
+                hidden.add(name)
+            if member.islnk():
+                target = _normalize_member_name(member.linkname)
+                target = links.setdefault(name, links.get(target, target))
+                if target not in copied:
+                    broken_links[target].append(member)
+                    continue
+            _copy_member(tar_out, member, _extract_data(tar_in, member))
+            copied.add(name)
+
+        self._hidden |= hidden
+        self._opaque |= opaque
+        return broken_links
+
+    def _is_hidden(self, name: str) -> bool:
+        """Whether an upper layer hides ``name`` from the lower ones."""
+        if name in self._hidden:
+            return True
+        parent = name
+        while parent:
+            parent = posixpath.dirname(parent)
+            if parent in self._hidden or parent in self._opaque:
+                return True
+        return False
+
 
+def _copy_link_targets(
+    tar_in: tarfile.TarFile,
+    tar_out: tarfile.TarFile,
+    broken_links: dict[str, list[tarfile.TarInfo]],
+) -> None:
+    """Copy hardlinks whose targets are hidden as files with the targets' data.
+
+    The first link to each target gets its data, and the others link to it.
+    """
+    for member in tar_in:
+        links = broken_links.pop(_normalize_member_name(member.name), None)
+        if not links:
+            continue
+        first, *others = links
+        info = copy.copy(member)
+        info.name = first.name
+        _copy_member(tar_out, info, _extract_data(tar_in, member))
+        for link in others:
+            link_info = copy.copy(link)
+            link_info.linkname = first.name
+            _copy_member(tar_out, link_info, None)
+        if not broken_links:
+            break
+
+
+def _copy_member(
+    tar_out: tarfile.TarFile, member: tarfile.TarInfo, file_obj: IO[bytes] | None
+) -> None:
+    """Copy a member read from a layer tarball, with its data, to ``tar_out``."""
+    info = copy.copy(member)
+    # The PAX records that tarfile parsed into the member's attributes would
+    # take precedence over them, and the sparse ones are written again below.
+    info.pax_headers = {
+        key: value
+        for key, value in member.pax_headers.items()
+        if key not in tarfile.PAX_FIELDS and not key.startswith("GNU.sparse.")
+    }
+    if member.sparse is None or file_obj is None:
+        tar_out.addfile(info, file_obj)
+        return
+
+    # Keep the holes out of the merged layer too.
+    info.type = tarfile.REGTYPE
+    info.sparse = None
+    sparse = cast(list[tuple[int, int]], member.sparse)
+    regions = [(offset, length) for offset, length in sparse if length]
+    sparse_map = _make_sparse_member(info, regions)
+
+    # Seek in the unbuffered file, as the buffered one would ask the stream of
+    # the tarball whether it can, even if only forward.
+    raw_file = cast(io.BufferedReader, file_obj).raw
+
+    def read_at(size: int, offset: int) -> bytes:
+        raw_file.seek(offset, os.SEEK_SET)
+        return raw_file.read(size)
+
+    tar_out.addfile(info, _SparseReader(read_at, sparse_map, regions))
+
+
+def _extract_data(
+    tar_file: tarfile.TarFile, member: tarfile.TarInfo
+) -> IO[bytes] | None:
+    """Get the data of a regular file in a streamed tarball, or None for others.
+
+    Unlike ``extractfile()``, this never looks for the target of a hardlink,
+    which a stream cannot seek back to.
+    """
+    return tar_file.extractfile(member) if member.isreg() else None
 
-def prune_prime_files(prime_dir: Path, files: set[str], base_layer_dir: Path) -> None:
+
+def _normalize_member_name(name: str) -> str:
+    """Normalize the name of a tarball member to its ``a/b/c`` form."""
+    return posixpath.normpath(f"/{name}").lstrip("/")
+
+
+def fingerprint_layer(
+    new_layer_dir: Path,
+    base_layer: Path | BaseIndex | None = None,
+    *,
+    paths: Collection[str] | None = None,
+    hash_contents: bool = False,
+) -> str:
+    """Get a fingerprint of the layer that ``archive_layer()`` would create.
+
+    The fingerprint covers the names in the layer and the metadata of the files
+    they come from: type, mode, ownership, size, modification time and inode,
+    plus the target of symlinks. Unless the files are modified while keeping
+    all of those, the same fingerprint means the same layer, without reading
+    the files. ``hash_contents`` also covers the content of the files.
+
+    See ``archive_layer()`` for the other parameters.
+
+    :returns: The fingerprint, as a sha256 hex digest.
+    """
+    layer_paths = _get_layer_paths(new_layer_dir, base_layer, paths)
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(f"{_LAYER_FORMAT_VERSION}:{get_source_date_epoch()}\0".encode())
+    for arcname in sorted(layer_paths):
+        filepath = layer_paths[arcname]
+        stat = filepath.lstat()
+        fields = [
+            arcname,
+            stat.st_mode,
+            stat.st_uid,
+            stat.st_gid,
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_dev,
+            stat.st_ino,
+            stat.st_nlink,
+            stat.st_rdev,
+        ]
+        if filepath.is_symlink():
+            fields.append(os.readlink(filepath))
+        elif hash_contents and filepath.is_file():
+            digest = hashlib.sha256()
+            with filepath.open("rb") as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            fields.append(digest.hexdigest())
+        fingerprint.update(
+            "\0".join(map(str, fields)).encode("utf-8", "surrogateescape")
+        )
+        fingerprint.update(b"\n")
+    return fingerprint.hexdigest()
+
+
+def split_prime_paths(
+    prime_dir: Path,
+    part_paths: Mapping[str, Collection[str]],
+    selectors: Sequence[tuple[Collection[str], Collection[str]]],
+) -> list[set[str]]:
+    """Split the content of a prime directory into groups, to archive as layers.
+
+    Each path goes in the group of the first selector that matches it, either
+    because it was primed by one of the selector's parts or because it matches
+    one of the selector's globs. Paths not matched by any selector, including
+    those that no part primed (like the ones from overlays), go in a final
+    group. Empty groups are left out.
+
+    Hardlinks to the same file all go in the first group that any of them
+    goes in, so that the layer stores the file once and links to it: a
+    hardlink cannot point to a file in another layer.
+
+    :param prime_dir: The directory containing the lifecycle's primed contents.
+    :param part_paths: The paths that each part primed, relative to ``prime_dir``.
+    :param selectors: The parts and path globs of each group but the last one.
+    :returns: The paths of each group, relative to ``prime_dir``.
+    """
+    owners: dict[str, str] = {}
+    for part_name, primed in part_paths.items():
+        for path in primed:
+            owners.setdefault(path, part_name)
+
+    indices: dict[str, int] = {}
+    hardlinks: defaultdict[tuple[int, int], list[str]] = defaultdict(list)
+    for dirpath, subdirs, filenames in os.walk(prime_dir):
+        relative_dir = Path(dirpath).relative_to(prime_dir)
+        for name in [*subdirs, *filenames]:
+            path = str(relative_dir / name)
+            owner = owners.get(path)
+            indices[path] = next(
+                (
+                    i
+                    for i, (parts, globs) in enumerate(selectors)
+                    if owner in parts
+                    or any(fnmatch.fnmatch(path, glob) for glob in globs)
+                ),
+                len(selectors),
+            )
+        for name in filenames:
+            stat = os.lstat(os.path.join(dirpath, name))
+            if S_ISREG(stat.st_mode) and stat.st_nlink > 1:
+                hardlinks[(stat.st_dev, stat.st_ino)].append(str(relative_dir / name))
+
+    for names in hardlinks.values():
+        index = min(indices[name] for name in names)
+        for name in names:
+            indices[name] = index
+
+    groups: list[set[str]] = [set() for _ in range(len(selectors) + 1)]
+    for path, index in indices.items():
+        groups[index].add(path)
+
+    return [group for group in groups if group]
+
+
+def prune_prime_files(
+    prime_dir: Path, files: set[str], base_layer: Path | BaseIndex | None
+) -> None:
     """Remove (prune) files in a prime directory if they exist in the base layer.
 
     Given a set of filenames ``files``, this function will remove (prune) all those
     filenames from prime dir ``prime_dir`` if the corresponding sub path exists in
-    the extracted base layer directory ``base_layer_dir`` with same contents and
-    permissions.
+    the base layer ``base_layer`` with same contents and permissions.
 
     For example, "{prime_dir}/dir/subdir/file1" will be pruned if the matching file
-    "{base_layer_dir}/dir/subdir/file1" exists and has the same contents, owner,
+    "{base_layer}/dir/subdir/file1" exists and has the same contents, owner,
     group, and permission bits.
 
     :param prime_dir: The directory containing the lifecycle's primed contents.
     :param files: The set of filenames added to ``prime_dir``, as provided by
         the corresponding post_step lifecycle callback.
-    :param base_layer_dir: The directory where the base layer was extracted.
+    :param base_layer: The directory where the base layer was extracted, or an
+        index of the base layer.
     """
     emit.debug("Pruning primed files that already exist on base layer...")
     for filename in files:
-        base_layer_file = base_layer_dir / filename
-        if base_layer_file.is_file():
-            prime_file = prime_dir / filename
-            if _all_compatible_files([base_layer_file, prime_file]):
-                emit.debug(f"Pruning: {prime_file} as it exists on the base")
-                prime_file.unlink()
-            else:
-                emit.debug(
-                    f"{prime_file} exists on the base but with different contents or permissions"
-                )
+        prime_file = prime_dir / filename
+        if isinstance(base_layer, BaseIndex):
+            if not base_layer.is_file(filename):
+                continue
+            compatible = base_layer.file_matches(filename, prime_file)
+        elif base_layer is not None and (base_layer / filename).is_file():
+            compatible = _all_compatible_files([base_layer / filename, prime_file])
+        else:
+            continue
+
+        if compatible:
+            emit.debug(f"Pruning: {prime_file} as it exists on the base")
+            prime_file.unlink()
+        else:
+            emit.debug(
+                f"{prime_file} exists on the base but with different contents or permissions"
+            )
 
 
 def _gather_layer_paths(
-    new_layer_dir: Path, base_layer_dir: Path | None = None
+    new_layer_dir: Path,
+    base_layer: Path | BaseIndex | None = None,
 ) -> dict[str, list[Path]]:
     """Map paths in ``new_layer_dir`` to names in a layer file.
 
@@ -145,12 +768,12 @@ def _gather_layer_paths(
         # Handle adding an entry for the directory. We skip this IF:
         # - The directory is the root (to skip a spurious "." entry), OR
         # - The directory is NOT an opaque OCI entry AND
-        # - The directory's exists on ``base_layer_dir`` as a symlink to another
+        # - The directory's exists on ``base_layer`` as a symlink to another
         #   directory (like in usrmerge).
         if upper_subpath != new_layer_dir:
             upper_is_not_opaque_dir = not overlays.is_oci_opaque_dir(upper_subpath)
             lower_symlink_target = _symlink_target_in_base_layer(
-                relative_path, base_layer_dir
+                relative_path, base_layer
             )
             lower_is_symlink = lower_symlink_target is not None
 
@@ -179,6 +802,25 @@ def _gather_layer_paths(
     return result
 
 
+def _select_layer_paths(
+    candidate_paths: dict[str, list[Path]],
+    new_layer_dir: Path,
+    paths: Collection[str],
+) -> dict[str, list[Path]]:
+    """Keep the ``candidate_paths`` for ``paths`` in ``new_layer_dir``, and their parents."""
+    selected: set[Path] = set()
+    for path in paths:
+        selected.add(new_layer_dir / path)
+        selected.update(new_layer_dir / parent for parent in Path(path).parents[:-1])
+
+    result: dict[str, list[Path]] = {}
+    for name, sources in candidate_paths.items():
+        selected_sources = [source for source in sources if source in selected]
+        if selected_sources:
+            result[name] = selected_sources
+    return result
+
+
 def _merge_layer_paths(candidate_paths: dict[str, list[Path]]) -> dict[str, Path]:
     """Merge ``candidate_paths`` into a single path per name.
 
@@ -223,21 +865,25 @@ def _merge_layer_paths(candidate_paths: dict[str, list[Path]]) -> dict[str, Path
 
 
 def _symlink_target_in_base_layer(
-    relative_path: Path, base_layer_dir: Path | None
+    relative_path: Path, base_layer: Path | BaseIndex | None
 ) -> Path | None:
-    """If `relative_path` is a dir symlink in `base_layer_dir`, return its 'target'.
+    """If `relative_path` is a dir symlink in `base_layer`, return its 'target'.
 
-    This function checks if `relative_path` exists in the base `base_layer_dir` as
+    This function checks if `relative_path` exists in the base `base_layer` as
     a symbolic link to another directory; if it does, the function will return the
     symlink target. In all other cases, the function returns None.
 
     :param relative_path: The subpath to check.
-    :param base_layer_dir: The directory with the contents of the base layer.
+    :param base_layer: The directory with the contents of the base layer, or an
+        index of the base layer.
     """
-    if base_layer_dir is None:
+    if isinstance(base_layer, BaseIndex):
+        return base_layer.readlink(relative_path)
+
+    if base_layer is None:
         return None
 
-    lower_path = base_layer_dir / relative_path
+    lower_path = base_layer / relative_path
 
     if lower_path.is_symlink():
         return Path(os.readlink(lower_path))
@@ -17,6 +17,11 @@
 """Rockcraft models."""
 
 
-from rockcraft.models.project import Project, load_project, transform_yaml
+from rockcraft.models.project import (
+    PrimeLayer,
+    Project,
+    load_project,
+    transform_yaml,
+)
 
-__all__ = ["Project", "load_project", "transform_yaml"]
+__all__ = ["PrimeLayer", "Project", "load_project", "transform_yaml"]
@@ -34,6 +34,7 @@ from pydantic_yaml import YamlModelMixin
 from typing_extensions import override
 
 from rockcraft.architectures import SUPPORTED_ARCHS
+from rockcraft.compression import LayerCompression
 from rockcraft.errors import ProjectLoadError
 from rockcraft.extensions import apply_extensions
 from rockcraft.parts import part_has_overlay, validate_part
@@ -97,6 +98,20 @@ class Platform(pydantic.BaseModel):
         return values
 
 
+class PrimeLayer(pydantic.BaseModel):
+    """A layer with some of the primed files, selected by part or by path."""
+
+    parts: list[str] | None
+    """The parts whose files go in the layer."""
+    paths: list[str] | None
+    """Globs matching the paths that go in the layer, relative to the root."""
+
+    class Config:  # pylint: disable=too-few-public-methods
+        """Pydantic model configuration."""
+
+        extra = "forbid"
+
+
 NAME_REGEX = r"^([a-z](?:-?[a-z0-9]){2,})$"
 """
 The regex for valid names for rocks. It matches the accepted values for pebble
@@ -140,11 +155,15 @@ class Project(YamlModelMixin, BaseProject):
     services: dict[str, Service] | None
     checks: dict[str, Check] | None
     entrypoint_service: str | None
+    compression: LayerCompression | None
+    metadata_layers: Literal["separate", "single"] | None
 
     package_repositories: list[dict[str, Any]] | None
 
     parts: dict[str, Any]
 
+    prime_layers: Literal["single", "per-part"] | list[PrimeLayer] | None
+
     class Config(CraftBaseConfig):  # pylint: disable=too-few-public-methods
         """Pydantic model configuration."""
 
@@ -319,6 +338,29 @@ class Project(YamlModelMixin, BaseProject):
             )
         return item
 
+    @pydantic.validator("prime_layers")
+    @classmethod
+    def _validate_prime_layers(
+        cls,
+        prime_layers: str | list[PrimeLayer] | None,
+        values: dict[str, Any],
+    ) -> str | list[PrimeLayer] | None:
+        """Verify that the prime layers only refer to the project's parts."""
+        if not isinstance(prime_layers, list):
+            return prime_layers
+
+        for layer in prime_layers:
+            if not layer.parts and not layer.paths:
+                raise CraftValidationError(
+                    "Each of the prime-layers must have 'parts' or 'paths'."
+                )
+            unknown_parts = set(layer.parts or []) - set(values.get("parts", {}))
+            if unknown_parts:
+                raise CraftValidationError(
+                    "Unknown parts in prime-layers: " + ", ".join(sorted(unknown_parts))
+                )
+        return prime_layers
+
     @pydantic.validator("entrypoint_service")
     @classmethod
     def _validate_entrypoint_service(
@@ -16,7 +16,8 @@
 
 """OCI image manipulation helpers."""
 
-import hashlib
+import contextlib
+import functools
 import json
 import logging
 import os
@@ -24,18 +25,26 @@ import shlex
 import shutil
 import subprocess
 import tempfile
-from dataclasses import dataclass
-from datetime import datetime
+import time
+from collections.abc import Collection, Iterator
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal, cast
 
 import yaml
 from craft_cli import emit
 
-from rockcraft import errors, layers
-from rockcraft.architectures import SUPPORTED_ARCHS
+from rockcraft import docker, errors, layers, oci_layout, registry, rootfs
+from rockcraft.architectures import SUPPORTED_ARCHS, ArchitectureMapping
+from rockcraft.base_index import BaseIndex
+from rockcraft.compression import (
+    DEFAULT_LAYER_COMPRESSION,
+    LayerCompression,
+    open_layer,
+)
 from rockcraft.pebble import Pebble
-from rockcraft.utils import get_snap_command_path
+from rockcraft.utils import get_build_time, get_snap_command_path
 
 logger = logging.getLogger(__name__)
 
@@ -45,8 +54,173 @@ ECR_URL = "public.ecr.aws/ubuntu"
 
 REGISTRY_URL = ECR_URL
 
-# The number of times to try downloading an image from `REGISTRY_URL`.
-MAX_DOWNLOAD_RETRIES = 5
+# Environment variable setting where base images are obtained from, instead
+# of REGISTRY_URL: another registry (like "mirror.example.com/ubuntu"), or a
+# local OCI image layout (like "oci:/srv/bases").
+BASE_MIRROR_ENV = "ROCKCRAFT_BASE_MIRROR"
+
+# Environment variables setting when to check cached base images for updates.
+BASE_REVALIDATION_ENV = "ROCKCRAFT_BASE_REVALIDATION"
+BASE_TTL_ENV = "ROCKCRAFT_BASE_TTL"
+DEFAULT_BASE_TTL = 24 * 60 * 60
+
+# Environment variable setting how new layers are matched with the layers
+# created before from the same files, to reuse them: by the files' metadata
+# ("stat"), also by their contents ("content"), or not at all ("off").
+LAYER_CACHE_ENV = "ROCKCRAFT_LAYER_CACHE"
+LAYER_CACHE_MODES = ("stat", "content", "off")
+
+
+@dataclass(frozen=True)
+class RevalidationPolicy:
+    """When to check whether a cached base image is still up to date.
+
+    :param mode: ``always`` checks the registry every time; ``ttl`` only does
+        once ``ttl`` seconds have passed since the last check; and ``never``
+        uses the cached image for as long as it exists.
+    :param ttl: The validity of a check, in seconds, for the ``ttl`` mode.
+    """
+
+    mode: Literal["always", "ttl", "never"] = "always"
+    ttl: int = DEFAULT_BASE_TTL
+
+    @classmethod
+    def from_environment(cls) -> "RevalidationPolicy":
+        """Get the policy set in the ``ROCKCRAFT_BASE_REVALIDATION`` environment.
+
+        The validity of checks for the ``ttl`` mode is read from
+        ``ROCKCRAFT_BASE_TTL``.
+        """
+        mode = os.getenv(BASE_REVALIDATION_ENV, "always")
+        ttl = os.getenv(BASE_TTL_ENV, str(DEFAULT_BASE_TTL))
+        if mode not in ("always", "ttl", "never"):
+            raise errors.RockcraftError(
+                f"Invalid value for {BASE_REVALIDATION_ENV}: {mode!r}",
+                resolution="Set it to 'always', 'ttl' or 'never'.",
+            )
+        if not ttl.isdigit():
+            raise errors.RockcraftError(
+                f"Invalid value for {BASE_TTL_ENV}: {ttl!r}",
+                resolution="Set it to a number of seconds.",
+            )
+        return cls(mode=cast(Literal["always", "ttl", "never"], mode), ttl=int(ttl))
+
+    def needs_check(self, validated: float) -> bool:
+        """Whether an image last checked at ``validated`` must be checked again.
+
+        :param validated: The time of the last check, in seconds since the epoch.
+        """
+        if self.mode == "never":
+            return False
+        if self.mode == "ttl":
+            return time.time() - validated >= self.ttl
+        return True
+
+
+@dataclass(frozen=True)
+class BaseSource:
+    """Where and how base images are obtained.
+
+    :param registry: The registry, and namespace in it, holding the bases as
+        ``<registry>/<name>:<tag>`` (like ``public.ecr.aws/ubuntu/ubuntu:22.04``).
+    :param layout: A local OCI image layout holding the bases instead, tagged
+        as ``<name>:<tag>`` (like ``ubuntu:22.04``), for each platform or as
+        multi-platform indexes.
+    :param blob_store: An optional host-wide store to cache the bases in, and
+        share their layers through.
+    :param revalidation: When to check the cached bases against the registry;
+        by default, every time.
+    :param offline: Whether to only use the bases cached in ``blob_store`` (or
+        the ones in ``layout``), failing right away if missing rather than
+        accessing the registry.
+    """
+
+    registry: str
+    layout: Path | None = None
+    blob_store: oci_layout.BlobStore | None = None
+    revalidation: RevalidationPolicy = RevalidationPolicy()
+    offline: bool = False
+
+    @classmethod
+    def from_environment(
+        cls, *, blob_store: oci_layout.BlobStore | None = None, offline: bool = False
+    ) -> "BaseSource":
+        """Get the source set in the ``ROCKCRAFT_BASE_MIRROR`` environment.
+
+        By default, bases are obtained from ``REGISTRY_URL``. The revalidation
+        policy is read from the environment too (see ``RevalidationPolicy``).
+
+        :param blob_store: An optional host-wide store to cache the bases in.
+        :param offline: Whether to only use the cached bases.
+        """
+        revalidation = RevalidationPolicy.from_environment()
+        mirror = os.getenv(BASE_MIRROR_ENV, "")
+        if mirror.startswith("oci:"):
+            layout = Path(mirror.removeprefix("oci:"))
+            if not (layout / "index.json").is_file():
+                raise errors.RockcraftError(
+                    f"Invalid value for {BASE_MIRROR_ENV}: {mirror!r}",
+                    details=f"{layout} is not an OCI image layout.",
+                    resolution="Set it to 'oci:<path>' of an OCI image layout.",
+                )
+            return cls(
+                registry=REGISTRY_URL,
+                layout=layout,
+                blob_store=blob_store,
+                revalidation=revalidation,
+                offline=offline,
+            )
+        mirror = mirror.removeprefix("docker://").rstrip("/")
+        if "://" in mirror:
+            raise errors.RockcraftError(
+                f"Invalid value for {BASE_MIRROR_ENV}: {mirror!r}",
+                resolution="Set it to '<registry>[/<namespace>]' or 'oci:<path>'.",
+            )
+        return cls(
+            registry=mirror or REGISTRY_URL,
+            blob_store=blob_store,
+            revalidation=revalidation,
+            offline=offline,
+        )
+
+    def get_source_image(self, image_name: str) -> str:
+        """Get the full form (e.g. ``docker://ubuntu:22.04``) of a base image.
+
+        :param image_name: The image, in ``name:tag`` format.
+        """
+        if self.layout is not None:
+            return f"oci:{self.layout}:{image_name}"
+        return f"docker://{self.registry}/{image_name}"
+
+
+@dataclass(frozen=True)
+class LayerOptions:
+    """How to add a new layer to an image.
+
+    :param base_layer: An optional path to the extracted contents of the new
+        layer's base layer, or an index of it. Used to preserve lower-layer
+        symlinks.
+    :param compression: The compression algorithm for the new layer, which the
+        image also uses for any further layers. Defaults to the compression of
+        the image.
+    :param created_by: The description of the layer in the image history.
+    :param paths: The paths in the new layer's directory to put in the layer,
+        if not all of them.
+    :param reuse: Whether to reuse a layer created before from the same files,
+        or else the compressed large files that did not change, if the image
+        has a blob store. Pointless for temporary directories. How files are
+        compared is set in the ``ROCKCRAFT_LAYER_CACHE`` environment.
+    :param layer_dir: For the methods that write files for the image, like
+        ``Image.add_user()``, a directory to write them to, instead of adding
+        a layer with them: the caller adds it, possibly with other files.
+    """
+
+    base_layer: Path | BaseIndex | None = None
+    compression: LayerCompression | None = None
+    created_by: str = "rockcraft add-layer"
+    paths: Collection[str] | None = None
+    reuse: bool = True
+    layer_dir: Path | None = None
 
 
 @dataclass(frozen=True)
@@ -55,10 +229,17 @@ class Image:
 
     :param image_name: The name of this image in ``name:tag`` format.
     :param path: The path to this image in the local filesystem.
+    :param compression: The compression algorithm for new layers.
+    :param blob_store: An optional host-wide store to share layers through.
+    :param source_digest: The digest of the image this one was obtained as,
+        if recorded when it was fetched or created.
     """
 
     image_name: str
     path: Path
+    compression: LayerCompression = DEFAULT_LAYER_COMPRESSION
+    blob_store: oci_layout.BlobStore | None = None
+    source_digest: str | None = None
 
     @classmethod
     def from_docker_registry(
@@ -67,16 +248,25 @@ class Image:
         *,
         image_dir: Path,
         arch: str,
+        source: BaseSource | None = None,
     ) -> tuple["Image", str]:
         """Obtain an image from a docker registry.
 
-        The image is fetched from the registry at ``REGISTRY_URL``.
+        The image is pulled from the registry at ``REGISTRY_URL``, or the one
+        of the given ``source``, downloading its blobs concurrently (see
+        ``registry.pull_image()``). If the ``source`` has a blob store, fetched
+        images are cached in it, pinned to the digest of their manifest in the
+        registry. A cached image is reused without downloading anything as long
+        as that digest doesn't change, which is checked according to the
+        revalidation policy of the ``source``.
+
+        If the ``source`` is a local OCI layout, the image is copied from it
+        instead, without accessing the network.
 
         :param image_name: The image to retrieve, in ``name@tag`` format.
         :param image_dir: The directory to store local OCI images.
         :param arch: The architecture of the Docker image to fetch, in Debian format.
-        :param variant: The variant, if any, of the Docker image to fetch.
-
+        :param source: Where and how to obtain the image.
 
         :returns: The downloaded image and it's corresponding source image
         """
@@ -86,42 +276,61 @@ class Image:
         image_name = image_name.replace("@", ":")
 
         image_dir.mkdir(parents=True, exist_ok=True)
-        image_target = image_dir / image_name
 
-        source_image = f"docker://{REGISTRY_URL}/{image_name}"
-        copy_params = ["--retry-times", str(MAX_DOWNLOAD_RETRIES)]
-
-        mapping = SUPPORTED_ARCHS[arch]
-
-        platform_params = [
-            "--override-arch",
-            mapping.go_arch,
-        ]
-        if mapping.go_variant:
-            platform_params += ["--override-variant", mapping.go_variant]
+        if source is None:
+            source = BaseSource(registry=REGISTRY_URL)
+        blob_store = source.blob_store
+        source_image = source.get_source_image(image_name)
+
+        platform = SUPPORTED_ARCHS[arch]
+        name, tag = image_name.split(":", 1)
+
+        if source.layout is not None:
+            source_digest = _copy_from_layout(
+                source.layout,
+                image_name,
+                oci_layout.ImageLayout.open(image_dir / name, blob_store=blob_store),
+                tag,
+                platform,
+            )
+        elif blob_store is None:
+            if source.offline:
+                raise _not_available_offline(image_name)
+            source_digest = _pull_image(
+                _get_remote_image(source.registry, name, tag),
+                oci_layout.ImageLayout.open(image_dir / name),
+                tag,
+                platform,
+            )
+        else:
+            source_digest = _fetch_into_blob_store(
+                image_name, image_dir, blob_store, source, platform
+            )
 
-        _copy_image(
+        return (
+            cls(
+                image_name=image_name,
+                path=image_dir,
+                blob_store=blob_store,
+                source_digest=source_digest,
+            ),
             source_image,
-            f"oci:{image_target}",
-            copy_params=copy_params,
-            *platform_params,
         )
 
-        return cls(image_name=image_name, path=image_dir), source_image
-
     @classmethod
     def new_oci_image(
         cls,
         image_name: str,
         image_dir: Path,
         arch: str,
+        blob_store: oci_layout.BlobStore | None = None,
     ) -> tuple["Image", str]:
         """Create a new OCI image out of thin air.
 
         :param image_name: The image to initiate, in ``name@tag`` format.
         :param image_dir: The directory to store the local OCI image.
         :param arch: The architecture of the OCI image to create, in Debian format.
-        :param variant: The variant, if any, of the OCI image to create.
+        :param blob_store: An optional host-wide store to share layers through.
 
         :returns: The new image object and it's corresponding source image
         """
@@ -131,112 +340,237 @@ class Image:
         image_name = image_name.replace("@", ":")
         image_dir.mkdir(parents=True, exist_ok=True)
         image_target = image_dir / image_name
-        image_target_no_tag = str(image_target).split(":", maxsplit=1)[0]
+        name, tag = image_name.split(":", maxsplit=1)
 
-        shutil.rmtree(image_target_no_tag, ignore_errors=True)
-        _process_run(["umoci", "init", "--layout", image_target_no_tag])
-        _process_run(["umoci", "new", "--image", str(image_target)])
+        shutil.rmtree(image_dir / name, ignore_errors=True)
+        layout = oci_layout.ImageLayout.init(image_dir / name, blob_store=blob_store)
 
-        # Note: umoci's docs aren't clear on this but we assume that arch-related
-        # calls must use GOARCH-format, following the OCI spec.
+        # Arch-related fields must use GOARCH-format, following the OCI spec.
         mapping = SUPPORTED_ARCHS[arch]
-
-        # Unfortunately, umoci does not allow initializing an image
-        # with arch and variant. We can configure the arch via
-        # umoci config, but not the variant. Need to do it manually
-        _config_image(image_target, ["--architecture", mapping.go_arch, "--no-history"])
-
-        if mapping.go_variant:
-            _inject_architecture_variant(Path(image_target_no_tag), mapping.go_variant)
+        layout.create_image(
+            tag, architecture=mapping.go_arch, variant=mapping.go_variant
+        )
 
         # for new OCI images, the source image corresponds to the newly generated image
         return (
-            cls(image_name=image_name, path=image_dir),
+            cls(
+                image_name=image_name,
+                path=image_dir,
+                blob_store=blob_store,
+                source_digest=layout.get_descriptor(tag)["digest"],
+            ),
             f"oci:{str(image_target)}",
         )
 
     def copy_to(self, image_name: str, *, image_dir: Path) -> "Image":
         """Make a copy of the current image.
 
+        No blob data is copied: if the new image is in the same layout, it only
+        gets a new index entry, and otherwise the blobs are hardlinked (or
+        reflinked, if possible) into the new image's layout.
+
         :param image_name: The new image name, in ``name:tag`` format.
         :param image_dir: The new image directory.
 
         :returns: The newly created image.
         """
-        src_path = self.path / self.image_name
-        dest_path = image_dir / image_name
-        _copy_image(f"oci:{str(src_path)}", f"oci:{str(dest_path)}")
+        layout, tag = self._get_layout()
+        dest_name, dest_tag = image_name.split(":", 1)
+        dest_layout = oci_layout.ImageLayout.open(
+            image_dir / dest_name, blob_store=self.blob_store
+        )
+        layout.copy_image(tag, dest_layout, dest_tag)
 
-        return Image(image_name=image_name, path=image_dir)
+        return replace(self, image_name=image_name, path=image_dir)
 
-    def extract_to(self, bundle_dir: Path, *, rootless: bool = False) -> Path:
+    def extract_to(
+        self,
+        bundle_dir: Path,
+        *,
+        rootless: bool = False,
+        cache: rootfs.RootfsCache | None = None,
+    ) -> Path:
         """Unpack the image to an OCI runtime bundle.
 
         :param bundle_dir: The directory to store runtime bundles.
         :param rootless: Whether the image should be unpacked even without
             root; won't necessarily preserve ownership but is useful for
             testing.
+        :param cache: An optional cache of unpacked images. If given, the
+            image is only unpacked if it's not cached yet, and the bundle is
+            then made of hardlinks to the cached one.
         """
         bundle_dir.mkdir(parents=True, exist_ok=True)
         bundle_path = bundle_dir / self.image_name.replace(":", "-")
-        image_path = self.path / self.image_name
         shutil.rmtree(bundle_path, ignore_errors=True)
+
+        if cache is None:
+            self._unpack(bundle_path, rootless=rootless)
+        else:
+            cached_path = cache.get_bundle(
+                self._get_bundle_key(rootless=rootless),
+                lambda path: self._unpack(path, rootless=rootless),
+            )
+            rootfs.link_tree(cached_path, bundle_path)
+
+        return bundle_path / "rootfs"
+
+    def get_index(self, *, cache: rootfs.RootfsCache | None = None) -> BaseIndex:
+        """Index the files in the image, without unpacking it.
+
+        :param cache: An optional cache of unpacked images, to keep the index in.
+        """
+        layout, tag = self._get_layout()
+        if cache is None:
+            return BaseIndex.from_image(layout, tag)
+        return cache.get_index(
+            self._get_bundle_key(rootless=False),
+            lambda: BaseIndex.from_image(layout, tag),
+        )
+
+    def _unpack(self, bundle_path: Path, *, rootless: bool) -> None:
+        image_path = self.path / self.image_name
         command = ["umoci", "unpack"]
         if rootless:
             command.append("--rootless")
         command.extend(["--image", str(image_path), str(bundle_path)])
         _process_run(command)
 
-        return bundle_path / "rootfs"
+    def _get_bundle_key(self, *, rootless: bool) -> str:
+        """Identify the content of the image's bundle, for caching it."""
+        layout, tag = self._get_layout()
+        digest = layout.get_descriptor(tag)["digest"]
+        _, config = layout.read_image(tag)
+        platform = "-".join(
+            value
+            for value in (config.get("architecture"), config.get("variant"))
+            if value
+        )
+        key = f"{digest.split(':', 1)[-1]}-{platform}"
+        return f"{key}-rootless" if rootless else key
 
     def add_layer(
-        self,
-        tag: str,
-        new_layer_dir: Path,
-        base_layer_dir: Path | None = None,
+        self, tag: str, new_layer_dir: Path, options: LayerOptions | None = None
     ) -> "Image":
         """Add a layer to the image.
 
         :param tag: The tag of the image containing the new layer.
         :param new_layer_dir: The path to the new layer root filesystem.
-        :param base_layer_dir: An optional path to the extracted contents of the
-          new layer's base layer. Used to preserve lower-layer symlinks.
+        :param options: How to add the layer, or the defaults. The returned
+          image uses its compression for any further layers.
         """
-        image_path = self.path / self.image_name
+        options = options or LayerOptions()
+        compression = options.compression or self.compression
+        created_by = options.created_by
+        layout, current_tag = self._get_layout()
+
+        cache_key = None
+        cache_mode = _get_layer_cache_mode()
+        if options.reuse and self.blob_store is not None and cache_mode != "off":
+            fingerprint = layers.fingerprint_layer(
+                new_layer_dir,
+                options.base_layer,
+                paths=options.paths,
+                hash_contents=cache_mode == "content",
+            )
+            cache_key = f"{compression}:{fingerprint}"
+
+        if cache_key and self._reuse_layer(tag, cache_key, created_by=created_by):
+            emit.debug(f"Reused the layer created before from {new_layer_dir}")
+        else:
+            # The large files that did not change are spliced from the layers
+            # created before, instead of being compressed again.
+            fragments = None
+            if cache_key and self.blob_store is not None:
+                fragments = layers.LayerFragments(
+                    self.blob_store.fragments, hash_contents=cache_mode == "content"
+                )
+            with layout.new_layer(
+                current_tag,
+                new_tag=tag,
+                created_by=created_by,
+                compression=compression,
+                fragmented=fragments is not None,
+            ) as layer_stream:
+                layers.archive_layer(
+                    new_layer_dir,
+                    layer_stream,
+                    options.base_layer,
+                    paths=options.paths,
+                    fragments=fragments,
+                )
+            if fragments is not None:
+                removed = fragments.cache.prune()
+                if removed:
+                    emit.debug(f"Evicted {len(removed)} layer fragments from the cache")
+            if cache_key and self.blob_store:
+                manifest, config = layout.read_image(tag)
+                self.blob_store.cache_layer(
+                    cache_key,
+                    manifest["layers"][-1],
+                    config["rootfs"]["diff_ids"][-1],
+                )
 
-        temp_file = Path(self.path, f".temp_layer.{os.getpid()}.tar")
-        temp_file.unlink(missing_ok=True)
+        name = self.image_name.split(":", 1)[0]
+        return replace(
+            self,
+            image_name=f"{name}:{tag}",
+            compression=compression,
+            source_digest=None,
+        )
 
-        try:
-            layers.archive_layer(new_layer_dir, temp_file, base_layer_dir)
-            _add_layer_into_image(image_path, temp_file, **{"--tag": tag})
-        finally:
-            temp_file.unlink(missing_ok=True)
+    def squash(self, tag: str) -> "Image":
+        """Merge all the layers of the image, the base ones included, into one.
+
+        The whiteouts and opaque directories of each layer are applied to the
+        ones below while streaming through them, without unpacking the image.
+
+        :param tag: The tag of the image with the merged layer.
+        """
+        layout, current_tag = self._get_layout()
+        manifest, config = layout.read_image(current_tag)
+        layer_openers = [
+            functools.partial(
+                open_layer, layout.blob_path(layer["digest"]), layer["mediaType"]
+            )
+            for layer in manifest["layers"]
+        ]
+        emit.debug(f"Squashing {len(layer_openers)} layers of {self.image_name}")
+
+        # The history of the merged layers goes with them.
+        config["rootfs"] = {"type": "layers", "diff_ids": []}
+        config["history"] = []
+        layout.write_image(tag, {**manifest, "layers": []}, config)
+        with layout.new_layer(
+            tag, created_by="rockcraft squash", compression=self.compression
+        ) as layer_stream:
+            layers.squash_layers(layer_openers, layer_stream)
 
         name = self.image_name.split(":", 1)[0]
-        return self.__class__(image_name=f"{name}:{tag}", path=self.path)
+        return replace(self, image_name=f"{name}:{tag}", source_digest=None)
 
     def add_user(
         self,
         prime_dir: Path,
-        base_layer_dir: Path,
         tag: str,
         username: str,
         uid: int,
+        options: LayerOptions | None = None,
     ) -> None:
         """Create a new rock user.
 
         :param prime_dir: Path to the user-defined parts' primed content.
-        :param base_layer_dir: Path to the base layer's root filesystem.
         :param tag: The rock's image tag.
         :param username: Username to be created. Same as group name.
         :param uid: UID of the username to be created. Same as GID.
+        :param options: The base layer to read the existing users from, and
+            how to add the layer with the user files.
         """
         # pylint: disable=too-many-arguments
+        options = options or LayerOptions()
         user_files = {"passwd": "", "group": "", "shadow": ""}
 
         prime_dir_etc = prime_dir / "etc"
-        base_layer_dir_etc = base_layer_dir / "etc"
         # Being cautious about possible changes (edits or removals) in
         # /etc/{passwd,group,shadow} done by the user through overlay scripts.
         # Basically:
@@ -247,10 +581,10 @@ class Image:
         for u_file in user_files:
             if (prime_dir_etc / u_file).exists():
                 user_files[u_file] = (prime_dir_etc / u_file).read_text()
-            elif (base_layer_dir_etc / u_file).exists() and not (
-                prime_dir_etc / f".wh.{u_file}"
-            ).exists():
-                user_files[u_file] = (base_layer_dir_etc / u_file).read_text()
+            elif not (prime_dir_etc / f".wh.{u_file}").exists():
+                user_files[u_file] = _read_base_file(
+                    f"etc/{u_file}", options.base_layer
+                )
 
         if (  # pylint: disable=too-many-boolean-expressions
             f"\n{username}:" in user_files["passwd"]
@@ -273,8 +607,8 @@ class Image:
         ] += f"{username}:x:{uid}:{uid}::/{Pebble.PEBBLE_PATH}:/usr/bin/false\n"
         user_files["group"] += f"{username}:x:{uid}:\n"
 
-        with tempfile.TemporaryDirectory() as tmpfs:
-            tmpfs_etc = Path(tmpfs) / "etc"
+        with self._new_layer_dir(tag, options) as tmpfs:
+            tmpfs_etc = tmpfs / "etc"
             tmpfs_etc.mkdir(parents=True, exist_ok=True)
             with open(tmpfs_etc / "passwd", "a+") as passwdf:
                 passwdf.write(user_files["passwd"])
@@ -283,7 +617,9 @@ class Image:
                 groupf.write(user_files["group"])
 
             if user_files["shadow"]:
-                days_since_epoch = (datetime.utcnow() - datetime(1970, 1, 1)).days
+                days_since_epoch = (
+                    get_build_time() - datetime.fromtimestamp(0, timezone.utc)
+                ).days
 
                 # only add the shadow file if there's already one in the base image
                 with open(tmpfs_etc / "shadow", "a+") as shadowf:
@@ -293,7 +629,6 @@ class Image:
                     )
 
             emit.progress(f"Adding user {username}:{uid} with group {username}:{uid}")
-            self.add_layer(tag, Path(tmpfs))
 
     def stat(self) -> dict[str, Any]:
         """Obtain the image statistics, as reported by "umoci stat --json"."""
@@ -304,6 +639,19 @@ class Image:
         result: dict[str, Any] = json.loads(output)
         return result
 
+    def get_source_digest(self, source_image: str) -> bytes:
+        """Obtain the digest of the image this one was obtained as.
+
+        The digest recorded when the image was fetched or created is used if
+        there is one, and otherwise it's looked up remotely.
+
+        :param source_image: the source image name, it its full form (e.g. docker://ubuntu:22.04)
+        :returns: The image digest bytes.
+        """
+        if self.source_digest is not None:
+            return bytes.fromhex(self.source_digest.split(":", 1)[-1])
+        return self.digest(source_image)
+
     @staticmethod
     def digest(source_image: str) -> bytes:
         """Obtain the image digest, given its full form name {transport}:{name}.
@@ -325,68 +673,65 @@ class Image:
         parts = output.split(":", 1)
         return bytes.fromhex(parts[-1])
 
-    def to_docker_daemon(self, tag: str) -> None:
+    def to_docker_daemon(self, tag: str, *, repo_tag: str | None = None) -> None:
         """Export the current image to the local docker daemon.
 
+        The image is streamed to the daemon as a Docker archive, straight from
+        the image's layout.
+
         :param tag: The tag to export.
+        :param repo_tag: The ``name:tag`` of the image in the daemon; by
+            default, the image's name and ``tag``.
         """
         name = self.image_name.split(":", 1)[0]
-        src_path = self.path / f"{name}:{tag}"
-        _copy_image(f"oci:{str(src_path)}", f"docker-daemon:{name}:{tag}")
+        layout = oci_layout.ImageLayout(self.path / name)
+        archive = layout.get_archive(tag, repo_tag=repo_tag or f"{name}:{tag}")
+        loaded = docker.DockerDaemon.from_environment().load(archive)
+        emit.debug(f"Loaded into the Docker daemon: {', '.join(loaded)}")
 
-    def to_oci_archive(self, tag: str, filename: str) -> None:
+    def to_oci_archive(
+        self, tag: str, filename: str, *, repo_tag: str | None = None
+    ) -> None:
         """Export the current image to a tar archive in OCI format.
 
+        Only the blobs of the exported image are archived, streamed from the
+        image's layout without any processing.
+
         :param tag: The tag to export.
+        :param repo_tag: The Docker ``name:tag`` of the image, to make the
+            archive a Docker archive too.
         """
         name = self.image_name.split(":", 1)[0]
-        src_path = self.path / f"{name}:{tag}"
-        _copy_image(f"oci:{str(src_path)}", f"oci-archive:{filename}:{tag}")
+        layout = oci_layout.ImageLayout(self.path / name)
+        layout.export_archive(tag, Path(filename), repo_tag=repo_tag)
+
+    def edit_config(self) -> "ImageConfigEditor":
+        """Start a transaction to edit the image config and manifest.
+
+        The returned editor is a context manager: all the changes done through
+        it are written at once, as a single new config and manifest, when the
+        ``with`` block exits without errors.
+        """
+        layout, tag = self._get_layout()
+        return ImageConfigEditor(layout, tag)
 
     def set_default_user(self, user: str) -> None:
         """Set the default runtime user for the OCI image.
 
         :param user: name of the default user (must already exist)
         """
-        image_path = self.path / self.image_name
-        params = ["--clear=config.entrypoint", "--config.user", user]
-        _config_image(image_path, params)
-        emit.progress(f"Default user set to {user}")
+        with self.edit_config() as config:
+            config.set_default_user(user)
 
     def set_entrypoint(self, entrypoint_service: str | None = None) -> None:
         """Set the OCI image entrypoint. It is always Pebble."""
-        emit.progress("Configuring entrypoint...")
-        image_path = self.path / self.image_name
-        entrypoint = [f"/{Pebble.PEBBLE_BINARY_PATH}", "enter", "--verbose"]
-        if entrypoint_service:
-            entrypoint.extend(["--args", entrypoint_service])
-        params = ["--clear=config.entrypoint"]
-        for entry in entrypoint:
-            params.extend(["--config.entrypoint", entry])
-        params.extend(["--clear=config.cmd"])
-        _config_image(image_path, params)
-        emit.progress(f"Entrypoint set to {entrypoint}")
+        with self.edit_config() as config:
+            config.set_entrypoint(entrypoint_service)
 
     def set_cmd(self, command: str | None = None) -> None:
         """Set the OCI image CMD."""
-        emit.progress("Configuring CMD...")
-        image_path = self.path / self.image_name
-        cmd_params = ["--clear=config.cmd"]
-        command_sh_args = shlex.split(command or "")
-        try:
-            opt_args = command_sh_args[
-                command_sh_args.index("[") + 1 : command_sh_args.index("]")
-            ]
-        except ValueError:
-            emit.debug(
-                f"The entrypoint-service command '{command}' has no default "
-                + "arguments. CMD won't be set."
-            )
-            return
-        for arg in opt_args:
-            cmd_params.extend(["--config.cmd", arg])
-        _config_image(image_path, cmd_params)
-        emit.progress(f"CMD set to {opt_args}")
+        with self.edit_config() as config:
+            config.set_cmd(command)
 
     def set_pebble_layer(
         self,
@@ -396,7 +741,7 @@ class Image:
         tag: str,
         summary: str,
         description: str,
-        base_layer_dir: Path,
+        options: LayerOptions | None = None,
     ) -> None:
         """Write the provided services and checks into a Pebble layer in the filesystem.
 
@@ -406,7 +751,8 @@ class Image:
         :param tag: The rock's image tag
         :param summary: The summary for the Pebble layer
         :param description: The description for the Pebble layer
-        :param base_layer_dir: Path to the base layer's root filesystem
+        :param options: The base layer to read the existing Pebble layers from,
+            and how to add the image layer with the Pebble layer file
         """
         # pylint: disable=too-many-arguments
         pebble_layer_content: dict[str, Any] = {
@@ -424,15 +770,13 @@ class Image:
             emit.progress(f"Configuring Pebble checks {', '.join(list(checks.keys()))}")
             pebble_layer_content["checks"] = checks
 
+        options = options or LayerOptions()
         pebble = Pebble()
-        with tempfile.TemporaryDirectory() as tmpfs:
-            tmpfs_path = Path(tmpfs)
+        with self._new_layer_dir(tag, options) as tmpfs_path:
             pebble.define_pebble_layer(
-                tmpfs_path, base_layer_dir, pebble_layer_content, name
+                tmpfs_path, options.base_layer, pebble_layer_content, name
             )
-
             emit.progress("Writing new Pebble layer file")
-            self.add_layer(tag, tmpfs_path)
 
     def set_environment(self, env: dict[str, str]) -> None:
         """Set the OCI image environment.
@@ -440,25 +784,20 @@ class Image:
         :param env: A dictionary mapping environment variables to
             their values.
         """
-        emit.progress("Configuring OCI environment...")
-        image_path = self.path / self.image_name
-        params: list[str] = []
-        env_list: list[str] = []
-
-        for name, value in env.items():
-            env_item = f"{name}={value}"
-            env_list.append(env_item)
-            params.extend(["--config.env", env_item])
-        _config_image(image_path, params)
-        emit.progress(f"Environment set to {env_list}")
+        with self.edit_config() as config:
+            config.set_environment(env)
 
-    def set_control_data(self, metadata: dict[str, Any]) -> None:
+    def set_control_data(
+        self, metadata: dict[str, Any], *, layer_dir: Path | None = None
+    ) -> None:
         """Create and populate the rock's control data folder.
 
         :param metadata: content for the rock's metadata YAML file
+        :param layer_dir: A directory to write the control data folder to,
+            instead of adding a layer with it
         """
         emit.progress("Setting the rock's control data")
-        local_control_data_path = Path(tempfile.mkdtemp())
+        local_control_data_path = layer_dir or Path(tempfile.mkdtemp())
 
         # the rock control data structure starts with the folder ".rock"
         control_data_rock_folder = local_control_data_path / ".rock"
@@ -468,15 +807,14 @@ class Image:
         with rock_metadata_file.open("w", encoding="utf-8") as rock_meta:
             yaml.dump(metadata, rock_meta)
         rock_metadata_file.chmod(0o644)
+        if layer_dir:
+            return
 
-        temp_tar_file = Path(self.path, f".temp_layer.control_data.{os.getpid()}.tar")
-        temp_tar_file.unlink(missing_ok=True)
-
-        try:
-            layers.archive_layer(local_control_data_path, temp_tar_file)
-            _add_layer_into_image(self.path / self.image_name, temp_tar_file)
-        finally:
-            temp_tar_file.unlink(missing_ok=True)
+        layout, tag = self._get_layout()
+        with layout.new_layer(
+            tag, created_by="rockcraft set-control-data", compression=self.compression
+        ) as layer_stream:
+            layers.archive_layer(local_control_data_path, layer_stream)
 
         emit.progress("Control data written")
         shutil.rmtree(local_control_data_path)
@@ -484,121 +822,350 @@ class Image:
     def set_annotations(self, annotations: dict[str, Any]) -> None:
         """Add the given annotations to the final image.
 
+        :param annotations: A dictionary with each annotation/label and its value
+        """
+        with self.edit_config() as config:
+            config.set_annotations(annotations)
+
+    def _reuse_layer(self, tag: str, cache_key: str, *, created_by: str) -> bool:
+        """Append the layer cached for ``cache_key`` to the image, if there is one.
+
+        :returns: Whether the layer was in the blob store.
+        """
+        cached = (
+            self.blob_store.get_cached_layer(cache_key) if self.blob_store else None
+        )
+        if cached is None or self.blob_store is None:
+            return False
+
+        layout, current_tag = self._get_layout()
+        digest = cached.descriptor["digest"]
+        self.blob_store.link_blob(digest, layout.blob_path(digest))
+        layout.append_layer(
+            current_tag,
+            cached.descriptor,
+            diff_id=cached.diff_id,
+            new_tag=tag,
+            created_by=created_by,
+        )
+        return True
+
+    @contextlib.contextmanager
+    def _new_layer_dir(self, tag: str, options: LayerOptions) -> Iterator[Path]:
+        """Get a directory for the files of a new layer, added to the image as ``tag``.
+
+        If the ``layer_dir`` of ``options`` is set, it is returned instead, and
+        no layer is added: the caller adds it, possibly with the files of other
+        steps. Otherwise the layer is added with the compression of ``options``.
+        """
+        if options.layer_dir:
+            yield options.layer_dir
+            return
+
+        with tempfile.TemporaryDirectory() as tmpfs:
+            yield Path(tmpfs)
+            self.add_layer(
+                tag,
+                Path(tmpfs),
+                LayerOptions(compression=options.compression, reuse=False),
+            )
+
+    def _get_layout(self) -> tuple[oci_layout.ImageLayout, str]:
+        """Get the OCI layout holding this image, and the image's tag in it."""
+        name, tag = self.image_name.split(":", 1)
+        return oci_layout.ImageLayout(self.path / name, blob_store=self.blob_store), tag
+
+
+class ImageConfigEditor:
+    """Accumulate changes to an image's config and manifest, and commit them at once.
+
+    Use it through ``Image.edit_config()``::
+
+        with image.edit_config() as config:
+            config.set_entrypoint()
+            config.set_environment({"FOO": "bar"})
+
+    :param layout: The OCI layout holding the image.
+    :param tag: The tag of the image to edit.
+    """
+
+    def __init__(self, layout: oci_layout.ImageLayout, tag: str) -> None:
+        self._layout = layout
+        self._tag = tag
+        self._manifest, self._config = layout.read_image(tag)
+        self._changed = False
+
+    def __enter__(self) -> "ImageConfigEditor":
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *_: Any) -> None:
+        if exc_type is None:
+            self.commit()
+
+    def _edit_runtime_config(self) -> dict[str, Any]:
+        """Get the runtime ("config") section of the image config, for editing."""
+        runtime_config: dict[str, Any] = self._config.setdefault("config", {})
+        self._changed = True
+        return runtime_config
+
+    def commit(self) -> None:
+        """Write the new image config and manifest, if anything changed."""
+        if not self._changed:
+            return
+        self._layout.write_image(self._tag, self._manifest, self._config)
+        self._changed = False
+
+    def set_default_user(self, user: str) -> None:
+        """Set the default runtime user for the OCI image.
+
+        :param user: name of the default user (must already exist)
+        """
+        runtime_config = self._edit_runtime_config()
+        runtime_config.pop("Entrypoint", None)
+        runtime_config["User"] = user
+        emit.progress(f"Default user set to {user}")
+
+    def set_entrypoint(self, entrypoint_service: str | None = None) -> None:
+        """Set the OCI image entrypoint. It is always Pebble."""
+        emit.progress("Configuring entrypoint...")
+        entrypoint = [f"/{Pebble.PEBBLE_BINARY_PATH}", "enter", "--verbose"]
+        if entrypoint_service:
+            entrypoint.extend(["--args", entrypoint_service])
+        runtime_config = self._edit_runtime_config()
+        runtime_config["Entrypoint"] = entrypoint
+        runtime_config.pop("Cmd", None)
+        emit.progress(f"Entrypoint set to {entrypoint}")
+
+    def set_cmd(self, command: str | None = None) -> None:
+        """Set the OCI image CMD."""
+        emit.progress("Configuring CMD...")
+        command_sh_args = shlex.split(command or "")
+        try:
+            opt_args = command_sh_args[
+                command_sh_args.index("[") + 1 : command_sh_args.index("]")
+            ]
+        except ValueError:
+            emit.debug(
+                f"The entrypoint-service command '{command}' has no default "
+                + "arguments. CMD won't be set."
+            )
+            return
+        self._edit_runtime_config()["Cmd"] = opt_args
+        emit.progress(f"CMD set to {opt_args}")
+
+    def set_environment(self, env: dict[str, str]) -> None:
+        """Set the OCI image environment.
+
+        Variables already defined in the image are overridden; all others are
+        kept.
+
+        :param env: A dictionary mapping environment variables to
+            their values.
+        """
+        emit.progress("Configuring OCI environment...")
+        runtime_config = self._edit_runtime_config()
+        current_env: list[str] = runtime_config.get("Env") or []
+        new_env = {item.split("=", 1)[0]: item for item in current_env}
+        env_list: list[str] = []
+
+        for name, value in env.items():
+            env_item = f"{name}={value}"
+            env_list.append(env_item)
+            new_env[name] = env_item
+        runtime_config["Env"] = list(new_env.values())
+        emit.progress(f"Environment set to {env_list}")
+
+    def set_annotations(self, annotations: dict[str, Any]) -> None:
+        """Set the image labels, and the manifest annotations as a copy of them.
+
         :param annotations: A dictionary with each annotation/label and its value
         """
         emit.progress("Configuring labels and annotations...")
-        image_path = self.path / self.image_name
-        label_params = ["--clear=config.labels"]
-        annotation_params = ["--clear=manifest.annotations"]
-
-        labels_list: list[str] = []
-        for label_key, label_value in annotations.items():
-            label_item = f"{label_key}={label_value}"
-            labels_list.append(label_item)
-            label_params.extend(["--config.label", label_item])
-            annotation_params.extend(["--manifest.annotation", label_item])
-        # Set the labels
-        _config_image(image_path, label_params)
+        labels = {key: str(value) for key, value in annotations.items()}
+        self._edit_runtime_config()["Labels"] = labels
         # Set the annotations as a copy of these labels (for OCI compliance only)
-        _config_image(image_path, annotation_params)
+        self._manifest["annotations"] = dict(labels)
+        labels_list = [f"{key}={value}" for key, value in labels.items()]
         emit.progress(f"Labels and annotations set to {labels_list}")
 
 
-def _copy_image(
-    source: str,
-    destination: str,
-    *system_params: str,
-    copy_params: list[str] | None = None,
+def pack_image_index(
+    archives: list[Path], *, tag: str, image_dir: Path, filename: str
 ) -> None:
-    """Transfer images from source to destination.
+    """Pack the images in several rocks into a single rock with an image index.
 
-    :param copy_params: Extra parameters to pass specifically to the "copy"
-        skopeo command (and not to skopeo itself).
+    The index lists the image of each rock under its platform. Blobs shared by
+    the images, such as identical layers, are stored only once.
+
+    :param archives: The rocks to pack, each for a different platform.
+    :param tag: The tag of the images in the rocks, and of the new index.
+    :param image_dir: The directory to assemble the index in.
+    :param filename: The path of the new rock.
     """
-    copy_extra = copy_params if copy_params else []
-    _process_run(
-        [
-            "skopeo",
-            "--insecure-policy",
-        ]
-        + list(system_params)
-        + [
-            "copy",
-            *copy_extra,
-            source,
-            destination,
-        ]
+    shutil.rmtree(image_dir, ignore_errors=True)
+    layout = oci_layout.ImageLayout.init(image_dir)
+
+    tags: list[str] = []
+    for number, archive in enumerate(archives):
+        if not archive.is_file():
+            raise errors.RockcraftError(f"Rock {str(archive)!r} not found")
+        image_tag = f"{tag}-{number}"
+        layout.import_archive(archive, tag, image_tag)
+        tags.append(image_tag)
+    layout.create_index(tag, tags)
+    layout.export_archive(tag, Path(filename))
+
+
+def _get_layer_cache_mode() -> str:
+    """Get the layer cache mode set in the ``ROCKCRAFT_LAYER_CACHE`` environment."""
+    mode = os.getenv(LAYER_CACHE_ENV, "stat")
+    if mode not in LAYER_CACHE_MODES:
+        raise errors.RockcraftError(
+            f"Invalid value for {LAYER_CACHE_ENV}: {mode!r}",
+            resolution="Set it to 'stat', 'content' or 'off'.",
+        )
+    return mode
+
+
+def _read_base_file(path: str, base_layer: Path | BaseIndex | None) -> str:
+    """Read a file of the base layer, or return an empty string if missing."""
+    if isinstance(base_layer, BaseIndex):
+        content = base_layer.read_bytes(path)
+        return content.decode() if content is not None else ""
+    if base_layer is not None and (base_layer / path).exists():
+        return (base_layer / path).read_text()
+    return ""
+
+
+def _fetch_into_blob_store(
+    image_name: str,
+    image_dir: Path,
+    blob_store: oci_layout.BlobStore,
+    source: BaseSource,
+    platform: ArchitectureMapping,
+) -> str:
+    """Obtain an image from the ``source`` registry, reusing its cached copy if current.
+
+    :param image_name: The image to retrieve, in ``name:tag`` format.
+    :param blob_store: The blob store of the ``source``, to cache the image in.
+    :returns: The digest of the image in the registry.
+    """
+    name, tag = image_name.split(":", 1)
+    # Keyed like when images were fetched with skopeo, to keep using them.
+    platform_params = ["--override-arch", platform.go_arch]
+    if platform.go_variant:
+        platform_params += ["--override-variant", platform.go_variant]
+    reference = " ".join([f"docker://{source.registry}/{image_name}", *platform_params])
+    layout = oci_layout.ImageLayout.open(image_dir / name, blob_store=blob_store)
+
+    cached = blob_store.get_cached_image(reference)
+    if cached is not None and (
+        source.offline or not source.revalidation.needs_check(cached.validated)
+    ):
+        if blob_store.restore_image(cached, layout, tag):
+            emit.debug(f"Using cached {image_name} ({cached.digest})")
+            return cached.digest
+    if source.offline:
+        raise _not_available_offline(image_name)
+
+    image = _get_remote_image(source.registry, name, tag)
+    digest = image.registry.get_digest(image.repository, tag)
+
+    if cached is not None and cached.digest == digest:
+        if blob_store.restore_image(cached, layout, tag):
+            blob_store.mark_validated(cached)
+            emit.debug(f"Using cached {image_name} ({digest}), which is up to date")
+            return digest
+
+    if cached is not None:
+        # Layers shared with the previous version needn't be downloaded again.
+        layout.link_shared_blobs(cached.blobs)
+
+    # Fetch exactly the checked manifest, even if the tag moves meanwhile.
+    _pull_image(replace(image, reference=digest), layout, tag, platform)
+    layout.prune_blobs()
+    blob_store.cache_image(reference, digest, layout, tag)
+    return digest
+
+
+def _get_remote_image(
+    registry_url: str, name: str, reference: str
+) -> registry.RemoteImage:
+    """Get image ``name`` at ``reference`` in the registry at ``registry_url``."""
+    host, _, namespace = registry_url.partition("/")
+    repository = f"{namespace}/{name}" if namespace else name
+    return registry.RemoteImage(
+        registry.Registry.from_host(host), repository, reference
     )
 
 
-def _config_image(image_path: Path, params: list[str]) -> None:
-    """Configure the OCI image."""
-    _process_run(["umoci", "config", "--image", str(image_path)] + params)
+def _pull_image(
+    image: registry.RemoteImage,
+    layout: oci_layout.ImageLayout,
+    tag: str,
+    platform: ArchitectureMapping,
+) -> str:
+    """Pull ``image`` for ``platform`` into ``layout``.
 
+    :returns: The digest of the image's reference in the registry.
+    """
+    emit.progress(f"Pulling {image.registry.host}/{image.repository}:{tag}")
+    return registry.pull_image(
+        image,
+        layout,
+        tag,
+        architecture=platform.go_arch,
+        variant=platform.go_variant,
+    )
 
-def _add_layer_into_image(
-    image_path: Path, archived_content: Path, **kwargs: str
-) -> None:
-    """Add raw layer (archived) into the OCI image.
 
-    :param image_path: path of the OCI image, in the format <image>:<tar>
-    :param archived_content: path to the archived content to be added
-    """
-    cmd = [
-        "umoci",
-        "raw",
-        "add-layer",
-        "--image",
-        str(image_path),
-        str(archived_content),
-    ] + [arg_val for k, v in kwargs.items() for arg_val in [k, v]]
-    _process_run(cmd + ["--history.created_by", " ".join(cmd)])
-
-
-def _inject_architecture_variant(image_path: Path, variant: str) -> None:
-    """Inject architecture variant into existing OCI Image config.
-
-    :param image_path: path of the OCI image, in the format <image>:<tar>
-    :param variant: name of the variant to inject in the OCI config
+def _copy_from_layout(
+    source: Path,
+    image_name: str,
+    layout: oci_layout.ImageLayout,
+    tag: str,
+    platform: ArchitectureMapping,
+) -> str:
+    """Copy the image tagged ``image_name`` in the layout at ``source`` into ``layout``.
+
+    Multi-platform images are resolved to the image for the given platform.
+
+    :returns: The digest of the image in ``source``.
     """
-    # pylint: disable=too-many-locals
-    blobs_path = image_path / "blobs" / "sha256"
-    # Get the top level OCI index
-    tl_index_path = image_path / "index.json"
-    tl_index = json.loads(tl_index_path.read_bytes())
-
-    # Since this is a 1-arch OCI image, the OCI top level index
-    # points to a manifest (otherwise it would be a manifest list)
-    manifest_digest = tl_index["manifests"][0]["digest"].split(":")[-1]
-    manifest_path = blobs_path / manifest_digest
-    manifest_content = json.loads(manifest_path.read_bytes())
-
-    # Get the current OCI Image Config
-    image_config_digest = manifest_content["config"]["digest"].split(":")[-1]
-    image_config_path = blobs_path / image_config_digest
-    image_config_content = json.loads(image_config_path.read_bytes())
-
-    # Set the variant
-    image_config_content["variant"] = variant
-
-    # The OCI image config has changed, so now we need to
-    # regenerate the digests
-    new_image_config_bytes = json.dumps(image_config_content).encode("utf-8")
-    new_image_config_digest = hashlib.sha256(new_image_config_bytes).hexdigest()
-    new_image_config_path = blobs_path / new_image_config_digest
-    new_image_config_path.write_bytes(new_image_config_bytes)
-
-    manifest_content["config"]["digest"] = f"sha256:{new_image_config_digest}"
-    manifest_content["config"]["size"] = len(new_image_config_bytes)
-
-    new_manifest_bytes = json.dumps(manifest_content).encode("utf-8")
-    new_manifest_digest = hashlib.sha256(new_manifest_bytes).hexdigest()
-    new_manifest_path = blobs_path / new_manifest_digest
-    new_manifest_path.write_bytes(new_manifest_bytes)
-
-    tl_index["manifests"][0]["digest"] = f"sha256:{new_manifest_digest}"
-    tl_index["manifests"][0]["size"] = len(new_manifest_bytes)
-    tl_index_path.write_bytes(json.dumps(tl_index).encode("utf-8"))
+    mirror = oci_layout.ImageLayout(source)
+    descriptor = mirror.get_descriptor(image_name)
+    if descriptor.get("mediaType") == oci_layout.MEDIA_TYPE_INDEX:
+        platform_digest = registry.select_manifest(
+            mirror.read_json_blob(descriptor["digest"]),
+            platform.go_arch,
+            platform.go_variant,
+        )
+        if platform_digest is None:
+            raise errors.RockcraftError(
+                f"No image for {platform.go_arch} in {source}:{image_name}"
+            )
+        platform_descriptor = {
+            "mediaType": oci_layout.MEDIA_TYPE_MANIFEST,
+            "digest": platform_digest,
+            "size": mirror.blob_path(platform_digest).stat().st_size,
+        }
+    else:
+        platform_descriptor = {
+            key: value for key, value in descriptor.items() if key != "annotations"
+        }
+    emit.progress(f"Copying {image_name} from {source}")
+    mirror.copy_manifest(platform_descriptor, layout, tag)
+    return str(descriptor["digest"])
+
+
+def _not_available_offline(image_name: str) -> errors.RockcraftError:
+    return errors.RockcraftError(
+        f"Base image {image_name} is not available offline",
+        resolution=(
+            "Run once without --offline to cache it, or set "
+            f"{BASE_MIRROR_ENV} to a local OCI layout holding it."
+        ),
+    )
 
 
 def _process_run(command: list[str], **kwargs: Any) -> subprocess.CompletedProcess[Any]:
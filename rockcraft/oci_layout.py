@@ -0,0 +1,1149 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process handling of OCI image layouts.
+
+An OCI image layout is a directory containing an ``oci-layout`` marker file, an
+``index.json`` file listing the tagged manifests and a content-addressable
+``blobs/`` store holding manifests, image configs and layers. This module reads
+and writes such layouts directly, without going through external tools.
+"""
+
+import contextlib
+import dataclasses
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import posixpath
+import secrets
+import shutil
+import tarfile
+import tempfile
+import time
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import IO, Any
+
+from rockcraft import errors
+from rockcraft.compression import (
+    DEFAULT_LAYER_COMPRESSION,
+    FragmentCache,
+    LayerCompression,
+    LayerWriter,
+    get_layer_writer,
+)
+from rockcraft.utils import get_build_time
+
+MEDIA_TYPE_INDEX = "application/vnd.oci.image.index.v1+json"
+MEDIA_TYPE_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MEDIA_TYPE_CONFIG = "application/vnd.oci.image.config.v1+json"
+
+ANNOTATION_REF_NAME = "org.opencontainers.image.ref.name"
+
+LAYOUT_VERSION = "1.0.0"
+
+# The ioctl to share the data of a file with another one (a "reflink").
+_FICLONE = 0x40049409
+
+# The errors of copy_file_range() and sendfile() when they can't copy the data.
+_UNSUPPORTED_COPY_ERRORS = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+)
+
+
+def sha256_digest(data: bytes) -> str:
+    """Get the digest of ``data``, in ``sha256:<hex>`` form."""
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+def now_timestamp() -> str:
+    """Get the build time as an RFC 3339 timestamp, as used in OCI configs.
+
+    See ``utils.get_build_time()``.
+    """
+    return get_build_time().isoformat().replace("+00:00", "Z")
+
+
+class BlobWriter:
+    """Write a blob into a layout, computing its digest while streaming.
+
+    The data is written to a temporary file inside the layout's blob directory
+    and only moved to its content-addressed location by ``commit()``.
+
+    :param blobs_dir: The ``blobs/sha256`` directory of the target layout.
+    """
+
+    def __init__(self, blobs_dir: Path) -> None:
+        blobs_dir.mkdir(parents=True, exist_ok=True)
+        self._blobs_dir = blobs_dir
+        self._hash = hashlib.sha256()
+        self._size = 0
+        fd, name = tempfile.mkstemp(prefix=".tmp-blob.", dir=blobs_dir)
+        self._temp_path = Path(name)
+        self._file: IO[bytes] = os.fdopen(fd, "wb")
+
+    def write(self, data: bytes) -> int:
+        """Write ``data`` to the blob."""
+        self._hash.update(data)
+        self._size += len(data)
+        self._file.write(data)
+        return len(data)
+
+    def write_file(self, path: Path) -> None:
+        """Write the content of the file at ``path`` to the blob.
+
+        The file is read to hash it, but copied with ``copy_file_data()``, so
+        that filesystems supporting it can share its data with the blob.
+        """
+        self._file.flush()
+        with path.open("rb") as source:
+            while chunk := source.read(1024 * 1024):
+                self._hash.update(chunk)
+            size = source.tell()
+            source.seek(0)
+            copy_file_data(source.fileno(), self._file.fileno(), size)
+        self._size += size
+
+    @property
+    def digest(self) -> str:
+        """The digest of the data written so far, in ``sha256:<hex>`` form."""
+        return f"sha256:{self._hash.hexdigest()}"
+
+    @property
+    def size(self) -> int:
+        """The number of bytes written so far."""
+        return self._size
+
+    def commit(self) -> tuple[str, int]:
+        """Move the blob into its final location.
+
+        :returns: The blob digest and size.
+        """
+        self._file.close()
+        os.chmod(self._temp_path, 0o644)
+        os.replace(self._temp_path, self._blobs_dir / self._hash.hexdigest())
+        return self.digest, self._size
+
+    def abort(self) -> None:
+        """Discard the blob being written."""
+        self._file.close()
+        self._temp_path.unlink(missing_ok=True)
+
+
+class BlobStore:
+    """A content-addressed store of blobs, shared by the image layouts of a host.
+
+    Layouts reference the blobs in the store through hardlinks (or copies, if
+    the layout is in a different filesystem), so that blobs common to several
+    layouts, like the layers of a popular base image, are stored only once.
+    This is safe because blob files are never modified in place.
+
+    The store also remembers the blobs of the images fetched from registries,
+    so that they can be provided to new layouts before fetching the same image,
+    and the layers created from directories, so that they can be reused if the
+    directories did not change. If only some files did, the compressed tar
+    members of the large files kept in ``fragments`` still save compressing
+    those again.
+
+    :param path: The root directory of the store.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    @property
+    def blobs_dir(self) -> Path:
+        """The directory holding the sha256 blobs of this store."""
+        return self.path / "blobs" / "sha256"
+
+    @property
+    def fragments(self) -> FragmentCache:
+        """The cache of the fragments of the layers created from directories."""
+        return FragmentCache(self.path / "fragments")
+
+    def blob_path(self, digest: str) -> Path:
+        """Get the path to the blob with the given ``sha256:<hex>`` digest."""
+        return _blob_path(self.blobs_dir, digest)
+
+    def has_blob(self, digest: str) -> bool:
+        """Whether the blob with the given digest exists in the store."""
+        return self.blob_path(digest).is_file()
+
+    def add_blob(self, digest: str, source: Path) -> None:
+        """Add the blob file at ``source`` to the store, unless already present."""
+        if self.has_blob(digest):
+            return
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(source, self.blob_path(digest))
+
+    def link_blob(self, digest: str, destination: Path) -> bool:
+        """Make ``destination`` a link to the stored blob with the given digest.
+
+        :returns: Whether the blob was in the store.
+        """
+        if not self.has_blob(digest):
+            return False
+        source = self.blob_path(digest)
+        if not _is_same_file(source, destination):
+            _link_or_copy(source, destination)
+        return True
+
+    def get_cached_image(self, reference: str) -> "CachedImage | None":
+        """Get the record of the image last fetched for ``reference``, if any."""
+        record = self._reference_record(reference)
+        if not record.is_file():
+            return None
+        return CachedImage(**json.loads(record.read_bytes()))
+
+    def cache_image(
+        self, reference: str, digest: str, layout: "ImageLayout", tag: str
+    ) -> "CachedImage":
+        """Put a freshly fetched image in the store, and record it for ``reference``.
+
+        :param reference: The reference the image was fetched with.
+        :param digest: The digest of the image's manifest in the registry.
+        :param layout: The layout the image was fetched into.
+        :param tag: The tag of the image in ``layout``.
+        """
+        blobs = layout.image_blobs(tag)
+        for blob in blobs:
+            if not self.link_blob(blob, layout.blob_path(blob)):
+                self.add_blob(blob, layout.blob_path(blob))
+        descriptor = layout.get_descriptor(tag)
+        descriptor.pop("annotations", None)
+        image = CachedImage(
+            reference=reference,
+            digest=digest,
+            descriptor=descriptor,
+            blobs=blobs,
+            validated=time.time(),
+        )
+        self._write_record(image)
+        return image
+
+    def mark_validated(self, image: "CachedImage") -> "CachedImage":
+        """Record that ``image`` was just found to be up to date."""
+        image = dataclasses.replace(image, validated=time.time())
+        self._write_record(image)
+        return image
+
+    def restore_image(
+        self, image: "CachedImage", layout: "ImageLayout", tag: str
+    ) -> bool:
+        """Link a cached image into ``layout``, tagged as ``tag``.
+
+        :returns: Whether the image could be restored, which requires all its
+            blobs to still be in the store.
+        """
+        if not all(self.has_blob(blob) for blob in image.blobs):
+            return False
+        layout.blobs_dir.mkdir(parents=True, exist_ok=True)
+        for blob in image.blobs:
+            self.link_blob(blob, layout.blob_path(blob))
+        layout.set_tag(tag, image.descriptor)
+        return True
+
+    def get_cached_layer(self, key: str) -> "CachedLayer | None":
+        """Get the layer recorded for ``key``, if its blob is still in the store.
+
+        :param key: The key the layer was recorded with, like a fingerprint of
+            the directory it was created from.
+        """
+        record = self._layer_record(key)
+        if not record.is_file():
+            return None
+        layer = CachedLayer(**json.loads(record.read_bytes()))
+        if not self.has_blob(layer.descriptor["digest"]):
+            return None
+        return layer
+
+    def cache_layer(self, key: str, descriptor: dict[str, Any], diff_id: str) -> None:
+        """Record a layer whose blob is in the store, for ``key``.
+
+        :param key: The key to get the layer with.
+        :param descriptor: The descriptor of the layer blob.
+        :param diff_id: The digest of the uncompressed layer.
+        """
+        record = self._layer_record(key)
+        record.parent.mkdir(parents=True, exist_ok=True)
+        layer = CachedLayer(descriptor=descriptor, diff_id=diff_id)
+        _write_json_atomic(record, dataclasses.asdict(layer))
+
+    def get_blob_repositories(self, host: str) -> dict[str, str]:
+        """Get the repositories of registry ``host`` known to have some blobs.
+
+        :returns: A repository for the digest of each known blob.
+        """
+        record = self._registry_record(host)
+        if not record.is_file():
+            return {}
+        repositories: dict[str, str] = json.loads(record.read_bytes())
+        return repositories
+
+    def add_blob_repository(
+        self, host: str, repository: str, digests: Iterable[str]
+    ) -> None:
+        """Record that a repository of registry ``host`` has the given blobs.
+
+        Only the latest repository of each blob is kept, which is enough for
+        the registry to mount the blob into other repositories from it.
+        """
+        record = self._registry_record(host)
+        record.parent.mkdir(parents=True, exist_ok=True)
+        repositories = self.get_blob_repositories(host)
+        repositories.update(dict.fromkeys(digests, repository))
+        _write_json_atomic(record, repositories)
+
+    def _write_record(self, image: "CachedImage") -> None:
+        record = self._reference_record(image.reference)
+        record.parent.mkdir(parents=True, exist_ok=True)
+        _write_json_atomic(record, dataclasses.asdict(image))
+
+    def _reference_record(self, reference: str) -> Path:
+        key = hashlib.sha256(reference.encode("utf-8")).hexdigest()
+        return self.path / "references" / f"{key}.json"
+
+    def _layer_record(self, key: str) -> Path:
+        key_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return self.path / "layers" / f"{key_hash}.json"
+
+    def _registry_record(self, host: str) -> Path:
+        key = hashlib.sha256(host.encode("utf-8")).hexdigest()
+        return self.path / "registries" / f"{key}.json"
+
+
+@dataclasses.dataclass(frozen=True)
+class CachedImage:
+    """The record of an image fetched from a registry into a blob store.
+
+    :param reference: The reference the image was fetched with.
+    :param digest: The digest of the image's manifest in the registry.
+    :param descriptor: The descriptor of the image's manifest in the store.
+    :param blobs: The digests of all the blobs of the image.
+    :param validated: When the image was last checked against the registry,
+        in seconds since the epoch.
+    """
+
+    reference: str
+    digest: str
+    descriptor: dict[str, Any]
+    blobs: list[str]
+    validated: float
+
+
+@dataclasses.dataclass(frozen=True)
+class CachedLayer:
+    """The record of a layer created into a blob store.
+
+    :param descriptor: The descriptor of the layer blob.
+    :param diff_id: The digest of the uncompressed layer.
+    """
+
+    descriptor: dict[str, Any]
+    diff_id: str
+
+
+class ImageLayout:
+    """An OCI image layout in the local filesystem.
+
+    Images in the layout are identified by their tag, which is stored in the
+    ``org.opencontainers.image.ref.name`` annotation of the index entry (the
+    same convention used by umoci and skopeo).
+
+    :param path: The root directory of the layout.
+    :param blob_store: An optional store to share the layout's layers with.
+    """
+
+    def __init__(self, path: Path, *, blob_store: BlobStore | None = None) -> None:
+        self.path = path
+        self.blob_store = blob_store
+
+    @classmethod
+    def init(cls, path: Path, *, blob_store: BlobStore | None = None) -> "ImageLayout":
+        """Create a new, empty layout at ``path``."""
+        path.mkdir(parents=True, exist_ok=True)
+        (path / "blobs" / "sha256").mkdir(parents=True, exist_ok=True)
+        _write_json_atomic(path / "oci-layout", {"imageLayoutVersion": LAYOUT_VERSION})
+        _write_json_atomic(path / "index.json", {"schemaVersion": 2, "manifests": []})
+        return cls(path, blob_store=blob_store)
+
+    @classmethod
+    def open(cls, path: Path, *, blob_store: BlobStore | None = None) -> "ImageLayout":
+        """Get the layout at ``path``, creating an empty one if it doesn't exist."""
+        if (path / "index.json").is_file():
+            return cls(path, blob_store=blob_store)
+        return cls.init(path, blob_store=blob_store)
+
+    @property
+    def blobs_dir(self) -> Path:
+        """The directory holding the sha256 blobs of this layout."""
+        return self.path / "blobs" / "sha256"
+
+    def blob_path(self, digest: str) -> Path:
+        """Get the path to the blob with the given ``sha256:<hex>`` digest."""
+        return _blob_path(self.blobs_dir, digest)
+
+    def has_blob(self, digest: str) -> bool:
+        """Whether the blob with the given digest exists in the layout."""
+        return self.blob_path(digest).is_file()
+
+    def blob_writer(self) -> BlobWriter:
+        """Get a writer for a new blob in this layout."""
+        return BlobWriter(self.blobs_dir)
+
+    def write_blob(self, data: bytes) -> tuple[str, int]:
+        """Store ``data`` as a blob.
+
+        :returns: The blob digest and size.
+        """
+        digest = sha256_digest(data)
+        if not self.has_blob(digest):
+            writer = self.blob_writer()
+            try:
+                writer.write(data)
+            except BaseException:
+                writer.abort()
+                raise
+            writer.commit()
+        return digest, len(data)
+
+    def write_json_blob(
+        self, content: dict[str, Any], media_type: str
+    ) -> dict[str, Any]:
+        """Serialize ``content`` and store it as a blob.
+
+        :returns: The OCI descriptor of the new blob.
+        """
+        digest, size = self.write_blob(_to_json_bytes(content))
+        return {"mediaType": media_type, "digest": digest, "size": size}
+
+    def read_json_blob(self, digest: str) -> dict[str, Any]:
+        """Load the JSON blob with the given digest."""
+        result: dict[str, Any] = json.loads(self.blob_path(digest).read_bytes())
+        return result
+
+    def read_index(self) -> dict[str, Any]:
+        """Load the layout's top-level index."""
+        result: dict[str, Any] = json.loads((self.path / "index.json").read_bytes())
+        return result
+
+    def write_index(self, index: dict[str, Any]) -> None:
+        """Replace the layout's top-level index."""
+        _write_json_atomic(self.path / "index.json", index)
+
+    def get_descriptor(self, tag: str) -> dict[str, Any]:
+        """Get the index descriptor of the manifest tagged ``tag``."""
+        for descriptor in self.read_index().get("manifests", []):
+            if descriptor.get("annotations", {}).get(ANNOTATION_REF_NAME) == tag:
+                return dict(descriptor)
+        raise errors.RockcraftError(f"Tag {tag!r} not found in image at {self.path}")
+
+    def set_tag(self, tag: str, descriptor: dict[str, Any]) -> None:
+        """Point ``tag`` at the manifest ``descriptor``, replacing any existing entry."""
+        index = self.read_index()
+        entry = dict(descriptor)
+        entry["annotations"] = {
+            **descriptor.get("annotations", {}),
+            ANNOTATION_REF_NAME: tag,
+        }
+        manifests = [
+            m
+            for m in index.get("manifests", [])
+            if m.get("annotations", {}).get(ANNOTATION_REF_NAME) != tag
+        ]
+        manifests.append(entry)
+        index["manifests"] = manifests
+        self.write_index(index)
+
+    def read_image(self, tag: str) -> tuple[dict[str, Any], dict[str, Any]]:
+        """Load the manifest and image config of the image tagged ``tag``."""
+        descriptor = self.get_descriptor(tag)
+        manifest = self.read_json_blob(descriptor["digest"])
+        config = self.read_json_blob(manifest["config"]["digest"])
+        return manifest, config
+
+    def write_image(
+        self,
+        tag: str,
+        manifest: dict[str, Any],
+        config: dict[str, Any],
+    ) -> dict[str, Any]:
+        """Store a new image config and manifest and tag the manifest as ``tag``.
+
+        The manifest's config descriptor is updated to point at ``config``.
+
+        :returns: The descriptor of the new manifest.
+        """
+        manifest = dict(manifest)
+        manifest["config"] = {
+            **manifest.get("config", {}),
+            **self.write_json_blob(config, MEDIA_TYPE_CONFIG),
+        }
+        descriptor = self.write_json_blob(manifest, MEDIA_TYPE_MANIFEST)
+        self.set_tag(tag, descriptor)
+        return descriptor
+
+    def image_blobs(self, tag: str) -> list[str]:
+        """Get the digests of the manifest, config and layers of an image."""
+        descriptor = self.get_descriptor(tag)
+        manifest = self.read_json_blob(descriptor["digest"])
+        return [
+            descriptor["digest"],
+            manifest["config"]["digest"],
+            *(layer["digest"] for layer in manifest.get("layers", [])),
+        ]
+
+    def copy_image(
+        self, tag: str, destination: "ImageLayout", new_tag: str
+    ) -> dict[str, Any]:
+        """Copy the image tagged ``tag`` into ``destination`` as ``new_tag``.
+
+        Blobs are immutable, so no data is actually copied: within the same
+        layout only a new index entry is added, and otherwise the blobs are
+        hardlinked (or reflinked, or as a last resort copied) into the
+        destination.
+
+        :returns: The descriptor of the copied manifest.
+        """
+        return self.copy_manifest(self.get_descriptor(tag), destination, new_tag)
+
+    def copy_manifest(
+        self, descriptor: dict[str, Any], destination: "ImageLayout", new_tag: str
+    ) -> dict[str, Any]:
+        """Copy the image with the manifest ``descriptor`` into ``destination``.
+
+        Like ``copy_image()``, for images that need not be tagged, such as the
+        images of each platform in an image index.
+
+        :returns: The descriptor of the copied manifest, tagged as ``new_tag``.
+        """
+        if not _is_same_file(self.path, destination.path):
+            manifest = self.read_json_blob(descriptor["digest"])
+            digests = [
+                descriptor["digest"],
+                manifest["config"]["digest"],
+                *(layer["digest"] for layer in manifest.get("layers", [])),
+            ]
+            destination.blobs_dir.mkdir(parents=True, exist_ok=True)
+            destination.link_shared_blobs(digests)
+            for digest in digests:
+                if not destination.has_blob(digest):
+                    _link_or_copy(self.blob_path(digest), destination.blob_path(digest))
+        destination.set_tag(new_tag, descriptor)
+        return descriptor
+
+    def create_image(
+        self, tag: str, *, architecture: str, variant: str | None = None
+    ) -> dict[str, Any]:
+        """Create a new image without any layers, tagged as ``tag``.
+
+        :param tag: The tag of the new image.
+        :param architecture: The image architecture, in GOARCH format.
+        :param variant: The architecture variant, if any.
+        :returns: The descriptor of the new manifest.
+        """
+        config: dict[str, Any] = {
+            "created": now_timestamp(),
+            "architecture": architecture,
+            "os": "linux",
+            "config": {},
+            "rootfs": {"type": "layers", "diff_ids": []},
+        }
+        if variant:
+            config["variant"] = variant
+
+        manifest: dict[str, Any] = {
+            "schemaVersion": 2,
+            "mediaType": MEDIA_TYPE_MANIFEST,
+            "config": {},
+            "layers": [],
+        }
+        return self.write_image(tag, manifest, config)
+
+    def create_index(self, tag: str, tags: list[str]) -> dict[str, Any]:
+        """Create an image index of the images tagged ``tags``, tagged as ``tag``.
+
+        Each image is listed with the platform in its config, so each must be
+        for a different platform.
+
+        :returns: The descriptor of the new index.
+        """
+        manifests: list[dict[str, Any]] = []
+        platforms: set[tuple[str, ...]] = set()
+        for image_tag in tags:
+            descriptor = self.get_descriptor(image_tag)
+            _, config = self.read_image(image_tag)
+            platform = {"architecture": config["architecture"], "os": config["os"]}
+            if config.get("variant"):
+                platform["variant"] = config["variant"]
+
+            if tuple(platform.values()) in platforms:
+                raise errors.RockcraftError(
+                    f"Cannot index several images for platform {platform}"
+                )
+            platforms.add(tuple(platform.values()))
+
+            entry = {k: v for k, v in descriptor.items() if k != "annotations"}
+            entry["platform"] = platform
+            manifests.append(entry)
+
+        index = {
+            "schemaVersion": 2,
+            "mediaType": MEDIA_TYPE_INDEX,
+            "manifests": manifests,
+        }
+        descriptor = self.write_json_blob(index, MEDIA_TYPE_INDEX)
+        self.set_tag(tag, descriptor)
+        return descriptor
+
+    def import_archive(self, archive: Path, tag: str, new_tag: str) -> dict[str, Any]:
+        """Import the image tagged ``tag`` in an OCI archive as ``new_tag``.
+
+        An OCI archive is a tarball of an image layout, like a ``.rock`` file.
+        Blobs already in this layout are skipped, so images that share blobs
+        store them only once.
+
+        :returns: The descriptor of the imported manifest.
+        """
+        index: dict[str, Any] | None = None
+        with tarfile.open(archive) as tar_file:
+            for member in tar_file:
+                dirname, basename = posixpath.split(posixpath.normpath(member.name))
+                if (dirname, basename) == ("", "index.json"):
+                    index = json.load(_extract(tar_file, member))
+                elif dirname == "blobs/sha256" and member.isreg():
+                    digest = f"sha256:{basename}"
+                    if not self.has_blob(digest):
+                        self._import_blob(digest, _extract(tar_file, member), archive)
+
+        if index is None:
+            raise errors.RockcraftError(f"{archive} is not an OCI archive")
+        for descriptor in index.get("manifests", []):
+            if descriptor.get("annotations", {}).get(ANNOTATION_REF_NAME) == tag:
+                self.set_tag(new_tag, descriptor)
+                return dict(descriptor)
+        raise errors.RockcraftError(f"Tag {tag!r} not found in {archive}")
+
+    def get_archive(self, tag: str, *, repo_tag: str | None = None) -> "Archive":
+        """Plan the OCI archive of the image tagged ``tag``, like a ``.rock`` file.
+
+        The archive holds a layout with only that image, or image index, and
+        the blobs reachable from it. With a ``repo_tag``, the archive is also a
+        Docker archive, which ``docker load`` imports as ``repo_tag``.
+
+        :param tag: The tag of the image to export, kept in the archive.
+        :param repo_tag: The Docker ``name:tag`` of the image, if any.
+        """
+        descriptor = self.get_descriptor(tag)
+        index = {"schemaVersion": 2, "manifests": [descriptor]}
+        layout_file = {"imageLayoutVersion": LAYOUT_VERSION}
+
+        archive = Archive()
+        archive.add_bytes("oci-layout", _to_json_bytes(layout_file))
+        archive.add_bytes("index.json", _to_json_bytes(index))
+        if repo_tag is not None:
+            docker_manifest = self._get_docker_manifest(descriptor, repo_tag)
+            archive.add_bytes("manifest.json", json.dumps(docker_manifest).encode())
+        archive.add_directory("blobs")
+        archive.add_directory("blobs/sha256")
+        for digest in sorted(self.reachable_blobs(tag)):
+            path = self.blob_path(digest)
+            archive.add_file(f"blobs/sha256/{path.name}", path)
+        return archive
+
+    def export_archive(
+        self, tag: str, filename: Path, *, repo_tag: str | None = None
+    ) -> None:
+        """Write the archive planned by ``get_archive()`` to ``filename``.
+
+        The archive only appears at ``filename`` once complete.
+        """
+        archive = self.get_archive(tag, repo_tag=repo_tag)
+        temp_path = filename.with_name(f".{filename.name}.{secrets.token_hex(8)}")
+        try:
+            with temp_path.open("wb") as archive_file:
+                archive.write_to(archive_file)
+            os.replace(temp_path, filename)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+
+    def _get_docker_manifest(
+        self, descriptor: dict[str, Any], repo_tag: str
+    ) -> list[dict[str, Any]]:
+        """Get the ``manifest.json`` of a Docker archive of an image."""
+        if descriptor.get("mediaType") == MEDIA_TYPE_INDEX:
+            raise errors.RockcraftError(
+                "Docker archives cannot hold multi-platform images"
+            )
+        manifest = self.read_json_blob(descriptor["digest"])
+        return [
+            {
+                "Config": f"blobs/sha256/{self.blob_path(manifest['config']['digest']).name}",
+                "RepoTags": [repo_tag],
+                "Layers": [
+                    f"blobs/sha256/{self.blob_path(layer['digest']).name}"
+                    for layer in manifest.get("layers", [])
+                ],
+            }
+        ]
+
+    def _import_blob(self, digest: str, source: IO[bytes], archive: Path) -> None:
+        writer = self.blob_writer()
+        try:
+            for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                writer.write(chunk)
+            if writer.digest != digest:
+                raise errors.RockcraftError(f"Blob {digest} in {archive} is corrupted")
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+        self.share_blob(digest)
+
+    @contextlib.contextmanager
+    def new_layer(
+        self,
+        tag: str,
+        *,
+        new_tag: str | None = None,
+        created_by: str | None = None,
+        compression: LayerCompression = DEFAULT_LAYER_COMPRESSION,
+        fragmented: bool = False,
+    ) -> Iterator[LayerWriter]:
+        """Append a new layer to an image, streaming its uncompressed tarball.
+
+        The uncompressed layer must be written to the yielded stream, which
+        hashes and compresses it on the fly. When the ``with`` block ends, the
+        compressed blob is stored and appended to the image; if an error happens
+        instead, the partial blob is discarded and the image is left unchanged.
+
+        :param tag: The tag of the image to add the layer to.
+        :param new_tag: The tag for the resulting image; defaults to ``tag``.
+        :param created_by: The description of the layer in the image history.
+        :param compression: The compression algorithm of the layer blob.
+        :param fragmented: Whether to prefer a layer writer that supports
+            cached fragments (see ``get_layer_writer()``).
+        """
+        # pylint: disable=too-many-arguments
+        blob_writer = self.blob_writer()
+        try:
+            with get_layer_writer(
+                blob_writer, compression=compression, fragmented=fragmented
+            ) as layer_writer:
+                yield layer_writer
+                layer_writer.finish()
+        except BaseException:
+            blob_writer.abort()
+            raise
+        digest, size = blob_writer.commit()
+        self.share_blob(digest)
+
+        self.append_layer(
+            tag,
+            {"mediaType": layer_writer.media_type, "digest": digest, "size": size},
+            diff_id=layer_writer.diff_id,
+            new_tag=new_tag,
+            created_by=created_by,
+        )
+
+    def append_layer(
+        self,
+        tag: str,
+        layer: dict[str, Any],
+        *,
+        diff_id: str,
+        new_tag: str | None = None,
+        created_by: str | None = None,
+    ) -> dict[str, Any]:
+        """Append an already-stored layer blob to an image.
+
+        :param tag: The tag of the image to add the layer to.
+        :param layer: The descriptor of the layer blob.
+        :param diff_id: The digest of the uncompressed layer.
+        :param new_tag: The tag for the resulting image; defaults to ``tag``.
+        :param created_by: The description of the layer in the image history.
+        :returns: The descriptor of the new manifest.
+        """
+        # pylint: disable=too-many-arguments
+        manifest, config = self.read_image(tag)
+
+        manifest["layers"] = [*manifest.get("layers", []), layer]
+
+        rootfs = config.setdefault("rootfs", {"type": "layers", "diff_ids": []})
+        rootfs["diff_ids"] = [*rootfs.get("diff_ids", []), diff_id]
+
+        history: dict[str, Any] = {"created": now_timestamp()}
+        if created_by:
+            history["created_by"] = created_by
+        config["history"] = [*config.get("history", []), history]
+
+        return self.write_image(new_tag or tag, manifest, config)
+
+    def share_blob(self, digest: str) -> None:
+        """Put a blob of this layout in the blob store, if the layout has one.
+
+        If the store already has the blob, the layout's copy is replaced by a
+        link to the stored one.
+        """
+        if self.blob_store is None:
+            return
+        if not self.blob_store.link_blob(digest, self.blob_path(digest)):
+            self.blob_store.add_blob(digest, self.blob_path(digest))
+
+    def share_layers(self, tag: str) -> list[str]:
+        """Put the layers of the image tagged ``tag`` in the blob store.
+
+        :returns: The digests of the layers.
+        """
+        manifest, _ = self.read_image(tag)
+        digests = [layer["digest"] for layer in manifest.get("layers", [])]
+        for digest in digests:
+            self.share_blob(digest)
+        return digests
+
+    def link_shared_blobs(self, digests: Iterable[str]) -> list[str]:
+        """Link the given blobs from the blob store, if not already in the layout.
+
+        :returns: The digests of the newly linked blobs.
+        """
+        linked: list[str] = []
+        if self.blob_store is None:
+            return linked
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        for digest in digests:
+            if not self.has_blob(digest) and self.blob_store.link_blob(
+                digest, self.blob_path(digest)
+            ):
+                linked.append(digest)
+        return linked
+
+    def reachable_blobs(self, tag: str | None = None) -> set[str]:
+        """Get the digests of all blobs referenced, directly or not, by the index.
+
+        :param tag: Only get the blobs of the image, or image index, tagged
+            ``tag``.
+        """
+        if tag is None:
+            descriptors = self.read_index().get("manifests", [])
+        else:
+            descriptors = [self.get_descriptor(tag)]
+
+        reachable: set[str] = set()
+        for descriptor, manifest in self._iter_manifests(descriptors):
+            reachable.add(descriptor["digest"])
+            if "config" in manifest:
+                reachable.add(manifest["config"]["digest"])
+            reachable.update(layer["digest"] for layer in manifest.get("layers", []))
+        return reachable
+
+    def prune_blobs(self) -> list[str]:
+        """Remove the blobs that are not reachable from the index.
+
+        :returns: The digests of the removed blobs.
+        """
+        reachable = self.reachable_blobs()
+        removed: list[str] = []
+        for blob in self.blobs_dir.iterdir():
+            digest = f"sha256:{blob.name}"
+            if not blob.name.startswith(".") and digest not in reachable:
+                blob.unlink()
+                removed.append(digest)
+        return removed
+
+    def _iter_manifests(
+        self, descriptors: Iterable[dict[str, Any]]
+    ) -> Iterator[tuple[dict[str, Any], dict[str, Any]]]:
+        """Iterate over the descriptors and contents of the given manifests.
+
+        Nested indexes (e.g. multi-platform images) are also yielded, followed
+        by the manifests they reference.
+        """
+        pending = list(descriptors)
+        seen: set[str] = set()
+        while pending:
+            descriptor = pending.pop(0)
+            if descriptor["digest"] in seen:
+                continue
+            seen.add(descriptor["digest"])
+            manifest = self.read_json_blob(descriptor["digest"])
+            if descriptor.get("mediaType") == MEDIA_TYPE_INDEX:
+                pending.extend(manifest.get("manifests", []))
+            yield descriptor, manifest
+
+
+class ArchiveReader:
+    """Read the image layout in an OCI archive, like a ``.rock`` file, in place.
+
+    Only the headers of the archive are read when opening it: blobs are then
+    read from their offsets in it, without extracting them. The archive must
+    not be compressed.
+
+    :param path: The path of the archive.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._blobs: dict[str, tuple[int, int]] = {}
+        index: dict[str, Any] | None = None
+        try:
+            with tarfile.open(path, "r:") as tar_file:
+                for member in tar_file:
+                    name = posixpath.normpath(member.name)
+                    dirname, basename = posixpath.split(name)
+                    if name == "index.json":
+                        index = json.load(_extract(tar_file, member))
+                    elif dirname == "blobs/sha256" and member.isreg():
+                        digest = f"sha256:{basename}"
+                        self._blobs[digest] = (member.offset_data, member.size)
+        except (OSError, tarfile.TarError, ValueError) as err:
+            raise errors.RockcraftError(f"Cannot read {path}: {err}") from err
+        if index is None:
+            raise errors.RockcraftError(f"{path} is not an OCI archive")
+        self.index = index
+
+    def get_descriptor(self, tag: str | None = None) -> dict[str, Any]:
+        """Get the descriptor of the image tagged ``tag`` in the archive.
+
+        :param tag: The tag of the image, which can be omitted if the archive
+            only has one, like rocks do.
+        """
+        manifests: list[dict[str, Any]] = self.index.get("manifests", [])
+        if tag is None:
+            if len(manifests) != 1:
+                raise errors.RockcraftError(f"{self.path} has no single image")
+            return dict(manifests[0])
+        for descriptor in manifests:
+            if descriptor.get("annotations", {}).get(ANNOTATION_REF_NAME) == tag:
+                return dict(descriptor)
+        raise errors.RockcraftError(f"Tag {tag!r} not found in {self.path}")
+
+    def has_blob(self, digest: str) -> bool:
+        """Whether the blob with the given digest is in the archive."""
+        return digest in self._blobs
+
+    def get_blob_size(self, digest: str) -> int:
+        """Get the size of the blob with the given digest, in bytes."""
+        return self._get_blob_location(digest)[1]
+
+    def read_blob(self, digest: str, offset: int = 0, size: int | None = None) -> bytes:
+        """Read (part of) the blob with the given digest.
+
+        Reads are independent of each other, so blobs can be read from several
+        threads at once.
+
+        :param offset: Where to start reading in the blob.
+        :param size: The number of bytes to read; the rest of the blob if None.
+        """
+        blob_offset, blob_size = self._get_blob_location(digest)
+        offset = min(offset, blob_size)
+        size = blob_size - offset if size is None else min(size, blob_size - offset)
+        with self.path.open("rb") as archive:
+            data = os.pread(archive.fileno(), size, blob_offset + offset)
+        if len(data) != size:
+            raise errors.RockcraftError(f"Blob {digest} in {self.path} is truncated")
+        return data
+
+    def read_json_blob(self, digest: str) -> dict[str, Any]:
+        """Read a JSON blob, like a manifest or config."""
+        content: dict[str, Any] = json.loads(self.read_blob(digest))
+        return content
+
+    def _get_blob_location(self, digest: str) -> tuple[int, int]:
+        if digest not in self._blobs:
+            raise errors.RockcraftError(f"Blob {digest} not found in {self.path}")
+        return self._blobs[digest]
+
+
+class Archive:
+    """A tarball planned in advance, so that its size is known before writing it.
+
+    The data of files is only read when writing the archive, and streamed into
+    it within the kernel where possible.
+    """
+
+    def __init__(self) -> None:
+        self._entries: list[tuple[bytes, bytes | Path, int]] = []
+
+    def add_directory(self, name: str) -> None:
+        """Add a directory entry."""
+        self._add(name, tarfile.DIRTYPE, b"", size=0)
+
+    def add_bytes(self, name: str, data: bytes) -> None:
+        """Add a file with the given contents."""
+        self._add(name, tarfile.REGTYPE, data, size=len(data))
+
+    def add_file(self, name: str, path: Path) -> None:
+        """Add a file with the contents of the file at ``path``."""
+        self._add(name, tarfile.REGTYPE, path, size=path.stat().st_size)
+
+    @property
+    def size(self) -> int:
+        """The size of the archive, in bytes."""
+        # The entries are followed by two empty blocks, and a full record.
+        return _padded(self._entries_size() + tarfile.BLOCKSIZE * 2, tarfile.RECORDSIZE)
+
+    def write_to(self, file: IO[bytes]) -> None:
+        """Write the archive to ``file``, from its current position."""
+        for header, content, size in self._entries:
+            file.write(header)
+            if isinstance(content, bytes):
+                file.write(content)
+            else:
+                with content.open("rb") as source:
+                    if os.fstat(source.fileno()).st_size != size:
+                        raise errors.RockcraftError(f"{content} changed unexpectedly")
+                    file.flush()
+                    copy_file_data(source.fileno(), file.fileno(), size)
+            file.write(tarfile.NUL * (_padded(size) - size))
+
+        file.write(tarfile.NUL * (self.size - self._entries_size()))
+        file.flush()
+
+    def _entries_size(self) -> int:
+        return sum(len(header) + _padded(size) for header, _, size in self._entries)
+
+    def _add(
+        self, name: str, entry_type: bytes, content: bytes | Path, *, size: int
+    ) -> None:
+        info = tarfile.TarInfo(name)
+        info.type = entry_type
+        info.size = size
+        info.mode = 0o755 if entry_type == tarfile.DIRTYPE else 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        self._entries.append((header, content, size))
+
+
+def _padded(size: int, block_size: int = tarfile.BLOCKSIZE) -> int:
+    """Round ``size`` up to a multiple of ``block_size``."""
+    return -(-size // block_size) * block_size
+
+
+def copy_file_data(source: int, destination: int, size: int) -> None:
+    """Copy ``size`` bytes between the current positions of two files.
+
+    The data is copied within the kernel with ``copy_file_range()``, which can
+    share the data on filesystems supporting it, or else ``sendfile()``. Only
+    if neither is supported is it copied through userspace.
+    """
+    remaining = size
+    for copy in (_copy_file_range, _sendfile, _read_write):
+        try:
+            while remaining:
+                copied = copy(source, destination, remaining)
+                if not copied:
+                    raise errors.RockcraftError("File changed while copying it")
+                remaining -= copied
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED_COPY_ERRORS:
+                raise
+        else:
+            return
+
+
+def _copy_file_range(source: int, destination: int, count: int) -> int:
+    return os.copy_file_range(source, destination, count)
+
+
+def _sendfile(source: int, destination: int, count: int) -> int:
+    return os.sendfile(destination, source, None, count)
+
+
+def _read_write(source: int, destination: int, count: int) -> int:
+    data = os.read(source, min(count, 1024 * 1024))
+    written = 0
+    while written < len(data):
+        written += os.write(destination, data[written:])
+    return len(data)
+
+
+def _blob_path(blobs_dir: Path, digest: str) -> Path:
+    algorithm, _, hex_digest = digest.partition(":")
+    if algorithm != "sha256" or not hex_digest:
+        raise errors.RockcraftError(f"Unsupported blob digest {digest!r}")
+    return blobs_dir / hex_digest
+
+
+def _extract(tar_file: tarfile.TarFile, member: tarfile.TarInfo) -> IO[bytes]:
+    file_obj = tar_file.extractfile(member)
+    if file_obj is None:
+        raise errors.RockcraftError(f"Cannot read {member.name} in OCI archive")
+    return file_obj
+
+
+def _is_same_file(path: Path, other: Path) -> bool:
+    try:
+        return os.path.samefile(path, other)
+    except FileNotFoundError:
+        return False
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    """Atomically make ``destination`` a hardlink to ``source``, or a copy of it.
+
+    Blobs are only copied when they cannot be hardlinked, for instance when the
+    paths are in different filesystems; even then, filesystems supporting
+    reflinks (like btrfs or XFS) share the data instead of duplicating it.
+    """
+    temp_path = destination.with_name(
+        f".tmp-{destination.name[:12]}.{secrets.token_hex(8)}"
+    )
+    try:
+        try:
+            os.link(source, temp_path)
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            _clone_or_copy(source, temp_path)
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, destination)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def _clone_or_copy(source: Path, destination: Path) -> None:
+    """Create ``destination`` as a reflink of ``source``, or copy it if unsupported."""
+    with source.open("rb") as source_file, destination.open("xb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), _FICLONE, source_file.fileno())
+        except OSError:
+            pass
+        else:
+            return
+    shutil.copyfile(source, destination)
+
+
+def _to_json_bytes(content: dict[str, Any]) -> bytes:
+    return json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+
+def _write_json_atomic(path: Path, content: dict[str, Any]) -> None:
+    """Write ``content`` as JSON to ``path``, replacing the file atomically."""
+    fd, temp_name = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(_to_json_bytes(content))
+        os.chmod(temp_name, 0o644)
+        os.replace(temp_name, path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
@@ -16,6 +16,7 @@
 
 """Pebble metadata and configuration helpers."""
 
+import fnmatch
 import glob
 from collections.abc import Mapping
 from pathlib import Path
@@ -26,6 +27,8 @@ import yaml
 from craft_application.errors import CraftValidationError
 from craft_cli import emit
 
+from rockcraft.base_index import BaseIndex
+
 
 def _alias_generator(name: str) -> str:
     """Convert underscores to dashes in aliases."""
@@ -182,7 +185,7 @@ class Pebble:
     def define_pebble_layer(
         self,
         target_dir: Path,
-        ref_fs: Path,
+        ref_fs: Path | BaseIndex | None,
         layer_content: dict[str, Any],
         rock_name: str,
     ) -> None:
@@ -192,16 +195,27 @@ class Pebble:
         ref_fs and writes the layer content into target_dir.
 
         :param target_dir: Path where to write the new Pebble layer file
-        :param ref_fs: filesystem to use as a reference when inferring the layer name
+        :param ref_fs: filesystem to use as a reference when inferring the layer
+            name, or an index of it
         :param layer_content: the actual Pebble layer, in JSON
         :param rock_name: name of the rock where the layer will end up
         """
         # NOTE: the layer's filename prefix will always be "001-" when using
         # "bare" and "ubuntu" bases
-        pebble_layers_path_in_base = f"{ref_fs}/{self.PEBBLE_LAYERS_PATH}"
-        existing_pebble_layers = glob.glob(
-            pebble_layers_path_in_base + "/[0-9][0-9][0-9]-???*.yaml"
-        ) + glob.glob(pebble_layers_path_in_base + "/[0-9][0-9][0-9]-???*.yml")
+        if isinstance(ref_fs, BaseIndex):
+            existing_pebble_layers = [
+                name
+                for name in ref_fs.listdir(self.PEBBLE_LAYERS_PATH)
+                if fnmatch.fnmatchcase(name, "[0-9][0-9][0-9]-???*.yaml")
+                or fnmatch.fnmatchcase(name, "[0-9][0-9][0-9]-???*.yml")
+            ]
+        elif ref_fs is not None:
+            pebble_layers_path_in_base = f"{ref_fs}/{self.PEBBLE_LAYERS_PATH}"
+            existing_pebble_layers = glob.glob(
+                pebble_layers_path_in_base + "/[0-9][0-9][0-9]-???*.yaml"
+            ) + glob.glob(pebble_layers_path_in_base + "/[0-9][0-9][0-9]-???*.yml")
+        else:
+            existing_pebble_layers = []
 
         prefixes = list(map(lambda l: Path(l).name[:3], existing_pebble_layers))
         prefixes.sort()
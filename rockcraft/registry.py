@@ -0,0 +1,755 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Minimal client for the OCI distribution API of image registries."""
+
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from http import HTTPStatus
+from pathlib import Path
+from typing import Any
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from craft_cli import emit
+
+from rockcraft import errors, oci_layout
+
+MEDIA_TYPE_DOCKER_MANIFEST = "application/vnd.docker.distribution.manifest.v2+json"
+MEDIA_TYPE_DOCKER_MANIFEST_LIST = (
+    "application/vnd.docker.distribution.manifest.list.v2+json"
+)
+
+MANIFEST_MEDIA_TYPES = [
+    oci_layout.MEDIA_TYPE_INDEX,
+    oci_layout.MEDIA_TYPE_MANIFEST,
+    MEDIA_TYPE_DOCKER_MANIFEST_LIST,
+    MEDIA_TYPE_DOCKER_MANIFEST,
+]
+
+# The OCI equivalents of Docker's media types, to store pulled images in OCI
+# layouts like skopeo does.
+_OCI_MEDIA_TYPES = {
+    MEDIA_TYPE_DOCKER_MANIFEST: oci_layout.MEDIA_TYPE_MANIFEST,
+    "application/vnd.docker.container.image.v1+json": oci_layout.MEDIA_TYPE_CONFIG,
+    "application/vnd.docker.image.rootfs.diff.tar.gzip": (
+        "application/vnd.oci.image.layer.v1.tar+gzip"
+    ),
+    "application/vnd.docker.image.rootfs.foreign.diff.tar.gzip": (
+        "application/vnd.oci.image.layer.nondistributable.v1.tar+gzip"
+    ),
+}
+
+# Timeout, in seconds, for connecting to and reading from registries.
+REQUEST_TIMEOUT = 60
+
+# The number of blobs downloaded at the same time when pulling an image.
+PULL_WORKERS = 4
+
+# The number of times to try downloading a blob, resuming where the previous
+# attempt stopped, and the delay in seconds before each retry (multiplied by
+# the number of attempts so far).
+DOWNLOAD_ATTEMPTS = 5
+RETRY_DELAY = 1.0
+
+# The number of blobs uploaded at the same time when pushing an image, the
+# size of the chunks they are uploaded in, and the number of times to try
+# uploading each of them.
+PUSH_WORKERS = 4
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+UPLOAD_ATTEMPTS = 3
+
+_CHUNK_SIZE = 1024 * 1024
+
+_CHALLENGE_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+
+class Registry:
+    """A registry implementing the OCI distribution API.
+
+    Both anonymous and authenticated access are supported, through the basic
+    and token-based flows that registries (like ECR Public or Docker Hub)
+    require.
+
+    :param url: The base URL of the registry, e.g. ``https://public.ecr.aws``.
+    :param credentials: The username and password to authenticate with, if any.
+    """
+
+    def __init__(self, url: str, *, credentials: tuple[str, str] | None = None) -> None:
+        self.url = url.rstrip("/")
+        self._credentials = credentials
+        self._session = requests.Session()
+        # The Authorization headers obtained for each scope of access.
+        self._authorizations: dict[str, str] = {}
+
+    @classmethod
+    def from_host(
+        cls, host: str, *, credentials: tuple[str, str] | None = None
+    ) -> "Registry":
+        """Get the registry at ``host``.
+
+        Like the Docker daemon, registries in the local host are accessed
+        through plain HTTP, and everything else through HTTPS.
+        """
+        hostname = host.rsplit(":", 1)[0] if host.count(":") == 1 else host
+        if hostname in ("localhost", "127.0.0.1", "[::1]"):
+            return cls(f"http://{host}", credentials=credentials)
+        return cls(f"https://{host}", credentials=credentials)
+
+    @property
+    def host(self) -> str:
+        """The ``host[:port]`` of the registry."""
+        return urlsplit(self.url).netloc
+
+    def get_digest(self, repository: str, reference: str) -> str:
+        """Get the digest of the manifest that a tag points to.
+
+        Only the manifest's headers are fetched, which is the cheapest way of
+        checking whether a tag has changed.
+
+        :param repository: The repository, e.g. ``ubuntu/ubuntu``.
+        :param reference: The tag or digest of the manifest.
+        """
+        response = self._request(
+            "HEAD",
+            repository,
+            f"manifests/{reference}",
+            headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)},
+        )
+        digest = response.headers.get("Docker-Content-Digest")
+        if not digest:
+            # The header is optional, so get the manifest itself to hash it.
+            digest, _ = self.get_manifest(repository, reference)
+        return digest
+
+    def get_manifest(
+        self, repository: str, reference: str
+    ) -> tuple[str, dict[str, Any]]:
+        """Get a manifest, or image index, from the registry.
+
+        :param repository: The repository, e.g. ``ubuntu/ubuntu``.
+        :param reference: The tag or digest of the manifest.
+        :returns: The digest of the manifest and its content.
+        """
+        digest, content = self.get_manifest_content(repository, reference)
+        manifest: dict[str, Any] = json.loads(content)
+        return digest, manifest
+
+    def get_manifest_content(
+        self, repository: str, reference: str
+    ) -> tuple[str, bytes]:
+        """Get a manifest, or image index, as the exact bytes the registry serves.
+
+        :param repository: The repository, e.g. ``ubuntu/ubuntu``.
+        :param reference: The tag or digest of the manifest.
+        :returns: The digest of the manifest and its content.
+        """
+        response = self._request(
+            "GET",
+            repository,
+            f"manifests/{reference}",
+            headers={"Accept": ", ".join(MANIFEST_MEDIA_TYPES)},
+        )
+        digest = oci_layout.sha256_digest(response.content)
+        if reference.startswith("sha256:") and digest != reference:
+            raise errors.RegistryError(
+                f"Digest mismatch for manifest {repository}@{reference}",
+                details=f"The registry returned a manifest with digest {digest}.",
+            )
+        return digest, response.content
+
+    def download_blob(
+        self, repository: str, digest: str, destination: Path, *, size: int | None
+    ) -> None:
+        """Download a blob into a file, verifying its digest while streaming it.
+
+        If ``destination`` already has part of the blob, from an interrupted
+        download, only the rest of it is requested. A file that turns out not
+        to match the digest is removed, so that the next attempt starts over.
+
+        :param repository: The repository, e.g. ``ubuntu/ubuntu``.
+        :param digest: The digest of the blob.
+        :param destination: The file to download the blob into.
+        :param size: The size of the blob, if known.
+        """
+        blob_hash = hashlib.sha256()
+        offset = 0
+        if destination.exists():
+            with destination.open("rb") as partial:
+                while chunk := partial.read(_CHUNK_SIZE):
+                    blob_hash.update(chunk)
+                offset = partial.tell()
+            if f"sha256:{blob_hash.hexdigest()}" == digest:
+                return
+            if size is not None and offset >= size:
+                destination.unlink()
+                blob_hash = hashlib.sha256()
+                offset = 0
+
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        response = self._request(
+            "GET", repository, f"blobs/{digest}", headers=headers, stream=True
+        )
+        if response.status_code != HTTPStatus.PARTIAL_CONTENT:
+            # The registry ignored the range, and sends the whole blob.
+            blob_hash = hashlib.sha256()
+            offset = 0
+
+        expected = response.headers.get("Content-Length")
+        received = 0
+        with response, destination.open("ab" if offset else "wb") as file:
+            try:
+                for chunk in response.iter_content(_CHUNK_SIZE):
+                    blob_hash.update(chunk)
+                    file.write(chunk)
+                    received += len(chunk)
+            except requests.RequestException as err:
+                raise errors.RegistryError(
+                    f"Interrupted download of {repository}@{digest}",
+                    details=str(err),
+                ) from err
+        if expected is not None and received < int(expected):
+            raise errors.RegistryError(
+                f"Interrupted download of {repository}@{digest}",
+                details=f"Got {received} of {expected} bytes.",
+            )
+
+        if f"sha256:{blob_hash.hexdigest()}" != digest:
+            destination.unlink()
+            raise errors.RegistryError(
+                f"Digest mismatch for blob {repository}@{digest}",
+                details=f"The registry returned a blob with digest "
+                f"sha256:{blob_hash.hexdigest()}.",
+            )
+
+    def has_blob(self, repository: str, digest: str) -> bool:
+        """Whether a repository has the blob with the given digest.
+
+        :param repository: The repository, e.g. ``ubuntu/ubuntu``.
+        :param digest: The digest of the blob.
+        """
+        path = f"blobs/{digest}"
+        response = self._send(
+            "HEAD", repository, path, scopes=[f"repository:{repository}:pull,push"]
+        )
+        if response.status_code == HTTPStatus.NOT_FOUND:
+            return False
+        self._raise_for_status("HEAD", repository, path, response)
+        return True
+
+    def upload_blob(
+        self,
+        repository: str,
+        blob: dict[str, Any],
+        read: Callable[[int, int], bytes],
+        *,
+        mount_from: str | None = None,
+    ) -> bool:
+        """Upload a blob to a repository, in chunks.
+
+        With ``mount_from``, the registry is first asked to mount the blob from
+        that repository instead, which needs no upload at all. Registries that
+        can't (for instance, because the blob isn't there) start a regular
+        upload instead.
+
+        :param repository: The repository, e.g. ``ubuntu/ubuntu``.
+        :param blob: The descriptor of the blob, with its digest and size.
+        :param read: A function returning up to a given number of bytes of the
+            blob, from a given offset.
+        :param mount_from: Another repository of the registry that has the blob.
+        :returns: Whether the blob was mounted rather than uploaded.
+        """
+        digest: str = blob["digest"]
+        size: int = blob["size"]
+        scopes = [f"repository:{repository}:pull,push"]
+        params = None
+        if mount_from is not None:
+            scopes.append(f"repository:{mount_from}:pull")
+            params = {"mount": digest, "from": mount_from}
+        response = self._request(
+            "POST", repository, "blobs/uploads/", scopes=scopes, params=params
+        )
+        if response.status_code == HTTPStatus.CREATED:
+            return True
+
+        # Registries can require chunks larger than ours, but not smaller.
+        chunk_size = max(
+            UPLOAD_CHUNK_SIZE, int(response.headers.get("OCI-Chunk-Min-Length", 0))
+        )
+        offset = 0
+        while offset < size:
+            chunk = read(offset, min(chunk_size, size - offset))
+            if not chunk:
+                raise errors.RegistryError(
+                    f"Blob {digest} is shorter than {size} bytes"
+                )
+            response = self._request(
+                "PATCH",
+                repository,
+                _get_location(response),
+                scopes=scopes,
+                data=chunk,
+                headers={
+                    "Content-Type": "application/octet-stream",
+                    "Content-Range": f"{offset}-{offset + len(chunk) - 1}",
+                },
+            )
+            offset += len(chunk)
+        self._request(
+            "PUT",
+            repository,
+            _get_location(response),
+            scopes=scopes,
+            params={"digest": digest},
+            headers={"Content-Type": "application/octet-stream"},
+        )
+        return False
+
+    def put_manifest(
+        self, repository: str, reference: str, content: bytes, media_type: str
+    ) -> str:
+        """Put a manifest, or image index, in a repository.
+
+        :param repository: The repository, e.g. ``ubuntu/ubuntu``.
+        :param reference: The tag or digest to put the manifest as.
+        :param content: The exact bytes of the manifest.
+        :param media_type: The media type of the manifest.
+        :returns: The digest of the manifest.
+        """
+        self._request(
+            "PUT",
+            repository,
+            f"manifests/{reference}",
+            scopes=[f"repository:{repository}:pull,push"],
+            data=content,
+            headers={"Content-Type": media_type},
+        )
+        return oci_layout.sha256_digest(content)
+
+    def _request(
+        self,
+        method: str,
+        repository: str,
+        path: str,
+        *,
+        scopes: list[str] | None = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        """Send a request about ``repository``, failing on error statuses.
+
+        See ``_send()`` for the parameters.
+        """
+        response = self._send(method, repository, path, scopes=scopes, **kwargs)
+        self._raise_for_status(method, repository, path, response)
+        return response
+
+    def _send(
+        self,
+        method: str,
+        repository: str,
+        path: str,
+        *,
+        scopes: list[str] | None = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        """Send a request about ``repository``, authenticating as needed.
+
+        :param path: The path of the request, relative to the repository, or
+            an absolute URL (like the location of an upload).
+        :param scopes: The scopes of access needed; pulling from the repository
+            by default.
+        """
+        url = urljoin(f"{self.url}/v2/{repository}/", path)
+        if scopes is None:
+            scopes = [f"repository:{repository}:pull"]
+        scope = " ".join(scopes)
+        headers: dict[str, str] = kwargs.pop("headers", {})
+        try:
+            for _ in range(2):
+                authorization = self._authorizations.get(scope)
+                if authorization:
+                    headers["Authorization"] = authorization
+                response = self._session.request(
+                    method, url, headers=headers, timeout=REQUEST_TIMEOUT, **kwargs
+                )
+                if response.status_code != HTTPStatus.UNAUTHORIZED or authorization:
+                    break
+                self._authorizations[scope] = self._authenticate(scopes, response)
+        except requests.RequestException as err:
+            raise errors.RegistryError(
+                f"Failed to access image registry at {self.url}", details=str(err)
+            ) from err
+        return response
+
+    def _raise_for_status(
+        self, method: str, repository: str, path: str, response: requests.Response
+    ) -> None:
+        """Raise an error if ``response``, to a request about ``repository``, failed."""
+        if response.ok:
+            return
+        if method in ("GET", "HEAD"):
+            message = f"Failed to get {repository}/{path} from {self.url}"
+        else:
+            message = f"Failed to push to {repository} at {self.url}"
+        raise errors.RegistryError(
+            message,
+            details=f"The registry replied: {response.status_code} {response.reason}",
+        )
+
+    def _authenticate(self, scopes: list[str], response: requests.Response) -> str:
+        """Get the Authorization header for the scopes, as requested by a 401 response."""
+        challenge = response.headers.get("WWW-Authenticate", "")
+        scheme, _, params_str = challenge.partition(" ")
+        params = dict(_CHALLENGE_PARAM.findall(params_str))
+        if scheme.lower() == "basic" and self._credentials is not None:
+            username, password = self._credentials
+            encoded = base64.b64encode(f"{username}:{password}".encode()).decode()
+            return f"Basic {encoded}"
+        if scheme.lower() != "bearer" or "realm" not in params:
+            raise errors.RegistryError(
+                f"Unsupported authentication required by {self.url}",
+                details=f"Challenge: {challenge!r}",
+            )
+
+        query: dict[str, str | list[str]] = {"scope": scopes}
+        if "service" in params:
+            query["service"] = params["service"]
+        try:
+            token_response = self._session.get(
+                params["realm"],
+                params=query,
+                auth=self._credentials,
+                timeout=REQUEST_TIMEOUT,
+            )
+            token_response.raise_for_status()
+            token_data = token_response.json()
+        except (requests.RequestException, ValueError) as err:
+            raise errors.RegistryError(
+                f"Failed to authenticate with image registry at {self.url}",
+                details=str(err),
+            ) from err
+
+        token = token_data.get("token") or token_data.get("access_token")
+        if not token:
+            raise errors.RegistryError(
+                f"Failed to authenticate with image registry at {self.url}",
+                details="The token response had no token.",
+            )
+        return f"Bearer {token}"
+
+
+@dataclass(frozen=True)
+class RemoteImage:
+    """An image, or image index, in a registry.
+
+    :param registry: The registry holding the image.
+    :param repository: The repository of the image, e.g. ``ubuntu/ubuntu``.
+    :param reference: The tag or digest of the image.
+    """
+
+    registry: Registry
+    repository: str
+    reference: str
+
+
+def pull_image(
+    image: RemoteImage,
+    layout: oci_layout.ImageLayout,
+    tag: str,
+    *,
+    architecture: str,
+    variant: str | None = None,
+) -> str:
+    """Pull an image for a Linux platform from a registry into an OCI layout.
+
+    Image indexes are resolved to the manifest for the given ``architecture``
+    and ``variant``, and Docker manifests are converted to OCI ones. The blobs
+    that are neither in the layout nor in its blob store are downloaded by
+    ``PULL_WORKERS`` threads at once, verifying their digests. Failed downloads
+    are retried from where they stopped, and left in the blob store (if the
+    layout has one) for later pulls to resume them.
+
+    :param image: The image to pull.
+    :param layout: The layout to pull the image into.
+    :param tag: The tag of the image in ``layout``.
+    :param architecture: The architecture of the image, in Go format.
+    :param variant: The variant of the architecture, if any.
+    :returns: The digest of the image's reference in the registry.
+    """
+    registry, repository, reference = (
+        image.registry,
+        image.repository,
+        image.reference,
+    )
+    digest, content = registry.get_manifest_content(repository, reference)
+    manifest: dict[str, Any] = json.loads(content)
+    if "manifests" in manifest:
+        platform_digest = select_manifest(manifest, architecture, variant)
+        if platform_digest is None:
+            raise errors.RegistryError(
+                f"No image for {architecture} in {repository}@{reference}"
+            )
+        _, content = registry.get_manifest_content(repository, platform_digest)
+        manifest = json.loads(content)
+    if manifest.get("mediaType") == MEDIA_TYPE_DOCKER_MANIFEST:
+        manifest = _to_oci_manifest(manifest)
+        content = json.dumps(manifest).encode()
+
+    blobs = [manifest["config"], *manifest.get("layers", [])]
+    layout.link_shared_blobs(blob["digest"] for blob in blobs)
+    missing = [blob for blob in blobs if not layout.has_blob(blob["digest"])]
+    if missing:
+        emit.progress(f"Downloading {len(missing)} blobs of {repository}")
+    with ThreadPoolExecutor(
+        max_workers=PULL_WORKERS, thread_name_prefix="rockcraft-pull"
+    ) as executor:
+        futures = [
+            executor.submit(_pull_blob, registry, repository, blob, layout)
+            for blob in missing
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    if layout.blob_store is not None:
+        # Pushes to the same registry can mount these blobs from the repository.
+        layout.blob_store.add_blob_repository(
+            registry.host, repository, [blob["digest"] for blob in blobs]
+        )
+
+    manifest_digest, manifest_size = layout.write_blob(content)
+    layout.set_tag(
+        tag,
+        {
+            "mediaType": oci_layout.MEDIA_TYPE_MANIFEST,
+            "digest": manifest_digest,
+            "size": manifest_size,
+        },
+    )
+    return digest
+
+
+def push_image(
+    destination: RemoteImage,
+    archive: oci_layout.ArchiveReader,
+    descriptor: dict[str, Any],
+    *,
+    blob_store: oci_layout.BlobStore | None = None,
+) -> str:
+    """Push an image, or image index, from an OCI archive to a registry.
+
+    The blobs of the image are pushed first, by ``PUSH_WORKERS`` threads at once:
+    those that the repository already has are skipped, and those that the
+    ``blob_store`` knows another repository of the registry to have (like the
+    layers of a base image pulled from it) are mounted from it, if the
+    registry can. Only the rest are uploaded. The manifests are put last, so
+    that the image never appears in the registry with missing blobs.
+
+    :param destination: The image to push to, whose reference is the tag to
+        push the image as.
+    :param archive: The archive holding the image.
+    :param descriptor: The descriptor of the image in the archive.
+    :param blob_store: The store recording which repositories have which blobs.
+    :returns: The digest of the image's manifest.
+    """
+    registry, repository = destination.registry, destination.repository
+    platform_manifests: list[dict[str, Any]] = []
+    if descriptor.get("mediaType") == oci_layout.MEDIA_TYPE_INDEX:
+        index = archive.read_json_blob(descriptor["digest"])
+        platform_manifests = index.get("manifests", [])
+    blobs: dict[str, dict[str, Any]] = {}
+    for manifest_descriptor in platform_manifests or [descriptor]:
+        manifest = archive.read_json_blob(manifest_descriptor["digest"])
+        for blob in [manifest["config"], *manifest.get("layers", [])]:
+            blobs.setdefault(blob["digest"], blob)
+
+    known = blob_store.get_blob_repositories(registry.host) if blob_store else {}
+    emit.progress(f"Pushing {len(blobs)} blobs to {repository}")
+    with ThreadPoolExecutor(
+        max_workers=PUSH_WORKERS, thread_name_prefix="rockcraft-push"
+    ) as executor:
+        futures = [
+            executor.submit(_push_blob, destination, digest, archive, known.get(digest))
+            for digest in blobs
+        ]
+        try:
+            results = [future.result() for future in futures]
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    emit.debug(
+        f"Pushed {len(blobs)} blobs: {results.count('uploaded')} uploaded, "
+        f"{results.count('mounted')} mounted, {results.count('present')} present"
+    )
+    if blob_store is not None:
+        blob_store.add_blob_repository(registry.host, repository, blobs)
+
+    # The manifests of an index must be in the repository before the index.
+    for manifest_descriptor in platform_manifests:
+        registry.put_manifest(
+            repository,
+            manifest_descriptor["digest"],
+            archive.read_blob(manifest_descriptor["digest"]),
+            manifest_descriptor["mediaType"],
+        )
+    return registry.put_manifest(
+        repository,
+        destination.reference,
+        archive.read_blob(descriptor["digest"]),
+        descriptor["mediaType"],
+    )
+
+
+def select_manifest(
+    index: dict[str, Any], architecture: str, variant: str | None
+) -> str | None:
+    """Get the digest of the Linux manifest for a platform in an image index.
+
+    Manifests with the exact variant are preferred over ones with no variant,
+    and any variant will do if none is given.
+    """
+    candidates: dict[str | None, str] = {}
+    for entry in index["manifests"]:
+        platform = entry.get("platform", {})
+        if platform.get("os") == "linux" and platform.get("architecture") == (
+            architecture
+        ):
+            candidates.setdefault(platform.get("variant"), entry["digest"])
+    if variant in candidates:
+        return candidates[variant]
+    if None in candidates:
+        return candidates[None]
+    if variant is None and candidates:
+        return next(iter(candidates.values()))
+    return None
+
+
+def _to_oci_manifest(manifest: dict[str, Any]) -> dict[str, Any]:
+    """Convert a Docker manifest to an OCI one, for the same blobs."""
+
+    def _convert(descriptor: dict[str, Any]) -> dict[str, Any]:
+        media_type = descriptor.get("mediaType", "")
+        return {**descriptor, "mediaType": _OCI_MEDIA_TYPES.get(media_type, media_type)}
+
+    return {
+        **manifest,
+        "mediaType": oci_layout.MEDIA_TYPE_MANIFEST,
+        "config": _convert(manifest["config"]),
+        "layers": [_convert(layer) for layer in manifest.get("layers", [])],
+    }
+
+
+def _pull_blob(
+    registry: Registry,
+    repository: str,
+    descriptor: dict[str, Any],
+    layout: oci_layout.ImageLayout,
+) -> None:
+    """Download a blob into ``layout``, through its blob store if it has one."""
+    digest = descriptor["digest"]
+    hex_digest = digest.partition(":")[2]
+    blob_store = layout.blob_store
+    if blob_store is not None:
+        partial = blob_store.path / "partial" / hex_digest
+    else:
+        partial = layout.blobs_dir / f".tmp-partial.{hex_digest}"
+    partial.parent.mkdir(parents=True, exist_ok=True)
+
+    # Pulls of the same blob by other processes wait for this one.
+    with partial.open("ab") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if blob_store is not None and blob_store.has_blob(digest):
+            layout.link_shared_blobs([digest])
+            return
+
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                registry.download_blob(
+                    repository, digest, partial, size=descriptor.get("size")
+                )
+                break
+            except errors.RegistryError as err:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                emit.debug(f"Retrying download of {digest}: {err}")
+                time.sleep(RETRY_DELAY * attempt)
+
+        os.chmod(partial, 0o644)
+        if blob_store is not None:
+            blob_store.blobs_dir.mkdir(parents=True, exist_ok=True)
+            os.replace(partial, blob_store.blob_path(digest))
+            layout.link_shared_blobs([digest])
+        else:
+            os.replace(partial, layout.blob_path(digest))
+
+
+def _push_blob(
+    destination: RemoteImage,
+    digest: str,
+    archive: oci_layout.ArchiveReader,
+    mount_from: str | None,
+) -> str:
+    """Push a blob from ``archive`` to a repository, unless it is already there.
+
+    :param mount_from: Another repository of the registry known to have the blob.
+    :returns: How the blob got to the repository: whether it was ``present``
+        already, ``mounted`` or ``uploaded``.
+    """
+    registry, repository = destination.registry, destination.repository
+    if registry.has_blob(repository, digest):
+        return "present"
+    if mount_from == repository:
+        mount_from = None
+    blob = {"digest": digest, "size": archive.get_blob_size(digest)}
+
+    def _upload() -> str:
+        mounted = registry.upload_blob(
+            repository,
+            blob,
+            lambda offset, size: archive.read_blob(digest, offset, size),
+            mount_from=mount_from,
+        )
+        return "mounted" if mounted else "uploaded"
+
+    for attempt in range(1, UPLOAD_ATTEMPTS):
+        try:
+            return _upload()
+        except errors.RegistryError as err:
+            emit.debug(f"Retrying upload of {digest}: {err}")
+            time.sleep(RETRY_DELAY * attempt)
+    return _upload()
+
+
+def _get_location(response: requests.Response) -> str:
+    """Get the absolute URL of the upload session that a response points to."""
+    location = response.headers.get("Location")
+    if not location:
+        raise errors.RegistryError(
+            f"Invalid upload response from {response.url}",
+            details="The response had no Location header.",
+        )
+    return urljoin(response.url, location)
@@ -0,0 +1,165 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of unpacked base images, shared between builds on the same host."""
+
+import errno
+import os
+import secrets
+import shutil
+import stat
+from collections.abc import Callable
+from pathlib import Path
+
+from craft_cli import emit
+
+from rockcraft.base_index import BaseIndex
+
+
+class RootfsCache:
+    """A directory of unpacked OCI runtime bundles, and of indexes of images.
+
+    Bundles are never modified once unpacked, so builds get them as a tree of
+    hardlinks (see ``link_tree()``) that costs no data copying, and that they
+    can remove without affecting the cache.
+
+    :param path: The directory holding the cached bundles.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def bundle_path(self, key: str) -> Path:
+        """Get the path of the cached bundle identified by ``key``."""
+        return self.path / key
+
+    def get_bundle(self, key: str, unpack: Callable[[Path], None]) -> Path:
+        """Get the cached bundle for ``key``, unpacking it first if needed.
+
+        :param key: What identifies the bundle's content, e.g. the digest of
+            the unpacked image's manifest.
+        :param unpack: The function that unpacks the bundle into the path that
+            it's given, which doesn't exist yet.
+        :returns: The path to the cached bundle.
+        """
+        bundle_path = self.bundle_path(key)
+        if bundle_path.is_dir():
+            emit.debug(f"Using cached bundle {key}")
+            return bundle_path
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Unpack to a temporary name first, so that interrupted unpacks are
+        # never mistaken for complete bundles.
+        temp_path = self.path / f".tmp-{key[:12]}.{secrets.token_hex(8)}"
+        try:
+            unpack(temp_path)
+            try:
+                temp_path.rename(bundle_path)
+            except OSError as err:
+                # Another build unpacked the same bundle concurrently.
+                if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+        return bundle_path
+
+    def get_index(self, key: str, build: Callable[[], BaseIndex]) -> BaseIndex:
+        """Get the cached image index for ``key``, building it first if needed.
+
+        :param key: What identifies the indexed image, like for bundles.
+        :param build: The function that indexes the image.
+        """
+        index_path = self.path / f"{key}.index.json"
+        index = BaseIndex.load(index_path)
+        if index is not None:
+            emit.debug(f"Using cached index {key}")
+            return index
+
+        index = build()
+        self.path.mkdir(parents=True, exist_ok=True)
+        index.save(index_path)
+        return index
+
+
+def link_tree(source: Path, destination: Path) -> None:
+    """Recreate the tree at ``source`` in ``destination``, hardlinking its files.
+
+    Directories and symlinks are recreated, with their ownership and
+    permissions, and everything else is hardlinked. When that isn't possible,
+    for instance across filesystems, files are copied instead.
+
+    :param source: The tree to link.
+    :param destination: The path of the new tree, which must not exist.
+    """
+    as_root = os.geteuid() == 0
+    directories: list[tuple[Path, Path]] = []
+
+    for dirpath, dirnames, filenames in os.walk(source):
+        source_dir = Path(dirpath)
+        dest_dir = destination / source_dir.relative_to(source)
+        # Writable until all its entries are created; see below.
+        dest_dir.mkdir(mode=0o700)
+        directories.append((source_dir, dest_dir))
+
+        # os.walk() lists symlinks to directories as directories, but doesn't
+        # descend into them.
+        entries = filenames + [
+            name for name in dirnames if (source_dir / name).is_symlink()
+        ]
+        for name in entries:
+            linked = _link_entry(source_dir / name, dest_dir / name)
+            if as_root and not linked:
+                _copy_ownership(source_dir / name, dest_dir / name)
+
+    # Set the directories' permissions and times last, as creating entries in
+    # them updates their modification times.
+    for source_dir, dest_dir in reversed(directories):
+        if as_root:
+            _copy_ownership(source_dir, dest_dir)
+        shutil.copystat(source_dir, dest_dir, follow_symlinks=False)
+
+
+def _link_entry(source: Path, destination: Path) -> bool:
+    """Hardlink, or else recreate, ``source`` as ``destination``.
+
+    :returns: Whether ``destination`` is a hardlink to ``source``.
+    """
+    source_stat = source.lstat()
+    if stat.S_ISLNK(source_stat.st_mode):
+        os.symlink(os.readlink(source), destination)
+        return False
+
+    try:
+        os.link(source, destination)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    else:
+        return True
+
+    if stat.S_ISREG(source_stat.st_mode):
+        shutil.copy2(source, destination)
+    else:
+        # Device nodes, fifos and sockets.
+        os.mknod(destination, source_stat.st_mode, source_stat.st_rdev)
+        shutil.copystat(source, destination)
+    return False
+
+
+def _copy_ownership(source: Path, destination: Path) -> None:
+    source_stat = source.lstat()
+    os.chown(destination, source_stat.st_uid, source_stat.st_gid, follow_symlinks=False)
@@ -23,20 +23,37 @@ from typing import cast
 from craft_application import AppMetadata, ProjectService, ServiceFactory
 from craft_cli import emit
 
-from rockcraft import models, oci
+from rockcraft import models, oci, oci_layout, rootfs
+from rockcraft.base_index import BaseIndex
+from rockcraft.parts import part_has_overlay
 
 
 @dataclass(frozen=True)
 class ImageInfo:
-    """Metadata about a fetched OCI Image."""
+    """Metadata about a fetched OCI Image.
+
+    The base is only unpacked in ``base_layer_dir`` if the parts need it as
+    an overlay; everything else about it can be looked up in ``base_index``.
+    """
 
     base_image: oci.Image
-    base_layer_dir: Path
+    base_layer_dir: Path | None
     base_digest: bytes
+    base_index: BaseIndex | None = None
+
+    @property
+    def base_layer(self) -> Path | BaseIndex | None:
+        """The base below the rock's layers: its index, or else where it was unpacked."""
+        return self.base_index if self.base_index is not None else self.base_layer_dir
 
 
 class RockcraftImageService(ProjectService):
-    """Service to fetch and cache OCI images."""
+    """Service to fetch and cache OCI images.
+
+    Base images are obtained from the source set in the environment (see
+    ``oci.BaseSource``). If ``offline`` is set, only local copies of them are
+    used, failing right away if there are none.
+    """
 
     def __init__(
         self,
@@ -45,13 +62,19 @@ class RockcraftImageService(ProjectService):
         *,
         project: models.Project,
         work_dir: Path,
+        cache_dir: Path,
         build_for: str,
     ):
+        # pylint: disable=too-many-arguments
         super().__init__(app, services, project=project)
 
         self._work_dir = work_dir
         self._build_for = build_for
         self._image_info: ImageInfo | None = None
+        self.offline = False
+        # Host-wide, so that projects on the same base share its layers.
+        self._blob_store = oci_layout.BlobStore(cache_dir / "oci")
+        self._rootfs_cache = rootfs.RootfsCache(cache_dir / "bundles")
 
     def obtain_image(self) -> ImageInfo:
         """Return the ImageInfo for the project's base, possibly fetching it."""
@@ -70,6 +93,7 @@ class RockcraftImageService(ProjectService):
                 f"{project.base}@latest",
                 image_dir=image_dir,
                 arch=self._build_for,
+                blob_store=self._blob_store,
             )
         else:
             emit.progress(f"Retrieving base {project.base} for {build_for}")
@@ -77,22 +101,35 @@ class RockcraftImageService(ProjectService):
                 project.base,
                 image_dir=image_dir,
                 arch=self._build_for,
+                source=oci.BaseSource.from_environment(
+                    blob_store=self._blob_store, offline=self.offline
+                ),
             )
             emit.progress(f"Retrieved base {project.base} for {build_for}")
 
-        emit.progress(f"Extracting {base_image.image_name}")
-        rootfs = base_image.extract_to(bundle_dir)
-        emit.progress(f"Extracted {base_image.image_name}")
+        base_index = base_image.get_index(cache=self._rootfs_cache)
+
+        rootfs_dir = None
+        if self._needs_rootfs():
+            emit.progress(f"Extracting {base_image.image_name}")
+            rootfs_dir = base_image.extract_to(bundle_dir, cache=self._rootfs_cache)
+            emit.progress(f"Extracted {base_image.image_name}")
 
         # TODO: check if destination image already exists, etc.
         project_base_image = base_image.copy_to(
             f"{project.name}:rockcraft-base", image_dir=image_dir
         )
 
-        base_digest = project_base_image.digest(source_image)
+        base_digest = project_base_image.get_source_digest(source_image)
 
         return ImageInfo(
             base_image=project_base_image,
-            base_layer_dir=rootfs,
+            base_layer_dir=rootfs_dir,
             base_digest=base_digest,
+            base_index=base_index,
         )
+
+    def _needs_rootfs(self) -> bool:
+        """Whether any part uses overlays, which need the base to be unpacked."""
+        project = cast(models.Project, self._project)
+        return any(part_has_overlay(part) for part in project.parts.values())
@@ -23,9 +23,10 @@ from typing import Any, cast
 from craft_application import LifecycleService
 from craft_archives import repo  # type: ignore[import-untyped]
 from craft_cli import emit
-from craft_parts import Features, LifecycleManager, Step, callbacks
+from craft_parts import Features, LifecycleManager, Part, Step, callbacks
 from craft_parts.errors import CallbackRegistrationError
 from craft_parts.infos import ProjectInfo, StepInfo
+from craft_parts.state_manager import states
 from overrides import override  # type: ignore[reportUnknownVariableType]
 
 from rockcraft import layers
@@ -61,6 +62,7 @@ class RockcraftLifecycleService(LifecycleService):
             project_name=project.name,
             project_vars=project_vars,
             rootfs_dir=image_info.base_layer_dir,
+            base_index=image_info.base_index,
         )
 
         super().setup()
@@ -83,6 +85,24 @@ class RockcraftLifecycleService(LifecycleService):
         finally:
             callbacks.unregister_all()
 
+    def get_primed_paths(self) -> dict[str, set[str]]:
+        """Get the paths that each part primed, as recorded in the parts' state.
+
+        :returns: The files and directories primed by each part, relative to
+            the prime directory, in the order that the parts are defined.
+        """
+        project = cast(Project, self._project)
+        project_dirs = self.project_info.dirs
+
+        primed_paths: dict[str, set[str]] = {}
+        for part_name in project.parts:
+            part = Part(part_name, {}, project_dirs=project_dirs)
+            state = states.load_step_state(part, Step.PRIME)
+            primed_paths[part_name] = (
+                set(state.files) | set(state.directories) if state else set()
+            )
+        return primed_paths
+
 
 def _install_package_repositories(
     package_repositories: list[dict[str, Any]] | None,
@@ -113,10 +133,11 @@ def _install_overlay_repositories(overlay_dir: Path, project_info: ProjectInfo)
 
 def _post_prime_callback(step_info: StepInfo) -> bool:
     prime_dir = step_info.prime_dir
-    base_layer_dir = step_info.rootfs_dir
+    base_index = step_info.base_index
+    base_layer = base_index if base_index is not None else step_info.rootfs_dir
     files: set[str]
 
     files = step_info.state.files if step_info.state else set()
 
-    layers.prune_prime_files(prime_dir, files, base_layer_dir)
+    layers.prune_prime_files(prime_dir, files, base_layer)
     return True
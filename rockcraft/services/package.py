@@ -16,22 +16,53 @@
 
 """Rockcraft Package service."""
 
-import datetime
+import dataclasses
 import pathlib
+import tempfile
 import typing
-from typing import cast
+from typing import Literal, cast
 
 from craft_application import AppMetadata, PackageService, models, util
 from craft_cli import emit
 from overrides import override  # type: ignore[reportUnknownVariableType]
 
-from rockcraft import errors, oci
-from rockcraft.models import Project
+from rockcraft import docker, errors, layers, oci, utils
+from rockcraft.compression import DEFAULT_LAYER_COMPRESSION, LayerCompression
+from rockcraft.models import PrimeLayer, Project
+from rockcraft.services.image import ImageInfo
 from rockcraft.usernames import SUPPORTED_GLOBAL_USERNAMES
 
 if typing.TYPE_CHECKING:
     from rockcraft.services import RockcraftServiceFactory
 
+ExportFormat = Literal["docker-archive", "docker-daemon"]
+"""Where rocks can be exported to, besides ``.rock`` files."""
+
+EXPORT_FORMATS: tuple[ExportFormat, ...] = ("docker-archive", "docker-daemon")
+
+
+@dataclasses.dataclass(frozen=True)
+class PackOptions:
+    """How to pack a rock from its primed contents.
+
+    :param rock_suffix: The suffix to append to the rock's filename, after the
+        name and version.
+    :param build_for: The architecture of the rock, to add as metadata.
+    :param compression: The compression algorithm of the rock's layers.
+    :param export: Where to export the rock to, besides the ``.rock`` file.
+    :param prime_layers: The paths in the prime directory of each layer, to
+        split the primed contents in several layers.
+    :param squash: Whether to merge all the layers of the rock, base ones
+        included, into one.
+    """
+
+    rock_suffix: str
+    build_for: str
+    compression: LayerCompression = DEFAULT_LAYER_COMPRESSION
+    export: ExportFormat | None = None
+    prime_layers: list[set[str]] | None = None
+    squash: bool = False
+
 
 class RockcraftPackageService(PackageService):
     """Package service subclass for Rockcraft."""
@@ -48,6 +79,18 @@ class RockcraftPackageService(PackageService):
         super().__init__(app, services, project=project)
         self._platform = platform
         self._build_for = build_for
+        self.compression: LayerCompression | None = None
+        """The layer compression, overriding the one set in the project."""
+        self.export: ExportFormat | None = None
+        """Where to export the rock to, if anywhere besides the ``.rock`` file.
+
+        With ``docker-archive``, the ``.rock`` file is also a Docker archive.
+        With ``docker-daemon``, the rock is loaded into the Docker daemon
+        instead; in managed mode, the daemon is out of reach, so the rock is
+        packed as a Docker archive for the host to load.
+        """
+        self.squash = False
+        """Whether to merge all the rock's layers, base ones included, into one."""
 
     @override
     def pack(self, prime_dir: pathlib.Path, dest: pathlib.Path) -> list[pathlib.Path]:
@@ -86,17 +129,71 @@ class RockcraftPackageService(PackageService):
 
             platform = build_plan[0].platform
 
+        project = cast(Project, self._project)
+        prime_layers = None
+        if project.prime_layers and project.prime_layers != "single":
+            prime_layers = _get_prime_layers(
+                prime_dir, project, services.lifecycle.get_primed_paths()
+            )
+
         archive_name = _pack(
             prime_dir=prime_dir,
-            project=cast(Project, self._project),
-            project_base_image=image_info.base_image,
-            base_digest=image_info.base_digest,
-            rock_suffix=platform,
-            build_for=self._build_for,
-            base_layer_dir=image_info.base_layer_dir,
+            project=project,
+            image_info=image_info,
+            options=PackOptions(
+                rock_suffix=platform,
+                build_for=self._build_for,
+                compression=self.compression
+                or project.compression
+                or DEFAULT_LAYER_COMPRESSION,
+                export=self.export,
+                prime_layers=prime_layers,
+                squash=self.squash,
+            ),
         )
 
-        return [dest / archive_name]
+        return [dest / archive_name] if archive_name else []
+
+    def pack_index(self, platforms: list[str], dest: pathlib.Path) -> pathlib.Path:
+        """Pack the rocks of several platforms into one, with an OCI image index.
+
+        :param platforms: The platforms whose rocks were packed into ``dest``.
+        :param dest: Directory into which to write the new rock.
+        :returns: The path to the new rock.
+        """
+        if not platforms:
+            raise errors.RockcraftError("No platforms to pack into an OCI index.")
+
+        project = cast(Project, self._project)
+        archives = [dest / _get_rock_name(project, platform) for platform in platforms]
+        archive_path = dest / f"{project.name}_{project.version}.rock"
+
+        emit.progress(f"Packing {len(platforms)} platforms into an OCI index")
+        with tempfile.TemporaryDirectory() as work_dir:
+            oci.pack_image_index(
+                archives,
+                tag=project.version,
+                image_dir=pathlib.Path(work_dir, "index"),
+                filename=str(archive_path),
+            )
+        return archive_path
+
+    def load_into_docker(self, platforms: list[str], dest: pathlib.Path) -> list[str]:
+        """Load the rocks of several platforms into the Docker daemon.
+
+        :param platforms: The platforms whose rocks were packed into ``dest``,
+            as Docker archives.
+        :param dest: Directory holding the rocks.
+        :returns: The names of the loaded images.
+        """
+        project = cast(Project, self._project)
+        daemon = docker.DockerDaemon.from_environment()
+        loaded: list[str] = []
+        for platform in platforms:
+            archive_path = dest / _get_rock_name(project, platform)
+            emit.progress(f"Loading {archive_path.name} into the Docker daemon")
+            loaded.extend(daemon.load_file(archive_path))
+        return loaded
 
     @override
     def write_metadata(self, path: pathlib.Path) -> None:
@@ -117,89 +214,149 @@ def _pack(
     *,
     prime_dir: pathlib.Path,
     project: Project,
-    project_base_image: oci.Image,
-    base_digest: bytes,
-    rock_suffix: str,
-    build_for: str,
-    base_layer_dir: pathlib.Path,
-) -> str:
+    image_info: ImageInfo,
+    options: PackOptions,
+) -> str | None:
     """Create the rock image for a given architecture.
 
     :param lifecycle:
       The lifecycle object containing the primed payload for the rock.
-    :param project_base_image:
-      The Image for the base over which the payload was primed.
-    :param base_digest:
-      The digest of the base image, to add to the new image's metadata.
-    :param rock_suffix:
-      The suffix to append to the image's filename, after the name and version.
-    :param build_for:
-      The architecture of the built rock, to add as metadata.
-    :param base_layer_dir:
-      The directory where the rock's base image was extracted.
+    :param image_info:
+      The base over which the payload was primed: its Image, digest, and
+      extracted directory or index.
+    :param options:
+      The options of the packing.
+    :returns:
+      The name of the ``.rock`` file, unless loaded into the Docker daemon.
     """
+    base_layer = image_info.base_layer
     emit.progress("Creating new layer")
-    new_image = project_base_image.add_layer(
-        tag=project.version,
-        new_layer_dir=prime_dir,
-        base_layer_dir=base_layer_dir,
+    new_image = image_info.base_image
+    layer_paths: list[set[str] | None] = (
+        [*options.prime_layers] if options.prime_layers else [None]
     )
-    emit.progress("Created new layer")
-
-    if project.run_user:
-        emit.progress(f"Creating new user {project.run_user}")
-        new_image.add_user(
-            prime_dir=prime_dir,
-            base_layer_dir=base_layer_dir,
+    for paths in layer_paths:
+        new_image = new_image.add_layer(
             tag=project.version,
-            username=project.run_user,
-            uid=SUPPORTED_GLOBAL_USERNAMES[project.run_user]["uid"],
+            new_layer_dir=prime_dir,
+            options=oci.LayerOptions(
+                base_layer=base_layer, compression=options.compression, paths=paths
+            ),
         )
+    emit.progress("Created new layer")
 
-        emit.progress(f"Setting the default OCI user to be {project.run_user}")
-        new_image.set_default_user(project.run_user)
-
-    emit.progress("Adding Pebble entrypoint")
+    # The user files, Pebble layer and control data are small, so they can all
+    # go in a single layer instead of one each.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        metadata_dir = (
+            pathlib.Path(tmpdir) if project.metadata_layers == "single" else None
+        )
+        metadata_options = oci.LayerOptions(
+            base_layer=base_layer, layer_dir=metadata_dir
+        )
+        if project.run_user:
+            emit.progress(f"Creating new user {project.run_user}")
+            new_image.add_user(
+                prime_dir=prime_dir,
+                tag=project.version,
+                username=project.run_user,
+                uid=SUPPORTED_GLOBAL_USERNAMES[project.run_user]["uid"],
+                options=metadata_options,
+            )
+
+        services = project.dict(exclude_none=True, by_alias=True).get("services", {})
+
+        checks = project.dict(exclude_none=True, by_alias=True).get("checks", {})
+
+        if services or checks:
+            new_image.set_pebble_layer(
+                services=services,
+                checks=checks,
+                name=project.name,
+                tag=project.version,
+                summary=project.summary,
+                description=project.description,
+                options=metadata_options,
+            )
+
+        # Set annotations and metadata, both dynamic and the ones based on
+        # user-provided properties. Also include the "created" timestamp (the
+        # build time, see utils.get_build_time())
+        emit.progress("Adding metadata")
+        oci_annotations, rock_metadata = project.generate_metadata(
+            utils.get_build_time().isoformat(), image_info.base_digest
+        )
+        rock_metadata["architecture"] = options.build_for
+        # TODO: add variant to rock_metadata too
+        # if build_for_variant:
+        #     rock_metadata["variant"] = build_for_variant
+        new_image.set_control_data(rock_metadata, layer_dir=metadata_dir)
+
+        if metadata_dir:
+            emit.progress("Writing the metadata layer")
+            new_image.add_layer(
+                project.version,
+                metadata_dir,
+                oci.LayerOptions(created_by="rockcraft add-metadata", reuse=False),
+            )
+
+    if options.squash:
+        emit.progress("Squashing the layers into one")
+        new_image = new_image.squash(project.version)
+        emit.progress("Squashed the layers into one")
+
+    # All the config changes are written at once, when the editing ends.
+    with new_image.edit_config() as image_config:
+        if project.run_user:
+            emit.progress(f"Setting the default OCI user to be {project.run_user}")
+            image_config.set_default_user(project.run_user)
+
+        emit.progress("Adding Pebble entrypoint")
+
+        image_config.set_entrypoint(project.entrypoint_service)
+        if project.services and project.entrypoint_service in project.services:
+            image_config.set_cmd(project.services[project.entrypoint_service].command)
+
+        if project.environment:
+            image_config.set_environment(project.environment)
+
+        image_config.set_annotations(oci_annotations)
+    emit.progress("Metadata added")
 
-    new_image.set_entrypoint(project.entrypoint_service)
-    if project.services and project.entrypoint_service in project.services:
-        new_image.set_cmd(project.services[project.entrypoint_service].command)
+    repo_tag = f"{project.name}:{project.version}" if options.export else None
+    if options.export == "docker-daemon" and not utils.is_managed_mode():
+        emit.progress("Loading into the Docker daemon")
+        new_image.to_docker_daemon(project.version, repo_tag=repo_tag)
+        emit.progress(f"Loaded {repo_tag} into the Docker daemon")
+        return None
 
-    services = project.dict(exclude_none=True, by_alias=True).get("services", {})
+    emit.progress("Exporting to OCI archive")
+    archive_name = _get_rock_name(project, options.rock_suffix)
+    new_image.to_oci_archive(
+        tag=project.version, filename=archive_name, repo_tag=repo_tag
+    )
+    emit.progress(f"Exported to OCI archive '{archive_name}'")
 
-    checks = project.dict(exclude_none=True, by_alias=True).get("checks", {})
+    return archive_name
 
-    if services or checks:
-        new_image.set_pebble_layer(
-            services=services,
-            checks=checks,
-            name=project.name,
-            tag=project.version,
-            summary=project.summary,
-            description=project.description,
-            base_layer_dir=base_layer_dir,
-        )
 
-    if project.environment:
-        new_image.set_environment(project.environment)
+def _get_prime_layers(
+    prime_dir: pathlib.Path, project: Project, primed_paths: dict[str, set[str]]
+) -> list[set[str]]:
+    """Split the primed contents in layers, following the project's prime-layers."""
+    selectors: list[tuple[list[str], list[str]]]
+    if project.prime_layers == "per-part":
+        selectors = [([part_name], []) for part_name in primed_paths]
+    else:
+        selectors = [
+            (layer.parts or [], layer.paths or [])
+            for layer in cast(list[PrimeLayer], project.prime_layers)
+        ]
 
-    # Set annotations and metadata, both dynamic and the ones based on user-provided properties
-    # Also include the "created" timestamp, just before packing the image
-    emit.progress("Adding metadata")
-    oci_annotations, rock_metadata = project.generate_metadata(
-        datetime.datetime.now(datetime.timezone.utc).isoformat(), base_digest
-    )
-    rock_metadata["architecture"] = build_for
-    # TODO: add variant to rock_metadata too
-    # if build_for_variant:
-    #     rock_metadata["variant"] = build_for_variant
-    new_image.set_annotations(oci_annotations)
-    new_image.set_control_data(rock_metadata)
-    emit.progress("Metadata added")
+    prime_layers = layers.split_prime_paths(prime_dir, primed_paths, selectors)
+    emit.debug(f"Splitting the primed contents in {len(prime_layers)} layers")
+    return prime_layers
 
-    emit.progress("Exporting to OCI archive")
-    archive_name = f"{project.name}_{project.version}_{rock_suffix}.rock"
-    new_image.to_oci_archive(tag=project.version, filename=archive_name)
-    emit.progress(f"Exported to OCI archive '{archive_name}'")
 
-    return archive_name
+def _get_rock_name(project: Project, rock_suffix: str) -> str:
+    return f"{project.name}_{project.version}_{rock_suffix}.rock"
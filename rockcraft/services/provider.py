@@ -16,15 +16,59 @@
 
 """Rockcraft Provider service."""
 
-from craft_application import ProviderService
+import contextlib
+import os
+from collections.abc import Iterator
+from pathlib import Path, PurePosixPath
+
+import craft_providers
+from craft_application import ProviderService, models
 from overrides import override  # type: ignore[reportUnknownVariableType]
 
+from rockcraft import oci
+
+# Where a local mirror of the base images is mounted in the instances.
+BASE_MIRROR_MOUNT = PurePosixPath("/root/base-mirror")
+
 
 class RockcraftProviderService(ProviderService):
-    """ProviderService specialization to configure the APT packages."""
+    """ProviderService specialization to configure the APT packages.
+
+    The base images mirror set in the environment, if any, is also made
+    available in the instances.
+    """
 
     @override
     def setup(self) -> None:
         """Configure the APT packages to be installed in the provider instance."""
         super().setup()
         self.packages.extend(["gpg", "dirmngr"])
+
+        mirror = os.getenv(oci.BASE_MIRROR_ENV)
+        if mirror:
+            if mirror.startswith("oci:"):
+                mirror = f"oci:{BASE_MIRROR_MOUNT}"
+            self.environment[oci.BASE_MIRROR_ENV] = mirror
+
+    @contextlib.contextmanager
+    @override
+    def instance(
+        self,
+        build_info: models.BuildInfo,
+        *,
+        work_dir: Path,
+        allow_unstable: bool = True,
+        **kwargs: bool | str | None,
+    ) -> Iterator[craft_providers.Executor]:
+        """Get a provider instance, with the local base images mirror mounted."""
+        with super().instance(
+            build_info, work_dir=work_dir, allow_unstable=allow_unstable, **kwargs
+        ) as instance:
+            source = oci.BaseSource.from_environment()
+            if source.layout is not None:
+                # Ignore argument type until craft-providers accepts PurePosixPaths
+                instance.mount(
+                    host_source=source.layout,
+                    target=BASE_MIRROR_MOUNT,  # type: ignore[arg-type]
+                )
+            yield instance
@@ -45,3 +45,4 @@ class RockcraftServiceFactory(ServiceFactory):
 
     if TYPE_CHECKING:
         image: services.RockcraftImageService = None  # type: ignore[assignment]
+        lifecycle: services.RockcraftLifecycleService = None  # type: ignore[assignment]
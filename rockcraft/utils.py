@@ -17,6 +17,7 @@
 """Utilities for rockcraft."""
 
 
+import datetime
 import logging
 import os
 import pathlib
@@ -29,6 +30,10 @@ import rockcraft.errors
 
 logger = logging.getLogger(__name__)
 
+# The timestamp that reproducible builds use instead of the current time, see
+# https://reproducible-builds.org/specs/source-date-epoch/
+SOURCE_DATE_EPOCH_ENV = "SOURCE_DATE_EPOCH"
+
 
 class OSPlatform(NamedTuple):
     """Tuple containing the OS platform information."""
@@ -44,6 +49,34 @@ def is_managed_mode() -> bool:
     return strtobool(managed_flag) == 1
 
 
+def get_source_date_epoch() -> int | None:
+    """Get the timestamp to use for a reproducible build, if one was set.
+
+    :returns: The value of ``SOURCE_DATE_EPOCH``, in seconds since the epoch,
+        or None if the build need not be reproducible.
+    """
+    value = os.getenv(SOURCE_DATE_EPOCH_ENV)
+    if not value:
+        return None
+    if not value.isdigit():
+        raise rockcraft.errors.RockcraftError(
+            f"Invalid value for {SOURCE_DATE_EPOCH_ENV}: {value!r}",
+            resolution="Set it to a number of seconds since the Unix epoch.",
+        )
+    return int(value)
+
+
+def get_build_time() -> datetime.datetime:
+    """Get the time to record as the build time, in UTC.
+
+    This is the current time, unless ``SOURCE_DATE_EPOCH`` is set.
+    """
+    source_date_epoch = get_source_date_epoch()
+    if source_date_epoch is None:
+        return datetime.datetime.now(datetime.timezone.utc)
+    return datetime.datetime.fromtimestamp(source_date_epoch, datetime.timezone.utc)
+
+
 def get_managed_environment_home_path() -> pathlib.Path:
     """Path for home when running in managed environment."""
     return pathlib.Path("/root")
@@ -139,19 +139,23 @@ def default_factory(default_project):
         app=APP_METADATA,
         project=default_project,
     )
-    factory.set_kwargs("image", work_dir=Path("work"), build_for="amd64")
+    factory.set_kwargs(
+        "image", work_dir=Path("work"), cache_dir=Path("cache"), build_for="amd64"
+    )
     return factory
 
 
 @pytest.fixture()
 def default_image_info():
     from rockcraft import oci
+    from rockcraft.base_index import BaseIndex
     from rockcraft.services.image import ImageInfo
 
     return ImageInfo(
         base_image=oci.Image(image_name="fake_image", path=Path()),
         base_layer_dir=Path(),
         base_digest=b"deadbeef",
+        base_index=BaseIndex({}),
     )
 
 
@@ -172,6 +176,7 @@ def image_service(default_project, default_factory, tmp_path):
         project=default_project,
         services=default_factory,
         work_dir=tmp_path,
+        cache_dir=tmp_path / "cache",
         build_for="amd64",
     )
 
@@ -117,7 +117,9 @@ def test_add_layer_with_symlink_in_base(new_dir):
         (new_target_dir / f"new_{target}_file").write_text(f"new {target} file")
 
     new_image = image.add_layer(
-        tag="new", new_layer_dir=new_layer_dir, base_layer_dir=base_layer_dir
+        tag="new",
+        new_layer_dir=new_layer_dir,
+        options=oci.LayerOptions(base_layer=base_layer_dir),
     )
 
     assert get_names_in_layer(new_image) == [
@@ -160,7 +162,7 @@ def test_add_layer_with_overlay(new_dir, mocker, lifecycle_service, mock_obtain_
 
     image_info = ImageInfo(
         base_image=image,
-        base_layer_dir=base_layer_dir,
+        base_layer=base_layer_dir,
         base_digest=b"deadbeef",
     )
     mock_obtain_image.return_value = image_info
@@ -179,7 +181,7 @@ def test_add_layer_with_overlay(new_dir, mocker, lifecycle_service, mock_obtain_
     new_image = image.add_layer(
         tag="new",
         new_layer_dir=lifecycle_service.prime_dir,
-        base_layer_dir=base_layer_dir,
+        options=oci.LayerOptions(base_layer=base_layer_dir),
     )
 
     assert get_names_in_layer(new_image) == [
@@ -0,0 +1,100 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+
+import pytest
+from rockcraft import errors, oci_layout
+from rockcraft.application import APP_METADATA
+from rockcraft.commands import PushCommand
+from rockcraft.commands.push import parse_destination
+
+
+@pytest.mark.parametrize(
+    ("destination", "expected"),
+    [
+        ("ghcr.io/org/name:1.0", ("ghcr.io", "org/name", "1.0")),
+        ("docker://ghcr.io/org/name", ("ghcr.io", "org/name", None)),
+        ("localhost:5000/name:latest", ("localhost:5000", "name", "latest")),
+        ("localhost/name", ("localhost", "name", None)),
+        ("docker.io/org/name:1.0", ("registry-1.docker.io", "org/name", "1.0")),
+        ("docker.io/name", ("registry-1.docker.io", "library/name", None)),
+        ("index.docker.io/org/name", ("registry-1.docker.io", "org/name", None)),
+    ],
+)
+def test_parse_destination(destination, expected):
+    assert parse_destination(destination) == expected
+
+
+@pytest.mark.parametrize("destination", ["org/name:1.0", "ghcr.io"])
+def test_parse_destination_no_registry(destination):
+    with pytest.raises(errors.RockcraftError, match="Invalid destination"):
+        parse_destination(destination)
+
+
+@pytest.mark.parametrize(
+    "destination",
+    [
+        "ghcr.io/org/name@sha256:abcd",
+        "ghcr.io/org/name:1.0@sha256:abcd",
+        "localhost:5000/name@sha256:abcd",
+    ],
+)
+def test_parse_destination_digest(destination):
+    with pytest.raises(errors.RockcraftError, match="Invalid destination") as raised:
+        parse_destination(destination)
+    assert raised.value.details is not None
+    assert "pushed by tag" in raised.value.details
+
+
+@pytest.fixture()
+def rock(tmp_path):
+    layout = oci_layout.ImageLayout.init(tmp_path / "image")
+    layout.create_image("1.0", architecture="amd64")
+    layout.export_archive("1.0", tmp_path / "test_1.0_amd64.rock")
+    return tmp_path / "test_1.0_amd64.rock"
+
+
+@pytest.mark.parametrize(("tag", "expected_tag"), [("", "1.0"), (":edge", "edge")])
+def test_push(fake_registry, emitter, monkeypatch, tmp_path, rock, tag, expected_tag):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    command = PushCommand({"app": APP_METADATA, "services": None})
+
+    command.run(
+        argparse.Namespace(rock=rock, destination=f"{fake_registry.host}/test{tag}")
+    )
+
+    media_type, content = fake_registry.manifests[("test", expected_tag)]
+    assert media_type == oci_layout.MEDIA_TYPE_MANIFEST
+    digest = oci_layout.sha256_digest(content)
+    emitter.assert_message(
+        f"Pushed {rock} to {fake_registry.host}/test:{expected_tag}@{digest}"
+    )
+    # The pushed blobs are recorded, to mount them in other repositories
+    blob_store = oci_layout.BlobStore(tmp_path / "cache/rockcraft/oci")
+    assert set(blob_store.get_blob_repositories(fake_registry.host).values()) == {
+        "test"
+    }
+
+
+def test_push_rock_not_found(tmp_path):
+    command = PushCommand({"app": APP_METADATA, "services": None})
+
+    with pytest.raises(errors.RockcraftError, match="not found"):
+        command.run(
+            argparse.Namespace(
+                rock=tmp_path / "missing.rock", destination="ghcr.io/org/name"
+            )
+        )
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import contextlib
+import tempfile
 from pathlib import Path
 from unittest import mock
 
@@ -84,3 +85,25 @@ def fake_provider(mock_instance):
             yield mock_instance
 
     return FakeProvider()
+
+
+@pytest.fixture()
+def fake_registry():
+    """Provide a local stand-in for an image registry."""
+    from tests.unit.testing.registry import FakeRegistry
+
+    with FakeRegistry() as registry:
+        yield registry
+
+
+@pytest.fixture()
+def fake_docker_daemon(monkeypatch):
+    """Provide a local stand-in for the Docker daemon, set as DOCKER_HOST."""
+    from tests.unit.testing.docker import FakeDockerDaemon
+
+    # Unix socket paths are too short for pytest's temporary directories.
+    with tempfile.TemporaryDirectory(prefix="docker-") as socket_dir:
+        socket_path = Path(socket_dir, "docker.sock")
+        monkeypatch.setenv("DOCKER_HOST", f"unix://{socket_path}")
+        with FakeDockerDaemon(socket_path) as daemon:
+            yield daemon
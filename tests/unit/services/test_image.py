@@ -13,6 +13,11 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from pathlib import Path
+
+import pytest
+
+from rockcraft import oci
 
 
 def test_image_service_cache(image_service, default_image_info, mocker):
@@ -28,3 +33,48 @@ def test_image_service_cache(image_service, default_image_info, mocker):
     assert info2 is default_image_info
 
     mock_create.assert_called_once_with()
+
+
+@pytest.mark.parametrize(
+    ("extra_project_params", "unpacked"),
+    [
+        ({"parts": {"foo": {"plugin": "nil"}}}, False),
+        ({"parts": {"foo": {"plugin": "nil", "overlay-script": "true"}}}, True),
+    ],
+)
+def test_image_service_unpack_for_overlays(image_service, mocker, unpacked):
+    """The base is only unpacked if the parts use overlays."""
+    base_image = oci.Image("ubuntu:22.04", Path("images"), source_digest="sha256:00")
+    mocker.patch.object(
+        oci.Image, "from_docker_registry", return_value=(base_image, "source")
+    )
+    mocker.patch.object(oci.Image, "copy_to", return_value=base_image)
+    mock_get_index = mocker.patch.object(oci.Image, "get_index")
+    mock_extract_to = mocker.patch.object(
+        oci.Image, "extract_to", return_value=Path("rootfs")
+    )
+
+    info = image_service.obtain_image()
+
+    assert info.base_index is mock_get_index.return_value
+    assert info.base_layer is info.base_index
+    assert mock_extract_to.called is unpacked
+    assert info.base_layer_dir == (Path("rootfs") if unpacked else None)
+
+
+def test_image_service_offline(image_service, monkeypatch, mocker):
+    monkeypatch.setenv(oci.BASE_MIRROR_ENV, "mirror.example.com/ubuntu")
+    base_image = oci.Image("ubuntu:22.04", Path("images"), source_digest="sha256:00")
+    mock_from_registry = mocker.patch.object(
+        oci.Image, "from_docker_registry", return_value=(base_image, "source")
+    )
+    mocker.patch.object(oci.Image, "copy_to", return_value=base_image)
+    mocker.patch.object(oci.Image, "get_index")
+
+    image_service.offline = True
+    image_service.obtain_image()
+
+    source = mock_from_registry.call_args.kwargs["source"]
+    assert source.registry == "mirror.example.com/ubuntu"
+    assert source.offline is True
+    assert source.blob_store is not None
@@ -17,7 +17,8 @@ from pathlib import Path
 from unittest import mock
 
 import pytest
-from craft_parts import LifecycleManager, callbacks
+from craft_parts import LifecycleManager, ProjectDirs, callbacks
+from craft_parts.state_manager.prime_state import PrimeState
 
 from rockcraft.services import lifecycle as lifecycle_module
 
@@ -56,6 +57,7 @@ def test_lifecycle_args(lifecycle_service, default_factory, default_image_info,
         project_vars={"version": "1.0"},
         work_dir=Path("work"),
         rootfs_dir=Path("."),
+        base_index=default_image_info.base_index,
     )
 
 
@@ -78,3 +80,23 @@ def test_lifecycle_package_repositories(
     mock_callback.assert_called_once_with(
         lifecycle_module._install_overlay_repositories
     )
+
+
+@pytest.mark.parametrize(
+    "extra_project_params",
+    [{"parts": {name: {"plugin": "nil"} for name in ("app", "libs", "unprimed")}}],
+)
+def test_get_primed_paths(lifecycle_service, tmp_path):
+    lifecycle_service._lcm = mock.MagicMock(spec=LifecycleManager)
+    lifecycle_service._lcm.project_info.dirs = ProjectDirs(work_dir=tmp_path)
+    for part_name, directory in [("app", "bin"), ("libs", "lib")]:
+        state_dir = tmp_path / "parts" / part_name / "state"
+        state_dir.mkdir(parents=True)
+        state = PrimeState(files={f"{directory}/{part_name}"}, directories={directory})
+        state.write(state_dir / "prime")
+
+    assert lifecycle_service.get_primed_paths() == {
+        "app": {"bin", "bin/app"},
+        "libs": {"lib", "lib/libs"},
+        "unprimed": set(),
+    }
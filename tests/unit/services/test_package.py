@@ -14,8 +14,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from pathlib import Path
+from unittest.mock import ANY
 
+import pytest
+from rockcraft import errors, oci
+from rockcraft.models import PrimeLayer
 from rockcraft.services import package
+from rockcraft.services.image import ImageInfo
 
 
 def test_pack(package_service, default_factory, default_image_info, mocker):
@@ -34,11 +39,204 @@ def test_pack(package_service, default_factory, default_image_info, mocker):
     # Check that the regular _pack() function was called with the correct
     # parameters.
     mock_inner_pack.assert_called_once_with(
-        base_digest=b"deadbeef",
-        base_layer_dir=Path(),
-        build_for="amd64",
         prime_dir=Path("prime"),
         project=default_factory.project,
-        project_base_image=default_image_info.base_image,
-        rock_suffix="amd64",
+        image_info=default_image_info,
+        options=package.PackOptions(
+            rock_suffix="amd64", build_for="amd64", compression="gzip"
+        ),
     )
+
+
+def test_pack_compression(package_service, default_factory, default_image_info, mocker):
+    mocker.patch.object(
+        default_factory.image, "obtain_image", return_value=default_image_info
+    )
+    mock_inner_pack = mocker.patch.object(package, "_pack")
+
+    package_service.compression = "zstd"
+    package_service.pack(prime_dir=Path("prime"), dest=Path())
+
+    assert mock_inner_pack.call_args.kwargs["options"].compression == "zstd"
+
+
+def test_pack_squash(default_project, mocker):
+    base_image = mocker.MagicMock()
+    new_image = base_image.add_layer.return_value
+
+    package._pack(
+        prime_dir=Path("prime"),
+        project=default_project,
+        image_info=ImageInfo(base_image, None, b"deadbeef"),
+        options=package.PackOptions(
+            rock_suffix="amd64", build_for="amd64", squash=True
+        ),
+    )
+
+    new_image.squash.assert_called_once_with("1.0")
+    squashed_image = new_image.squash.return_value
+    squashed_image.to_oci_archive.assert_called_once_with(
+        tag="1.0", filename="default_1.0_amd64.rock", repo_tag=None
+    )
+
+
+def test_pack_index(package_service, default_project, mocker, tmp_path):
+    mock_pack_index = mocker.patch("rockcraft.oci.pack_image_index")
+
+    rock = package_service.pack_index(["amd64", "arm64"], tmp_path)
+
+    name = f"{default_project.name}_{default_project.version}"
+    assert rock == tmp_path / f"{name}.rock"
+    mock_pack_index.assert_called_once_with(
+        [tmp_path / f"{name}_amd64.rock", tmp_path / f"{name}_arm64.rock"],
+        tag=default_project.version,
+        image_dir=ANY,
+        filename=str(rock),
+    )
+
+
+def test_pack_index_no_platforms(package_service, tmp_path):
+    with pytest.raises(errors.RockcraftError, match="No platforms"):
+        package_service.pack_index([], tmp_path)
+
+
+def test_pack_loaded_into_docker(
+    package_service, default_factory, default_image_info, mocker
+):
+    mocker.patch.object(
+        default_factory.image, "obtain_image", return_value=default_image_info
+    )
+    mock_inner_pack = mocker.patch.object(package, "_pack", return_value=None)
+
+    package_service.export = "docker-daemon"
+    packages = package_service.pack(prime_dir=Path("prime"), dest=Path())
+
+    assert mock_inner_pack.call_args.kwargs["options"].export == "docker-daemon"
+    assert packages == []
+
+
+@pytest.mark.parametrize(
+    ("export", "managed", "loaded", "repo_tag"),
+    [
+        (None, False, False, None),
+        ("docker-archive", False, False, "default:1.0"),
+        ("docker-daemon", False, True, "default:1.0"),
+        ("docker-daemon", True, False, "default:1.0"),
+    ],
+)
+def test_pack_export(
+    default_project, mocker, monkeypatch, export, managed, loaded, repo_tag
+):
+    monkeypatch.setenv("CRAFT_MANAGED_MODE", "1" if managed else "0")
+    base_image = mocker.MagicMock()
+    new_image = base_image.add_layer.return_value
+
+    archive_name = package._pack(
+        prime_dir=Path("prime"),
+        project=default_project,
+        image_info=ImageInfo(base_image, None, b"deadbeef"),
+        options=package.PackOptions(
+            rock_suffix="amd64", build_for="amd64", export=export
+        ),
+    )
+
+    if loaded:
+        assert archive_name is None
+        new_image.to_docker_daemon.assert_called_once_with("1.0", repo_tag=repo_tag)
+        assert not new_image.to_oci_archive.called
+    else:
+        assert archive_name == "default_1.0_amd64.rock"
+        new_image.to_oci_archive.assert_called_once_with(
+            tag="1.0", filename=archive_name, repo_tag=repo_tag
+        )
+        assert not new_image.to_docker_daemon.called
+
+
+def test_load_into_docker(package_service, mocker, tmp_path):
+    mock_load_file = mocker.patch(
+        "rockcraft.docker.DockerDaemon.load_file",
+        side_effect=[["default:1.0"], ["default:1.0"]],
+    )
+
+    loaded = package_service.load_into_docker(["amd64", "arm64"], tmp_path)
+
+    assert loaded == ["default:1.0", "default:1.0"]
+    assert [call.args[0] for call in mock_load_file.mock_calls] == [
+        tmp_path / "default_1.0_amd64.rock",
+        tmp_path / "default_1.0_arm64.rock",
+    ]
+
+
+@pytest.mark.parametrize("metadata_layers", [None, "separate", "single"])
+def test_pack_metadata_layers(default_project, mocker, metadata_layers):
+    project = default_project.copy(
+        update={"metadata_layers": metadata_layers, "run_user": "_daemon_"}
+    )
+    base_image = mocker.MagicMock()
+    new_image = base_image.add_layer.return_value
+
+    package._pack(
+        prime_dir=Path("prime"),
+        project=project,
+        image_info=ImageInfo(base_image, None, b"deadbeef"),
+        options=package.PackOptions(rock_suffix="amd64", build_for="amd64"),
+    )
+
+    layer_dir = new_image.add_user.call_args.kwargs["options"].layer_dir
+    assert new_image.set_control_data.call_args.kwargs["layer_dir"] == layer_dir
+    if metadata_layers == "single":
+        assert isinstance(layer_dir, Path)
+        new_image.add_layer.assert_called_once_with(
+            "1.0",
+            layer_dir,
+            oci.LayerOptions(created_by="rockcraft add-metadata", reuse=False),
+        )
+    else:
+        assert layer_dir is None
+        assert not new_image.add_layer.called
+
+
+def test_pack_prime_layers(default_project, mocker):
+    base_image = mocker.MagicMock()
+
+    package._pack(
+        prime_dir=Path("prime"),
+        project=default_project,
+        image_info=ImageInfo(base_image, None, b"deadbeef"),
+        options=package.PackOptions(
+            rock_suffix="amd64", build_for="amd64", prime_layers=[{"a"}, {"b", "c"}]
+        ),
+    )
+
+    first_layer = base_image.add_layer
+    second_layer = first_layer.return_value.add_layer
+    assert first_layer.call_args.kwargs["options"].paths == {"a"}
+    assert second_layer.call_args.kwargs["options"].paths == {"b", "c"}
+    assert second_layer.call_args.kwargs["new_layer_dir"] == Path("prime")
+
+
+@pytest.mark.parametrize(
+    ("prime_layers", "expected"),
+    [
+        ("per-part", [{"lib", "lib/a.so"}, {"bin", "bin/app"}, {"etc"}]),
+        ([{"paths": ["lib/*"]}], [{"lib/a.so"}, {"bin", "bin/app", "etc", "lib"}]),
+        ([{"parts": ["app"]}], [{"bin", "bin/app"}, {"etc", "lib", "lib/a.so"}]),
+    ],
+)
+def test_get_prime_layers(default_project, tmp_path, prime_layers, expected):
+    (tmp_path / "lib").mkdir()
+    (tmp_path / "lib/a.so").touch()
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin/app").touch()
+    (tmp_path / "etc").mkdir()
+    project = default_project.copy(update={"prime_layers": prime_layers})
+    if isinstance(prime_layers, list):
+        project = project.copy(
+            update={"prime_layers": [PrimeLayer(**layer) for layer in prime_layers]}
+        )
+
+    layers = package._get_prime_layers(
+        tmp_path, project, {"libs": {"lib", "lib/a.so"}, "app": {"bin", "bin/app"}}
+    )
+
+    assert layers == expected
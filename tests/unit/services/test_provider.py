@@ -13,9 +13,67 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from pathlib import PurePosixPath
+
+import pytest
+from craft_application.models import BuildInfo
+from craft_providers.bases import BaseName
+from rockcraft import oci, oci_layout
 
 
 def test_packages(provider_service):
     assert provider_service.packages == []
     provider_service.setup()
     assert provider_service.packages == ["gpg", "dirmngr"]
+
+
+@pytest.mark.parametrize(
+    ("mirror", "expected"),
+    [
+        (None, None),
+        ("mirror.example.com/ubuntu", "mirror.example.com/ubuntu"),
+        ("oci:{layout}", "oci:/root/base-mirror"),
+    ],
+)
+def test_base_mirror(
+    provider_service,
+    fake_provider,
+    mock_instance,
+    monkeypatch,
+    tmp_path,
+    mirror,
+    expected,
+):
+    # pylint: disable=too-many-arguments
+    oci_layout.ImageLayout.init(tmp_path / "layout")
+    if mirror is None:
+        monkeypatch.delenv(oci.BASE_MIRROR_ENV, raising=False)
+    else:
+        monkeypatch.setenv(
+            oci.BASE_MIRROR_ENV, mirror.format(layout=tmp_path / "layout")
+        )
+    monkeypatch.setattr(provider_service, "_provider", fake_provider)
+    monkeypatch.setattr(
+        provider_service, "_capture_logs_from_instance", lambda instance: None
+    )
+    provider_service.setup()
+    build_info = BuildInfo(
+        platform="amd64",
+        build_on="amd64",
+        build_for="amd64",
+        base=BaseName(name="ubuntu", version="22.04"),
+    )
+
+    with provider_service.instance(build_info, work_dir=tmp_path):
+        pass
+
+    # The mirror is passed on to the instance, with local layouts mounted in it
+    assert provider_service.environment.get(oci.BASE_MIRROR_ENV) == expected
+    mounts = [call.kwargs for call in mock_instance.mount.mock_calls]
+    if expected == "oci:/root/base-mirror":
+        assert {
+            "host_source": tmp_path / "layout",
+            "target": PurePosixPath("/root/base-mirror"),
+        } in mounts
+    else:
+        assert len(mounts) == 1  # only the project
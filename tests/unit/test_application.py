@@ -13,9 +13,19 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import subprocess
+import sys
 from pathlib import Path
 
+import pytest
+from craft_application import Application
+from craft_application.commands import lifecycle
+from craft_application.models import BuildInfo
+from rockcraft import cli, errors
+from rockcraft.application import APP_METADATA, PLATFORM_WORKER_ENV, Rockcraft
 from rockcraft.pebble import Pebble
+from rockcraft.services import RockcraftPackageService
 
 ENVIRONMENT_YAML = """\
 name: environment-test
@@ -64,3 +74,157 @@ def test_application_pebble_part(default_application, new_dir):
 
     project = default_application.project
     assert project.parts["pebble"] == Pebble.PEBBLE_PART_SPEC
+
+
+@pytest.fixture()
+def multi_platform_app(default_application, default_factory, mocker, monkeypatch):
+    """An application packing a project for amd64 and arm64, on amd64."""
+    monkeypatch.delenv(PLATFORM_WORKER_ENV, raising=False)
+    mocker.patch("craft_application.util.get_host_architecture", return_value="amd64")
+    build_plan = [
+        BuildInfo(platform, build_on, build_on, ("ubuntu", "22.04"))
+        for platform, build_on in [("amd64", "amd64"), ("arm64", "arm64")]
+    ]
+    build_plan.append(BuildInfo("cross", "amd64", "arm64", ("ubuntu", "22.04")))
+    project = mocker.Mock(get_build_plan=mocker.Mock(return_value=build_plan))
+    mocker.patch.object(default_application, "get_project", return_value=project)
+    default_factory.set_kwargs("package", platform=None, build_for="amd64")
+    mocker.patch.object(sys, "argv", ["rockcraft", "pack"])
+    return default_application
+
+
+def _set_args(mocker, app, *args):
+    """Make ``app`` run ``pack`` with the given arguments."""
+    cli._create_app()  # Registers rockcraft's options of the command.
+    command = lifecycle.PackCommand({"app": APP_METADATA, "services": app.services})
+    parser = argparse.ArgumentParser()
+    command.fill_parser(parser)
+    app._dispatcher = mocker.Mock(
+        **{"parsed_args.return_value": parser.parse_args(args)},
+    )
+    mocker.patch.object(sys, "argv", ["rockcraft", "pack", *args])
+
+
+def test_run_managed_sequential(mocker, multi_platform_app):
+    _set_args(mocker, multi_platform_app)
+    mock_run_managed = mocker.patch.object(Application, "run_managed")
+    mock_run = mocker.patch("subprocess.run")
+
+    multi_platform_app.run_managed(None, None)
+
+    mock_run_managed.assert_called_once_with(None, None)
+    assert not mock_run.called
+
+
+def test_run_managed_parallel(mocker, tmp_path, multi_platform_app):
+    mocker.patch.object(Rockcraft, "log_path", new=tmp_path / "rockcraft.log")
+    _set_args(
+        mocker,
+        multi_platform_app,
+        "--platform",
+        "amd64",
+        "--compression",
+        "zstd",
+        "--parallel-platforms=2",
+        "--oci-index",
+        "--squash",
+    )
+    mock_run_managed = mocker.patch.object(Application, "run_managed")
+    mocker.patch.object(RockcraftPackageService, "pack_index")
+    mock_run = mocker.patch(
+        "subprocess.run", return_value=subprocess.CompletedProcess([], 0)
+    )
+
+    multi_platform_app.run_managed(None, None)
+
+    assert not mock_run_managed.called
+    commands = sorted(call.args[0] for call in mock_run.mock_calls)
+    # The options of the parallel builds are not passed on to the workers.
+    args = ["pack", "--compression", "zstd", "--squash"]
+    assert commands == [
+        [sys.executable, "-m", "rockcraft", *args, "--platform=amd64"],
+        [sys.executable, "-m", "rockcraft", *args, "--platform=cross"],
+    ]
+    for call in mock_run.mock_calls:
+        assert call.kwargs["env"][PLATFORM_WORKER_ENV] == "1"
+    logs = sorted(call.kwargs["stdout"].name for call in mock_run.mock_calls)
+    assert logs == [
+        str(tmp_path / "rockcraft-amd64.log"),
+        str(tmp_path / "rockcraft-cross.log"),
+    ]
+
+
+def test_run_managed_parallel_error(mocker, tmp_path, multi_platform_app):
+    mocker.patch.object(Rockcraft, "log_path", new=tmp_path / "rockcraft.log")
+    _set_args(mocker, multi_platform_app, "--parallel-platforms", "2")
+
+    def fake_run(command, stdout, **kwargs):
+        returncode = 1 if command[-1] == "--platform=cross" else 0
+        stdout.write("".join(f"line {number}\n" for number in range(20)))
+        return subprocess.CompletedProcess(command, returncode)
+
+    mocker.patch("subprocess.run", side_effect=fake_run)
+
+    with pytest.raises(errors.RockcraftError, match="platforms: cross$") as raised:
+        multi_platform_app.run_managed(None, None)
+    log_path = tmp_path / "rockcraft-cross.log"
+    tail = "\n".join(f"line {number}" for number in range(10, 20))
+    assert raised.value.details == f"cross (full log: {log_path}):\n{tail}"
+
+
+def test_run_managed_oci_index(mocker, multi_platform_app):
+    _set_args(mocker, multi_platform_app, "--oci-index")
+    mocker.patch.object(Application, "run_managed")
+    mock_pack_index = mocker.patch.object(
+        RockcraftPackageService, "pack_index", return_value=Path("rock.rock")
+    )
+
+    multi_platform_app.run_managed(None, "arm64")
+
+    mock_pack_index.assert_called_once_with(["cross"], multi_platform_app._work_dir)
+
+
+def test_run_managed_source_date_epoch(
+    mocker, monkeypatch, tmp_path, multi_platform_app
+):
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    _set_args(mocker, multi_platform_app)
+    multi_platform_app.services.set_kwargs("provider", work_dir=tmp_path)
+    mocker.patch.object(Application, "run_managed")
+
+    multi_platform_app.run_managed(None, None)
+
+    environment = multi_platform_app.services.provider.environment
+    assert environment["SOURCE_DATE_EPOCH"] == "1700000000"
+
+
+def test_run_managed_docker_daemon(mocker, multi_platform_app):
+    _set_args(mocker, multi_platform_app, "--export", "docker-daemon")
+    mocker.patch.object(Application, "run_managed")
+    mock_load = mocker.patch.object(
+        RockcraftPackageService, "load_into_docker", return_value=["default:1.0"]
+    )
+
+    multi_platform_app.run_managed(None, None)
+
+    mock_load.assert_called_once_with(["amd64", "cross"], multi_platform_app._work_dir)
+
+
+def test_run_managed_worker(mocker, monkeypatch, multi_platform_app):
+    monkeypatch.setenv(PLATFORM_WORKER_ENV, "1")
+    _set_args(
+        mocker,
+        multi_platform_app,
+        "--parallel-platforms=2",
+        "--oci-index",
+        "--export=docker-daemon",
+    )
+    mock_run_managed = mocker.patch.object(Application, "run_managed")
+    mock_pack_index = mocker.patch.object(RockcraftPackageService, "pack_index")
+    mock_load = mocker.patch.object(RockcraftPackageService, "load_into_docker")
+
+    multi_platform_app.run_managed("amd64", None)
+
+    mock_run_managed.assert_called_once_with("amd64", None)
+    assert not mock_pack_index.called
+    assert not mock_load.called
@@ -0,0 +1,173 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import io
+import json
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+from rockcraft import oci_layout
+from rockcraft.base_index import BaseIndex, Entry
+
+
+def _add_layer(layout, members):
+    """Add a layer made of ``members``, (name, type, content) tuples."""
+    with layout.new_layer("base") as out:
+        with tarfile.open(fileobj=out, mode="w|") as tar_file:
+            for name, member_type, content in members:
+                info = tarfile.TarInfo(name)
+                info.type = member_type
+                info.mode = 0o755 if member_type == tarfile.DIRTYPE else 0o644
+                data = content.encode()
+                if member_type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                    info.linkname = content
+                    data = b""
+                info.size = len(data)
+                tar_file.addfile(info, io.BytesIO(data))
+
+
+@pytest.fixture()
+def layout(tmp_path):
+    layout = oci_layout.ImageLayout.init(tmp_path / "image")
+    layout.create_image("base", architecture="amd64")
+    _add_layer(
+        layout,
+        [
+            ("./etc", tarfile.DIRTYPE, ""),
+            ("./etc/passwd", tarfile.REGTYPE, "root:x:0:0::/root:/bin/bash\n"),
+            ("./etc/hostname", tarfile.REGTYPE, "base"),
+            ("./usr/bin", tarfile.DIRTYPE, ""),
+            ("./usr/bin/tool", tarfile.REGTYPE, "#!/bin/sh"),
+            ("./bin", tarfile.SYMTYPE, "usr/bin"),
+            ("./opt/old", tarfile.DIRTYPE, ""),
+            ("./opt/old/file", tarfile.REGTYPE, "old"),
+            ("./var/lib/app", tarfile.DIRTYPE, ""),
+            ("./var/lib/app/lower", tarfile.REGTYPE, "lower"),
+        ],
+    )
+    _add_layer(
+        layout,
+        [
+            ("etc/passwd", tarfile.REGTYPE, "root:x:0:0::/root:/bin/sh\n"),
+            ("etc/.wh.hostname", tarfile.REGTYPE, ""),
+            ("etc/group", tarfile.LNKTYPE, "etc/passwd"),
+            ("opt/old", tarfile.REGTYPE, "now a file"),
+            ("var/lib/app/upper", tarfile.REGTYPE, "upper"),
+            ("var/lib/app/.wh..wh..opq", tarfile.REGTYPE, ""),
+        ],
+    )
+    return layout
+
+
+def test_from_image(layout):
+    index = BaseIndex.from_image(layout, "base")
+
+    assert sorted(index.entries) == [
+        "bin",
+        "etc",
+        "etc/group",
+        "etc/passwd",
+        "opt",
+        "opt/old",
+        "usr",
+        "usr/bin",
+        "usr/bin/tool",
+        "var",
+        "var/lib",
+        "var/lib/app",
+        "var/lib/app/upper",
+    ]
+    assert index.get("/usr/bin/tool") == Entry(
+        "file",
+        0o644,
+        0,
+        0,
+        size=9,
+        sha256=hashlib.sha256(b"#!/bin/sh").hexdigest(),
+    )
+    assert index.readlink("bin") == Path("usr/bin")
+    assert index.readlink("usr/bin") is None
+    assert index.is_file("opt/old")
+    assert not index.is_file("etc")
+
+
+def test_from_image_inline_files(layout):
+    index = BaseIndex.from_image(layout, "base")
+
+    assert index.read_bytes("etc/passwd") == b"root:x:0:0::/root:/bin/sh\n"
+    # Hardlinked to the passwd file
+    assert index.read_bytes("etc/group") == b"root:x:0:0::/root:/bin/sh\n"
+    assert index.read_bytes("etc/shadow") is None
+    assert index.read_bytes("usr/bin/tool") is None
+
+
+def test_listdir(layout):
+    index = BaseIndex.from_image(layout, "base")
+
+    assert index.listdir("") == ["bin", "etc", "opt", "usr", "var"]
+    assert index.listdir("etc") == ["group", "passwd"]
+    assert index.listdir("missing") == []
+
+
+def test_save_load(tmp_path, layout):
+    index = BaseIndex.from_image(layout, "base")
+
+    index.save(tmp_path / "index.json")
+    loaded = BaseIndex.load(tmp_path / "index.json")
+
+    assert loaded is not None
+    assert loaded.entries == index.entries
+    assert loaded.contents == index.contents
+    assert os.listdir(tmp_path) == ["image", "index.json"]
+
+
+def test_load_missing_or_outdated(tmp_path):
+    assert BaseIndex.load(tmp_path / "index.json") is None
+
+    (tmp_path / "index.json").write_text(json.dumps({"version": 0}))
+    assert BaseIndex.load(tmp_path / "index.json") is None
+
+
+def test_file_matches(tmp_path, layout):
+    index = BaseIndex.from_image(layout, "base")
+    owner = os.getuid(), os.getgid()
+    index.entries["usr/bin/tool"] = Entry(
+        "file",
+        0o644,
+        *owner,
+        size=9,
+        sha256=hashlib.sha256(b"#!/bin/sh").hexdigest(),
+    )
+
+    tool = tmp_path / "tool"
+    tool.write_text("#!/bin/sh")
+    tool.chmod(0o644)
+    assert index.file_matches("usr/bin/tool", tool)
+
+    # Different permissions
+    tool.chmod(0o755)
+    assert not index.file_matches("usr/bin/tool", tool)
+
+    # Different contents
+    tool.chmod(0o644)
+    tool.write_text("#!/bin/ZZ")
+    assert not index.file_matches("usr/bin/tool", tool)
+
+    # Not a file in the base
+    assert not index.file_matches("usr/bin", tool)
+    assert not index.file_matches("missing", tool)
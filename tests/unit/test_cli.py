@@ -72,6 +72,73 @@ def test_run_pack_services(mocker, monkeypatch, tmp_path):
     assert log_path.is_file()
 
 
+def test_run_pack_options(mocker, monkeypatch, tmp_path):
+    monkeypatch.setenv("CRAFT_MANAGED_MODE", "1")
+    mocker.patch.object(Rockcraft, "get_project")
+    mocker.patch.object(Rockcraft, "log_path", new=tmp_path / "rockcraft.log")
+    mocker.patch.multiple(
+        services.RockcraftLifecycleService,
+        setup=DEFAULT,
+        prime_dir=Path("/fake/prime/dir"),
+        run=DEFAULT,
+    )
+
+    options = []
+
+    def fake_pack(self, prime_dir, dest):
+        options.append((self.compression, self.export, self.squash))
+        return []
+
+    mocker.patch.object(services.RockcraftPackageService, "write_metadata")
+    mocker.patch.object(services.RockcraftPackageService, "pack", fake_pack)
+    mocker.patch.object(
+        sys,
+        "argv",
+        [
+            "rockcraft",
+            "pack",
+            "--compression",
+            "zstd",
+            "--export",
+            "docker-archive",
+            "--squash",
+        ],
+    )
+
+    cli.run()
+
+    assert options == [("zstd", "docker-archive", True)]
+
+
+def test_run_pack_oci_index_destructive(mocker, tmp_path):
+    mocker.patch.object(Rockcraft, "get_project")
+    mocker.patch.object(Rockcraft, "log_path", new=tmp_path / "rockcraft.log")
+    mock_run = mocker.patch.object(services.RockcraftLifecycleService, "run")
+    mock_error = mocker.spy(emit, "error")
+    mocker.patch.object(
+        sys, "argv", ["rockcraft", "pack", "--destructive-mode", "--oci-index"]
+    )
+
+    assert cli.run() == 1
+
+    assert not mock_run.called
+    assert "destructive mode" in str(mock_error.call_args.args[0])
+
+
+@pytest.mark.parametrize("jobs", ["0", "-1", "two"])
+def test_run_pack_parallel_platforms_invalid(mocker, capsys, tmp_path, jobs):
+    mocker.patch.object(Rockcraft, "log_path", new=tmp_path / "rockcraft.log")
+    mock_run = mocker.patch.object(services.RockcraftLifecycleService, "run")
+    mocker.patch.object(
+        sys, "argv", ["rockcraft", "pack", f"--parallel-platforms={jobs}"]
+    )
+
+    assert cli.run() != 0
+
+    assert not mock_run.called
+    assert "not a positive integer" in capsys.readouterr().err
+
+
 def test_run_init(mocker, lifecycle_init_mock):
     mock_ended_ok = mocker.spy(emit, "ended_ok")
     mocker.patch.object(sys, "argv", ["rockcraft", "init"])
@@ -0,0 +1,382 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import hashlib
+import io
+import os
+import random
+import shutil
+import subprocess
+import zlib
+
+import pytest
+from rockcraft import compression, errors
+
+needs_zstd = pytest.mark.skipif(
+    shutil.which("zstd") is None, reason="the zstd tool is not installed"
+)
+
+
+# The share of the payload that is zeros, the rest being random.
+ZERO_CHUNK_RATIO = 0.5
+
+
+def _payload(size):
+    """Generate a payload with a mix of compressible and random data."""
+    rng = random.Random(42)
+    chunks = []
+    while size > 0:
+        chunk = rng.randbytes(min(size, 4096))
+        if rng.random() < ZERO_CHUNK_RATIO:
+            chunk = bytes(len(chunk))
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _compress(writer_class, data, **kwargs):
+    sink = io.BytesIO()
+    with writer_class(sink, **kwargs) as writer:
+        # Feed the data in uneven pieces, like a tar stream would
+        for offset in range(0, len(data), 10000):
+            writer.write(data[offset : offset + 10000])
+        writer.finish()
+    return writer, sink.getvalue()
+
+
+@pytest.mark.parametrize("size", [0, 1, 100_000, 1_000_000])
+def test_gzip_layer_writer(size):
+    data = _payload(size)
+
+    writer, compressed = _compress(compression.GzipLayerWriter, data)
+
+    assert gzip.decompress(compressed) == data
+    assert writer.diff_id == f"sha256:{hashlib.sha256(data).hexdigest()}"
+    assert writer.media_type == compression.MEDIA_TYPE_LAYER_GZIP
+
+
+@pytest.mark.parametrize("size", [0, 1, 100_000, 1_000_000])
+@pytest.mark.parametrize("block_size", [1024, 65536, 1_000_000])
+def test_parallel_gzip_layer_writer(size, block_size):
+    data = _payload(size)
+
+    writer, compressed = _compress(
+        compression.ParallelGzipLayerWriter, data, threads=4, block_size=block_size
+    )
+
+    assert gzip.decompress(compressed) == data
+    assert writer.diff_id == f"sha256:{hashlib.sha256(data).hexdigest()}"
+    assert writer.media_type == compression.MEDIA_TYPE_LAYER_GZIP
+
+    # A single gzip member, with nothing trailing it
+    decompressor = zlib.decompressobj(31)
+    assert decompressor.decompress(compressed) == data
+    assert decompressor.eof
+    assert decompressor.unused_data == b""
+
+
+def test_parallel_gzip_ratio():
+    """The per-block dictionaries keep the ratio close to single-threaded gzip."""
+    data = _payload(2_000_000)
+
+    _, single = _compress(compression.GzipLayerWriter, data)
+    _, parallel = _compress(
+        compression.ParallelGzipLayerWriter, data, threads=4, block_size=65536
+    )
+
+    assert len(parallel) < len(single) * 1.01
+
+
+def test_parallel_gzip_close_without_finish():
+    sink = io.BytesIO()
+    writer = compression.ParallelGzipLayerWriter(sink, threads=2, block_size=1024)
+    writer.write(_payload(10_000))
+    writer.close()
+
+    assert writer.closed
+
+
+def _compress_fragmented(cache, fragment, digest=None, reread=None):
+    sink = io.BytesIO()
+    with compression.ParallelGzipLayerWriter(
+        sink, threads=2, block_size=65536
+    ) as writer:
+        writer.write(b"before" * 10000)
+        writer.begin_fragment(cache, digest, reread or (lambda: [fragment]))
+        writer.write(fragment)
+        fragment_digest = writer.end_fragment()
+        writer.write(b"after" * 10000)
+        writer.finish()
+    return writer, fragment_digest, sink.getvalue()
+
+
+def test_parallel_gzip_fragments(tmp_path, mocker):
+    cache = compression.FragmentCache(tmp_path)
+    fragment = _payload(300_000)
+    data = b"before" * 10000 + fragment + b"after" * 10000
+
+    writer, digest, compressed = _compress_fragmented(cache, fragment)
+
+    assert digest == hashlib.sha256(fragment).hexdigest()
+    assert cache.fragment_path(writer.fragment_variant, digest).is_file()
+    assert gzip.decompress(compressed) == data
+
+    # The cached fragment is spliced, without compressing its data again.
+    spy = mocker.spy(compression, "_deflate_block")
+    reread = mocker.Mock(return_value=[fragment])
+    writer, spliced_digest, spliced = _compress_fragmented(
+        cache, fragment, digest, reread
+    )
+
+    assert spliced_digest == digest
+    assert not reread.called
+    assert spliced == compressed
+    assert writer.diff_id == f"sha256:{hashlib.sha256(data).hexdigest()}"
+    assert sum(len(call.args[0]) for call in spy.mock_calls) == len(data) - len(
+        fragment
+    )
+
+
+def test_parallel_gzip_fragment_changed(tmp_path):
+    cache = compression.FragmentCache(tmp_path)
+    _, stale_digest, _ = _compress_fragmented(cache, _payload(300_000))
+    fragment = _payload(200_000)
+
+    # The fragment's file changed, but not its metadata.
+    writer, digest, compressed = _compress_fragmented(cache, fragment, stale_digest)
+
+    assert digest == hashlib.sha256(fragment).hexdigest()
+    assert gzip.decompress(compressed) == (
+        b"before" * 10000 + fragment + b"after" * 10000
+    )
+    assert cache.fragment_path(writer.fragment_variant, digest).is_file()
+    assert sorted(
+        (tmp_path / "fragments" / writer.fragment_variant).iterdir()
+    ) == sorted(
+        [
+            cache.fragment_path(writer.fragment_variant, stale_digest),
+            cache.fragment_path(writer.fragment_variant, digest),
+        ]
+    )
+
+
+def test_parallel_gzip_fragment_changed_again(tmp_path):
+    cache = compression.FragmentCache(tmp_path)
+    _, stale_digest, _ = _compress_fragmented(cache, _payload(300_000))
+
+    # The fragment's file changed, and again before reading it a second time.
+    with pytest.raises(errors.RockcraftError, match="changed while compressing"):
+        _compress_fragmented(
+            cache, _payload(200_000), stale_digest, lambda: [_payload(100_000)]
+        )
+
+
+def test_parallel_gzip_fragment_discarded(tmp_path):
+    cache = compression.FragmentCache(tmp_path)
+    writer = compression.ParallelGzipLayerWriter(io.BytesIO(), threads=2)
+    writer.begin_fragment(cache)
+    writer.write(_payload(10_000))
+    writer.close()
+
+    assert list((tmp_path / "fragments" / writer.fragment_variant).iterdir()) == []
+
+
+def test_fragment_cache_prune(tmp_path):
+    cache = compression.FragmentCache(tmp_path)
+    fragments = []
+    for index, size in enumerate([100_000, 200_000, 300_000]):
+        writer, digest, _ = _compress_fragmented(cache, _payload(size))
+        fragment = cache.fragment_path(writer.fragment_variant, digest)
+        os.utime(fragment, (index, index))
+        fragments.append(fragment)
+    # The oldest fragment was used since, so the second one is evicted first.
+    cache.mark_used(fragments[0])
+    max_size = fragments[0].stat().st_size + fragments[2].stat().st_size
+
+    assert cache.prune(max_size) == [fragments[1]]
+    assert cache.prune(max_size) == []
+    assert [fragment.is_file() for fragment in fragments] == [True, False, True]
+
+
+def test_fragment_cache_member_digest(tmp_path):
+    cache = compression.FragmentCache(tmp_path)
+    assert cache.get_member_digest("file") is None
+
+    cache.set_member_digest("file", "abc")
+    assert cache.get_member_digest("file") == "abc"
+
+    cache.forget_member_digest("file")
+    assert cache.get_member_digest("file") is None
+
+
+def _zstd_decompress(data):
+    return subprocess.run(
+        ["zstd", "--decompress", "--stdout"],
+        input=data,
+        capture_output=True,
+        check=True,
+    ).stdout
+
+
+@needs_zstd
+@pytest.mark.parametrize("size", [0, 1, 1_000_000])
+@pytest.mark.parametrize("threads", [1, 4])
+def test_zstd_layer_writer(size, threads):
+    data = _payload(size)
+
+    writer, compressed = _compress(compression.ZstdLayerWriter, data, threads=threads)
+
+    assert compressed.startswith(b"\x28\xb5\x2f\xfd")  # zstd frame magic
+    assert _zstd_decompress(compressed) == data
+    assert writer.diff_id == f"sha256:{hashlib.sha256(data).hexdigest()}"
+    assert writer.media_type == compression.MEDIA_TYPE_LAYER_ZSTD
+
+
+@needs_zstd
+def test_zstd_layer_writer_sink_error():
+    class FailingSink:
+        def write(self, data):
+            raise OSError("disk full")
+
+    writer = compression.ZstdLayerWriter(FailingSink())
+    with pytest.raises(OSError, match="disk full"):
+        writer.write(_payload(4_000_000))
+        writer.finish()
+    writer.close()
+
+
+@needs_zstd
+def test_zstd_close_without_finish():
+    writer = compression.ZstdLayerWriter(io.BytesIO())
+    writer.write(_payload(10_000))
+    writer.close()
+
+    assert writer.closed
+
+
+@pytest.mark.parametrize(
+    ("threads", "writer_class"),
+    [
+        (1, compression.GzipLayerWriter),
+        (2, compression.ParallelGzipLayerWriter),
+    ],
+)
+def test_get_layer_writer(threads, writer_class):
+    writer = compression.get_layer_writer(io.BytesIO(), threads=threads)
+    assert isinstance(writer, writer_class)
+    writer.close()
+
+
+def test_get_layer_writer_fragmented():
+    writer = compression.get_layer_writer(io.BytesIO(), threads=1, fragmented=True)
+    assert isinstance(writer, compression.ParallelGzipLayerWriter)
+    writer.close()
+
+
+def test_get_layer_writer_reproducible(monkeypatch):
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "0")
+    data = _payload(1_000_000)
+
+    outputs = []
+    for threads in (1, 4):
+        output = io.BytesIO()
+        with compression.get_layer_writer(output, threads=threads) as writer:
+            writer.write(data)
+            writer.finish()
+        outputs.append(output.getvalue())
+
+    assert outputs[0] == outputs[1]
+
+
+@needs_zstd
+def test_get_layer_writer_zstd():
+    writer = compression.get_layer_writer(io.BytesIO(), compression="zstd", threads=2)
+    assert isinstance(writer, compression.ZstdLayerWriter)
+    writer.close()
+
+
+def test_uncompressed_layer_writer():
+    data = _payload(100_000)
+
+    writer, blob = _compress(compression.UncompressedLayerWriter, data)
+
+    assert blob == data
+    assert writer.diff_id == f"sha256:{hashlib.sha256(data).hexdigest()}"
+    assert writer.media_type == compression.MEDIA_TYPE_LAYER
+    assert isinstance(
+        compression.get_layer_writer(io.BytesIO(), compression="none"),
+        compression.UncompressedLayerWriter,
+    )
+
+
+def test_get_layer_writer_unsupported():
+    with pytest.raises(errors.RockcraftError, match="Unsupported layer compression"):
+        compression.get_layer_writer(io.BytesIO(), compression="xz")  # type: ignore[arg-type]
+
+
+def test_get_compression_threads_default(monkeypatch, mocker):
+    monkeypatch.delenv(compression.COMPRESSION_THREADS_ENV, raising=False)
+    cpus = {0, 1, 2}
+    mocker.patch("os.sched_getaffinity", return_value=cpus)
+
+    assert compression.get_compression_threads() == len(cpus)
+
+
+def test_get_compression_threads_env(monkeypatch):
+    threads = 7
+    monkeypatch.setenv(compression.COMPRESSION_THREADS_ENV, str(threads))
+
+    assert compression.get_compression_threads() == threads
+
+
+@pytest.mark.parametrize("value", ["0", "-1", "many"])
+def test_get_compression_threads_invalid(monkeypatch, value):
+    monkeypatch.setenv(compression.COMPRESSION_THREADS_ENV, value)
+
+    with pytest.raises(errors.RockcraftError, match="Invalid value"):
+        compression.get_compression_threads()
+
+
+@pytest.mark.parametrize(
+    ("media_type", "compress"),
+    [
+        (compression.MEDIA_TYPE_LAYER, lambda data: data),
+        (compression.MEDIA_TYPE_LAYER_GZIP, gzip.compress),
+        ("application/vnd.docker.image.rootfs.diff.tar.gzip", gzip.compress),
+        pytest.param(
+            compression.MEDIA_TYPE_LAYER_ZSTD,
+            lambda data: _compress(compression.ZstdLayerWriter, data)[1],
+            marks=needs_zstd,
+        ),
+    ],
+)
+def test_open_layer(tmp_path, media_type, compress):
+    data = _payload(100_000)
+    (tmp_path / "blob").write_bytes(compress(data))
+
+    with compression.open_layer(tmp_path / "blob", media_type) as stream:
+        assert stream.read() == data
+
+
+@needs_zstd
+def test_open_layer_zstd_error(tmp_path):
+    (tmp_path / "blob").write_bytes(b"not zstd")
+
+    with pytest.raises(errors.RockcraftError, match="Failed to decompress layer"):
+        with compression.open_layer(
+            tmp_path / "blob", compression.MEDIA_TYPE_LAYER_ZSTD
+        ) as stream:
+            stream.read()
@@ -0,0 +1,102 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import io
+import json
+import tarfile
+from pathlib import Path
+
+import pytest
+from rockcraft import docker, errors, oci_layout
+
+
+@pytest.fixture()
+def layout(tmp_path):
+    layout = oci_layout.ImageLayout.init(tmp_path / "image")
+    layout.create_image("1.0", architecture="amd64")
+    with layout.new_layer("1.0") as out:
+        tar_bytes = io.BytesIO()
+        with tarfile.open(fileobj=tar_bytes, mode="w") as tar_file:
+            info = tarfile.TarInfo("foo.txt")
+            info.size = 3
+            tar_file.addfile(info, io.BytesIO(b"foo"))
+        out.write(tar_bytes.getvalue())
+    return layout
+
+
+def test_from_environment(monkeypatch):
+    monkeypatch.delenv("DOCKER_HOST", raising=False)
+    assert docker.DockerDaemon.from_environment().socket_path == Path(
+        "/var/run/docker.sock"
+    )
+
+    monkeypatch.setenv("DOCKER_HOST", "unix:///run/user/1000/docker.sock")
+    assert docker.DockerDaemon.from_environment().socket_path == Path(
+        "/run/user/1000/docker.sock"
+    )
+
+
+def test_from_environment_unsupported(monkeypatch):
+    monkeypatch.setenv("DOCKER_HOST", "tcp://example.com:2375")
+
+    with pytest.raises(errors.DockerError, match="Unsupported DOCKER_HOST"):
+        docker.DockerDaemon.from_environment()
+
+
+def test_load(fake_docker_daemon, layout):
+    archive = layout.get_archive("1.0", repo_tag="rock:1.0")
+
+    loaded = docker.DockerDaemon.from_environment().load(archive)
+
+    assert loaded == ["rock:1.0"]
+    (data,) = fake_docker_daemon.archives
+    assert len(data) == archive.size
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar_file:
+        manifest = json.load(tar_file.extractfile("manifest.json"))
+    assert manifest[0]["RepoTags"] == ["rock:1.0"]
+
+
+def test_load_file(fake_docker_daemon, layout, tmp_path):
+    layout.export_archive("1.0", tmp_path / "rock.rock", repo_tag="rock:1.0")
+
+    loaded = docker.DockerDaemon.from_environment().load_file(tmp_path / "rock.rock")
+
+    assert loaded == ["rock:1.0"]
+    assert fake_docker_daemon.archives == [(tmp_path / "rock.rock").read_bytes()]
+
+
+def test_load_error(fake_docker_daemon, layout):
+    fake_docker_daemon.error = "invalid archive"
+    archive = layout.get_archive("1.0", repo_tag="rock:1.0")
+
+    with pytest.raises(errors.DockerError, match="failed to load") as raised:
+        docker.DockerDaemon.from_environment().load(archive)
+    assert raised.value.details == "invalid archive"
+
+
+def test_load_unexpected_reply(fake_docker_daemon, layout):
+    fake_docker_daemon.reply = b'{"stream": "Loading"}\n<html>Bad Gateway</html>'
+    archive = layout.get_archive("1.0", repo_tag="rock:1.0")
+
+    with pytest.raises(errors.DockerError, match="Unexpected reply") as raised:
+        docker.DockerDaemon.from_environment().load(archive)
+    assert raised.value.details == '{"stream": "Loading"}\n<html>Bad Gateway</html>'
+
+
+def test_load_no_daemon(tmp_path, layout):
+    daemon = docker.DockerDaemon(tmp_path / "missing.sock")
+
+    with pytest.raises(errors.DockerError, match="Failed to load image"):
+        daemon.load(layout.get_archive("1.0", repo_tag="rock:1.0"))
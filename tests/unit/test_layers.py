@@ -13,6 +13,8 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gzip
+import io
 import os
 import re
 import stat
@@ -23,7 +25,13 @@ from pathlib import Path
 import pytest
 from craft_parts.overlays import overlays
 
-from rockcraft import errors, layers
+from rockcraft import compression, errors, layers
+from tests.unit.testing.base_index import index_directory
+
+# The SOURCE_DATE_EPOCH of reproducible layers, and the mtime of a file older
+# than it, which is kept.
+SOURCE_DATE_EPOCH = 1000000000
+OLD_MTIME = 900000000
 
 
 def get_tar_contents(tar_path: Path) -> list[str]:
@@ -86,6 +94,243 @@ def test_archive_layer_directories(tmp_path):
     assert temp_tar_contents == expected_tar_contents
 
 
+def test_archive_layer_stream(tmp_path):
+    """Test that the layer can be streamed to a file-like object."""
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "first").mkdir(parents=True)
+    (layer_dir / "first/first.txt").write_text("first")
+
+    stream = io.BytesIO()
+    layers.archive_layer(layer_dir, stream)
+
+    # The stream is left open for the caller to finish.
+    assert not stream.closed
+    stream.seek(0)
+    with tarfile.open(fileobj=stream, mode="r") as tar_file:
+        assert tar_file.getnames() == ["first", "first/first.txt"]
+        first_file = tar_file.extractfile("first/first.txt")
+        assert first_file is not None
+        assert first_file.read() == b"first"
+
+
+def test_archive_layer_reproducible(tmp_path, monkeypatch):
+    """Test that layers of the same content are identical with SOURCE_DATE_EPOCH."""
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", str(SOURCE_DATE_EPOCH))
+
+    archives = []
+    for mtime in (1500000000.5, 1600000000.25):
+        layer_dir = tmp_path / f"layer_{mtime}"
+        (layer_dir / "first").mkdir(parents=True)
+        (layer_dir / "first/first.txt").write_text("first")
+        (layer_dir / "old.txt").write_text("old")
+        os.utime(layer_dir / "old.txt", (OLD_MTIME + 0.5, OLD_MTIME + 0.5))
+        os.utime(layer_dir / "first/first.txt", (mtime, mtime))
+        os.utime(layer_dir / "first", (mtime, mtime))
+
+        stream = io.BytesIO()
+        layers.archive_layer(layer_dir, stream)
+        archives.append(stream.getvalue())
+
+    assert archives[0] == archives[1]
+    with tarfile.open(fileobj=io.BytesIO(archives[0]), mode="r") as tar_file:
+        members = {member.name: member for member in tar_file.getmembers()}
+    assert members["first/first.txt"].mtime == SOURCE_DATE_EPOCH
+    assert members["old.txt"].mtime == OLD_MTIME
+    assert all(m.uname == "" and m.gname == "" for m in members.values())
+    assert all(not m.pax_headers for m in members.values())
+
+
+def test_archive_layer_paths(tmp_path):
+    """Test that only the given paths, and their parents, can be archived."""
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "first/sub").mkdir(parents=True)
+    (layer_dir / "first/sub/first.txt").touch()
+    (layer_dir / "first/other.txt").touch()
+    (layer_dir / "second").mkdir()
+
+    temp_tar_path = tmp_path / "layer.tar"
+    layers.archive_layer(layer_dir, temp_tar_path, paths=["first/sub/first.txt"])
+
+    assert get_tar_contents(temp_tar_path) == [
+        "first",
+        "first/sub",
+        "first/sub/first.txt",
+    ]
+
+
+@pytest.mark.parametrize("hash_contents", [False, True])
+def test_archive_layer_fragments(tmp_path, monkeypatch, hash_contents):
+    """Test that large files are spliced from the fragments of the layers before."""
+    monkeypatch.setattr(layers, "FRAGMENT_MIN_SIZE", 1024)
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "lib").mkdir(parents=True)
+    (layer_dir / "lib/big.so").write_bytes(bytes(range(256)) * 100)
+    (layer_dir / "lib/small.so").write_bytes(b"small")
+    fragments = compression.FragmentCache(tmp_path / "cache")
+
+    def _archive():
+        sink = io.BytesIO()
+        with compression.ParallelGzipLayerWriter(sink, threads=2) as writer:
+            layers.archive_layer(
+                layer_dir,
+                writer,
+                fragments=layers.LayerFragments(fragments, hash_contents),
+            )
+            writer.finish()
+        return sink.getvalue()
+
+    first = _archive()
+    second = _archive()
+
+    plain = io.BytesIO()
+    layers.archive_layer(layer_dir, plain)
+    assert gzip.decompress(first) == plain.getvalue()
+    assert second == first
+    fragments_dir = tmp_path / "cache/fragments"
+    assert len(list(fragments_dir.glob("*/*"))) == 1
+
+    # A changed file gets a new fragment.
+    (layer_dir / "lib/big.so").write_bytes(bytes(range(256))[::-1] * 100)
+    third = _archive()
+
+    plain = io.BytesIO()
+    layers.archive_layer(layer_dir, plain)
+    assert gzip.decompress(third) == plain.getvalue()
+    assert len(list(fragments_dir.glob("*/*"))) == len([first, third])
+
+
+def test_fingerprint_layer(tmp_path):
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "first").mkdir(parents=True)
+    (layer_dir / "first/first.txt").write_text("first")
+    (layer_dir / "link").symlink_to("first")
+    os.utime(layer_dir / "first/first.txt", ns=(10**18, 10**18))
+
+    fingerprint = layers.fingerprint_layer(layer_dir)
+    content_fingerprint = layers.fingerprint_layer(layer_dir, hash_contents=True)
+    assert layers.fingerprint_layer(layer_dir) == fingerprint
+    assert content_fingerprint != fingerprint
+
+    # Same metadata, different contents
+    (layer_dir / "first/first.txt").write_text("FIRST")
+    os.utime(layer_dir / "first/first.txt", ns=(10**18, 10**18))
+    assert layers.fingerprint_layer(layer_dir) == fingerprint
+    assert layers.fingerprint_layer(layer_dir, hash_contents=True) != (
+        content_fingerprint
+    )
+
+    # Different metadata
+    (layer_dir / "first/first.txt").chmod(0o600)
+    assert layers.fingerprint_layer(layer_dir) != fingerprint
+
+    # Only the selected paths count
+    assert layers.fingerprint_layer(layer_dir, paths=["link"]) == (
+        layers.fingerprint_layer(layer_dir, paths=["link"])
+    )
+    assert layers.fingerprint_layer(layer_dir, paths=["link"]) != (
+        layers.fingerprint_layer(layer_dir)
+    )
+
+
+def test_split_prime_paths(tmp_path):
+    (tmp_path / "usr/bin").mkdir(parents=True)
+    (tmp_path / "usr/bin/app").touch()
+    (tmp_path / "usr/lib").mkdir()
+    (tmp_path / "usr/lib/libfoo.so").touch()
+    (tmp_path / "usr/lib/libbar.so").touch()
+    (tmp_path / "etc").mkdir()
+
+    groups = layers.split_prime_paths(
+        tmp_path,
+        {
+            "foo": {"usr", "usr/lib", "usr/lib/libfoo.so"},
+            "app": {"usr", "usr/bin", "usr/bin/app"},
+            "empty": set(),
+        },
+        [(["foo"], []), ([], ["*/libbar.so"]), (["empty"], [])],
+    )
+
+    assert groups == [
+        {"usr", "usr/lib", "usr/lib/libfoo.so"},
+        {"usr/lib/libbar.so"},
+        {"usr/bin", "usr/bin/app", "etc"},
+    ]
+
+
+def test_split_prime_paths_hardlinks(tmp_path):
+    """Test that hardlinks to the same file end up in the same group."""
+    (tmp_path / "usr/bin").mkdir(parents=True)
+    (tmp_path / "usr/bin/python3.10").write_text("python")
+    (tmp_path / "usr/bin/python3").hardlink_to(tmp_path / "usr/bin/python3.10")
+
+    groups = layers.split_prime_paths(
+        tmp_path,
+        {"python": {"usr", "usr/bin", "usr/bin/python3.10"}},
+        [([], ["usr/bin/python3.10"])],
+    )
+
+    assert groups == [
+        {"usr/bin/python3", "usr/bin/python3.10"},
+        {"usr", "usr/bin"},
+    ]
+
+
+def test_archive_layer_hardlinks(tmp_path):
+    """Test that hardlinked files are stored once, and linked to afterwards."""
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "usr/bin").mkdir(parents=True)
+    (layer_dir / "usr/bin/perl5.34").write_text("perl")
+    (layer_dir / "usr/bin/perl").hardlink_to(layer_dir / "usr/bin/perl5.34")
+    (tmp_path / "outside").hardlink_to(layer_dir / "usr/bin/perl5.34")
+
+    temp_tar_path = tmp_path / "layer.tar"
+    layers.archive_layer(layer_dir, temp_tar_path)
+
+    with tarfile.open(temp_tar_path) as tar_file:
+        perl = tar_file.getmember("usr/bin/perl")
+        perl_version = tar_file.getmember("usr/bin/perl5.34")
+    assert perl.isreg()
+    assert perl.size == len("perl")
+    assert perl_version.islnk()
+    assert perl_version.linkname == "usr/bin/perl"
+
+    # Only the first name of the file in each layer stores its content.
+    temp_tar_path = tmp_path / "partial.tar"
+    layers.archive_layer(layer_dir, temp_tar_path, paths=["usr/bin/perl5.34"])
+
+    with tarfile.open(temp_tar_path) as tar_file:
+        assert tar_file.getmember("usr/bin/perl5.34").isreg()
+
+
+def test_archive_layer_sparse(tmp_path):
+    """Test that only the data of sparse files is read and stored."""
+    layer_dir = tmp_path / "layer_dir"
+    layer_dir.mkdir()
+    with (layer_dir / "seed.db").open("wb") as file:
+        file.write(b"header")
+        file.seek(4 * 1024 * 1024)
+        file.write(b"data")
+        file.truncate(16 * 1024 * 1024)
+    with (layer_dir / "empty.img").open("wb") as file:
+        file.truncate(1024 * 1024)
+    if not layers._is_sparse_file(layer_dir / "seed.db"):
+        pytest.skip("the filesystem does not support sparse files")
+
+    temp_tar_path = tmp_path / "layer.tar"
+    layers.archive_layer(layer_dir, temp_tar_path)
+
+    assert temp_tar_path.stat().st_size < 1024 * 1024
+    with tarfile.open(temp_tar_path) as tar_file:
+        assert tar_file.getnames() == ["empty.img", "seed.db"]
+        seed = tar_file.getmember("seed.db")
+        assert seed.size == 16 * 1024 * 1024
+        assert seed.sparse is not None
+        tar_file.extractall(tmp_path / "extracted")
+    extracted = (tmp_path / "extracted/seed.db").read_bytes()
+    assert extracted == (layer_dir / "seed.db").read_bytes()
+    assert (tmp_path / "extracted/empty.img").read_bytes() == bytes(1024 * 1024)
+
+
 def test_archive_layer_symlinks(tmp_path):
     """
     Test creating a new layer with symlinks (both file and dir).
@@ -132,7 +377,7 @@ def test_archive_layer_with_base_layer_dir(tmp_path):
     (rootfs_dir / "second").symlink_to("first")
 
     temp_tar_path = tmp_path / "layer.tar"
-    layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+    layers.archive_layer(layer_dir, temp_tar_path, base_layer=rootfs_dir)
     temp_tar_contents = get_tar_contents(temp_tar_path)
 
     # The tarfile must *not* contain the "./second" dir entry, to preserve
@@ -146,6 +391,23 @@ def test_archive_layer_with_base_layer_dir(tmp_path):
     assert temp_tar_contents == expected_tar_contents
 
 
+def test_archive_layer_with_base_index(tmp_path):
+    """Test creating a layer with an index of the base for reference."""
+    layer_dir = tmp_path / "layer_dir"
+    (layer_dir / "second").mkdir(parents=True)
+    (layer_dir / "second/second.txt").touch()
+
+    rootfs_dir = tmp_path / "rootfs"
+    (rootfs_dir / "first").mkdir(parents=True)
+    (rootfs_dir / "second").symlink_to("first")
+    base_index = index_directory(rootfs_dir)
+
+    temp_tar_path = tmp_path / "layer.tar"
+    layers.archive_layer(layer_dir, temp_tar_path, base_layer=base_index)
+
+    assert get_tar_contents(temp_tar_path) == ["first/second.txt"]
+
+
 def test_archive_layer_with_base_layer_dir_opaque(tmp_path):
     """
     Test creating a layer with a base layer dir for reference, but the new
@@ -172,7 +434,7 @@ def test_archive_layer_with_base_layer_dir_opaque(tmp_path):
     (rootfs_dir / "second").symlink_to("first")
 
     temp_tar_path = tmp_path / "layer.tar"
-    layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+    layers.archive_layer(layer_dir, temp_tar_path, base_layer=rootfs_dir)
     temp_tar_contents = get_tar_contents(temp_tar_path)
 
     # The tarfile *must* contain the "second" dir entry, because of the
@@ -215,7 +477,7 @@ def test_archive_layer_with_base_layer_subdirs(tmp_path):
     (rootfs_dir / "second").symlink_to("first")
 
     temp_tar_path = tmp_path / "layer.tar"
-    layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+    layers.archive_layer(layer_dir, temp_tar_path, base_layer=rootfs_dir)
     temp_tar_contents = get_tar_contents(temp_tar_path)
 
     expected_tar_contents = [
@@ -239,7 +501,7 @@ def test_archive_layer_duplicate_dirs(tmp_path):
     layer_dir, rootfs_dir = duplicate_dirs_setup(tmp_path)
 
     temp_tar_path = tmp_path / "layer.tar"
-    layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+    layers.archive_layer(layer_dir, temp_tar_path, base_layer=rootfs_dir)
     temp_tar_contents = get_tar_contents(temp_tar_path)
 
     expected_tar_contents = [
@@ -278,7 +540,7 @@ def test_archive_layer_duplicate_dirs_conflict(tmp_path):
     )
     temp_tar_path = tmp_path / "layer.tar"
     with pytest.raises(errors.LayerArchivingError, match=re.escape(expected_message)):
-        layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+        layers.archive_layer(layer_dir, temp_tar_path, base_layer=rootfs_dir)
 
 
 def test_archive_layer_duplicate_files(tmp_path):
@@ -302,7 +564,7 @@ def test_archive_layer_duplicate_files(tmp_path):
     )
     temp_tar_path = tmp_path / "layer.tar"
     with pytest.raises(errors.LayerArchivingError, match=re.escape(expected_message)):
-        layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+        layers.archive_layer(layer_dir, temp_tar_path, base_layer=rootfs_dir)
 
 
 def test_archive_layer_duplicate_identical_files(tmp_path):
@@ -318,7 +580,7 @@ def test_archive_layer_duplicate_identical_files(tmp_path):
     (layer_dir / "usr/bin/dir1/same.txt").write_text("foobar")
 
     temp_tar_path = tmp_path / "layer.tar"
-    layers.archive_layer(layer_dir, temp_tar_path, base_layer_dir=rootfs_dir)
+    layers.archive_layer(layer_dir, temp_tar_path, base_layer=rootfs_dir)
     temp_tar_contents = get_tar_contents(temp_tar_path)
 
     expected_tar_contents = [
@@ -357,3 +619,180 @@ def test_prune_prime_files(tmp_path):
 
     # "file1.txt" gets pruned, the other files remain.
     assert sorted(os.listdir(prime_dir)) == ["file2.txt", "file3.txt"]
+
+
+def test_prune_prime_files_base_index(tmp_path):
+    base_layer_dir = tmp_path / "base"
+    (base_layer_dir / "dir").mkdir(parents=True)
+    (base_layer_dir / "file1.txt").write_text("file1")
+    (base_layer_dir / "file2.txt").write_text("file2")
+    (base_layer_dir / "link.txt").symlink_to("file1.txt")
+    base_index = index_directory(base_layer_dir)
+
+    prime_dir = tmp_path / "prime"
+    (prime_dir / "dir").mkdir(parents=True)
+    (prime_dir / "file1.txt").write_text("file1")
+    (prime_dir / "file2.txt").write_text("different")
+    (prime_dir / "link.txt").write_text("file1")
+
+    files = {"dir", "file1.txt", "file2.txt", "link.txt"}
+    layers.prune_prime_files(prime_dir, files, base_index)
+
+    # Only "file1.txt" is identical in the base
+    assert sorted(os.listdir(prime_dir)) == ["dir", "file2.txt", "link.txt"]
+
+
+def _make_layer(*entries: tuple[str, str, bytes | str]) -> bytes:
+    """Create a layer tarball with (name, type, data or link target) entries."""
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode="w") as tar_file:
+        for name, entry_type, data in entries:
+            info = tarfile.TarInfo(name)
+            if entry_type == "dir":
+                info.type = tarfile.DIRTYPE
+                tar_file.addfile(info)
+            elif entry_type in ("symlink", "hardlink"):
+                info.type = (
+                    tarfile.SYMTYPE if entry_type == "symlink" else tarfile.LNKTYPE
+                )
+                info.linkname = str(data)
+                tar_file.addfile(info)
+            else:
+                info.size = len(data)
+                tar_file.addfile(
+                    info,
+                    io.BytesIO(bytes(data, "utf-8") if isinstance(data, str) else data),
+                )
+    return stream.getvalue()
+
+
+def _squash(*layer_tarballs: bytes) -> dict[str, tarfile.TarInfo | bytes]:
+    """Squash layer tarballs, and get the merged entries with the files' data."""
+    output = io.BytesIO()
+    layers.squash_layers(
+        [lambda data=data: io.BytesIO(data) for data in layer_tarballs], output
+    )
+    output.seek(0)
+    merged: dict[str, tarfile.TarInfo | bytes] = {}
+    with tarfile.open(fileobj=output) as tar_file:
+        for member in tar_file:
+            file_obj = tar_file.extractfile(member) if member.isreg() else None
+            merged[member.name] = member if file_obj is None else file_obj.read()
+    return merged
+
+
+def test_squash_layers():
+    base = _make_layer(
+        ("etc", "dir", ""),
+        ("etc/hostname", "file", "base"),
+        ("etc/os-release", "file", "base"),
+        ("var", "dir", ""),
+        ("var/cache", "dir", ""),
+        ("var/cache/apt", "file", "base"),
+        ("var/lib", "dir", ""),
+        ("var/lib/dpkg", "file", "base"),
+        ("opt", "dir", ""),
+        ("opt/app", "dir", ""),
+        ("opt/app/old", "file", "base"),
+    )
+    upper = _make_layer(
+        ("etc", "dir", ""),
+        ("etc/hostname", "file", "upper"),
+        ("etc/.wh.os-release", "file", ""),
+        (".wh.var", "file", ""),
+        ("var", "dir", ""),
+        ("var/lib", "dir", ""),
+        ("var/lib/new", "file", "upper"),
+        ("opt", "symlink", "usr/opt"),
+    )
+
+    merged = _squash(base, upper)
+
+    assert sorted(merged) == [
+        "etc",
+        "etc/hostname",
+        "opt",
+        "var",
+        "var/lib",
+        "var/lib/new",
+    ]
+    assert merged["etc/hostname"] == b"upper"
+    assert isinstance(merged["opt"], tarfile.TarInfo)
+    assert merged["opt"].linkname == "usr/opt"
+
+
+def test_squash_layers_opaque_dirs():
+    base = _make_layer(
+        ("app", "dir", ""),
+        ("app/lib", "dir", ""),
+        ("app/lib/old.so", "file", "base"),
+        ("app/config", "file", "base"),
+    )
+    middle = _make_layer(
+        ("app", "dir", ""),
+        ("app/lib", "dir", ""),
+        ("app/lib/.wh..wh..opq", "file", ""),
+        ("app/lib/new.so", "file", "middle"),
+    )
+    upper = _make_layer(("app", "dir", ""), ("app/lib", "dir", ""))
+
+    merged = _squash(base, middle, upper)
+
+    assert sorted(merged) == ["app", "app/config", "app/lib", "app/lib/new.so"]
+
+
+def test_squash_layers_whiteouts_only_hide_lower_layers():
+    base = _make_layer(("file", "file", "base"))
+    upper = _make_layer((".wh.file", "file", ""), ("file", "file", "upper"))
+
+    assert _squash(base, upper) == {"file": b"upper"}
+
+
+def test_squash_layers_hardlinks():
+    base = _make_layer(
+        ("bin", "dir", ""),
+        ("bin/tool", "file", "base tool"),
+        ("bin/alias", "hardlink", "bin/tool"),
+        ("bin/other", "hardlink", "bin/tool"),
+        ("lib", "dir", ""),
+        ("lib/a.so", "file", "base lib"),
+        ("lib/b.so", "hardlink", "lib/a.so"),
+    )
+    upper = _make_layer(("bin", "dir", ""), ("bin/tool", "file", "upper tool"))
+
+    merged = _squash(base, upper)
+
+    # The links to a file from the same layer are kept.
+    assert isinstance(merged["lib/b.so"], tarfile.TarInfo)
+    assert merged["lib/b.so"].linkname == "lib/a.so"
+    # The links to a replaced file take its data.
+    assert merged["bin/tool"] == b"upper tool"
+    assert merged["bin/alias"] == b"base tool"
+    assert isinstance(merged["bin/other"], tarfile.TarInfo)
+    assert merged["bin/other"].linkname == "bin/alias"
+
+
+def test_squash_layers_sparse(tmp_path):
+    layer_dir = tmp_path / "layer_dir"
+    layer_dir.mkdir()
+    with (layer_dir / "seed.db").open("wb") as file:
+        file.write(b"header")
+        file.seek(4 * 1024 * 1024)
+        file.write(b"data")
+        file.truncate(16 * 1024 * 1024)
+    if not layers._is_sparse_file(layer_dir / "seed.db"):
+        pytest.skip("the filesystem does not support sparse files")
+    stream = io.BytesIO()
+    layers.archive_layer(layer_dir, stream)
+
+    output = io.BytesIO()
+    layers.squash_layers([lambda: io.BytesIO(stream.getvalue())], output)
+
+    assert len(output.getvalue()) < 1024 * 1024
+    output.seek(0)
+    with tarfile.open(fileobj=output) as tar_file:
+        seed = tar_file.getmember("seed.db")
+        assert seed.sparse is not None
+        file_obj = tar_file.extractfile(seed)
+        assert file_obj is not None
+        assert file_obj.read() == (layer_dir / "seed.db").read_bytes()
@@ -14,19 +14,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import datetime
-import hashlib
+import io
 import json
 import os
+import shutil
 import tarfile
-from collections import namedtuple
+from dataclasses import replace
 from pathlib import Path
-from unittest.mock import ANY, call, mock_open, patch
+from unittest.mock import ANY, call
 
 import pytest
 
 import tests
-from rockcraft import errors, oci
+from rockcraft import compression, errors, layers, oci, oci_layout, rootfs
 from rockcraft.architectures import SUPPORTED_ARCHS
+from tests.unit.testing.base_index import index_directory
+
+# The mode of the metadata files that rockcraft writes in images.
+METADATA_FILE_MODE = 0o644
 
 MOCK_NEW_USER = {
     "user": "foo",
@@ -46,49 +51,36 @@ def mock_run(mocker):
     return mocker.patch("rockcraft.oci._process_run")
 
 
-@pytest.fixture()
-def mock_archive_layer(mocker):
-    return mocker.patch("rockcraft.layers.archive_layer")
-
-
-@pytest.fixture()
-def mock_rmtree(mocker):
-    return mocker.patch("shutil.rmtree")
-
-
-@pytest.fixture()
-def mock_mkdir(mocker):
-    return mocker.patch("pathlib.Path.mkdir")
-
-
-@pytest.fixture()
-def mock_mkdtemp(mocker):
-    return mocker.patch("tempfile.mkdtemp")
-
-
 @pytest.fixture()
 def mock_tmpdir(mocker):
     return mocker.patch("tempfile.TemporaryDirectory")
 
 
 @pytest.fixture()
-def mock_inject_variant(mocker):
-    return mocker.patch("rockcraft.oci._inject_architecture_variant")
+def mock_add_layer(mocker):
+    return mocker.patch("rockcraft.oci.Image.add_layer")
 
 
 @pytest.fixture()
-def mock_read_bytes(mocker):
-    return mocker.patch("pathlib.Path.read_bytes")
+def blank_image(new_dir):
+    image, _ = oci.Image.new_oci_image(
+        "bare@latest", image_dir=Path("images"), arch="amd64"
+    )
+    return image
 
 
-@pytest.fixture()
-def mock_write_bytes(mocker):
-    return mocker.patch("pathlib.Path.write_bytes")
+def _get_layout(image):
+    return oci_layout.ImageLayout(image.path / image.image_name.split(":")[0])
 
 
-@pytest.fixture()
-def mock_add_layer(mocker):
-    return mocker.patch("rockcraft.oci.Image.add_layer")
+def _config_digest(image):
+    manifest, _ = _get_layout(image).read_image(image.image_name.split(":")[1])
+    return manifest["config"]["digest"]
+
+
+def _get_runtime_config(image):
+    _, config = _get_layout(image).read_image(image.image_name.split(":")[1])
+    return config["config"]
 
 
 @tests.linux_only
@@ -100,66 +92,41 @@ class TestImage:
         assert image.image_name == "a:b"
         assert image.path == Path("/c")
 
-    def test_from_docker_registry(self, mock_run, new_dir):
+    @pytest.fixture()
+    def ecr_platforms(self):
+        # The platforms of the registry that we currently use
+        # (https://gallery.ecr.aws/ubuntu/ubuntu)
+        return [
+            ("amd64", None),
+            ("arm", "v7"),
+            ("arm64", "v8"),
+            ("ppc64le", None),
+            ("s390x", None),
+        ]
+
+    def test_from_docker_registry(self, fake_registry, monkeypatch, new_dir):
+        monkeypatch.setattr(oci, "REGISTRY_URL", f"{fake_registry.host}/ubuntu")
+        digest = fake_registry.add_image(
+            "ubuntu/a", "b", [b"layer 1", b"layer 2"], [("amd64", None)]
+        )
+
         image, source_image = oci.Image.from_docker_registry(
             "a@b", image_dir=Path("images/dir"), arch="amd64"
         )
+
         assert Path("images/dir").is_dir()
         assert image.image_name == "a:b"
         assert source_image == f"docker://{oci.REGISTRY_URL}/a:b"
         assert image.path == Path("images/dir")
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "skopeo",
-                    "--insecure-policy",
-                    "--override-arch",
-                    "amd64",
-                    "copy",
-                    "--retry-times",
-                    str(oci.MAX_DOWNLOAD_RETRIES),
-                    f"docker://{oci.REGISTRY_URL}/a:b",
-                    "oci:images/dir/a:b",
-                ]
-            )
-        ]
-        mock_run.reset_mock()
-        _ = oci.Image.from_docker_registry(
-            "a@b", image_dir=Path("images/dir"), arch="arm64"
-        )
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "skopeo",
-                    "--insecure-policy",
-                    "--override-arch",
-                    "arm64",
-                    "--override-variant",
-                    "v8",
-                    "copy",
-                    "--retry-times",
-                    str(oci.MAX_DOWNLOAD_RETRIES),
-                    f"docker://{oci.REGISTRY_URL}/a:b",
-                    "oci:images/dir/a:b",
-                ]
-            )
-        ]
-
-    def _get_arch_from_call(self, mock_call):
-        ArchData = namedtuple("ArchData", ["override_arch", "override_variant"])
-
-        call_args = mock_call.args[0]
-        override_arch_index = call_args.index("--override-arch")
-        override_arch = call_args[override_arch_index + 1]
-
-        override_variant = None
-        try:
-            override_variant_index = call_args.index("--override-variant")
-            override_variant = call_args[override_variant_index + 1]
-        except ValueError:
-            pass
-
-        return ArchData(override_arch, override_variant)
+        assert image.source_digest == digest
+        layout = oci_layout.ImageLayout(Path("images/dir/a"))
+        manifest, config = layout.read_image("b")
+        assert config["architecture"] == "amd64"
+        assert [
+            layout.blob_path(layer["digest"]).read_bytes()
+            for layer in manifest["layers"]
+        ] == [b"layer 1", b"layer 2"]
+        assert not list(layout.blobs_dir.glob(".*"))
 
     # The archs here were taken from the supported architectures in the registry
     # that we currently use (https://gallery.ecr.aws/ubuntu/ubuntu)
@@ -174,19 +141,30 @@ class TestImage:
         ],
     )
     def test_from_docker_registry_arch(
-        self, mock_run, new_dir, deb_arch, expected_arch, expected_variant
+        self,
+        fake_registry,
+        monkeypatch,
+        new_dir,
+        ecr_platforms,
+        deb_arch,
+        expected_arch,
+        expected_variant,
     ):
-        """Test that the correct arch-related parameters are passed to skopeo."""
+        """Test that the image for the right platform is pulled."""
+        # pylint: disable=too-many-arguments
+        monkeypatch.setattr(oci, "REGISTRY_URL", f"{fake_registry.host}/ubuntu")
+        fake_registry.add_image("ubuntu/a", "b", [b"layer"], ecr_platforms)
+
         oci.Image.from_docker_registry(
             "a@b", image_dir=Path("images/dir"), arch=deb_arch
         )
-        arch_data = self._get_arch_from_call(mock_run.mock_calls[0])
 
-        assert arch_data.override_arch == expected_arch
-        assert arch_data.override_variant == expected_variant
+        _, config = oci_layout.ImageLayout(Path("images/dir/a")).read_image("b")
+        assert config["architecture"] == expected_arch
+        assert config.get("variant") == expected_variant
 
     @pytest.mark.parametrize("deb_arch", list(SUPPORTED_ARCHS))
-    def test_new_oci_image(self, mock_inject_variant, mock_run, deb_arch):
+    def test_new_oci_image(self, new_dir, mock_run, deb_arch):
         """Test that new blank images are created with the correct GOARCH values."""
         expected = SUPPORTED_ARCHS[deb_arch]
 
@@ -198,44 +176,342 @@ class TestImage:
         assert image.image_name == "bare:latest"
         assert source_image == f"oci:{str(image_dir)}/bare:latest"
         assert image.path == Path("images/dir")
-        assert mock_run.mock_calls == [
-            call(["umoci", "init", "--layout", f"{image_dir}/bare"]),
-            call(["umoci", "new", "--image", f"{image_dir}/bare:latest"]),
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    f"{image_dir}/bare:latest",
-                    "--architecture",
-                    expected.go_arch,
-                    "--no-history",
-                ]
-            ),
+        assert mock_run.mock_calls == []
+
+        layout = oci_layout.ImageLayout(image_dir / "bare")
+        manifest, config = layout.read_image("latest")
+        assert manifest["layers"] == []
+        assert config["architecture"] == expected.go_arch
+        assert config.get("variant") == expected.go_variant
+        assert config["rootfs"] == {"type": "layers", "diff_ids": []}
+        assert image.source_digest == layout.get_descriptor("latest")["digest"]
+
+    @pytest.fixture()
+    def base_registry(self, fake_registry, monkeypatch):
+        """Serve the base "a:b" from a local registry."""
+        monkeypatch.setattr(oci, "REGISTRY_URL", f"{fake_registry.host}/ubuntu")
+        base = {"layers": [b"layer 1"]}
+
+        def publish():
+            return fake_registry.add_image(
+                "ubuntu/a", "b", base["layers"], [("amd64", None)]
+            )
+
+        def downloaded():
+            return [
+                fake_registry.blobs[path.rsplit("/", 1)[-1]]
+                for method, path in fake_registry.requests
+                if method == "GET" and "/blobs/" in path
+            ]
+
+        base["publish"] = publish
+        base["downloaded"] = downloaded
+        publish()
+        return base
+
+    def test_from_docker_registry_cached(self, base_registry, fake_registry, new_dir):
+        """Unchanged bases are restored from the blob store."""
+        blob_store = oci_layout.BlobStore(Path("cache"))
+        source = oci.BaseSource(oci.REGISTRY_URL, blob_store=blob_store)
+        digest = base_registry["publish"]()
+
+        images = [
+            oci.Image.from_docker_registry(
+                "a@b", image_dir=Path(image_dir), arch="amd64", source=source
+            )[0]
+            for image_dir in ("project1", "project2")
+        ]
+
+        # The base was fetched once, pinned to the digest of its manifest
+        manifest_gets = [
+            path
+            for method, path in fake_registry.requests
+            if method == "GET" and "/manifests/" in path
         ]
-        if expected.go_variant is None:
-            mock_inject_variant.assert_not_called()
+        base_layout = oci_layout.ImageLayout(images[0].path / "a")
+        platform_digest = base_layout.get_descriptor("b")["digest"]
+        # The index, then the amd64 manifest
+        assert manifest_gets == [
+            f"/v2/ubuntu/a/manifests/{digest}",
+            f"/v2/ubuntu/a/manifests/{platform_digest}",
+        ]
+        assert sorted(base_registry["downloaded"]()) == sorted(
+            [b"layer 1", fake_registry.blobs[_config_digest(images[0])]]
+        )
+        assert images[1].blob_store is blob_store
+        # The digest in the registry is known without looking it up again
+        assert [image.source_digest for image in images] == [digest, digest]
+
+        layouts = [oci_layout.ImageLayout(image.path / "a") for image in images]
+        assert layouts[0].read_image("b") == layouts[1].read_image("b")
+        for blob in layouts[1].image_blobs("b"):
+            assert layouts[1].blob_path(blob).samefile(blob_store.blob_path(blob))
+        assert list((blob_store.path / "partial").glob("*")) == []
+
+    def test_from_docker_registry_cache_outdated(
+        self, base_registry, fake_registry, new_dir
+    ):
+        """Updated bases are fetched again, reusing the unchanged layers."""
+        source = oci.BaseSource(
+            oci.REGISTRY_URL, blob_store=oci_layout.BlobStore(Path("cache"))
+        )
+        oci.Image.from_docker_registry(
+            "a@b", image_dir=Path("images"), arch="amd64", source=source
+        )
+        base_registry["layers"] = [b"layer 1", b"layer 2"]
+        base_registry["publish"]()
+        fake_registry.requests.clear()
+
+        oci.Image.from_docker_registry(
+            "a@b", image_dir=Path("images"), arch="amd64", source=source
+        )
+
+        # The config is the same, as only the layers changed
+        assert base_registry["downloaded"]() == [b"layer 2"]
+        manifest, _ = oci_layout.ImageLayout(Path("images/a")).read_image("b")
+        assert len(manifest["layers"]) == len(base_registry["layers"])
+
+    @pytest.mark.parametrize(
+        ("policy", "elapsed", "checked"),
+        [
+            (oci.RevalidationPolicy("always"), 0, True),
+            (oci.RevalidationPolicy("ttl", ttl=60), 30, False),
+            (oci.RevalidationPolicy("ttl", ttl=60), 60, True),
+            (oci.RevalidationPolicy("never"), 10**9, False),
+        ],
+    )
+    def test_from_docker_registry_revalidation(
+        self,
+        base_registry,
+        fake_registry,
+        mocker,
+        new_dir,
+        policy,
+        elapsed,
+        checked,
+    ):
+        # pylint: disable=too-many-arguments
+        source = oci.BaseSource(
+            oci.REGISTRY_URL, blob_store=oci_layout.BlobStore(Path("cache"))
+        )
+        mocker.patch("time.time", return_value=1000.0)
+        oci.Image.from_docker_registry(
+            "a@b", image_dir=Path("images"), arch="amd64", source=source
+        )
+        fake_registry.requests.clear()
+        mocker.patch("time.time", return_value=1000.0 + elapsed)
+
+        oci.Image.from_docker_registry(
+            "a@b",
+            image_dir=Path("images"),
+            arch="amd64",
+            source=replace(source, revalidation=policy),
+        )
+
+        # Only the manifest's digest is checked, if at all
+        expected = [("HEAD", "/v2/ubuntu/a/manifests/b")] if checked else []
+        assert fake_registry.requests == expected
+
+    def test_revalidation_policy_from_environment(self, monkeypatch):
+        monkeypatch.delenv(oci.BASE_REVALIDATION_ENV, raising=False)
+        monkeypatch.delenv(oci.BASE_TTL_ENV, raising=False)
+        assert oci.RevalidationPolicy.from_environment() == oci.RevalidationPolicy(
+            "always", oci.DEFAULT_BASE_TTL
+        )
+
+        monkeypatch.setenv(oci.BASE_REVALIDATION_ENV, "ttl")
+        monkeypatch.setenv(oci.BASE_TTL_ENV, "600")
+        assert oci.RevalidationPolicy.from_environment() == oci.RevalidationPolicy(
+            "ttl", 600
+        )
+
+    @pytest.mark.parametrize(
+        ("mode", "ttl", "message"),
+        [
+            ("sometimes", "600", "Invalid value for ROCKCRAFT_BASE_REVALIDATION"),
+            ("ttl", "-1", "Invalid value for ROCKCRAFT_BASE_TTL"),
+            ("ttl", "soon", "Invalid value for ROCKCRAFT_BASE_TTL"),
+        ],
+    )
+    def test_revalidation_policy_invalid(self, monkeypatch, mode, ttl, message):
+        monkeypatch.setenv(oci.BASE_REVALIDATION_ENV, mode)
+        monkeypatch.setenv(oci.BASE_TTL_ENV, ttl)
+        with pytest.raises(errors.RockcraftError, match=message):
+            oci.RevalidationPolicy.from_environment()
+
+    @pytest.mark.parametrize("cached", [False, True])
+    def test_from_docker_registry_offline(
+        self, base_registry, fake_registry, new_dir, cached
+    ):
+        """Offline, only cached bases are used, and missing ones fail right away."""
+        source = oci.BaseSource(
+            oci.REGISTRY_URL, blob_store=oci_layout.BlobStore(Path("cache"))
+        )
+        if cached:
+            oci.Image.from_docker_registry(
+                "a@b", image_dir=Path("images"), arch="amd64", source=source
+            )
+        fake_registry.requests.clear()
+
+        if cached:
+            image, _ = oci.Image.from_docker_registry(
+                "a@b",
+                image_dir=Path("other"),
+                arch="amd64",
+                source=replace(source, offline=True),
+            )
+            assert oci_layout.ImageLayout(Path("other/a")).read_image("b")
+            assert image.source_digest is not None
+        else:
+            with pytest.raises(errors.RockcraftError, match="not available offline"):
+                oci.Image.from_docker_registry(
+                    "a@b",
+                    image_dir=Path("images"),
+                    arch="amd64",
+                    source=replace(source, offline=True),
+                )
+        assert fake_registry.requests == []
+
+    def test_from_docker_registry_mirror(self, fake_registry, new_dir):
+        fake_registry.add_image("mirror/a", "b", [b"layer"], [("amd64", None)])
+        source = oci.BaseSource(registry=f"{fake_registry.host}/mirror")
+
+        image, source_image = oci.Image.from_docker_registry(
+            "a@b", image_dir=Path("images"), arch="amd64", source=source
+        )
+
+        assert source_image == f"docker://{fake_registry.host}/mirror/a:b"
+        manifest, _ = oci_layout.ImageLayout(Path("images/a")).read_image("b")
+        assert len(manifest["layers"]) == 1
+
+    @pytest.mark.parametrize("multi_platform", [False, True])
+    def test_from_docker_registry_layout(self, new_dir, multi_platform):
+        """Bases are copied from a local OCI layout, even offline."""
+        mirror = oci_layout.ImageLayout.init(Path("mirror"))
+        mirror.create_image("a:b-amd64", architecture="amd64")
+        if multi_platform:
+            mirror.create_image("a:b-arm64", architecture="arm64", variant="v8")
+            mirror.create_index("a:b", ["a:b-amd64", "a:b-arm64"])
         else:
-            mock_inject_variant.assert_called_once_with(
-                image_dir / "bare", expected.go_variant
+            mirror.set_tag("a:b", mirror.get_descriptor("a:b-amd64"))
+        source = oci.BaseSource(
+            registry="unused",
+            layout=Path("mirror"),
+            blob_store=oci_layout.BlobStore(Path("cache")),
+            offline=True,
+        )
+
+        image, source_image = oci.Image.from_docker_registry(
+            "a@b",
+            image_dir=Path("images"),
+            arch="arm64" if multi_platform else "amd64",
+            source=source,
+        )
+
+        assert source_image == "oci:mirror:a:b"
+        assert image.source_digest == mirror.get_descriptor("a:b")["digest"]
+        _, config = oci_layout.ImageLayout(Path("images/a")).read_image("b")
+        assert config["architecture"] == ("arm64" if multi_platform else "amd64")
+
+    def test_from_docker_registry_layout_missing(self, new_dir):
+        oci_layout.ImageLayout.init(Path("mirror"))
+
+        with pytest.raises(errors.RockcraftError, match="Tag 'a:b' not found"):
+            oci.Image.from_docker_registry(
+                "a@b",
+                image_dir=Path("images"),
+                arch="amd64",
+                source=oci.BaseSource(registry="unused", layout=Path("mirror")),
             )
 
-    def test_copy_to(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-        new_image = image.copy_to("d:e", image_dir=Path("/f"))
+    def test_base_source_from_environment(self, monkeypatch, tmp_path):
+        monkeypatch.delenv(oci.BASE_MIRROR_ENV, raising=False)
+        monkeypatch.delenv(oci.BASE_REVALIDATION_ENV, raising=False)
+        assert oci.BaseSource.from_environment() == oci.BaseSource(oci.REGISTRY_URL)
+
+        monkeypatch.setenv(oci.BASE_MIRROR_ENV, "docker://mirror.example.com/ubuntu/")
+        assert oci.BaseSource.from_environment() == oci.BaseSource(
+            "mirror.example.com/ubuntu"
+        )
+
+        oci_layout.ImageLayout.init(tmp_path)
+        monkeypatch.setenv(oci.BASE_MIRROR_ENV, f"oci:{tmp_path}")
+        assert oci.BaseSource.from_environment().layout == tmp_path
+
+    def test_base_source_from_environment_options(self, monkeypatch):
+        """The revalidation policy is read too, and the other options passed."""
+        monkeypatch.delenv(oci.BASE_MIRROR_ENV, raising=False)
+        monkeypatch.setenv(oci.BASE_REVALIDATION_ENV, "never")
+        blob_store = oci_layout.BlobStore(Path("cache"))
+
+        source = oci.BaseSource.from_environment(blob_store=blob_store, offline=True)
+
+        assert source == oci.BaseSource(
+            oci.REGISTRY_URL,
+            blob_store=blob_store,
+            revalidation=oci.RevalidationPolicy("never"),
+            offline=True,
+        )
+
+    @pytest.mark.parametrize("mirror", ["oci:/nonexistent", "https://example.com"])
+    def test_base_source_invalid(self, monkeypatch, mirror):
+        monkeypatch.setenv(oci.BASE_MIRROR_ENV, mirror)
+        with pytest.raises(errors.RockcraftError, match="ROCKCRAFT_BASE_MIRROR"):
+            oci.BaseSource.from_environment()
+
+    def test_copy_to_blob_store(self, mock_run, new_dir):
+        blob_store = oci_layout.BlobStore(Path("cache"))
+        image, _ = oci.Image.new_oci_image(
+            "a@b", image_dir=Path("c"), arch="amd64", blob_store=blob_store
+        )
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").touch()
+        image = image.add_layer("b", Path("layer_dir"))
+        manifest, _ = oci_layout.ImageLayout(Path("c/a")).read_image("b")
+        layer = manifest["layers"][0]["digest"]
+
+        new_image = image.copy_to("d:e", image_dir=Path("f"))
+
+        assert new_image.blob_store is blob_store
+        dest_layout = oci_layout.ImageLayout(Path("f/d"))
+        assert dest_layout.blob_path(layer).samefile(blob_store.blob_path(layer))
+        assert mock_run.mock_calls == []
+
+    def test_copy_to(self, mock_run, new_dir):
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="amd64")
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").touch()
+        image = image.add_layer("b", Path("layer_dir"))
+        layout = oci_layout.ImageLayout(Path("c/a"))
+
+        new_image = image.copy_to("d:e", image_dir=Path("f"))
+
         assert new_image.image_name == "d:e"
-        assert new_image.path == Path("/f")
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "skopeo",
-                    "--insecure-policy",
-                    "copy",
-                    "oci:/c/a:b",
-                    "oci:/f/d:e",
-                ]
-            )
-        ]
+        assert new_image.path == Path("f")
+        # No external tools are involved
+        assert mock_run.mock_calls == []
+
+        dest_layout = oci_layout.ImageLayout(Path("f/d"))
+        assert dest_layout.get_descriptor("e") == {
+            **layout.get_descriptor("b"),
+            "annotations": {oci_layout.ANNOTATION_REF_NAME: "e"},
+        }
+        # The blobs are hardlinked, not copied
+        for digest in layout.image_blobs("b"):
+            assert dest_layout.blob_path(digest).samefile(layout.blob_path(digest))
+
+    def test_copy_to_same_layout(self, mock_run, new_dir):
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="amd64")
+        blobs_before = sorted(os.listdir("c/a/blobs/sha256"))
+
+        new_image = image.copy_to("a:e", image_dir=Path("c"))
+
+        assert new_image.image_name == "a:e"
+        layout = oci_layout.ImageLayout(Path("c/a"))
+        assert layout.get_descriptor("e")["digest"] == (
+            layout.get_descriptor("b")["digest"]
+        )
+        assert sorted(os.listdir("c/a/blobs/sha256")) == blobs_before
 
     def test_extract_to(self, mock_run, new_dir):
         image = oci.Image("a:b", Path("/c"))
@@ -273,36 +549,222 @@ class TestImage:
         assert Path("bundle/dir/a-b/foo.txt").exists() is False
         assert bundle_path == Path("bundle/dir/a-b/rootfs")
 
+    def test_extract_to_cached(self, mock_run, new_dir):
+        cache = rootfs.RootfsCache(Path("cache"))
+
+        def fake_umoci(command):
+            Path(command[-1], "rootfs/etc").mkdir(parents=True)
+            Path(command[-1], "rootfs/etc/hostname").write_text("base")
+
+        mock_run.side_effect = fake_umoci
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="arm64")
+
+        rootfs_dirs = [
+            image.extract_to(Path(bundle_dir), cache=cache)
+            for bundle_dir in ("bundle1", "bundle2")
+        ]
+
+        # The image was only unpacked once, into the cache
+        (umoci_call,) = mock_run.mock_calls
+        digest = oci_layout.ImageLayout(Path("c/a")).get_descriptor("b")["digest"]
+        key = f"{digest[7:]}-arm64-v8"
+        assert umoci_call.args[0][-1].startswith(f"cache/.tmp-{key[:12]}.")
+        assert rootfs_dirs == [Path("bundle1/a-b/rootfs"), Path("bundle2/a-b/rootfs")]
+        for rootfs_dir in rootfs_dirs:
+            assert (rootfs_dir / "etc/hostname").samefile(
+                cache.bundle_path(key) / "rootfs/etc/hostname"
+            )
+
+    def test_get_index(self, mocker, new_dir):
+        cache = rootfs.RootfsCache(Path("cache"))
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="amd64")
+        Path("layer_dir/etc").mkdir(parents=True)
+        Path("layer_dir/etc/passwd").write_text("root:x:0:0::/root:/bin/sh\n")
+        image = image.add_layer("b", Path("layer_dir"))
+        spy_from_image = mocker.spy(oci.BaseIndex, "from_image")
+
+        indexes = [image.get_index(cache=cache) for _ in range(2)]
+
+        # The image was only indexed once
+        assert spy_from_image.call_count == 1
+        for index in indexes:
+            assert index.read_bytes("etc/passwd") == b"root:x:0:0::/root:/bin/sh\n"
+            assert index.listdir("etc") == ["passwd"]
+
     def test_add_layer(self, mocker, mock_run, new_dir):
-        image = oci.Image("a:b", new_dir / "c")
-        Path("c").mkdir()
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="amd64")
         Path("layer_dir").mkdir()
         Path("layer_dir/foo.txt").touch()
-        pid = os.getpid()
 
         spy_add = mocker.spy(tarfile.TarFile, "add")
 
-        image.add_layer("tag", Path("layer_dir"))
-        # The `Tarfile.add()` on the directory ends up calling the method multiple
-        # times (due to the recursion), but we're mainly interested that the first
-        # call was to add `layer_dir`.
-        assert spy_add.mock_calls[0] == call(
-            ANY, Path("layer_dir/foo.txt"), arcname="foo.txt", recursive=False
-        )
-
-        expected_cmd = [
-            "umoci",
-            "raw",
-            "add-layer",
-            "--image",
-            str(new_dir / "c/a:b"),
-            str(new_dir / f"c/.temp_layer.{pid}.tar"),
-            "--tag",
-            "tag",
+        new_image = image.add_layer("tag", Path("layer_dir"))
+        assert new_image.image_name == "a:tag"
+        assert new_image.source_digest is None
+        assert spy_add.mock_calls == [
+            call(
+                ANY,
+                Path("layer_dir/foo.txt"),
+                arcname="foo.txt",
+                recursive=False,
+                filter=None,
+            )
         ]
-        assert mock_run.mock_calls == [
-            call(expected_cmd + ["--history.created_by", " ".join(expected_cmd)])
+        # No external tools are involved, and no temporary tarball is written.
+        assert mock_run.mock_calls == []
+        assert os.listdir("c") == ["a"]
+
+        layout = oci_layout.ImageLayout(Path("c/a"))
+        manifest, config = layout.read_image("tag")
+        assert len(manifest["layers"]) == 1
+        assert config["history"][0]["created_by"] == "rockcraft add-layer"
+
+        layer = manifest["layers"][0]
+        assert layer["mediaType"] == compression.MEDIA_TYPE_LAYER_GZIP
+        with tarfile.open(layout.blob_path(layer["digest"]), "r:gz") as tar_file:
+            assert tar_file.getnames() == ["foo.txt"]
+
+        # The original tag is left untouched
+        manifest, _ = layout.read_image("b")
+        assert manifest["layers"] == []
+
+    def test_squash(self, mock_run, new_dir):
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="amd64")
+        Path("base/etc").mkdir(parents=True)
+        Path("base/etc/hostname").write_text("base")
+        Path("base/etc/motd").write_text("base")
+        Path("prime/etc").mkdir(parents=True)
+        Path("prime/etc/hostname").write_text("prime")
+        Path("prime/etc/.wh.motd").touch()
+        image = image.add_layer("base", Path("base"))
+        image = image.add_layer("prime", Path("prime"))
+        layout = oci_layout.ImageLayout(Path("c/a"))
+        prime_manifest, _ = layout.read_image("prime")
+
+        new_image = image.squash("squashed")
+
+        assert new_image.image_name == "a:squashed"
+        manifest, config = layout.read_image("squashed")
+        assert len(manifest["layers"]) == 1
+        assert len(config["rootfs"]["diff_ids"]) == 1
+        assert [entry["created_by"] for entry in config["history"]] == [
+            "rockcraft squash"
         ]
+        layer = manifest["layers"][0]
+        with tarfile.open(layout.blob_path(layer["digest"]), "r:gz") as tar_file:
+            assert sorted(tar_file.getnames()) == ["etc", "etc/hostname"]
+            hostname = tar_file.extractfile("etc/hostname")
+            assert hostname is not None
+            assert hostname.read() == b"prime"
+
+        # The original tag is left untouched
+        assert layout.read_image("prime")[0] == prime_manifest
+
+    @pytest.mark.skipif(shutil.which("zstd") is None, reason="zstd not installed")
+    def test_add_layer_zstd(self, mock_run, new_dir):
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="amd64")
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").touch()
+
+        new_image = image.add_layer(
+            "tag", Path("layer_dir"), oci.LayerOptions(compression="zstd")
+        )
+        # Further layers use the same compression
+        assert new_image.compression == "zstd"
+        new_image.set_control_data({"name": "foo"})
+
+        layout = oci_layout.ImageLayout(Path("c/a"))
+        manifest, _ = layout.read_image("tag")
+        assert [layer["mediaType"] for layer in manifest["layers"]] == [
+            compression.MEDIA_TYPE_LAYER_ZSTD,
+            compression.MEDIA_TYPE_LAYER_ZSTD,
+        ]
+
+    @pytest.mark.parametrize("mode", ["stat", "content"])
+    def test_add_layer_reuse(self, mocker, monkeypatch, new_dir, mode):
+        monkeypatch.setenv("ROCKCRAFT_LAYER_CACHE", mode)
+        blob_store = oci_layout.BlobStore(Path("cache"))
+        image, _ = oci.Image.new_oci_image(
+            "a@b", image_dir=Path("c"), arch="amd64", blob_store=blob_store
+        )
+        Path("layer_dir").mkdir()
+        Path("layer_dir/foo.txt").write_text("foo")
+        spy_archive = mocker.spy(layers, "archive_layer")
+
+        image.add_layer("one", Path("layer_dir"))
+        image.add_layer("two", Path("layer_dir"))
+
+        assert len(spy_archive.mock_calls) == 1
+        layout = oci_layout.ImageLayout(Path("c/a"))
+        first, first_config = layout.read_image("one")
+        second, second_config = layout.read_image("two")
+        assert second["layers"] == first["layers"]
+        assert second_config["rootfs"] == first_config["rootfs"]
+        assert layout.has_blob(second["layers"][0]["digest"])
+
+        # Changed files and other compressions get new layers
+        Path("layer_dir/foo.txt").write_text("bar")
+        spy_archive.reset_mock()
+        new_layers = [
+            ("three", None),
+            ("four", oci.LayerOptions(compression="none")),
+        ]
+        for tag, options in new_layers:
+            image.add_layer(tag, Path("layer_dir"), options)
+
+        assert len(spy_archive.mock_calls) == len(new_layers)
+
+    def test_add_layer_reuse_off(self, mocker, monkeypatch, new_dir):
+        monkeypatch.setenv("ROCKCRAFT_LAYER_CACHE", "off")
+        image, _ = oci.Image.new_oci_image(
+            "a@b",
+            image_dir=Path("c"),
+            arch="amd64",
+            blob_store=oci_layout.BlobStore(Path("cache")),
+        )
+        Path("layer_dir").mkdir()
+        spy_archive = mocker.spy(layers, "archive_layer")
+
+        tags = ["one", "two"]
+        for tag in tags:
+            image.add_layer(tag, Path("layer_dir"))
+
+        assert len(spy_archive.mock_calls) == len(tags)
+        assert not Path("cache/layers").exists()
+
+    def test_add_layer_reproducible_with_cache(self, monkeypatch, new_dir):
+        """With SOURCE_DATE_EPOCH, the layer cache does not change the layer bytes."""
+        monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+        monkeypatch.setattr(layers, "FRAGMENT_MIN_SIZE", 1024)
+        Path("layer_dir").mkdir()
+        Path("layer_dir/small.txt").write_text("small")
+        Path("layer_dir/large.bin").write_bytes(bytes(range(256)) * 64)
+        digests = []
+        for mode in ("off", "stat"):
+            monkeypatch.setenv("ROCKCRAFT_LAYER_CACHE", mode)
+            image, _ = oci.Image.new_oci_image(
+                "a@b",
+                image_dir=Path(mode),
+                arch="amd64",
+                blob_store=oci_layout.BlobStore(Path(f"cache-{mode}")),
+            )
+            image.add_layer("one", Path("layer_dir"))
+            manifest, _ = oci_layout.ImageLayout(Path(mode, "a")).read_image("one")
+            digests.append(manifest["layers"][-1]["digest"])
+
+        assert digests[0] == digests[1]
+
+    def test_add_layer_reuse_invalid(self, monkeypatch, new_dir):
+        monkeypatch.setenv("ROCKCRAFT_LAYER_CACHE", "maybe")
+        image, _ = oci.Image.new_oci_image(
+            "a@b",
+            image_dir=Path("c"),
+            arch="amd64",
+            blob_store=oci_layout.BlobStore(Path("cache")),
+        )
+
+        with pytest.raises(errors.RockcraftError, match="ROCKCRAFT_LAYER_CACHE"):
+            image.add_layer("one", Path("layer_dir"))
 
     def test_add_new_user(
         self,
@@ -317,10 +779,10 @@ class TestImage:
         image = oci.Image("a:b", Path("/c"))
         image.add_user(
             tmp_path / "prime",
-            tmp_path,
             "mock-tag",
             MOCK_NEW_USER["user"],
             MOCK_NEW_USER["uid"],
+            oci.LayerOptions(base_layer=tmp_path),
         )
 
         mock_tmpdir.assert_called_once()
@@ -334,17 +796,19 @@ class TestImage:
         )
 
         check.is_false(os.path.exists(fake_tmpfs / "etc/shadow"))
-        mock_add_layer.assert_called_once_with("mock-tag", fake_tmpfs)
+        mock_add_layer.assert_called_once_with(
+            "mock-tag", fake_tmpfs, oci.LayerOptions(reuse=False)
+        )
 
         # Test with a conflicting user or ID.
         # Use the new fs as a base to force the error.
         with pytest.raises(errors.RockcraftError) as err:
             image.add_user(
                 tmp_path / "prime",
-                fake_tmpfs,
                 "mock-tag",
                 MOCK_NEW_USER["user"],
                 MOCK_NEW_USER["uid"] + 1,
+                oci.LayerOptions(base_layer=fake_tmpfs),
             )
             check.is_in(
                 "conflict with existing user/group in the base filesystem", str(err)
@@ -353,13 +817,52 @@ class TestImage:
         with pytest.raises(errors.RockcraftError) as err:
             image.add_user(
                 tmp_path / "prime",
-                fake_tmpfs,
                 "mock-tag",
                 MOCK_NEW_USER["user"] + "bar",
                 MOCK_NEW_USER["uid"],
+                oci.LayerOptions(base_layer=fake_tmpfs),
             )
             check.is_in("conflict with existing user/group in the base filesystem", err)
 
+    def test_add_user_base_index(self, mock_tmpdir, mock_add_layer, tmp_path):
+        fake_tmpfs = tmp_path / "mock-tmp"
+        mock_tmpdir.return_value = fake_tmpfs
+        (tmp_path / "base/etc").mkdir(parents=True)
+        (tmp_path / "base/etc/passwd").write_text("root:x:0:0::/root:/bin/sh\n")
+        (tmp_path / "base/etc/shadow").write_text("root:*:19000:0:99999:7:::\n")
+        base_index = index_directory(tmp_path / "base")
+
+        image = oci.Image("a:b", Path("/c"))
+        image.add_user(
+            tmp_path / "prime",
+            "mock-tag",
+            MOCK_NEW_USER["user"],
+            MOCK_NEW_USER["uid"],
+            oci.LayerOptions(base_layer=base_index),
+        )
+
+        assert (fake_tmpfs / "etc/passwd").read_text() == (
+            "root:x:0:0::/root:/bin/sh\n" + MOCK_NEW_USER["passwd"]
+        )
+        assert (fake_tmpfs / "etc/group").read_text() == MOCK_NEW_USER["group"]
+        assert (fake_tmpfs / "etc/shadow").read_text() == (
+            "root:*:19000:0:99999:7:::\n" + MOCK_NEW_USER["shadow"]
+        )
+
+    def test_add_user_layer_dir(self, mock_add_layer, tmp_path):
+        image = oci.Image("a:b", Path("/c"))
+        image.add_user(
+            tmp_path / "prime",
+            "mock-tag",
+            MOCK_NEW_USER["user"],
+            MOCK_NEW_USER["uid"],
+            oci.LayerOptions(layer_dir=tmp_path / "layer"),
+        )
+
+        assert (tmp_path / "layer/etc/passwd").read_text() == MOCK_NEW_USER["passwd"]
+        assert (tmp_path / "layer/etc/group").read_text() == MOCK_NEW_USER["group"]
+        assert not mock_add_layer.called
+
     @pytest.mark.parametrize(
         (
             "base_user_files",
@@ -461,14 +964,16 @@ class TestImage:
         image = oci.Image("a:b", Path("/c"))
         image.add_user(
             fake_prime,
-            tmp_path,
             "mock-tag",
             MOCK_NEW_USER["user"],
             MOCK_NEW_USER["uid"],
+            oci.LayerOptions(base_layer=tmp_path),
         )
 
         mock_tmpdir.assert_called_once()
-        mock_add_layer.assert_called_once_with("mock-tag", fake_tmp_new_layer)
+        mock_add_layer.assert_called_once_with(
+            "mock-tag", fake_tmp_new_layer, oci.LayerOptions(reuse=False)
+        )
         check.equal(
             (fake_tmp_new_layer / "etc/passwd").read_text(),
             expected_user_files["passwd"],
@@ -483,35 +988,26 @@ class TestImage:
                 expected_user_files["shadow"],
             )
 
-    def test_to_docker_daemon(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-        image.to_docker_daemon("tag")
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "skopeo",
-                    "--insecure-policy",
-                    "copy",
-                    "oci:/c/a:tag",
-                    "docker-daemon:a:tag",
-                ]
-            )
-        ]
+    def test_to_docker_daemon(self, mock_run, fake_docker_daemon, blank_image):
+        blank_image.to_docker_daemon("latest")
+        blank_image.to_docker_daemon("latest", repo_tag="rock:1.0")
 
-    def test_to_oci_archive(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-        image.to_oci_archive("tag", filename="foobar")
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "skopeo",
-                    "--insecure-policy",
-                    "copy",
-                    "oci:/c/a:tag",
-                    "oci-archive:foobar:tag",
-                ]
-            )
-        ]
+        loaded = []
+        for archive in fake_docker_daemon.archives:
+            with tarfile.open(fileobj=io.BytesIO(archive)) as tar_file:
+                manifest = json.load(tar_file.extractfile("manifest.json"))
+            loaded.extend(manifest[0]["RepoTags"])
+        assert loaded == ["bare:latest", "rock:1.0"]
+        assert not mock_run.called
+
+    def test_to_oci_archive(self, mock_run, blank_image):
+        blank_image.to_oci_archive("latest", filename="foobar")
+
+        with tarfile.open("foobar") as tar_file:
+            index = json.load(tar_file.extractfile("index.json"))
+        descriptor = _get_layout(blank_image).get_descriptor("latest")
+        assert index["manifests"] == [descriptor]
+        assert not mock_run.called
 
     def test_digest(self, mocker):
         source_image = "docker://ubuntu:22.04"
@@ -542,117 +1038,69 @@ class TestImage:
         ]
         assert digest == bytes([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15])
 
-    def test_set_default_user(self, mock_run):
+    def test_get_source_digest(self, mocker):
+        mock_digest = mocker.patch.object(oci.Image, "digest")
+        image = oci.Image("a:b", Path("/c"), source_digest="sha256:000102")
+
+        assert image.get_source_digest("docker://a:b") == bytes([0, 1, 2])
+        assert mock_digest.mock_calls == []
+
+    def test_get_source_digest_fallback(self, mocker):
+        mock_digest = mocker.patch.object(oci.Image, "digest", return_value=b"\x00")
         image = oci.Image("a:b", Path("/c"))
 
-        image.set_default_user("foo")
+        assert image.get_source_digest("docker://a:b") == b"\x00"
+        assert mock_digest.mock_calls == [call("docker://a:b")]
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=config.entrypoint",
-                    "--config.user",
-                    "foo",
-                ]
-            )
-        ]
+    def test_set_default_user(self, blank_image):
+        blank_image.set_entrypoint()
+        blank_image.set_default_user("foo")
 
-    def test_set_entrypoint_default(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
+        runtime_config = _get_runtime_config(blank_image)
+        assert runtime_config["User"] == "foo"
+        assert "Entrypoint" not in runtime_config
 
-        image.set_entrypoint()
+    def test_set_entrypoint_default(self, blank_image):
+        blank_image.set_entrypoint()
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=config.entrypoint",
-                    "--config.entrypoint",
-                    "/bin/pebble",
-                    "--config.entrypoint",
-                    "enter",
-                    "--config.entrypoint",
-                    "--verbose",
-                    "--clear=config.cmd",
-                ],
-            ),
+        assert _get_runtime_config(blank_image)["Entrypoint"] == [
+            "/bin/pebble",
+            "enter",
+            "--verbose",
         ]
 
-    def test_set_entrypoint_withservice(self, mock_run):
-        image = oci.Image("a:b", Path("/tmp"))
-        image.set_entrypoint("test-service")
-
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/tmp/a:b",
-                    "--clear=config.entrypoint",
-                    "--config.entrypoint",
-                    "/bin/pebble",
-                    "--config.entrypoint",
-                    "enter",
-                    "--config.entrypoint",
-                    "--verbose",
-                    "--config.entrypoint",
-                    "--args",
-                    "--config.entrypoint",
-                    "test-service",
-                    "--clear=config.cmd",
-                ],
-            ),
+    def test_set_entrypoint_withservice(self, blank_image):
+        blank_image.set_cmd("echo [ foo ]")
+        blank_image.set_entrypoint("test-service")
+
+        runtime_config = _get_runtime_config(blank_image)
+        assert runtime_config["Entrypoint"] == [
+            "/bin/pebble",
+            "enter",
+            "--verbose",
+            "--args",
+            "test-service",
         ]
+        # Setting the entrypoint clears the CMD
+        assert "Cmd" not in runtime_config
 
-    def test_set_cmd_empty(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-        image.set_cmd()
+    def test_set_cmd_empty(self, blank_image):
+        index_before = _get_layout(blank_image).read_index()
+        blank_image.set_cmd()
 
-        assert mock_run.mock_calls == []
+        # Nothing to change, so nothing is written
+        assert _get_layout(blank_image).read_index() == index_before
+        assert "Cmd" not in _get_runtime_config(blank_image)
 
-    def test_set_cmd_nonempty(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-        image.set_cmd("echo [ foo ]")
+    def test_set_cmd_nonempty(self, blank_image):
+        blank_image.set_cmd("echo [ foo ]")
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=config.cmd",
-                    "--config.cmd",
-                    "foo",
-                ]
-            ),
-        ]
+        assert _get_runtime_config(blank_image)["Cmd"] == ["foo"]
 
-    def test_set_cmd_nonempty2(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-        image.set_cmd("echo foo [ bar ]")
+    def test_set_cmd_nonempty2(self, blank_image):
+        blank_image.set_cmd("echo foo [ bar ]")
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=config.cmd",
-                    "--config.cmd",
-                    "bar",
-                ]
-            ),
-        ]
+        assert _get_runtime_config(blank_image)["Cmd"] == ["bar"]
 
     @pytest.mark.parametrize(
         ("mock_services", "mock_checks"),
@@ -734,47 +1182,29 @@ class TestImage:
             mock_tag,
             mock_summary,
             mock_description,
-            mock_base_layer_dir,
+            oci.LayerOptions(base_layer=mock_base_layer_dir),
         )
 
         mock_tmpdir.assert_called_once()
-        mock_add_layer.assert_called_once_with(mock_tag, fake_tmpfs)
+        mock_add_layer.assert_called_once_with(
+            mock_tag, fake_tmpfs, oci.LayerOptions(reuse=False)
+        )
         mock_define_pebble_layer.assert_called_once_with(
             fake_tmpfs, mock_base_layer_dir, expected_layer, mock_name
         )
 
-    def test_set_environment(self, mock_run):
-        image = oci.Image("a:b", Path("/c"))
-
-        image.set_environment({"NAME1": "VALUE1", "NAME2": "VALUE2"})
+    def test_set_environment(self, blank_image):
+        blank_image.set_environment({"NAME1": "VALUE1", "NAME2": "VALUE2"})
+        blank_image.set_environment({"NAME2": "VALUE3", "NAME3": "VALUE4"})
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--config.env",
-                    "NAME1=VALUE1",
-                    "--config.env",
-                    "NAME2=VALUE2",
-                ]
-            )
+        assert _get_runtime_config(blank_image)["Env"] == [
+            "NAME1=VALUE1",
+            "NAME2=VALUE3",
+            "NAME3=VALUE4",
         ]
 
-    def test_set_control_data(
-        self,
-        mock_archive_layer,
-        mock_rmtree,
-        mock_mkdir,
-        mock_mkdtemp,
-        mock_run,
-    ):
-        image = oci.Image("a:b", Path("/c"))
-
-        mock_control_data_path = "layer_dir"
-        mock_mkdtemp.return_value = mock_control_data_path
+    def test_set_control_data(self, new_dir):
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="amd64")
 
         now = datetime.datetime.now(datetime.timezone.utc).isoformat()
         metadata = {"name": "rock-name", "version": 1, "created": now}
@@ -783,129 +1213,72 @@ class TestImage:
             n=os.linesep
         )
 
-        mocked_data = {"writes": ""}
-
-        def mock_write(s):
-            mocked_data["writes"] += s
-
-        m = mock_open()
-        with patch("pathlib.Path.open", m):
-            with patch("pathlib.Path.chmod") as local_mock_chmod:
-                m.return_value.write = mock_write
-                image.set_control_data(metadata)
-
-        local_mock_chmod.assert_called_once_with(0o644)
-        assert mocked_data["writes"] == expected
-        mock_mkdtemp.assert_called_once()
-        mock_mkdir.assert_called_once()
-        mock_archive_layer.assert_called_once_with(
-            Path(mock_control_data_path),
-            Path(f"/c/.temp_layer.control_data.{os.getpid()}.tar"),
-        )
-        expected_cmd = [
-            "umoci",
-            "raw",
-            "add-layer",
-            "--image",
-            "/c/a:b",
-            str(f"/c/.temp_layer.control_data.{os.getpid()}.tar"),
-        ]
-        assert mock_run.mock_calls == [
-            call(
-                expected_cmd + ["--history.created_by", " ".join(expected_cmd)],
-            )
-        ]
-        mock_rmtree.assert_called_once_with(Path(mock_control_data_path))
-
-    def test_set_annotations(self, mocker):
-        mocker.patch("rockcraft.utils.get_host_command").return_value = "umoci"
-        mock_run = mocker.patch("subprocess.run")
-        image = oci.Image("a:b", Path("/c"))
-
-        image.set_annotations({"NAME1": "VALUE1", "NAME2": "VALUE2"})
+        image.set_control_data(metadata)
+
+        layout = oci_layout.ImageLayout(Path("c/a"))
+        manifest, config = layout.read_image("b")
+        assert config["history"][-1]["created_by"] == "rockcraft set-control-data"
+        layer_path = layout.blob_path(manifest["layers"][-1]["digest"])
+        with tarfile.open(layer_path, "r:gz") as tar_file:
+            assert tar_file.getnames() == [".rock", ".rock/metadata.yaml"]
+            metadata_member = tar_file.getmember(".rock/metadata.yaml")
+            assert metadata_member.mode == METADATA_FILE_MODE
+            metadata_file = tar_file.extractfile(metadata_member)
+            assert metadata_file is not None
+            assert metadata_file.read().decode() == expected
+        assert os.listdir("c") == ["a"]
+
+    def test_set_control_data_layer_dir(self, new_dir):
+        image, _ = oci.Image.new_oci_image("a@b", image_dir=Path("c"), arch="amd64")
+        layout = oci_layout.ImageLayout(Path("c/a"))
+        manifest_before, _ = layout.read_image("b")
+        Path("layer").mkdir()
+
+        image.set_control_data({"name": "rock-name"}, layer_dir=Path("layer"))
+
+        assert Path("layer/.rock/metadata.yaml").read_text() == "name: rock-name\n"
+        assert layout.read_image("b")[0] == manifest_before
+
+    def test_set_annotations(self, blank_image):
+        blank_image.set_annotations({"NAME1": "VALUE1", "NAME2": 2})
+        blank_image.set_annotations({"NAME1": "VALUE1", "NAME3": "VALUE3"})
+
+        expected = {"NAME1": "VALUE1", "NAME3": "VALUE3"}
+        manifest, config = _get_layout(blank_image).read_image("latest")
+        assert config["config"]["Labels"] == expected
+        assert manifest["annotations"] == expected
+
+    def test_edit_config_single_write(self, blank_image, mocker):
+        layout = _get_layout(blank_image)
+        spy_write = mocker.spy(oci_layout.ImageLayout, "write_image")
+
+        with blank_image.edit_config() as config:
+            config.set_default_user("foo")
+            config.set_entrypoint("svc")
+            config.set_cmd("echo [ bar ]")
+            config.set_environment({"NAME": "VALUE"})
+            config.set_annotations({"KEY": "VALUE"})
+
+        assert spy_write.call_count == 1
+        manifest, config = layout.read_image("latest")
+        assert config["config"] == {
+            "User": "foo",
+            "Entrypoint": ["/bin/pebble", "enter", "--verbose", "--args", "svc"],
+            "Cmd": ["bar"],
+            "Env": ["NAME=VALUE"],
+            "Labels": {"KEY": "VALUE"},
+        }
+        assert manifest["annotations"] == {"KEY": "VALUE"}
 
-        assert mock_run.mock_calls == [
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=config.labels",
-                    "--config.label",
-                    "NAME1=VALUE1",
-                    "--config.label",
-                    "NAME2=VALUE2",
-                ],
-                capture_output=True,
-                check=True,
-                text=True,
-            ),
-            call(
-                [
-                    "umoci",
-                    "config",
-                    "--image",
-                    "/c/a:b",
-                    "--clear=manifest.annotations",
-                    "--manifest.annotation",
-                    "NAME1=VALUE1",
-                    "--manifest.annotation",
-                    "NAME2=VALUE2",
-                ],
-                capture_output=True,
-                check=True,
-                text=True,
-            ),
-        ]
+    def test_edit_config_error(self, blank_image):
+        index_before = _get_layout(blank_image).read_index()
 
-    def test_inject_architecture_variant(self, mock_read_bytes, mock_write_bytes):
-        test_index = {"manifests": [{"digest": "sha256:foomanifest"}]}
-        test_manifest = {"config": {"digest": "sha256:fooconfig"}}
-        test_config = {}
-        mock_read_bytes.side_effect = [
-            json.dumps(test_index),
-            json.dumps(test_manifest),
-            json.dumps(test_config),
-        ]
-        test_variant = "v0"
-
-        new_test_config = {**test_config, **{"variant": test_variant}}
-        new_test_config_bytes = json.dumps(new_test_config).encode("utf-8")
-
-        new_image_config_digest = hashlib.sha256(new_test_config_bytes).hexdigest()
-        new_test_manifest = {
-            **test_manifest,
-            **{
-                "config": {
-                    "digest": f"sha256:{new_image_config_digest}",
-                    "size": len(new_test_config_bytes),
-                }
-            },
-        }
-        new_test_manifest_bytes = json.dumps(new_test_manifest).encode("utf-8")
-        new_test_manifest_digest = hashlib.sha256(new_test_manifest_bytes).hexdigest()
-
-        new_test_index = {
-            **test_index,
-            **{
-                "manifests": [
-                    {
-                        "digest": f"sha256:{new_test_manifest_digest}",
-                        "size": len(new_test_manifest_bytes),
-                    }
-                ]
-            },
-        }
+        with pytest.raises(RuntimeError):
+            with blank_image.edit_config() as config:
+                config.set_default_user("foo")
+                raise RuntimeError("oops")
 
-        # pylint: disable=protected-access
-        oci._inject_architecture_variant(Path("img"), test_variant)
-        assert mock_read_bytes.call_count == 3
-        assert mock_write_bytes.mock_calls == [
-            call(new_test_config_bytes),
-            call(new_test_manifest_bytes),
-            call(json.dumps(new_test_index).encode("utf-8")),
-        ]
+        assert _get_layout(blank_image).read_index() == index_before
 
     def test_stat(self, new_dir, mock_run, mocker):
         image_dir = Path("images/dir")
@@ -930,3 +1303,44 @@ class TestImage:
             )
         ]
         assert mock_loads.called
+
+
+def _make_rock(image_dir, arch, path):
+    image, _ = oci.Image.new_oci_image("rock@1.0", image_dir=image_dir, arch=arch)
+    layout = _get_layout(image)
+    with tarfile.open(path, "w") as tar_file:
+        for name in ("oci-layout", "index.json", "blobs"):
+            tar_file.add(layout.path / name, arcname=name)
+    return path
+
+
+def test_pack_image_index(mock_run, tmp_path):
+    rocks = [
+        _make_rock(tmp_path / arch, arch, tmp_path / f"rock_1.0_{arch}.rock")
+        for arch in ("amd64", "arm64")
+    ]
+    image_dir = tmp_path / "index"
+
+    filename = tmp_path / "rock.rock"
+
+    oci.pack_image_index(rocks, tag="1.0", image_dir=image_dir, filename=str(filename))
+
+    layout = oci_layout.ImageLayout.init(tmp_path / "imported")
+    descriptor = layout.import_archive(filename, "1.0", "1.0")
+    index = layout.read_json_blob(descriptor["digest"])
+    platforms = [manifest["platform"] for manifest in index["manifests"]]
+    assert platforms == [
+        {"architecture": "amd64", "os": "linux"},
+        {"architecture": "arm64", "os": "linux", "variant": "v8"},
+    ]
+    assert not mock_run.called
+
+
+def test_pack_image_index_missing_rock(mock_run, tmp_path):
+    with pytest.raises(errors.RockcraftError, match="not found"):
+        oci.pack_image_index(
+            [tmp_path / "missing.rock"],
+            tag="1.0",
+            image_dir=tmp_path / "index",
+            filename="rock.rock",
+        )
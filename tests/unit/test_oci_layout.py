@@ -0,0 +1,557 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import errno
+import gzip
+import hashlib
+import io
+import json
+import tarfile
+
+import pytest
+from rockcraft import compression, errors, oci_layout
+
+
+@pytest.fixture()
+def layout(tmp_path):
+    layout = oci_layout.ImageLayout.init(tmp_path / "image")
+    layout.create_image("base", architecture="arm64", variant="v8")
+    return layout
+
+
+def _make_tarball(files):
+    tar_bytes = io.BytesIO()
+    with tarfile.open(fileobj=tar_bytes, mode="w") as tar_file:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar_file.addfile(info, io.BytesIO(content))
+    return tar_bytes.getvalue()
+
+
+def test_init(tmp_path):
+    layout = oci_layout.ImageLayout.init(tmp_path / "image")
+
+    assert json.loads((tmp_path / "image/oci-layout").read_text()) == {
+        "imageLayoutVersion": "1.0.0"
+    }
+    assert layout.read_index() == {"schemaVersion": 2, "manifests": []}
+    assert layout.blobs_dir.is_dir()
+
+
+def test_create_image(layout):
+    descriptor = layout.get_descriptor("base")
+    assert descriptor["mediaType"] == oci_layout.MEDIA_TYPE_MANIFEST
+    assert descriptor["annotations"] == {oci_layout.ANNOTATION_REF_NAME: "base"}
+
+    manifest, config = layout.read_image("base")
+    assert manifest["layers"] == []
+    assert manifest["config"]["mediaType"] == oci_layout.MEDIA_TYPE_CONFIG
+    assert config["architecture"] == "arm64"
+    assert config["variant"] == "v8"
+    assert config["os"] == "linux"
+
+
+def test_create_image_reproducible(tmp_path, monkeypatch):
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+
+    descriptors = []
+    for name in ("first", "second"):
+        layout = oci_layout.ImageLayout.init(tmp_path / name)
+        layout.create_image("base", architecture="amd64")
+        with layout.new_layer("base", created_by="test") as layer:
+            layer.write(b"layer")
+        descriptors.append(layout.get_descriptor("base"))
+
+    assert descriptors[0] == descriptors[1]
+    _, config = layout.read_image("base")
+    assert config["created"] == "2023-11-14T22:13:20Z"
+    assert config["history"] == [
+        {"created": "2023-11-14T22:13:20Z", "created_by": "test"}
+    ]
+
+
+def test_write_blob_content_addressed(layout):
+    digest, size = layout.write_blob(b"hello")
+
+    assert digest == f"sha256:{hashlib.sha256(b'hello').hexdigest()}"
+    assert size == len(b"hello")
+    assert layout.blob_path(digest).read_bytes() == b"hello"
+    # Writing the same content again is a no-op
+    assert layout.write_blob(b"hello") == (digest, size)
+    assert not list(layout.blobs_dir.glob(".tmp-blob.*"))
+
+
+def test_blob_writer_write_file(layout, tmp_path):
+    source = tmp_path / "fragment"
+    source.write_bytes(b"world" * 100000)
+
+    writer = layout.blob_writer()
+    writer.write(b"hello")
+    writer.write_file(source)
+    writer.write(b"!")
+    digest, size = writer.commit()
+
+    data = b"hello" + b"world" * 100000 + b"!"
+    assert digest == f"sha256:{hashlib.sha256(data).hexdigest()}"
+    assert size == len(data)
+    assert layout.blob_path(digest).read_bytes() == data
+
+
+def test_blob_path_bad_digest(layout):
+    with pytest.raises(errors.RockcraftError, match="Unsupported blob digest"):
+        layout.blob_path("md5:abc")
+
+
+def test_get_descriptor_missing_tag(layout):
+    with pytest.raises(errors.RockcraftError, match="Tag 'missing' not found"):
+        layout.get_descriptor("missing")
+
+
+def test_set_tag_replaces_entry(layout):
+    descriptor = layout.get_descriptor("base")
+    layout.set_tag("other", descriptor)
+    layout.set_tag("other", descriptor)
+
+    tags = [
+        m["annotations"][oci_layout.ANNOTATION_REF_NAME]
+        for m in layout.read_index()["manifests"]
+    ]
+    assert tags == ["base", "other"]
+
+
+def test_new_layer(layout):
+    tar_bytes = _make_tarball({"foo.txt": b"foo"})
+
+    with layout.new_layer("base", new_tag="new", created_by="test add-layer") as out:
+        # Written in several chunks, as a streaming archiver would
+        out.write(tar_bytes[:100])
+        out.write(tar_bytes[100:])
+
+    manifest, config = layout.read_image("new")
+    (layer,) = manifest["layers"]
+    blob = layout.blob_path(layer["digest"]).read_bytes()
+
+    assert layer["mediaType"] == compression.MEDIA_TYPE_LAYER_GZIP
+    assert layer["size"] == len(blob)
+    assert layer["digest"] == f"sha256:{hashlib.sha256(blob).hexdigest()}"
+    assert gzip.decompress(blob) == tar_bytes
+    assert config["rootfs"]["diff_ids"] == [
+        f"sha256:{hashlib.sha256(tar_bytes).hexdigest()}"
+    ]
+    assert config["history"][0]["created_by"] == "test add-layer"
+    assert config["history"][0]["created"].endswith("Z")
+
+    # The source tag is unchanged
+    manifest, config = layout.read_image("base")
+    assert manifest["layers"] == []
+    assert config["rootfs"]["diff_ids"] == []
+
+
+def test_new_layer_same_tag(layout):
+    names = ("one", "two")
+    for name in names:
+        with layout.new_layer("base") as out:
+            out.write(_make_tarball({name: name.encode()}))
+
+    manifest, config = layout.read_image("base")
+    assert len(manifest["layers"]) == len(names)
+    assert len(config["rootfs"]["diff_ids"]) == len(names)
+    assert len(config["history"]) == len(names)
+    assert len(layout.read_index()["manifests"]) == 1
+
+
+def test_new_layer_error(layout):
+    index_before = layout.read_index()
+    blobs_before = sorted(layout.blobs_dir.iterdir())
+
+    with pytest.raises(RuntimeError):
+        with layout.new_layer("base") as out:
+            out.write(_make_tarball({"foo.txt": b"foo"}))
+            raise RuntimeError("archiving failed")
+
+    # Neither the image nor the blob store were touched
+    assert layout.read_index() == index_before
+    assert sorted(layout.blobs_dir.iterdir()) == blobs_before
+
+
+@pytest.fixture()
+def blob_store(tmp_path):
+    return oci_layout.BlobStore(tmp_path / "store")
+
+
+def _add_layer(layout, tag, files):
+    with layout.new_layer(tag) as out:
+        out.write(_make_tarball(files))
+    manifest, _ = layout.read_image(tag)
+    return manifest["layers"][-1]["digest"]
+
+
+def test_new_layer_shared(tmp_path, blob_store):
+    layouts = []
+    for name in ("one", "two"):
+        layout = oci_layout.ImageLayout.init(tmp_path / name, blob_store=blob_store)
+        layout.create_image("base", architecture="amd64")
+        layouts.append(layout)
+
+    digests = [_add_layer(layout, "base", {"foo.txt": b"foo"}) for layout in layouts]
+
+    # Identical layers are stored once, and linked from both layouts
+    assert digests[0] == digests[1]
+    store_path = blob_store.blob_path(digests[0])
+    assert store_path.stat().st_nlink == len(layouts) + 1
+    for layout in layouts:
+        assert layout.blob_path(digests[0]).samefile(store_path)
+
+
+def test_link_shared_blobs(tmp_path, blob_store, layout):
+    layout.blob_store = blob_store
+    digest = _add_layer(layout, "base", {"foo.txt": b"foo"})
+
+    other = oci_layout.ImageLayout(tmp_path / "other", blob_store=blob_store)
+    linked = other.link_shared_blobs([digest, "sha256:" + "0" * 64])
+
+    assert linked == [digest]
+    assert other.blob_path(digest).samefile(blob_store.blob_path(digest))
+    # Blobs already in the layout are not linked again
+    assert other.link_shared_blobs([digest]) == []
+
+
+def test_link_shared_blobs_cross_device(mocker, tmp_path, blob_store, layout):
+    layout.blob_store = blob_store
+    digest = _add_layer(layout, "base", {"foo.txt": b"foo"})
+    mocker.patch("os.link", side_effect=OSError(errno.EXDEV, "cross-device link"))
+
+    other = oci_layout.ImageLayout(tmp_path / "other", blob_store=blob_store)
+    assert other.link_shared_blobs([digest]) == [digest]
+
+    # The blob was copied instead
+    blob = other.blob_path(digest)
+    assert blob.read_bytes() == blob_store.blob_path(digest).read_bytes()
+    assert not blob.samefile(blob_store.blob_path(digest))
+    assert not list(other.blobs_dir.glob(".tmp-*"))
+
+
+def test_cache_layer(blob_store, layout):
+    layout.blob_store = blob_store
+    digest = _add_layer(layout, "base", {"foo.txt": b"foo"})
+    manifest, config = layout.read_image("base")
+    assert blob_store.get_cached_layer("key") is None
+
+    blob_store.cache_layer(
+        "key", manifest["layers"][0], config["rootfs"]["diff_ids"][0]
+    )
+
+    cached = blob_store.get_cached_layer("key")
+    assert cached is not None
+    assert cached.descriptor == manifest["layers"][0]
+    assert cached.diff_id == config["rootfs"]["diff_ids"][0]
+    assert blob_store.get_cached_layer("other") is None
+
+    # Records of layers whose blob is gone are ignored
+    blob_store.blob_path(digest).unlink()
+    assert blob_store.get_cached_layer("key") is None
+
+
+def test_cache_image(tmp_path, blob_store, layout):
+    layout.blob_store = blob_store
+    _add_layer(layout, "base", {"foo.txt": b"foo"})
+    assert blob_store.get_cached_image("docker://foo:1") is None
+
+    cached = blob_store.cache_image("docker://foo:1", "sha256:abc", layout, "base")
+
+    assert blob_store.get_cached_image("docker://foo:1") == cached
+    assert blob_store.get_cached_image("docker://foo:2") is None
+    assert cached.digest == "sha256:abc"
+    assert cached.blobs == layout.image_blobs("base")
+    for blob in cached.blobs:
+        assert blob_store.blob_path(blob).samefile(layout.blob_path(blob))
+
+    # The cached image can be restored in another layout
+    other = oci_layout.ImageLayout.open(tmp_path / "other")
+    assert blob_store.restore_image(cached, other, "restored")
+    assert other.read_image("restored") == layout.read_image("base")
+
+
+def test_restore_image_missing_blob(tmp_path, blob_store, layout):
+    layout.blob_store = blob_store
+    _add_layer(layout, "base", {"foo.txt": b"foo"})
+    cached = blob_store.cache_image("docker://foo:1", "sha256:abc", layout, "base")
+    blob_store.blob_path(cached.blobs[-1]).unlink()
+
+    other = oci_layout.ImageLayout.open(tmp_path / "other")
+    assert not blob_store.restore_image(cached, other, "restored")
+    assert other.read_index()["manifests"] == []
+
+
+def test_mark_validated(mocker, blob_store, layout):
+    cached_at, validated_at = 100.0, 200.0
+    mocker.patch("time.time", return_value=cached_at)
+    cached = blob_store.cache_image("docker://foo:1", "sha256:abc", layout, "base")
+    mocker.patch("time.time", return_value=validated_at)
+
+    blob_store.mark_validated(cached)
+
+    assert cached.validated == cached_at
+    assert blob_store.get_cached_image("docker://foo:1").validated == validated_at
+
+
+def test_prune_blobs(layout):
+    original_blobs = layout.image_blobs("base")
+    layer = _add_layer(layout, "base", {"foo.txt": b"foo"})
+    unreferenced, _ = layout.write_blob(b"unreferenced")
+
+    # The unreferenced blob goes, as well as the manifest and config of the
+    # image before the layer was added.
+    removed = layout.prune_blobs()
+    assert sorted(removed) == sorted([unreferenced, *original_blobs])
+
+    manifest, _ = layout.read_image("base")
+    reachable = layout.reachable_blobs()
+    assert reachable == {
+        layout.get_descriptor("base")["digest"],
+        manifest["config"]["digest"],
+        layer,
+    }
+    assert {f"sha256:{blob.name}" for blob in layout.blobs_dir.iterdir()} == reachable
+
+
+def test_copy_image_reflink(mocker, tmp_path, layout):
+    """Blobs are reflinked when they cannot be hardlinked."""
+    mocker.patch("os.link", side_effect=OSError(errno.EXDEV, "cross-device link"))
+    mock_ioctl = mocker.patch("fcntl.ioctl")
+    destination = oci_layout.ImageLayout.open(tmp_path / "other")
+
+    layout.copy_image("base", destination, "copy")
+
+    assert mock_ioctl.call_count == len(layout.image_blobs("base"))
+    assert mock_ioctl.call_args.args[1] == oci_layout._FICLONE
+    assert destination.get_descriptor("copy")["digest"] == (
+        layout.get_descriptor("base")["digest"]
+    )
+
+
+def test_copy_image_copy_fallback(mocker, tmp_path, layout):
+    mocker.patch("os.link", side_effect=OSError(errno.EXDEV, "cross-device link"))
+    mocker.patch("fcntl.ioctl", side_effect=OSError(errno.EOPNOTSUPP, "no reflinks"))
+    destination = oci_layout.ImageLayout.open(tmp_path / "other")
+
+    layout.copy_image("base", destination, "copy")
+
+    manifest, config = destination.read_image("copy")
+    assert (manifest, config) == layout.read_image("base")
+    assert not list(destination.blobs_dir.glob(".tmp-*"))
+
+
+def test_open(tmp_path, layout):
+    assert oci_layout.ImageLayout.open(layout.path).read_index() == layout.read_index()
+
+    new_layout = oci_layout.ImageLayout.open(tmp_path / "new")
+    assert new_layout.read_index() == {"schemaVersion": 2, "manifests": []}
+
+
+def _make_archive(layout, path):
+    with tarfile.open(path, "w") as tar_file:
+        for name in ("oci-layout", "index.json", "blobs"):
+            tar_file.add(layout.path / name, arcname=name)
+    return path
+
+
+def test_create_index(tmp_path, layout):
+    layout.create_image("other", architecture="amd64")
+
+    descriptor = layout.create_index("multi", ["base", "other"])
+
+    assert descriptor["mediaType"] == oci_layout.MEDIA_TYPE_INDEX
+    assert layout.get_descriptor("multi")["digest"] == descriptor["digest"]
+    index = layout.read_json_blob(descriptor["digest"])
+    assert index["mediaType"] == oci_layout.MEDIA_TYPE_INDEX
+    assert index["manifests"] == [
+        {
+            "mediaType": oci_layout.MEDIA_TYPE_MANIFEST,
+            "digest": layout.get_descriptor("base")["digest"],
+            "size": layout.get_descriptor("base")["size"],
+            "platform": {"architecture": "arm64", "os": "linux", "variant": "v8"},
+        },
+        {
+            "mediaType": oci_layout.MEDIA_TYPE_MANIFEST,
+            "digest": layout.get_descriptor("other")["digest"],
+            "size": layout.get_descriptor("other")["size"],
+            "platform": {"architecture": "amd64", "os": "linux"},
+        },
+    ]
+    # The images are reachable through the index
+    assert set(layout.image_blobs("other")) <= layout.reachable_blobs()
+
+
+def test_create_index_same_platform(layout):
+    _add_layer(layout, "base", {"foo.txt": b"foo"})
+    layout.create_image("other", architecture="arm64", variant="v8")
+
+    with pytest.raises(errors.RockcraftError, match="several images for platform"):
+        layout.create_index("multi", ["base", "other"])
+
+
+def test_import_archive(tmp_path, layout):
+    layer = _add_layer(layout, "base", {"foo.txt": b"foo"})
+    archive = _make_archive(layout, tmp_path / "base.rock")
+    destination = oci_layout.ImageLayout.init(tmp_path / "other")
+    destination.create_image("other", architecture="amd64")
+    with destination.new_layer("other") as out:
+        out.write(_make_tarball({"foo.txt": b"foo"}))
+    shared = destination.blob_path(layer)
+    shared_inode = shared.stat().st_ino
+
+    descriptor = destination.import_archive(archive, "base", "imported")
+
+    assert descriptor == layout.get_descriptor("base")
+    assert destination.read_image("imported") == layout.read_image("base")
+    # The blob already in the layout was kept
+    assert shared.stat().st_ino == shared_inode
+    assert not list(destination.blobs_dir.glob(".tmp-*"))
+
+
+def test_import_archive_missing_tag(tmp_path, layout):
+    archive = _make_archive(layout, tmp_path / "base.rock")
+    destination = oci_layout.ImageLayout.init(tmp_path / "other")
+
+    with pytest.raises(errors.RockcraftError, match="Tag 'missing' not found"):
+        destination.import_archive(archive, "missing", "imported")
+
+
+def test_import_archive_corrupted(tmp_path, layout):
+    digest = _add_layer(layout, "base", {"foo.txt": b"foo"})
+    layout.blob_path(digest).write_bytes(b"corrupted")
+    archive = _make_archive(layout, tmp_path / "base.rock")
+    destination = oci_layout.ImageLayout.init(tmp_path / "other")
+
+    with pytest.raises(errors.RockcraftError, match=f"Blob {digest} in .* corrupted"):
+        destination.import_archive(archive, "base", "imported")
+    assert not list(destination.blobs_dir.glob(".tmp-*"))
+
+
+def test_archive_reader(tmp_path, layout):
+    layer = _add_layer(layout, "base", {"foo.txt": b"foo" * 1000})
+    archive = oci_layout.ArchiveReader(_make_archive(layout, tmp_path / "base.rock"))
+
+    assert archive.get_descriptor() == layout.get_descriptor("base")
+    assert archive.get_descriptor("base") == layout.get_descriptor("base")
+    content = layout.blob_path(layer).read_bytes()
+    assert archive.get_blob_size(layer) == len(content)
+    assert archive.read_blob(layer) == content
+    assert archive.read_blob(layer, 10, 20) == content[10:30]
+    assert archive.read_blob(layer, len(content) - 5, 20) == content[-5:]
+    with pytest.raises(errors.RockcraftError, match="Tag 'missing' not found"):
+        archive.get_descriptor("missing")
+    with pytest.raises(errors.RockcraftError, match="Blob sha256:0+ not found"):
+        archive.read_blob("sha256:" + "0" * 64)
+
+
+def test_archive_reader_not_an_archive(tmp_path):
+    (tmp_path / "base.rock").write_bytes(b"not a tarball")
+
+    with pytest.raises(errors.RockcraftError, match="Cannot read"):
+        oci_layout.ArchiveReader(tmp_path / "base.rock")
+
+
+def test_export_archive(tmp_path, layout):
+    layer = _add_layer(layout, "base", {"foo.txt": b"foo" * 1000})
+    layout.create_image("other", architecture="amd64")
+    layout.write_blob(b"unreferenced")
+
+    layout.export_archive("base", tmp_path / "base.rock")
+
+    with tarfile.open(tmp_path / "base.rock") as tar_file:
+        names = tar_file.getnames()
+        index = json.load(tar_file.extractfile("index.json"))
+        blob = tar_file.extractfile(f"blobs/sha256/{layer.split(':')[1]}").read()
+    assert names[:4] == ["oci-layout", "index.json", "blobs", "blobs/sha256"]
+    assert sorted(names[4:]) == sorted(
+        f"blobs/sha256/{digest.split(':')[1]}" for digest in layout.image_blobs("base")
+    )
+    assert index == {"schemaVersion": 2, "manifests": [layout.get_descriptor("base")]}
+    assert blob == layout.blob_path(layer).read_bytes()
+    assert (tmp_path / "base.rock").stat().st_size % tarfile.RECORDSIZE == 0
+
+    # The archive can be read back
+    other = oci_layout.ImageLayout.init(tmp_path / "other")
+    other.import_archive(tmp_path / "base.rock", "base", "imported")
+    assert other.read_image("imported") == layout.read_image("base")
+
+
+def test_export_archive_index(tmp_path, layout):
+    layout.create_image("other", architecture="amd64")
+    layout.create_index("multi", ["base", "other"])
+
+    layout.export_archive("multi", tmp_path / "multi.rock")
+
+    with tarfile.open(tmp_path / "multi.rock") as tar_file:
+        names = set(tar_file.getnames())
+    assert names >= {
+        f"blobs/sha256/{digest.split(':')[1]}"
+        for digest in layout.image_blobs("base") + layout.image_blobs("other")
+    }
+
+
+@pytest.mark.parametrize(
+    "unsupported", [["os.copy_file_range"], ["os.copy_file_range", "os.sendfile"]]
+)
+def test_export_archive_copy_fallback(mocker, tmp_path, layout, unsupported):
+    layer = _add_layer(layout, "base", {"foo.txt": b"foo"})
+    for name in unsupported:
+        mocker.patch(name, side_effect=OSError(errno.EXDEV, "unsupported"))
+
+    layout.export_archive("base", tmp_path / "base.rock")
+
+    with tarfile.open(tmp_path / "base.rock") as tar_file:
+        blob = tar_file.extractfile(f"blobs/sha256/{layer.split(':')[1]}").read()
+    assert blob == layout.blob_path(layer).read_bytes()
+
+
+def test_export_archive_error(mocker, tmp_path, layout):
+    mocker.patch("os.copy_file_range", side_effect=OSError(errno.EIO, "I/O error"))
+
+    with pytest.raises(OSError, match="I/O error"):
+        layout.export_archive("base", tmp_path / "base.rock")
+    assert list(tmp_path.glob("*base.rock*")) == []
+
+
+def test_export_archive_docker(tmp_path, layout):
+    layer = _add_layer(layout, "base", {"foo.txt": b"foo"})
+    archive = layout.get_archive("base", repo_tag="rock:1.0")
+
+    layout.export_archive("base", tmp_path / "base.rock", repo_tag="rock:1.0")
+
+    assert (tmp_path / "base.rock").stat().st_size == archive.size
+    with tarfile.open(tmp_path / "base.rock") as tar_file:
+        manifest = json.load(tar_file.extractfile("manifest.json"))
+        names = set(tar_file.getnames())
+    image_manifest, _ = layout.read_image("base")
+    assert manifest == [
+        {
+            "Config": f"blobs/sha256/{image_manifest['config']['digest'][7:]}",
+            "RepoTags": ["rock:1.0"],
+            "Layers": [f"blobs/sha256/{layer[7:]}"],
+        }
+    ]
+    assert {manifest[0]["Config"], *manifest[0]["Layers"]} <= names
+
+
+def test_export_archive_docker_index(tmp_path, layout):
+    layout.create_image("other", architecture="amd64")
+    layout.create_index("multi", ["base", "other"])
+
+    with pytest.raises(errors.RockcraftError, match="multi-platform"):
+        layout.export_archive("multi", tmp_path / "multi.rock", repo_tag="rock:1.0")
@@ -24,6 +24,7 @@ from craft_application.errors import CraftValidationError
 
 import tests
 from rockcraft.pebble import Check, ExecCheck, HttpCheck, Pebble, Service, TcpCheck
+from tests.unit.testing.base_index import index_directory
 
 
 @tests.linux_only
@@ -187,6 +188,23 @@ class TestPebble:
                 for field in service_fields:
                     check.is_not_in("_", field)
 
+    def test_define_pebble_layer_ref_index(self, tmp_path):
+        base_layers_dir = tmp_path / "base" / Pebble.PEBBLE_LAYERS_PATH
+        base_layers_dir.mkdir(parents=True)
+        for layer in ["001-base.yaml", "002-other.yml", "3-bad-layer.yaml"]:
+            (base_layers_dir / layer).touch()
+        ref_index = index_directory(tmp_path / "base")
+
+        Pebble().define_pebble_layer(
+            tmp_path / "target",
+            ref_index,
+            {"summary": "mock summary"},
+            "my-rock",
+        )
+
+        new_layers_dir = tmp_path / "target" / Pebble.PEBBLE_LAYERS_PATH
+        assert os.listdir(new_layers_dir) == ["003-my-rock.yaml"]
+
     @pytest.mark.parametrize(
         "service",
         [
@@ -312,6 +312,67 @@ def test_project_entrypoint_service_absent(yaml_loaded_data):
     assert project.entrypoint_service is None
 
 
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_project_compression(yaml_loaded_data, compression):
+    yaml_loaded_data["compression"] = compression
+    project = Project.unmarshal(yaml_loaded_data)
+    assert project.compression == compression
+
+
+def test_project_compression_absent(yaml_loaded_data):
+    project = Project.unmarshal(yaml_loaded_data)
+    assert project.compression is None
+
+
+def test_project_compression_invalid(yaml_loaded_data):
+    yaml_loaded_data["compression"] = "xz"
+
+    with pytest.raises(CraftValidationError) as err:
+        load_project_yaml(yaml_loaded_data)
+    assert str(err.value) == (
+        "Bad rockcraft.yaml content:\n"
+        "- unexpected value; permitted: 'gzip', 'zstd', 'none' (in field 'compression')"
+    )
+
+
+@pytest.mark.parametrize("metadata_layers", ["separate", "single"])
+def test_project_metadata_layers(yaml_loaded_data, metadata_layers):
+    yaml_loaded_data["metadata-layers"] = metadata_layers
+    project = Project.unmarshal(yaml_loaded_data)
+    assert project.metadata_layers == metadata_layers
+
+
+@pytest.mark.parametrize(
+    "prime_layers",
+    ["single", "per-part", [{"parts": ["foo"]}, {"paths": ["usr/lib/*"]}]],
+)
+def test_project_prime_layers(yaml_loaded_data, prime_layers):
+    yaml_loaded_data["prime-layers"] = prime_layers
+    project = Project.unmarshal(yaml_loaded_data)
+    if isinstance(prime_layers, list):
+        assert [layer.dict() for layer in project.prime_layers] == [
+            {"parts": ["foo"], "paths": None},
+            {"parts": None, "paths": ["usr/lib/*"]},
+        ]
+    else:
+        assert project.prime_layers == prime_layers
+
+
+@pytest.mark.parametrize(
+    ("prime_layers", "message"),
+    [
+        ([{"parts": ["bar"]}], "Unknown parts in prime-layers: bar"),
+        ([{}], "Each of the prime-layers must have 'parts' or 'paths'."),
+    ],
+)
+def test_project_prime_layers_invalid(yaml_loaded_data, prime_layers, message):
+    yaml_loaded_data["prime-layers"] = prime_layers
+
+    with pytest.raises(CraftValidationError) as err:
+        load_project_yaml(yaml_loaded_data)
+    assert message in str(err.value)
+
+
 def test_project_build_base(yaml_loaded_data):
     yaml_loaded_data["build-base"] = "ubuntu@22.04"
 
@@ -0,0 +1,367 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import pytest
+from rockcraft import errors, oci_layout, registry
+
+from tests.unit.testing.registry import FakeRegistry
+
+INDEX = {
+    "schemaVersion": 2,
+    "mediaType": oci_layout.MEDIA_TYPE_INDEX,
+    "manifests": [],
+}
+
+
+@pytest.mark.parametrize(
+    ("host", "url"),
+    [
+        ("localhost:5000", "http://localhost:5000"),
+        ("127.0.0.1:5000", "http://127.0.0.1:5000"),
+        ("public.ecr.aws", "https://public.ecr.aws"),
+        ("registry.example.com:443", "https://registry.example.com:443"),
+    ],
+)
+def test_from_host(host, url):
+    assert registry.Registry.from_host(host).url == url
+
+
+def test_get_digest(fake_registry):
+    digest = fake_registry.add_manifest(
+        "ubuntu/ubuntu", "22.04", INDEX, oci_layout.MEDIA_TYPE_INDEX
+    )
+    client = registry.Registry.from_host(fake_registry.host)
+
+    assert client.get_digest("ubuntu/ubuntu", "22.04") == digest
+    # Only the headers are requested
+    assert fake_registry.requests == [("HEAD", "/v2/ubuntu/ubuntu/manifests/22.04")]
+
+
+def test_get_manifest(fake_registry):
+    digest = fake_registry.add_manifest(
+        "ubuntu/ubuntu", "22.04", INDEX, oci_layout.MEDIA_TYPE_INDEX
+    )
+    client = registry.Registry.from_host(fake_registry.host)
+
+    assert client.get_manifest("ubuntu/ubuntu", "22.04") == (digest, INDEX)
+    assert client.get_manifest("ubuntu/ubuntu", digest) == (digest, INDEX)
+
+
+def test_token_authentication():
+    with FakeRegistry(require_token=True) as fake_registry:
+        digest = fake_registry.add_manifest(
+            "ubuntu/ubuntu", "22.04", INDEX, oci_layout.MEDIA_TYPE_INDEX
+        )
+        client = registry.Registry.from_host(fake_registry.host)
+
+        assert client.get_digest("ubuntu/ubuntu", "22.04") == digest
+        assert client.get_digest("ubuntu/ubuntu", "22.04") == digest
+
+    # The token is requested once, and then reused
+    assert fake_registry.requests == [
+        ("HEAD", "/v2/ubuntu/ubuntu/manifests/22.04"),
+        ("GET", "/token?scope=repository%3Aubuntu%2Fubuntu%3Apull&service=fake"),
+        ("HEAD", "/v2/ubuntu/ubuntu/manifests/22.04"),
+        ("HEAD", "/v2/ubuntu/ubuntu/manifests/22.04"),
+    ]
+
+
+def test_not_found(fake_registry):
+    client = registry.Registry.from_host(fake_registry.host)
+
+    with pytest.raises(errors.RegistryError) as raised:
+        client.get_digest("ubuntu/ubuntu", "missing")
+
+    assert str(raised.value) == (
+        f"Failed to get ubuntu/ubuntu/manifests/missing from http://{fake_registry.host}"
+    )
+    assert raised.value.details == "The registry replied: 404 Not Found"
+
+
+def test_unreachable():
+    client = registry.Registry("http://127.0.0.1:1")
+
+    with pytest.raises(errors.RegistryError, match="Failed to access image registry"):
+        client.get_digest("ubuntu/ubuntu", "22.04")
+
+
+def test_download_blob(fake_registry, tmp_path):
+    data = b"blob" * 1000
+    digest = fake_registry.add_blob(data)
+    client = registry.Registry.from_host(fake_registry.host)
+
+    client.download_blob("ubuntu/ubuntu", digest, tmp_path / "blob", size=len(data))
+
+    assert (tmp_path / "blob").read_bytes() == data
+    assert fake_registry.ranges == [None]
+
+
+def test_download_blob_resume(fake_registry, tmp_path):
+    data = b"blob" * 1000
+    digest = fake_registry.add_blob(data)
+    fake_registry.interruptions[digest] = 1000
+    client = registry.Registry.from_host(fake_registry.host)
+
+    with pytest.raises(errors.RegistryError, match="Interrupted download"):
+        client.download_blob("ubuntu/ubuntu", digest, tmp_path / "blob", size=None)
+    assert (tmp_path / "blob").read_bytes() == data[:1000]
+
+    client.download_blob("ubuntu/ubuntu", digest, tmp_path / "blob", size=None)
+
+    assert (tmp_path / "blob").read_bytes() == data
+    assert fake_registry.ranges == [None, "bytes=1000-"]
+
+
+def test_download_blob_digest_mismatch(fake_registry, tmp_path):
+    digest = fake_registry.add_blob(b"blob")
+    fake_registry.blobs[digest] = b"tampered"
+    client = registry.Registry.from_host(fake_registry.host)
+
+    with pytest.raises(errors.RegistryError, match="Digest mismatch for blob"):
+        client.download_blob("ubuntu/ubuntu", digest, tmp_path / "blob", size=None)
+    assert not (tmp_path / "blob").exists()
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_pull_image(fake_registry, monkeypatch, tmp_path, shared):
+    monkeypatch.setattr(registry, "RETRY_DELAY", 0)
+    layers = [b"layer %d" % i * 1000 for i in range(6)]
+    digest = fake_registry.add_image(
+        "ubuntu/ubuntu", "22.04", layers, [("amd64", None), ("arm64", "v8")]
+    )
+    # An interrupted download is resumed from where it stopped
+    fake_registry.interruptions[fake_registry.add_blob(layers[2])] = 100
+    blob_store = oci_layout.BlobStore(tmp_path / "store") if shared else None
+    layout = oci_layout.ImageLayout.init(tmp_path / "layout", blob_store=blob_store)
+    client = registry.Registry.from_host(fake_registry.host)
+
+    pulled = registry.pull_image(
+        registry.RemoteImage(client, "ubuntu/ubuntu", "22.04"),
+        layout,
+        "base",
+        architecture="arm64",
+    )
+
+    assert pulled == digest
+    manifest, config = layout.read_image("base")
+    assert config["architecture"] == "arm64"
+    assert [
+        layout.blob_path(layer["digest"]).read_bytes() for layer in manifest["layers"]
+    ] == layers
+    assert "bytes=100-" in fake_registry.ranges
+    assert not list(layout.blobs_dir.glob(".*"))
+    if blob_store is not None:
+        assert blob_store.has_blob(manifest["layers"][0]["digest"])
+
+    # Blobs already in the layout are not downloaded again
+    fake_registry.requests.clear()
+    registry.pull_image(
+        registry.RemoteImage(client, "ubuntu/ubuntu", "22.04"),
+        layout,
+        "base",
+        architecture="arm64",
+    )
+    assert not any("/blobs/" in path for _, path in fake_registry.requests)
+
+
+def test_pull_image_docker_manifest(fake_registry, tmp_path):
+    config = fake_registry.add_blob(b"{}")
+    layer = fake_registry.add_blob(b"layer")
+    manifest = {
+        "schemaVersion": 2,
+        "mediaType": registry.MEDIA_TYPE_DOCKER_MANIFEST,
+        "config": {
+            "mediaType": "application/vnd.docker.container.image.v1+json",
+            "digest": config,
+            "size": 2,
+        },
+        "layers": [
+            {
+                "mediaType": "application/vnd.docker.image.rootfs.diff.tar.gzip",
+                "digest": layer,
+                "size": 5,
+            }
+        ],
+    }
+    fake_registry.add_manifest(
+        "ubuntu/ubuntu", "22.04", manifest, registry.MEDIA_TYPE_DOCKER_MANIFEST
+    )
+    layout = oci_layout.ImageLayout.init(tmp_path / "layout")
+    client = registry.Registry.from_host(fake_registry.host)
+
+    registry.pull_image(
+        registry.RemoteImage(client, "ubuntu/ubuntu", "22.04"),
+        layout,
+        "base",
+        architecture="amd64",
+    )
+
+    pulled, _ = layout.read_image("base")
+    assert pulled["mediaType"] == oci_layout.MEDIA_TYPE_MANIFEST
+    assert pulled["config"]["mediaType"] == oci_layout.MEDIA_TYPE_CONFIG
+    assert pulled["layers"] == [
+        {
+            "mediaType": "application/vnd.oci.image.layer.v1.tar+gzip",
+            "digest": layer,
+            "size": 5,
+        }
+    ]
+
+
+def test_pull_image_no_platform(fake_registry, tmp_path):
+    fake_registry.add_image("ubuntu/ubuntu", "22.04", [b"layer"], [("amd64", None)])
+    layout = oci_layout.ImageLayout.init(tmp_path / "layout")
+    client = registry.Registry.from_host(fake_registry.host)
+
+    with pytest.raises(errors.RegistryError, match="No image for s390x"):
+        registry.pull_image(
+            registry.RemoteImage(client, "ubuntu/ubuntu", "22.04"),
+            layout,
+            "base",
+            architecture="s390x",
+        )
+
+
+def _create_rock(layout, base_tag, tag, layer, path):
+    """Export the image tagged ``base_tag`` with one more layer as a rock."""
+    manifest, config = layout.read_image(base_tag)
+    digest, size = layout.write_blob(layer)
+    manifest["layers"].append(
+        {
+            "mediaType": manifest["layers"][0]["mediaType"],
+            "digest": digest,
+            "size": size,
+        }
+    )
+    layout.write_image(tag, manifest, config)
+    layout.export_archive(tag, path)
+    return oci_layout.ArchiveReader(path)
+
+
+def test_push_image(fake_registry, monkeypatch, tmp_path):
+    monkeypatch.setattr(registry, "UPLOAD_CHUNK_SIZE", 1000)
+    fake_registry.add_image("ubuntu/ubuntu", "22.04", [b"base"], [("amd64", None)])
+    blob_store = oci_layout.BlobStore(tmp_path / "store")
+    layout = oci_layout.ImageLayout.init(tmp_path / "layout", blob_store=blob_store)
+    client = registry.Registry.from_host(fake_registry.host)
+    registry.pull_image(
+        registry.RemoteImage(client, "ubuntu/ubuntu", "22.04"),
+        layout,
+        "base",
+        architecture="amd64",
+    )
+    archive = _create_rock(layout, "base", "1.0", b"new" * 1000, tmp_path / "a.rock")
+    fake_registry.requests.clear()
+
+    digest = registry.push_image(
+        registry.RemoteImage(client, "me/rock", "1.0"),
+        archive,
+        archive.get_descriptor(),
+        blob_store=blob_store,
+    )
+
+    assert fake_registry.manifests[("me/rock", "1.0")][1] == archive.read_blob(digest)
+    manifest = archive.read_json_blob(digest)
+    blobs = [manifest["config"], *manifest["layers"]]
+    methods = [method for method, _ in fake_registry.requests]
+    # The base layer is mounted, the config and new layer uploaded in chunks
+    assert methods.count("HEAD") == len(blobs)
+    assert methods.count("POST") == len(blobs)
+    assert methods.count("PATCH") == 1 + 3
+    assert ("PUT", "/v2/me/rock/manifests/1.0") == fake_registry.requests[-1]
+    assert any("mount=" in path for method, path in fake_registry.requests)
+    for blob in blobs:
+        assert fake_registry.has_blob("me/rock", blob["digest"])
+
+    # Blobs already in the repository are skipped
+    fake_registry.requests.clear()
+    registry.push_image(
+        registry.RemoteImage(client, "me/rock", "1.0"),
+        archive,
+        archive.get_descriptor(),
+    )
+    methods = [method for method, _ in fake_registry.requests]
+    assert methods == ["HEAD"] * len(blobs) + ["PUT"]
+
+
+def test_push_image_index(fake_registry, tmp_path):
+    layout = oci_layout.ImageLayout.init(tmp_path / "layout")
+    layer, size = layout.write_blob(b"layer")
+    tags = []
+    for architecture in ("amd64", "arm64"):
+        layout.create_image(architecture, architecture=architecture)
+        manifest, config = layout.read_image(architecture)
+        manifest["layers"] = [{"mediaType": "x", "digest": layer, "size": size}]
+        layout.write_image(architecture, manifest, config)
+        tags.append(architecture)
+    layout.create_index("1.0", tags)
+    layout.export_archive("1.0", tmp_path / "multi.rock")
+    archive = oci_layout.ArchiveReader(tmp_path / "multi.rock")
+    client = registry.Registry.from_host(fake_registry.host)
+    # Mounts are only attempted from repositories known to have the blobs
+    fake_registry.mounts_disabled = True
+
+    digest = registry.push_image(
+        registry.RemoteImage(client, "me/rock", "1.0"),
+        archive,
+        archive.get_descriptor(),
+    )
+
+    index = archive.read_json_blob(digest)
+    puts = [path for method, path in fake_registry.requests if method == "PUT"]
+    # The shared layer is uploaded once, and the index put after its manifests
+    assert puts[-3:] == [
+        *(f"/v2/me/rock/manifests/{entry['digest']}" for entry in index["manifests"]),
+        "/v2/me/rock/manifests/1.0",
+    ]
+    assert len(puts) == 3 + 3
+    assert fake_registry.has_blob("me/rock", layer)
+
+
+def test_push_image_upload_retried(fake_registry, monkeypatch, tmp_path):
+    monkeypatch.setattr(registry, "RETRY_DELAY", 0)
+    layout = oci_layout.ImageLayout.init(tmp_path / "layout")
+    layout.create_image("1.0", architecture="amd64")
+    layout.export_archive("1.0", tmp_path / "a.rock")
+    archive = oci_layout.ArchiveReader(tmp_path / "a.rock")
+    client = registry.Registry.from_host(fake_registry.host)
+    upload_blob = client.upload_blob
+    failures = [errors.RegistryError("Failed to push")]
+
+    def _flaky_upload(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return upload_blob(*args, **kwargs)
+
+    monkeypatch.setattr(client, "upload_blob", _flaky_upload)
+
+    registry.push_image(
+        registry.RemoteImage(client, "me/rock", "1.0"),
+        archive,
+        archive.get_descriptor(),
+    )
+
+    assert ("me/rock", "1.0") in fake_registry.manifests
+
+
+def test_upload_blob_digest_mismatch(fake_registry):
+    client = registry.Registry.from_host(fake_registry.host)
+
+    with pytest.raises(errors.RegistryError, match="Failed to push to me/rock"):
+        client.upload_blob(
+            "me/rock",
+            {"digest": oci_layout.sha256_digest(b"data"), "size": 5},
+            lambda offset, size: b"other"[offset : offset + size],
+        )
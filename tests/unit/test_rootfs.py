@@ -0,0 +1,136 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import errno
+import os
+from pathlib import Path
+
+import pytest
+from rockcraft import rootfs
+from rockcraft.base_index import BaseIndex, Entry
+
+# The permissions and modification time of files in the ``tree`` fixture.
+TOOL_MODE = 0o755
+PROC_MODE = 0o555
+USR_MTIME = 1000
+
+
+def _unpack(path):
+    (path / "rootfs/etc").mkdir(parents=True)
+    (path / "rootfs/etc/hostname").write_text("base")
+    (path / "config.json").write_text("{}")
+
+
+@pytest.fixture()
+def cache(tmp_path):
+    return rootfs.RootfsCache(tmp_path / "cache")
+
+
+def test_get_bundle(mocker, cache):
+    unpack = mocker.Mock(side_effect=_unpack)
+
+    paths = [cache.get_bundle("abc-amd64", unpack) for _ in range(2)]
+
+    # Only unpacked the first time
+    assert unpack.call_count == 1
+    assert paths == [cache.bundle_path("abc-amd64")] * 2
+    assert (paths[0] / "rootfs/etc/hostname").read_text() == "base"
+    assert os.listdir(cache.path) == ["abc-amd64"]
+
+
+def test_get_bundle_error(cache):
+    def failing_unpack(path):
+        _unpack(path)
+        raise RuntimeError("unpack failed")
+
+    with pytest.raises(RuntimeError):
+        cache.get_bundle("abc-amd64", failing_unpack)
+
+    # Nothing partially unpacked is left behind
+    assert os.listdir(cache.path) == []
+
+
+def test_get_bundle_concurrent(cache):
+    def racing_unpack(path):
+        _unpack(path)
+        _unpack(cache.bundle_path("abc-amd64"))
+        (cache.bundle_path("abc-amd64") / "winner").touch()
+
+    path = cache.get_bundle("abc-amd64", racing_unpack)
+
+    assert (path / "winner").exists()
+    assert os.listdir(cache.path) == ["abc-amd64"]
+
+
+def test_get_index(mocker, cache):
+    index = BaseIndex({"etc": Entry("dir", 0o755, 0, 0)})
+    build = mocker.Mock(return_value=index)
+
+    indexes = [cache.get_index("abc-amd64", build) for _ in range(2)]
+
+    # Only built the first time, and then loaded
+    assert build.call_count == 1
+    assert indexes[0] is index
+    assert indexes[1].entries == index.entries
+    assert os.listdir(cache.path) == ["abc-amd64.index.json"]
+
+
+@pytest.fixture()
+def tree(tmp_path):
+    source = tmp_path / "source"
+    (source / "usr/bin").mkdir(parents=True)
+    (source / "usr/bin/tool").write_text("#!/bin/sh")
+    (source / "usr/bin/tool").chmod(TOOL_MODE)
+    (source / "bin").symlink_to("usr/bin")
+    (source / "usr/bin/link").symlink_to("tool")
+    os.mkfifo(source / "fifo")
+    (source / "proc").mkdir(mode=PROC_MODE)
+    os.utime(source / "usr", (USR_MTIME, USR_MTIME))
+    return source
+
+
+def test_link_tree(tmp_path, tree):
+    destination = tmp_path / "destination"
+
+    rootfs.link_tree(tree, destination)
+
+    assert (destination / "usr/bin/tool").samefile(tree / "usr/bin/tool")
+    assert (destination / "fifo").samefile(tree / "fifo")
+    assert os.readlink(destination / "bin") == "usr/bin"
+    assert os.readlink(destination / "usr/bin/link") == "tool"
+    assert (destination / "proc").stat().st_mode & 0o777 == PROC_MODE
+    assert (destination / "usr").stat().st_mtime == USR_MTIME
+
+    # Removing the new tree leaves the source alone
+    (destination / "proc").chmod(0o755)
+    for path in sorted(destination.rglob("*"), reverse=True):
+        if path.is_dir() and not path.is_symlink():
+            path.rmdir()
+        else:
+            path.unlink()
+    assert (tree / "usr/bin/tool").read_text() == "#!/bin/sh"
+
+
+def test_link_tree_cross_device(mocker, tmp_path, tree):
+    mocker.patch("os.link", side_effect=OSError(errno.EXDEV, "cross-device link"))
+    destination = tmp_path / "destination"
+
+    rootfs.link_tree(tree, destination)
+
+    tool = destination / "usr/bin/tool"
+    assert tool.read_text() == "#!/bin/sh"
+    assert not tool.samefile(tree / "usr/bin/tool")
+    assert tool.stat().st_mode & 0o777 == TOOL_MODE
+    assert Path(destination / "fifo").is_fifo()
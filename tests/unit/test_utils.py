@@ -14,12 +14,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
 from pathlib import Path
 from unittest.mock import call
 
 import pytest
 
-from rockcraft import utils
+from rockcraft import errors, utils
+
+# 2023-11-14 22:13:20 UTC
+SOURCE_DATE_EPOCH = 1700000000
 
 
 @pytest.fixture()
@@ -37,6 +41,30 @@ def mock_is_managed_mode(mocker):
     return mocker.patch("rockcraft.utils.is_managed_mode", return_value=False)
 
 
+def test_get_source_date_epoch(monkeypatch):
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", str(SOURCE_DATE_EPOCH))
+
+    assert utils.get_source_date_epoch() == SOURCE_DATE_EPOCH
+    assert utils.get_build_time() == datetime.datetime(
+        2023, 11, 14, 22, 13, 20, tzinfo=datetime.timezone.utc
+    )
+
+
+def test_get_source_date_epoch_unset(monkeypatch):
+    monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+
+    assert utils.get_source_date_epoch() is None
+    assert utils.get_build_time().tzinfo == datetime.timezone.utc
+
+
+@pytest.mark.parametrize("value", ["-1", "1.5", "yesterday"])
+def test_get_source_date_epoch_invalid(monkeypatch, value):
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", value)
+
+    with pytest.raises(errors.RockcraftError, match="Invalid value"):
+        utils.get_source_date_epoch()
+
+
 def test_get_managed_environment_home_path():
     dirpath = utils.get_managed_environment_home_path()
 
@@ -0,0 +1,35 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers to index directories like base images, for use in tests."""
+import io
+import tarfile
+from pathlib import Path
+
+from rockcraft.base_index import BaseIndex
+
+
+def index_directory(path: Path) -> BaseIndex:
+    """Index the contents of ``path`` as if it was the single layer of an image."""
+    tar_bytes = io.BytesIO()
+    with tarfile.open(fileobj=tar_bytes, mode="w") as tar_file:
+        tar_file.add(path, arcname=".")
+    tar_bytes.seek(0)
+
+    index = BaseIndex({})
+    with tarfile.open(fileobj=tar_bytes, mode="r") as tar_file:
+        index.add_layer(tar_file)
+    return index
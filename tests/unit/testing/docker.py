@@ -0,0 +1,104 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for the Docker daemon, for use in tests."""
+import io
+import json
+import socketserver
+import tarfile
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from typing import Any
+
+
+class FakeDockerDaemon:
+    """Accept Docker archives through the image loading API, over a unix socket.
+
+    The loaded archives are kept, and the images in them are reported as
+    loaded under the tags in their ``manifest.json``.
+
+    :param socket_path: The path of the unix socket to listen at.
+    """
+
+    def __init__(self, socket_path: Path) -> None:
+        self.socket_path = socket_path
+        self.archives: list[bytes] = []
+        self.error: str | None = None
+        """An error to reply with, in the JSON message stream."""
+        self.reply: bytes | None = None
+        """A body to reply with instead of the JSON message stream."""
+        self._server = _UnixHTTPServer(str(socket_path), _make_handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "FakeDockerDaemon":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def _make_handler(daemon: FakeDockerDaemon) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        """Handle the requests to the fake daemon."""
+
+        def log_message(self, *args: Any) -> None:
+            """Keep the test output clean."""
+
+        def do_POST(self) -> None:  # noqa: N802
+            if self.path != "/images/load":
+                self._send(HTTPStatus.NOT_FOUND, b'{"message": "page not found"}')
+                return
+
+            archive = self.rfile.read(int(self.headers["Content-Length"]))
+            daemon.archives.append(archive)
+            if daemon.reply is not None:
+                self._send(HTTPStatus.OK, daemon.reply)
+                return
+            if daemon.error:
+                self._send(HTTPStatus.OK, json.dumps({"error": daemon.error}).encode())
+                return
+
+            with tarfile.open(fileobj=io.BytesIO(archive)) as tar_file:
+                manifest_file = tar_file.extractfile("manifest.json")
+                manifest = json.load(manifest_file) if manifest_file else []
+            messages = [
+                {"stream": f"Loaded image: {repo_tag}\n"}
+                for image in manifest
+                for repo_tag in image["RepoTags"]
+            ]
+            self._send(HTTPStatus.OK, "\r\n".join(map(json.dumps, messages)).encode())
+
+        def _send(self, status: HTTPStatus, content: bytes) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def address_string(self) -> str:
+            """Unix sockets have no client address."""
+            return "local"
+
+    return Handler
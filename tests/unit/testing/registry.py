@@ -0,0 +1,345 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A local stand-in for an OCI image registry, for use in tests."""
+import hashlib
+import json
+import re
+import threading
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+
+from rockcraft.compression import MEDIA_TYPE_LAYER_GZIP
+from rockcraft.oci_layout import (
+    MEDIA_TYPE_CONFIG,
+    MEDIA_TYPE_INDEX,
+    MEDIA_TYPE_MANIFEST,
+)
+
+TOKEN = "fake-token"  # noqa: S105
+
+_MANIFEST_PATH = re.compile(r"^/v2/(?P<repository>.+)/manifests/(?P<reference>[^/]+)$")
+_BLOB_PATH = re.compile(r"^/v2/(?P<repository>.+)/blobs/(?P<digest>[^/]+)$")
+_UPLOADS_PATH = re.compile(r"^/v2/(?P<repository>.+)/blobs/uploads/(?P<upload>[^/]*)$")
+_RANGE = re.compile(r"^bytes=(?P<start>\d+)-$")
+_CONTENT_RANGE = re.compile(r"^(?P<start>\d+)-(?P<end>\d+)$")
+
+
+class FakeRegistry:
+    """Serve, and accept pushes of, images through the OCI distribution API.
+
+    :param require_token: Whether clients must first get an anonymous token,
+        like with ECR Public.
+    """
+
+    def __init__(self, *, require_token: bool = False) -> None:
+        self.require_token = require_token
+        self.manifests: dict[tuple[str, str], tuple[str, bytes]] = {}
+        self.blobs: dict[str, bytes] = {}
+        self.requests: list[tuple[str, str]] = []
+        self.ranges: list[str | None] = []
+        # Blobs whose next download stops after the given number of bytes.
+        self.interruptions: dict[str, int] = {}
+        # The repositories having each blob; blobs not listed are in all.
+        self.blob_repositories: dict[str, set[str]] = {}
+        # Whether to ignore requests to mount blobs from other repositories.
+        self.mounts_disabled = False
+        self.uploads: dict[str, bytearray] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def host(self) -> str:
+        """The ``host:port`` address of the registry."""
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def add_manifest(
+        self, repository: str, tag: str, manifest: dict[str, Any], media_type: str
+    ) -> str:
+        """Serve ``manifest`` by ``tag`` and by digest, returning the digest."""
+        return self.add_manifest_content(
+            repository, tag, json.dumps(manifest).encode(), media_type
+        )
+
+    def add_manifest_content(
+        self, repository: str, reference: str, content: bytes, media_type: str
+    ) -> str:
+        """Serve the exact ``content`` of a manifest, returning its digest."""
+        digest = f"sha256:{hashlib.sha256(content).hexdigest()}"
+        with self._lock:
+            self.manifests[(repository, reference)] = (media_type, content)
+            self.manifests[(repository, digest)] = (media_type, content)
+        return digest
+
+    def add_blob(self, data: bytes, repository: str | None = None) -> str:
+        """Serve ``data`` as a blob, returning its digest.
+
+        :param repository: The only repository to serve the blob in, or None
+            to serve it in all of them.
+        """
+        digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+        with self._lock:
+            self.blobs[digest] = data
+            if repository is not None:
+                self.blob_repositories.setdefault(digest, set()).add(repository)
+        return digest
+
+    def has_blob(self, repository: str, digest: str) -> bool:
+        """Whether ``repository`` has the blob with the given digest."""
+        return digest in self.blobs and repository in self.blob_repositories.get(
+            digest, {repository}
+        )
+
+    def add_image(
+        self,
+        repository: str,
+        tag: str,
+        layers: list[bytes],
+        platforms: list[tuple[str, str | None]],
+    ) -> str:
+        """Serve an image index with a manifest per platform, returning its digest.
+
+        :param layers: The content of the layers, shared by all the platforms.
+        :param platforms: The architecture and variant of each platform.
+        """
+        manifests = []
+        for architecture, variant in platforms:
+            platform = {"os": "linux", "architecture": architecture}
+            if variant:
+                platform["variant"] = variant
+            config = json.dumps({**platform, "rootfs": {"type": "layers"}}).encode()
+            manifest = {
+                "schemaVersion": 2,
+                "mediaType": MEDIA_TYPE_MANIFEST,
+                "config": self._add_descriptor(repository, MEDIA_TYPE_CONFIG, config),
+                "layers": [
+                    self._add_descriptor(repository, MEDIA_TYPE_LAYER_GZIP, layer)
+                    for layer in layers
+                ],
+            }
+            digest = self.add_manifest(
+                repository,
+                f"{tag}-{architecture}{variant or ''}",
+                manifest,
+                MEDIA_TYPE_MANIFEST,
+            )
+            content = self.manifests[(repository, digest)][1]
+            manifests.append(
+                {
+                    "mediaType": MEDIA_TYPE_MANIFEST,
+                    "digest": digest,
+                    "size": len(content),
+                    "platform": platform,
+                }
+            )
+        index = {
+            "schemaVersion": 2,
+            "mediaType": MEDIA_TYPE_INDEX,
+            "manifests": manifests,
+        }
+        return self.add_manifest(repository, tag, index, MEDIA_TYPE_INDEX)
+
+    def _add_descriptor(
+        self, repository: str, media_type: str, data: bytes
+    ) -> dict[str, Any]:
+        return {
+            "mediaType": media_type,
+            "digest": self.add_blob(data, repository),
+            "size": len(data),
+        }
+
+    def __enter__(self) -> "FakeRegistry":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def _make_handler(registry: FakeRegistry) -> type[BaseHTTPRequestHandler]:
+    class Handler(BaseHTTPRequestHandler):
+        """Handle the requests to the fake registry."""
+
+        def log_message(self, *args: Any) -> None:
+            """Keep the test output clean."""
+
+        def do_HEAD(self) -> None:  # noqa: N802
+            self._handle(send_body=False)
+
+        def do_GET(self) -> None:  # noqa: N802
+            self._handle(send_body=True)
+
+        def do_POST(self) -> None:  # noqa: N802
+            if not self._authorize():
+                return
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            match = _UPLOADS_PATH.match(url.path)
+            if match is None or match["upload"]:
+                self._send(HTTPStatus.NOT_FOUND, b"", {})
+                return
+            repository = match["repository"]
+            if "mount" in query and not registry.mounts_disabled:
+                digest = query["mount"][0]
+                if registry.has_blob(query["from"][0], digest):
+                    registry.add_blob(registry.blobs[digest], repository)
+                    self._send(HTTPStatus.CREATED, b"", {})
+                    return
+            upload = uuid.uuid4().hex
+            registry.uploads[upload] = bytearray()
+            location = f"/v2/{repository}/blobs/uploads/{upload}"
+            self._send(HTTPStatus.ACCEPTED, b"", {"Location": location})
+
+        def do_PATCH(self) -> None:  # noqa: N802
+            if not self._authorize():
+                return
+            url = urlsplit(self.path)
+            match = _UPLOADS_PATH.match(url.path)
+            if match is None or match["upload"] not in registry.uploads:
+                self._send(HTTPStatus.NOT_FOUND, b"", {})
+                return
+            data = registry.uploads[match["upload"]]
+            content_range = _CONTENT_RANGE.match(self.headers["Content-Range"])
+            if content_range is None or int(content_range["start"]) != len(data):
+                self._send(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, b"", {})
+                return
+            data += self._read_body()
+            self._send(HTTPStatus.ACCEPTED, b"", {"Location": url.path})
+
+        def do_PUT(self) -> None:  # noqa: N802
+            if not self._authorize():
+                return
+            url = urlsplit(self.path)
+            body = self._read_body()
+            if match := _MANIFEST_PATH.match(url.path):
+                registry.add_manifest_content(
+                    match["repository"],
+                    match["reference"],
+                    body,
+                    self.headers["Content-Type"],
+                )
+                self._send(HTTPStatus.CREATED, b"", {})
+                return
+            match = _UPLOADS_PATH.match(url.path)
+            if match is None or match["upload"] not in registry.uploads:
+                self._send(HTTPStatus.NOT_FOUND, b"", {})
+                return
+            data = registry.uploads.pop(match["upload"]) + body
+            digest = parse_qs(url.query)["digest"][0]
+            if digest != f"sha256:{hashlib.sha256(data).hexdigest()}":
+                self._send(HTTPStatus.BAD_REQUEST, b"", {})
+                return
+            registry.add_blob(bytes(data), match["repository"])
+            self._send(HTTPStatus.CREATED, b"", {})
+
+        def _read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def _authorize(self) -> bool:
+            """Record the request, and check that it is authorized."""
+            registry.requests.append((self.command, self.path))
+
+            if self.path.startswith("/token"):
+                self._send(HTTPStatus.OK, json.dumps({"token": TOKEN}).encode(), {})
+                return False
+
+            if (
+                registry.require_token
+                and self.headers.get("Authorization") != f"Bearer {TOKEN}"
+            ):
+                realm = f"http://{registry.host}/token"
+                self._send(
+                    HTTPStatus.UNAUTHORIZED,
+                    b"",
+                    {"WWW-Authenticate": f'Bearer realm="{realm}",service="fake"'},
+                )
+                return False
+            return True
+
+        def _handle(self, *, send_body: bool) -> None:
+            if not self._authorize():
+                return
+
+            if match := _MANIFEST_PATH.match(self.path):
+                key = (match["repository"], match["reference"])
+                if key in registry.manifests:
+                    media_type, content = registry.manifests[key]
+                    digest = f"sha256:{hashlib.sha256(content).hexdigest()}"
+                    headers = {
+                        "Content-Type": media_type,
+                        "Docker-Content-Digest": digest,
+                    }
+                    self._send(HTTPStatus.OK, content, headers, send_body=send_body)
+                    return
+            elif match := _BLOB_PATH.match(self.path):
+                if registry.has_blob(match["repository"], match["digest"]):
+                    self._send_blob(match["digest"], send_body=send_body)
+                    return
+
+            self._send(HTTPStatus.NOT_FOUND, b"", {})
+
+        def _send_blob(self, digest: str, *, send_body: bool) -> None:
+            content = registry.blobs[digest]
+            status = HTTPStatus.OK
+            headers = {}
+            requested_range = self.headers.get("Range")
+            registry.ranges.append(requested_range)
+            if requested_range and (match := _RANGE.match(requested_range)):
+                start = int(match["start"])
+                status = HTTPStatus.PARTIAL_CONTENT
+                headers[
+                    "Content-Range"
+                ] = f"bytes {start}-{len(content) - 1}/{len(content)}"
+                content = content[start:]
+
+            interruption = registry.interruptions.pop(digest, None)
+            if interruption is None or not send_body:
+                self._send(status, content, headers, send_body=send_body)
+                return
+            # Promise the whole content, but close the connection midway.
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content[:interruption])
+            self.wfile.flush()
+            self.close_connection = True
+
+        def _send(
+            self,
+            status: HTTPStatus,
+            content: bytes,
+            headers: dict[str, str],
+            *,
+            send_body: bool = True,
+        ) -> None:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(content)
+
+    return Handler
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the compression of layer tarballs.
+
+The layer is either the archive of a directory (e.g. the prime dir of a rock
+like the one in tests/spread/general/big, or an extracted Ubuntu base) or a
+synthetic payload mixing compressible and incompressible data. It is
+compressed with the single-threaded gzip writer and with the parallel gzip
+writer, for each requested number of threads.
+
+Usage: layer_compression.py [--dir DIR | --size-mb N] [--threads 2,4,8]
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(script_dir, "../../"))
+
+from rockcraft import compression, layers  # noqa: E402
+
+# The share of the synthetic payload that is incompressible, like binaries
+# among text files.
+RANDOM_CHUNK_RATIO = 0.3
+
+
+class _NullSink:
+    """Count and discard the compressed output."""
+
+    def __init__(self) -> None:
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        return len(data)
+
+
+def _synthetic_payload(size: int) -> bytes:
+    rng = random.Random(0)
+    text = b"".join(
+        b"/usr/lib/python3/dist-packages/module_%d.py: def function_%d(): pass\n"
+        % (i, i)
+        for i in range(2000)
+    )
+    chunks = []
+    while size > 0:
+        if rng.random() < RANDOM_CHUNK_RATIO:
+            chunk = rng.randbytes(min(size, 64 * 1024))
+        else:
+            chunk = text[: min(size, len(text))]
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _directory_payload(directory: Path) -> bytes:
+    stream = io.BytesIO()
+    layers.archive_layer(directory, stream)
+    return stream.getvalue()
+
+
+def _run(writer: compression.LayerWriter, payload: bytes) -> float:
+    view = memoryview(payload)
+    start = time.perf_counter()
+    with writer:
+        for offset in range(0, len(payload), 10240):
+            writer.write(view[offset : offset + 10240])
+        writer.finish()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--dir", type=Path, help="Directory to archive as the layer")
+    group.add_argument("--size-mb", type=int, default=512, help="Synthetic size")
+    parser.add_argument(
+        "--threads",
+        default=f"2,4,{len(os.sched_getaffinity(0))}",
+        help="Comma-separated thread counts for the parallel writer",
+    )
+    args = parser.parse_args()
+
+    if args.dir:
+        payload = _directory_payload(args.dir)
+    else:
+        payload = _synthetic_payload(args.size_mb * 1024 * 1024)
+    size_mb = len(payload) / (1024 * 1024)
+    print(f"Payload: {size_mb:.1f} MiB uncompressed")
+
+    sink = _NullSink()
+    elapsed = _run(compression.GzipLayerWriter(sink), payload)
+    print(
+        f"gzip (1 thread):       {elapsed:7.2f}s {size_mb / elapsed:8.1f} MiB/s "
+        f"-> {sink.size / (1024 * 1024):.1f} MiB"
+    )
+
+    for threads in sorted({int(t) for t in args.threads.split(",")}):
+        sink = _NullSink()
+        writer = compression.ParallelGzipLayerWriter(sink, threads=threads)
+        elapsed = _run(writer, payload)
+        print(
+            f"pgzip ({threads:2} threads):    {elapsed:7.2f}s "
+            f"{size_mb / elapsed:8.1f} MiB/s -> {sink.size / (1024 * 1024):.1f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()